@@ -0,0 +1,93 @@
+"""
+Benchmark finding the changes of a build step in a rootfs: the naive
+way, walking and hashing the whole tree before and after the step,
+against `pkgbox.diff` stat snapshots.
+
+The rootfs is generated as by `bench_snapshot.py` and the step
+modifies, adds and deletes a few files.
+
+Usage: python bench/bench_diff.py [--files N] [--workers N]
+"""
+import os
+import sys
+import time
+import shutil
+import hashlib
+import pathlib
+import argparse
+import tempfile
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.realpath(__file__)))
+
+from bench_snapshot import generate
+
+from pkgbox import diff
+
+
+def hashes(root: pathlib.Path) -> dict:
+    """
+    Return the digest of every file of a tree, by path.
+    """
+    digests = {}
+    for dirpath, dirs, files in os.walk(root):
+        for name in files:
+            path = os.path.join(dirpath, name)
+            with open(path, 'rb') as f:
+                digests[os.path.relpath(path, root)] = hashlib.sha256(f.read()).digest()
+    return digests
+
+
+def step(root: pathlib.Path) -> None:
+    for i in range(0, 1000, 100):
+        (root / 'usr' / 'd0' / f'd{i // 100}' / f'f{i}').write_bytes(b'modified')
+    (root / 'usr' / 'd0' / 'd1' / 'new').write_bytes(b'added')
+    shutil.rmtree(root / 'usr' / 'd0' / 'd2')
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--files', type=int, default=50000)
+    parser.add_argument('--workers', type=int, default=diff.DEFAULT_WORKERS)
+    args = parser.parse_args()
+
+    work = pathlib.Path(tempfile.mkdtemp(prefix='pkgbox-bench-'))
+    try:
+        root = work / 'rootfs'
+        generate(root, args.files)
+        print(f'rootfs: {args.files} files')
+
+        started = time.perf_counter()
+        before = hashes(root)
+        naive_before = time.perf_counter() - started
+        snap = diff.record(root, work / 'before', args.workers)
+        record = time.perf_counter() - started - naive_before
+
+        step(root)
+
+        started = time.perf_counter()
+        after = hashes(root)
+        changed = sorted(set(before.items()) ^ set(after.items()))
+        naive_after = time.perf_counter() - started
+
+        started = time.perf_counter()
+        changes = list(diff.diff(snap, root, workers=args.workers))
+        elapsed = time.perf_counter() - started
+
+        # again, traced (and slower) for its memory usage
+        tracemalloc.start()
+        list(diff.diff(snap, root, workers=args.workers))
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+        print(f'naive:      before {naive_before * 1000:6.0f} ms, after {naive_after * 1000:6.0f} ms '
+              f'({len({p for p, _ in changed})} files)')
+        print(f'pkgbox.diff: record {record * 1000:6.0f} ms, diff  {elapsed * 1000:6.0f} ms '
+              f'({len(changes)} changes, {os.path.getsize(work / "before") / 1024:.0f} KiB snapshot, '
+              f'{peak / 1024 / 1024:.1f} MiB peak memory)')
+    finally:
+        shutil.rmtree(work)
+
+
+if __name__ == '__main__':
+    main()
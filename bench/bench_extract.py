@@ -0,0 +1,91 @@
+"""
+Benchmark getting layers extracted: downloading each blob then
+extracting it from the store vs extracting it while it is downloaded,
+against a local stand-in registry.
+
+Usage: python bench/bench_extract.py [--layers N] [--files N] [--size BYTES]
+"""
+import io
+import os
+import sys
+import time
+import shutil
+import pathlib
+import tarfile
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.realpath(__file__)))
+
+from registry import Registry
+
+from pkgbox import extract, image
+from pkgbox.store import BlobStore
+
+
+def layer(files: int, size: int) -> bytes:
+    """
+    Return a gzipped tar layer of `files` half compressible files.
+    """
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode='w:gz') as tar:
+        for i in range(files):
+            data = os.urandom(size // 2) + bytes(size // 2)
+            info = tarfile.TarInfo(f'usr/share/bench/{i}')
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+    return buf.getvalue()
+
+
+def run(ref: str, tee: bool) -> float:
+    """
+    Get every layer of `ref` extracted into a fresh directory and
+    return the elapsed time.
+    """
+    dest = pathlib.Path(tempfile.mkdtemp(prefix='pkgbox-bench-'))
+    try:
+        img = image.from_str(ref)
+        manifest = image.info(img)
+        store = BlobStore(dest / 'store')
+        layers = extract.LayerDirs(dest / 'layers')
+        started = time.perf_counter()
+        for desc in manifest.layers:
+            if tee:
+                extract.unpack(img, desc, store, layers)
+                continue
+            image.fetch_layer(img, desc, store)
+            with layers.extractor(desc) as x, open(store.path(desc), 'rb') as f:
+                while (chunk := f.read(extract.READ_SIZE)):
+                    x.write(chunk)
+                x.commit()
+        return time.perf_counter() - started
+    finally:
+        shutil.rmtree(dest)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--layers', type=int, default=4)
+    parser.add_argument('--files', type=int, default=64)
+    parser.add_argument('--size', type=int, default=256 * 1024)
+    parser.add_argument('--latency', type=float, default=0.05)
+    parser.add_argument('--bandwidth', type=int, default=32 * 1024 * 1024)
+    args = parser.parse_args()
+
+    with Registry(latency=args.latency, bandwidth=args.bandwidth) as registry:
+        blobs = [layer(args.files, args.size) for _ in range(args.layers)]
+        ref = registry.add_image('bench/extract', 'latest', blobs)
+        os.environ['PKGBOX_INSECURE_REGISTRIES'] = registry.address
+
+        sequential = run(ref, tee=False)
+        streaming = run(ref, tee=True)
+
+    total = sum(map(len, blobs)) / (1024 * 1024)
+    print(f'layers: {args.layers} x {args.files} files ({total:.1f} MiB compressed)')
+    print(f'download then extract: {sequential:.3f}s')
+    print(f'extract while downloading: {streaming:.3f}s')
+    print(f'speedup: {sequential / streaming:.2f}x')
+
+
+if __name__ == '__main__':
+    main()
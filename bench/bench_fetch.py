@@ -0,0 +1,63 @@
+"""
+Benchmark sequential vs concurrent `image.fetch` against a local
+stand-in registry.
+
+Usage: python bench/bench_fetch.py [--layers N] [--size BYTES] [--workers N]
+"""
+import os
+import sys
+import time
+import shutil
+import pathlib
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.realpath(__file__)))
+
+from registry import Registry
+
+from pkgbox import image
+from pkgbox.store import BlobStore
+
+
+def run(ref: str, workers: int) -> float:
+    """
+    Fetch `ref` into a fresh directory and return the elapsed time.
+    """
+    dest = pathlib.Path(tempfile.mkdtemp(prefix='pkgbox-bench-'))
+    try:
+        img = image.from_str(ref)
+        manifest = image.info(img)
+        started = time.perf_counter()
+        image.fetch(img, manifest, BlobStore(dest), workers=workers)
+        return time.perf_counter() - started
+    finally:
+        shutil.rmtree(dest)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--layers', type=int, default=16)
+    parser.add_argument('--size', type=int, default=4 * 1024 * 1024)
+    parser.add_argument('--workers', type=int, default=image.DEFAULT_WORKERS)
+    parser.add_argument('--latency', type=float, default=0.05)
+    parser.add_argument('--bandwidth', type=int, default=32 * 1024 * 1024)
+    args = parser.parse_args()
+
+    with Registry(latency=args.latency, bandwidth=args.bandwidth) as registry:
+        layers = [os.urandom(args.size) for _ in range(args.layers)]
+        ref = registry.add_image('bench/fetch', 'latest', layers)
+        os.environ['PKGBOX_INSECURE_REGISTRIES'] = registry.address
+
+        sequential = run(ref, 1)
+        concurrent = run(ref, args.workers)
+
+    total = args.layers * args.size / (1024 * 1024)
+    print(f'layers: {args.layers} x {args.size} bytes ({total:.1f} MiB)')
+    print(f'sequential: {sequential:.3f}s ({total / sequential:.1f} MiB/s)')
+    print(f'concurrent ({args.workers} workers): {concurrent:.3f}s ({total / concurrent:.1f} MiB/s)')
+    print(f'speedup: {sequential / concurrent:.2f}x')
+
+
+if __name__ == '__main__':
+    main()
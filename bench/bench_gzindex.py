@@ -0,0 +1,88 @@
+"""
+Benchmark reading one file of a big cached layer: streaming the layer
+up to the file vs reading it through the layer index, which
+decompresses at most `gzindex.SPAN` bytes.
+
+Usage: python bench/bench_gzindex.py [--files N] [--size BYTES] [--reads N]
+"""
+import io
+import os
+import time
+import gzip
+import random
+import shutil
+import pathlib
+import tarfile
+import argparse
+import tempfile
+
+from pkgbox import gzindex
+
+
+def layer(path: pathlib.Path, files: int, size: int) -> None:
+    """
+    Write a gzipped tar layer of `files` half compressible files.
+    """
+    with gzip.open(path, 'wb', compresslevel=1) as f, tarfile.open(fileobj=f, mode='w|') as tar:
+        for i in range(files):
+            data = os.urandom(size // 2) + bytes(size // 2)
+            info = tarfile.TarInfo(f'usr/share/bench/{i}')
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+
+
+def stream(path: pathlib.Path, name: str) -> bytes:
+    """
+    Read a file by streaming the layer up to it.
+    """
+    with tarfile.open(path, mode='r|gz') as tar:
+        for member in tar:
+            if member.name == name:
+                return tar.extractfile(member).read()
+    raise KeyError(name)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--files', type=int, default=2000)
+    parser.add_argument('--size', type=int, default=128 * 1024)
+    parser.add_argument('--reads', type=int, default=5)
+    args = parser.parse_args()
+
+    work = pathlib.Path(tempfile.mkdtemp(prefix='pkgbox-bench-'))
+    try:
+        blob = work / 'layer.tar.gz'
+        layer(blob, args.files, args.size)
+
+        started = time.perf_counter()
+        index = gzindex.build(blob)
+        index.save(work / 'layer.idx')
+        build_time = time.perf_counter() - started
+
+        names = random.Random(0).sample([m.name for m in index.members], args.reads)
+        started = time.perf_counter()
+        expected = [stream(blob, name) for name in names]
+        stream_time = (time.perf_counter() - started) / args.reads
+
+        started = time.perf_counter()
+        got = []
+        for name in names:
+            index = gzindex.Index.load(work / 'layer.idx')
+            got.append(b''.join(index.read(blob, index.find(name))))
+        index_time = (time.perf_counter() - started) / args.reads
+        assert got == expected
+
+        blob_size, index_size = blob.stat().st_size, (work / 'layer.idx').stat().st_size
+    finally:
+        shutil.rmtree(work)
+
+    mib = 1024 * 1024
+    print(f'layer: {args.files} files, {args.files * args.size / mib:.0f} MiB, {blob_size / mib:.1f} MiB gzipped')
+    print(f'index: built in {build_time:.3f}s, {len(index.points)} checkpoints, {index_size / 1024:.0f} KiB')
+    print(f'stream: {stream_time * 1000:.1f} ms per file')
+    print(f'index: {index_time * 1000:.1f} ms per file (index load included)')
+    print(f'speedup: {stream_time / index_time:.1f}x')
+
+
+if __name__ == '__main__':
+    main()
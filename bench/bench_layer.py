@@ -0,0 +1,84 @@
+"""
+Benchmark writing a layer of a rootfs into the blob store with
+`pkgbox.layer.write`, gzip with 1 and `--workers` threads and zstd,
+against the usual two pass way: `tarfile` with gzip compression into a
+temporary file, then copied into the store while hashing it.
+
+The rootfs is generated like for `bench_snapshot.py`, with files
+compressing about as well as binaries and packages.
+
+Usage: python bench/bench_layer.py [--files N] [--workers N] [--dir PATH]
+"""
+import os
+import time
+import shutil
+import pathlib
+import tarfile
+import argparse
+import tempfile
+
+from pkgbox import layer
+from pkgbox.store import BlobStore
+
+
+def generate(root: pathlib.Path, files: int) -> int:
+    """
+    Generate a rootfs of `files` files, a quarter random and the rest
+    text like, and return its size in bytes.
+    """
+    words = [os.urandom(4).hex().encode() for _ in range(512)]
+    total = 0
+    for i in range(files):
+        d = root / 'usr' / f'd{i // 100}'
+        if i % 100 == 0:
+            os.makedirs(d)
+        size = 4096 * (1 + i % 64)
+        text = b' '.join(words[(i * 7 + j) % len(words)] for j in range(size // 12))
+        (d / f'f{i}').write_bytes(os.urandom(size // 4) + text[:size - size // 4])
+        total += size
+    return total
+
+
+def two_pass(store: BlobStore, root: pathlib.Path, tmp: pathlib.Path) -> int:
+    with tarfile.open(tmp, mode='w:gz', compresslevel=layer.DEFAULT_GZIP_LEVEL, format=tarfile.PAX_FORMAT) as tar:
+        tar.add(root, arcname='.')
+    with store.new_writer() as w, open(tmp, 'rb') as f:
+        while (chunk := f.read(1024 * 1024)):
+            w.write(chunk)
+        w.commit()
+    os.unlink(tmp)
+    return w.size
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--files', type=int, default=5000)
+    parser.add_argument('--workers', type=int, default=layer.DEFAULT_WORKERS)
+    parser.add_argument('--dir', type=pathlib.Path, default=None)
+    args = parser.parse_args()
+
+    mib = 1024 * 1024
+    work = pathlib.Path(tempfile.mkdtemp(prefix='pkgbox-bench-', dir=args.dir))
+    try:
+        size = generate(work / 'rootfs', args.files)
+        print(f'rootfs: {args.files} files, {size / mib:.0f} MiB, {os.cpu_count()} cpus')
+        store = BlobStore(work / 'store')
+
+        started = time.perf_counter()
+        blob = two_pass(store, work / 'rootfs', work / 'layer.tar.gz')
+        baseline = time.perf_counter() - started
+        print(f'{"tarfile + copy":16} {baseline * 1000:8.0f} ms {blob / mib:8.1f} MiB')
+
+        for compression, workers in [('gzip', 1), ('gzip', args.workers), ('zstd', args.workers)]:
+            started = time.perf_counter()
+            lay = layer.write(store, work / 'rootfs', layer.changes(work / 'rootfs'), compression, workers=workers)
+            elapsed = time.perf_counter() - started
+            name = f'{compression} x{workers}'
+            print(f'{name:16} {elapsed * 1000:8.0f} ms {lay.descriptor.size / mib:8.1f} MiB '
+                  f'({size / mib / elapsed:.0f} MiB/s, {baseline / elapsed:.1f}x faster)')
+    finally:
+        shutil.rmtree(work)
+
+
+if __name__ == '__main__':
+    main()
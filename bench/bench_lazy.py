@@ -0,0 +1,141 @@
+"""
+Benchmark reading a few files of an image from a slow local stand-in
+registry: downloading its layers first vs reading them lazily with
+range requests (see `pkgbox.lazy`), for eStargz and plain gzip layers,
+and a second lazy run prefetching the access profile of the first.
+
+Usage: python bench/bench_lazy.py [--files N] [--size BYTES] [--reads N]
+"""
+import io
+import os
+import sys
+import gzip
+import json
+import time
+import random
+import shutil
+import struct
+import pathlib
+import tarfile
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.realpath(__file__)))
+
+from registry import Registry
+
+from pkgbox import gzindex, image, lazy
+from pkgbox.store import BlobStore
+
+
+def files(count: int, size: int) -> dict:
+    """
+    Return `count` half compressible files of `size` bytes.
+    """
+    return {f'usr/share/bench/{i}': os.urandom(size // 2) + bytes(size // 2) for i in range(count)}
+
+
+def targz(content: dict) -> bytes:
+    """
+    Return a gzipped tar layer of the given files.
+    """
+    buf = io.BytesIO()
+    with gzip.GzipFile(fileobj=buf, mode='wb', compresslevel=1) as f, tarfile.open(fileobj=f, mode='w|') as tar:
+        for name, data in content.items():
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+    return buf.getvalue()
+
+
+def estargz(content: dict) -> bytes:
+    """
+    Return an eStargz layer of the given files: each file content starts
+    a gzip member, followed by the table of contents and the footer.
+    """
+    out, pending, entries = bytearray(), bytearray(), []
+    for name, data in content.items():
+        info = tarfile.TarInfo(name)
+        info.size = len(data)
+        out += gzip.compress(bytes(pending) + info.tobuf(tarfile.GNU_FORMAT), compresslevel=1)
+        entries.append({'name': name, 'type': 'reg', 'size': len(data), 'offset': len(out)})
+        pending = bytearray(data + bytes(-len(data) % tarfile.BLOCKSIZE))
+    out += gzip.compress(bytes(pending), compresslevel=1)
+
+    toc = json.dumps({'version': 1, 'entries': entries}).encode()
+    info = tarfile.TarInfo(lazy.TOC_NAME)
+    info.size = len(toc)
+    offset = len(out)
+    out += gzip.compress(info.tobuf(tarfile.GNU_FORMAT) + toc + bytes(-len(toc) % tarfile.BLOCKSIZE))
+    extra = b'SG' + struct.pack('<H', 22) + b'%016xSTARGZ' % offset
+    out += b'\x1f\x8b\x08\x04\0\0\0\0\0\xff' + struct.pack('<H', len(extra)) + extra
+    out += b'\x01\x00\x00\xff\xff' + bytes(8)
+    return bytes(out)
+
+
+def run(registry: Registry, ref: str, names: list, mode: str, work: pathlib.Path) -> tuple:
+    """
+    Read `names` from the image and return the elapsed time, the time to
+    the first file and the bytes sent by the registry.
+    """
+    sent = registry.sent
+    started = time.perf_counter()
+    img = image.from_str(ref)
+    manifest = image.info(img)
+    store = BlobStore(work / 'store')
+
+    if mode == 'full':
+        image.fetch(img, manifest, store)
+        reader = gzindex.Files(manifest, store)
+    else:
+        reader = lazy.fetch(img, manifest, store, lazy.Profile(work / 'profile'))
+
+    first = None
+    for name in names:
+        b''.join(reader.read(name))
+        first = first or time.perf_counter() - started
+    if mode != 'full':
+        reader.close()
+
+    return time.perf_counter() - started, first, registry.sent - sent
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--files', type=int, default=400)
+    parser.add_argument('--size', type=int, default=256 * 1024)
+    parser.add_argument('--reads', type=int, default=8)
+    parser.add_argument('--latency', type=float, default=0.02)
+    parser.add_argument('--bandwidth', type=int, default=32 * 1024 * 1024)
+    args = parser.parse_args()
+
+    content = files(args.files, args.size)
+    names = random.Random(0).sample(sorted(content), args.reads)
+    results = []
+
+    with Registry(latency=args.latency, bandwidth=args.bandwidth) as registry:
+        refs = {
+            'gzip': registry.add_image('bench/lazy-gzip', 'latest', [targz(content)]),
+            'estargz': registry.add_image('bench/lazy-estargz', 'latest', [estargz(content)]),
+        }
+        os.environ['PKGBOX_INSECURE_REGISTRIES'] = registry.address
+
+        for label, ref, modes in [('full fetch', refs['gzip'], ['full']),
+                                  ('lazy gzip', refs['gzip'], ['lazy', 'lazy']),
+                                  ('lazy estargz', refs['estargz'], ['lazy', 'lazy'])]:
+            work = pathlib.Path(tempfile.mkdtemp(prefix='pkgbox-bench-'))
+            try:
+                for n, mode in enumerate(modes):
+                    results.append((label + (' (profiled)' if n else ''), *run(registry, ref, names, mode, work)))
+            finally:
+                shutil.rmtree(work)
+
+    mib = 1024 * 1024
+    print(f'layer: {args.files} files, {args.files * args.size / mib:.0f} MiB, reading {args.reads} files')
+    for label, elapsed, first, sent in results:
+        print(f'{label:>24}: {elapsed * 1000:7.0f} ms, first file {first * 1000:7.0f} ms, {sent / mib:7.1f} MiB sent')
+    print(f'speedup (estargz, first run): {results[0][1] / results[3][1]:.1f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,116 @@
+"""
+Benchmark the native Containerfile parser against the previous
+`dockerfile_parse` based path on large generated Containerfiles.
+
+Usage: python bench/bench_parse.py [--instructions N] [--rounds N]
+"""
+import io
+import time
+import random
+import hashlib
+import argparse
+
+from pkgbox import containerfile, parser
+
+
+def generate(count: int, seed: int = 0) -> str:
+    """
+    Generate a Containerfile with about `count` instructions.
+    """
+    rnd = random.Random(seed)
+    lines = ['# syntax=docker/dockerfile:1', 'ARG BASE=fedora', 'FROM registry.fedoraproject.org/${BASE}:39']
+
+    for i in range(count):
+        kind = rnd.choice(['LABEL', 'ENV', 'ARG', 'RUN', 'RUN', 'COPY', 'COMMENT'])
+        if kind == 'LABEL':
+            lines.append(f'LABEL org.pkgbox.key{i}="value {i}" other{i}=${{BASE}}')
+        elif kind == 'ENV':
+            lines.append(f'ENV VAR{i}=/opt/$BASE/{i} PATH="/opt/{i}:$PATH"')
+        elif kind == 'ARG':
+            lines.append(f'ARG ARG{i}={i}')
+        elif kind == 'RUN':
+            lines.append(f'RUN dnf install -y \\\n    pkg{i}-a \\\n    pkg{i}-b \\\n  && make -C /src/{i}')
+        elif kind == 'COPY':
+            lines.append(f'COPY src/{i} /opt/app/{i}')
+        else:
+            lines.append(f'# step {i}')
+
+    lines.append('CMD ["/bin/bash"]')
+
+    return '\n'.join(lines) + '\n'
+
+
+def legacy(content: str) -> dict:
+    """
+    The `as_dict` code path based on `dockerfile_parse`, where each
+    property parses the content again (with raw instruction digests).
+    """
+    from dockerfile_parse import DockerfileParser
+
+    p = DockerfileParser(fileobj=io.BytesIO(content.encode()), cache_content=True)
+
+    items = [
+        {'name': i['instruction'], 'value': i['value'],
+         'digest': 'sha256:' + hashlib.sha256(f'{i["instruction"]} {i["value"]}'.encode()).hexdigest()}
+        for i in p.structure
+    ]
+    digest = ''.join(i['digest'].split(':')[1] for i in items)
+
+    return {
+        'from': p.baseimage,
+        'labels': p.labels,
+        'envs': p.envs,
+        'cmd': p.cmd,
+        'args': p.args,
+        'build_args': p.build_args,
+        'instructions': {
+            'digest': 'sha256:' + hashlib.sha256(digest.encode()).hexdigest(),
+            'items': items
+        }
+    }
+
+
+def native(content: str) -> dict:
+    """
+    The current `as_dict` code path.
+    """
+    return containerfile.as_dict(parser.parse(content))
+
+
+def timeit(fn, content: str, rounds: int) -> float:
+    best = float('inf')
+    for _ in range(rounds):
+        started = time.perf_counter()
+        fn(content)
+        best = min(best, time.perf_counter() - started)
+    return best
+
+
+def main() -> None:
+    args = argparse.ArgumentParser(description=__doc__)
+    args.add_argument('--instructions', type=int, default=2000)
+    args.add_argument('--rounds', type=int, default=5)
+    opts = args.parse_args()
+
+    content = generate(opts.instructions)
+    new = timeit(native, content, opts.rounds)
+    print(f'instructions: {opts.instructions} ({len(content)} bytes)')
+    print(f'native: {new * 1000:.1f}ms')
+
+    try:
+        old = timeit(legacy, content, opts.rounds)
+    except ImportError:
+        print('dockerfile_parse not installed, skipping the legacy path')
+        return
+
+    old_data, new_data = legacy(content), native(content)
+    for key in ('from', 'labels', 'envs', 'cmd', 'args', 'build_args'):
+        assert old_data[key] == new_data[key], f'parsers output differ on "{key}"'
+    assert [(i['name'], i['value']) for i in old_data['instructions']['items']] == \
+        [(i['name'], i['value']) for i in new_data['instructions']['items']], 'parsers output differ'
+    print(f'dockerfile_parse: {old * 1000:.1f}ms')
+    print(f'speedup: {old / new:.2f}x')
+
+
+if __name__ == '__main__':
+    main()
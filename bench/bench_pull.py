@@ -0,0 +1,77 @@
+"""
+Benchmark pulling many images sharing layers, one `image.fetch` per
+image vs a single deduplicated `pull.pull`, against a local stand-in
+registry.
+
+Usage: python bench/bench_pull.py [--images N] [--shared N] [--own N] [--size BYTES]
+"""
+import os
+import sys
+import time
+import shutil
+import pathlib
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.realpath(__file__)))
+
+from registry import Registry
+
+from pkgbox import image, pull
+from pkgbox.store import BlobStore
+
+
+def per_image(refs, workers: int) -> float:
+    """
+    Fetch every image on its own, each into a fresh store, as separate
+    pulls on different nodes would, and return the elapsed time.
+    """
+    started = time.perf_counter()
+    for ref in refs:
+        dest = pathlib.Path(tempfile.mkdtemp(prefix='pkgbox-bench-'))
+        try:
+            img = image.from_str(ref)
+            image.fetch(img, image.info(img), BlobStore(dest), workers=workers)
+        finally:
+            shutil.rmtree(dest)
+    return time.perf_counter() - started
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--images', type=int, default=8)
+    parser.add_argument('--shared', type=int, default=4)
+    parser.add_argument('--own', type=int, default=1)
+    parser.add_argument('--size', type=int, default=2 * 1024 * 1024)
+    parser.add_argument('--workers', type=int, default=image.DEFAULT_WORKERS)
+    parser.add_argument('--latency', type=float, default=0.05)
+    parser.add_argument('--bandwidth', type=int, default=32 * 1024 * 1024)
+    args = parser.parse_args()
+
+    with Registry(latency=args.latency, bandwidth=args.bandwidth) as registry:
+        shared = [os.urandom(args.size) for _ in range(args.shared)]
+        refs = [
+            registry.add_image(f'bench/pull-{i}', 'latest', shared + [os.urandom(args.size) for _ in range(args.own)])
+            for i in range(args.images)
+        ]
+        os.environ['PKGBOX_INSECURE_REGISTRIES'] = registry.address
+
+        separate = per_image(refs, args.workers)
+
+        dest = pathlib.Path(tempfile.mkdtemp(prefix='pkgbox-bench-'))
+        try:
+            summary = pull.pull(refs, BlobStore(dest), workers=args.workers)
+        finally:
+            shutil.rmtree(dest)
+
+    mib = 1024 * 1024
+    print(f'images: {args.images} x ({args.shared} shared + {args.own} own) layers of {args.size} bytes')
+    print(f'per image: {separate:.3f}s')
+    print(f'pull: {summary.elapsed:.3f}s ({summary.throughput / mib:.1f} MiB/s), '
+          f'{summary.downloaded} of {summary.references} layers downloaded, '
+          f'{summary.saved_bytes / mib:.1f} MiB saved')
+    print(f'speedup: {separate / summary.elapsed:.2f}x')
+
+
+if __name__ == '__main__':
+    main()
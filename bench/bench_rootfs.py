@@ -0,0 +1,119 @@
+"""
+Benchmark rootfs assembly: applying every layer in order vs
+`rootfs.assemble`, which only extracts the surviving entries.
+
+The image is made of a base layer and upper layers each overwriting
+and deleting a share of the base files.
+
+Usage: python bench/bench_rootfs.py [--files N] [--size BYTES] [--layers N] [--churn RATIO] [--rounds N]
+"""
+import io
+import os
+import time
+import gzip
+import random
+import shutil
+import hashlib
+import pathlib
+import tarfile
+import argparse
+import tempfile
+from typing import List, Tuple
+
+from pkgbox import extract, rootfs
+from pkgbox.oci.v1 import Descriptor, Manifest
+from pkgbox.store import BlobStore
+
+
+def layer(files: List[Tuple[str, int]], whiteouts: List[str] = ()) -> bytes:
+    """
+    Return a gzipped tar layer of (name, size) files and whiteouts.
+    """
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode='w') as tar:
+        for name in whiteouts:
+            head, _, base = name.rpartition('/')
+            tar.addfile(tarfile.TarInfo(f'{head}/{extract.WHITEOUT_PREFIX}{base}'))
+        for name, size in files:
+            data = os.urandom(size // 2) + bytes(size - size // 2)
+            info = tarfile.TarInfo(name)
+            info.size = size
+            tar.addfile(info, io.BytesIO(data))
+    return gzip.compress(buf.getvalue(), compresslevel=1)
+
+
+def naive(blobs: List[pathlib.Path], dest: pathlib.Path) -> int:
+    """
+    Apply layers one after the other, returning the bytes written.
+    """
+    written = 0
+    for blob in blobs:
+        with extract.open_blob(blob) as f, tarfile.open(fileobj=f, mode='r|') as tar:
+            for member in tar:
+                name = extract._clean(member.name)
+                head, _, base = name.rpartition('/')
+                if base.startswith(extract.WHITEOUT_PREFIX):
+                    path = extract._resolve(str(dest), f'{head}/{base[len(extract.WHITEOUT_PREFIX):]}')
+                    extract._remove(path)
+                    continue
+                path = extract._resolve(str(dest), name)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                extract._remove(path)
+                with open(path, 'wb') as out:
+                    shutil.copyfileobj(tar.extractfile(member), out)
+                written += member.size
+    return written
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--files', type=int, default=2000)
+    parser.add_argument('--size', type=int, default=32 * 1024)
+    parser.add_argument('--layers', type=int, default=4)
+    parser.add_argument('--churn', type=float, default=0.3)
+    parser.add_argument('--workers', type=int, default=rootfs.DEFAULT_WORKERS)
+    parser.add_argument('--rounds', type=int, default=3)
+    args = parser.parse_args()
+
+    rnd = random.Random(0)
+    names = [f'usr/share/bench/{i // 100}/{i}' for i in range(args.files)]
+    blobs = [layer([(n, args.size) for n in names])]
+    for _ in range(args.layers - 1):
+        changed = rnd.sample(names, int(len(names) * args.churn))
+        half = len(changed) // 2
+        blobs.append(layer([(n, args.size) for n in changed[:half]], changed[half:]))
+
+    work = pathlib.Path(tempfile.mkdtemp(prefix='pkgbox-bench-'))
+    try:
+        store = BlobStore(work / 'store')
+        descs = []
+        for blob in blobs:
+            desc = Descriptor('sha256', hashlib.sha256(blob).hexdigest())
+            with store.writer(desc) as w:
+                w.write(blob)
+                w.commit()
+            descs.append(desc)
+        manifest = Manifest('bench', 'latest', 'amd64', descs, [], [], descs[-1])
+
+        naive_time = stats = None
+        for n in range(args.rounds):
+            started = time.perf_counter()
+            naive_bytes = naive([store.path(d) for d in descs], work / f'naive-{n}')
+            naive_time = min(naive_time or float('inf'), time.perf_counter() - started)
+
+            result = rootfs.assemble(manifest, store, work / f'rootfs-{n}', workers=args.workers)
+            if not stats or result.elapsed < stats.elapsed:
+                stats = result
+    finally:
+        shutil.rmtree(work)
+
+    mib = 1024 * 1024
+    print(f'layers: {args.layers}, base files: {args.files} x {args.size} bytes, churn: {args.churn:.0%}')
+    print(f'naive: {naive_time:.3f}s, {naive_bytes / mib:.1f} MiB written')
+    print(f'assemble: {stats.elapsed:.3f}s, {stats.written_bytes / mib:.1f} MiB written, '
+          f'{stats.skipped} entries ({stats.skipped_bytes / mib:.1f} MiB) skipped')
+    print(f'speedup: {naive_time / stats.elapsed:.2f}x, bytes written: {stats.written_bytes / naive_bytes:.0%}')
+
+
+if __name__ == '__main__':
+    main()
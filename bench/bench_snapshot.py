@@ -0,0 +1,107 @@
+"""
+Benchmark taking a build step snapshot of a rootfs, with each
+`Snapshotter` method, against a full `shutil.copytree` copy.
+
+The rootfs is generated with `--files` small files (sized like the
+ones of a distribution base image) in directories of 100 entries.
+Disk usage is measured from the filesystem free space.
+
+Usage: python bench/bench_snapshot.py [--files N] [--dir PATH]
+"""
+import os
+import time
+import random
+import shutil
+import pathlib
+import argparse
+import tempfile
+
+from pkgbox.runtime import snapshot
+from pkgbox.runtime.snapshot import Snapshotter
+
+
+def generate(root: pathlib.Path, files: int, seed: int = 0) -> int:
+    """
+    Generate a rootfs of `files` files and return its size in bytes.
+    """
+    rnd = random.Random(seed)
+    total = 0
+    for i in range(files):
+        d = root / 'usr' / f'd{i // 10000}' / f'd{i // 100}'
+        if i % 100 == 0:
+            os.makedirs(d)
+        # mostly small files, a few bigger ones
+        size = int(rnd.lognormvariate(8, 1.5)) % (1024 * 1024)
+        (d / f'f{i}').write_bytes(rnd.randbytes(size))
+        total += size
+    return total
+
+
+def used(path: pathlib.Path) -> int:
+    st = os.statvfs(path)
+    return (st.f_blocks - st.f_bfree) * st.f_frsize
+
+
+def measure(path: pathlib.Path, fn) -> tuple:
+    """
+    Return the time and disk space `fn` takes.
+    """
+    os.sync()
+    before = used(path)
+    started = time.perf_counter()
+    result = fn()
+    elapsed = time.perf_counter() - started
+    os.sync()
+    return elapsed, used(path) - before, result
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--files', type=int, default=50000)
+    parser.add_argument('--dir', type=pathlib.Path, default=None,
+                        help='Directory to work in, on the filesystem to benchmark.')
+    args = parser.parse_args()
+
+    mib = 1024 * 1024
+    work = pathlib.Path(tempfile.mkdtemp(prefix='pkgbox-bench-', dir=args.dir))
+    try:
+        size = generate(work / 'rootfs', args.files)
+        print(f'rootfs: {args.files} files, {size / mib:.0f} MiB')
+
+        elapsed, disk, _ = measure(work, lambda: shutil.copytree(work / 'rootfs', work / 'copytree', symlinks=True))
+        print(f'{"shutil.copytree":16} {elapsed * 1000:8.0f} ms {disk / mib:8.1f} MiB')
+        baseline = elapsed
+        shutil.rmtree(work / 'copytree')
+
+        methods = [snapshot.HARDLINK, snapshot.OVERLAY, snapshot.COPY]
+        if snapshot.reflink_supported(work):
+            methods.insert(0, snapshot.REFLINK)
+        else:
+            print('reflink: not supported by this filesystem')
+
+        for method in methods:
+            snap = Snapshotter(work / method, method)
+            snap.prepare('bench')
+            if method == snapshot.OVERLAY:
+                # the base rootfs is the upper dir of the first step
+                os.rmdir(snap._upper('bench'))
+                shutil.copytree(work / 'rootfs', snap._upper('bench'), symlinks=True)
+            else:
+                os.rmdir(snap.rootfs('bench'))
+                shutil.copytree(work / 'rootfs', snap.rootfs('bench'), symlinks=True)
+            snap.snapshot('bench')
+
+            # a build step writing a few files, then its snapshot
+            for i in range(10):
+                snap.writable('bench', f'usr/d0/d0/f{i}').write_bytes(b'step')
+            elapsed, disk, taken = measure(work, lambda: snap.snapshot('bench'))
+            cost = snap.cost(taken)
+            print(f'{method:16} {elapsed * 1000:8.0f} ms {disk / mib:8.1f} MiB '
+                  f'({cost.entries} entries, {cost.bytes / mib:.1f} MiB copied, {baseline / elapsed:.1f}x faster)')
+            shutil.rmtree(work / method)
+    finally:
+        shutil.rmtree(work)
+
+
+if __name__ == '__main__':
+    main()
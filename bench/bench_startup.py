@@ -0,0 +1,93 @@
+"""
+Benchmark the pkgbox cli startup time of each subcommand.
+
+Each subcommand is run in a fresh interpreter with `-X importtime`:
+the sum of the reported import times, leaving out the imports done by
+the interpreter startup, is checked against a per subcommand budget, and modules which should never be imported by
+a subcommand are reported.
+
+Exits with a non zero status if any budget is exceeded.
+
+Usage: python bench/bench_startup.py [--rounds N]
+"""
+import os
+import sys
+import argparse
+import tempfile
+import subprocess
+import statistics
+from typing import Dict, List, Tuple
+
+
+BENCH_DIR = os.path.dirname(os.path.realpath(__file__))
+FIXTURE = os.path.join(BENCH_DIR, '..', 'test', 'fixtures', 'containerfiles', 'simple', 'Containerfile')
+
+# subcommand -> (args, import time budget in ms, forbidden modules)
+BUDGETS: Dict[str, Tuple[List[str], float, List[str]]] = {
+    'version': (['version'], 60.0, ['requests', 'canonicaljson', 'pkgbox.containerfile', 'pkgbox.image']),
+    'info': (['info'], 60.0, ['requests', 'canonicaljson', 'pkgbox.containerfile', 'pkgbox.image']),
+    'init': (['init'], 60.0, ['requests', 'canonicaljson', 'pkgbox.containerfile', 'pkgbox.image']),
+    'build': (['build', FIXTURE], 90.0, ['requests', 'pkgbox.image']),
+}
+
+
+def importtime(code: str, args: List[str], home: str) -> List[Tuple[str, int, bool]]:
+    """
+    Run `code` with `-X importtime` and return the (module, cumulative
+    time in us, is top level) tuple of each import.
+    """
+    res = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', code] + args,
+        env={**os.environ, 'PKGBOX_HOME': home}, capture_output=True, text=True
+    )
+
+    entries = []
+    for line in res.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        entries.append((name.strip(), int(cumulative), not name[1:].startswith(' ')))
+
+    return entries
+
+
+def imports(args: List[str], home: str, startup: List[str]) -> Tuple[float, List[str]]:
+    """
+    Run the cli with `args` and return its total import time (ms),
+    leaving out the interpreter `startup` imports, and the list of
+    imported modules.
+    """
+    code = 'import sys; from pkgbox.cli import main; sys.argv = ["pkgbox"] + sys.argv[1:]; main()'
+    entries = importtime(code, args, home)
+    total = sum(t for name, t, top in entries if top and name not in startup)
+
+    return total / 1000, [name for name, _, _ in entries]
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--rounds', type=int, default=5)
+    opts = parser.parse_args()
+
+    failed = False
+    with tempfile.TemporaryDirectory(prefix='pkgbox-bench-') as home:
+        startup = [name for name, _, top in importtime('pass', [], home) if top]
+        for name, (args, budget, forbidden) in BUDGETS.items():
+            runs = [imports(args, home, startup) for _ in range(opts.rounds)]
+            ms = statistics.median(r[0] for r in runs)
+            loaded = [m for m in forbidden if m in runs[0][1]]
+
+            status = 'ok'
+            if ms > budget or loaded:
+                status = 'FAIL'
+                failed = True
+
+            print(f'{name:10} {ms:8.1f}ms (budget {budget:.0f}ms) {status}')
+            for m in loaded:
+                print(f'  imports forbidden module "{m}"')
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
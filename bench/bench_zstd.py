@@ -0,0 +1,100 @@
+"""
+Benchmark decompressing a layer blob, gzip vs zstd: the raw
+decompression throughput, fed in `READ_SIZE` chunks as the extractor
+does, and reading every file of the layer through `extract.open_blob`.
+
+Usage: python bench/bench_zstd.py [--files N] [--size BYTES] [--level N]
+"""
+import io
+import os
+import time
+import gzip
+import shutil
+import pathlib
+import tarfile
+import argparse
+import tempfile
+
+from pkgbox import extract, zstd
+from pkgbox.extract import READ_SIZE
+
+
+def layer(files: int, size: int) -> bytes:
+    """
+    Return a tar stream of `files` files, a quarter random and the rest
+    text like, compressing about as well as binaries and packages.
+    """
+    words = [os.urandom(4).hex().encode() for _ in range(512)]
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode='w') as tar:
+        for i in range(files):
+            text = b' '.join(words[(i * 7 + j) % len(words)] for j in range(size // 12))
+            data = os.urandom(size // 4) + text[:size - size // 4]
+            info = tarfile.TarInfo(f'usr/lib/bench/{i}')
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+    return buf.getvalue()
+
+
+def decompress(blob: bytes, runs: int) -> float:
+    """
+    Return the best time to decompress `blob` in `READ_SIZE` chunks.
+    """
+    best = float('inf')
+    for _ in range(runs):
+        started = time.perf_counter()
+        d = extract._decompressor(blob)
+        for i in range(0, len(blob), READ_SIZE):
+            d.decompress(blob[i:i + READ_SIZE])
+        best = min(best, time.perf_counter() - started)
+    return best
+
+
+def untar(path: pathlib.Path, runs: int) -> float:
+    """
+    Return the best time to read every file of a layer blob.
+    """
+    best = float('inf')
+    for _ in range(runs):
+        started = time.perf_counter()
+        with extract.open_blob(path) as f, tarfile.open(fileobj=f, mode='r|') as tar:
+            for member in tar:
+                tar.extractfile(member).read()
+        best = min(best, time.perf_counter() - started)
+    return best
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--files', type=int, default=400)
+    parser.add_argument('--size', type=int, default=256 * 1024)
+    parser.add_argument('--level', type=int, default=zstd.DEFAULT_LEVEL)
+    parser.add_argument('--runs', type=int, default=3)
+    args = parser.parse_args()
+
+    data = layer(args.files, args.size)
+    blobs = {
+        'gzip': gzip.compress(data, compresslevel=6),
+        'zstd': zstd.compress(data, level=args.level),
+    }
+
+    mib = 1024 * 1024
+    work = pathlib.Path(tempfile.mkdtemp(prefix='pkgbox-bench-'))
+    try:
+        print(f'layer: {args.files} files, {len(data) / mib:.0f} MiB')
+        times = {}
+        for name, blob in blobs.items():
+            path = work / name
+            path.write_bytes(blob)
+            times[name] = decompress(blob, args.runs), untar(path, args.runs)
+            print(f'{name}: {len(blob) / mib:.1f} MiB, decompress {len(data) / mib / times[name][0]:.0f} MiB/s, '
+                  f'read files {len(data) / mib / times[name][1]:.0f} MiB/s')
+    finally:
+        shutil.rmtree(work)
+
+    print(f'speedup: decompress {times["gzip"][0] / times["zstd"][0]:.1f}x, '
+          f'read files {times["gzip"][1] / times["zstd"][1]:.1f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,172 @@
+"""
+A local stand-in OCI registry used by the benchmarks.
+
+It serves OCI manifests and blobs from memory, honoring single
+`Range` requests on blobs, and can inject a per-request latency and a
+per-connection bandwidth limit to simulate a remote registry.
+"""
+import re
+import json
+import time
+import random
+import hashlib
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Optional
+
+
+_GZIP_LAYER = 'application/vnd.oci.image.layer.v1.tar+gzip'
+_ZSTD_LAYER = 'application/vnd.oci.image.layer.v1.tar+zstd'
+_ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+
+
+class Registry:
+    """
+    In-memory registry served over plain http on localhost.
+
+    `latency` is the delay (in seconds) added to every request and
+    `bandwidth` the maximum amount of bytes per second sent by a
+    single connection (`None` means unlimited).
+    """
+    def __init__(self, latency: float = 0.0, bandwidth: Optional[int] = None) -> None:
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.manifests: Dict[str, bytes] = {}
+        self.blobs: Dict[str, bytes] = {}
+        self.requests = 0
+        self.sent = 0
+        self._server: Optional[ThreadingHTTPServer] = None
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def address(self) -> str:
+        """
+        Return the "host:port" address of the running registry.
+        """
+        host, port = self._server.server_address[:2]
+        return f'{host}:{port}'
+
+    def add_image(self, namespace: str, tag: str, layers: List[bytes]) -> str:
+        """
+        Add an image made of the given layer blobs and return
+        its full reference, such as "127.0.0.1:5000/fedora:39".
+        """
+        config = json.dumps({
+            'architecture': 'amd64',
+            'os': 'linux',
+            'rootfs': {'type': 'layers', 'diff_ids': []},
+        }).encode()
+
+        manifest = {
+            'schemaVersion': 2,
+            'mediaType': 'application/vnd.oci.image.manifest.v1+json',
+            'config': self._blob(config, 'application/vnd.oci.image.config.v1+json'),
+            'layers': [self._blob(blob, _ZSTD_LAYER if blob.startswith(_ZSTD_MAGIC) else _GZIP_LAYER)
+                       for blob in layers],
+        }
+        self.manifests[f'{namespace}:{tag}'] = json.dumps(manifest).encode()
+
+        return f'{self.address}/{namespace}:{tag}'
+
+    def generate_image(self, namespace: str, tag: str, count: int, size: int, seed: int = 0) -> str:
+        """
+        Add an image of `count` layers of `size` pseudo-random bytes,
+        the same for a given `seed`, and return its full reference.
+        """
+        rnd = random.Random(f'{namespace}:{tag}:{seed}')
+        return self.add_image(namespace, tag, [rnd.randbytes(size) for _ in range(count)])
+
+    def _blob(self, blob: bytes, media_type: str) -> Dict[str, Any]:
+        digest = 'sha256:' + hashlib.sha256(blob).hexdigest()
+        self.blobs[digest] = blob
+        return {'mediaType': media_type, 'size': len(blob), 'digest': digest}
+
+    def start(self) -> 'Registry':
+        """
+        Start serving requests in a background thread.
+        """
+        registry = self
+
+        class Handler(_Handler):
+            pass
+        Handler.registry = registry
+
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+
+        return self
+
+    def stop(self) -> None:
+        """
+        Stop the server.
+        """
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+
+    def __enter__(self) -> 'Registry':
+        return self.start()
+
+    def __exit__(self, *args) -> None:
+        self.stop()
+
+
+_RANGE_RE = re.compile(r'^bytes=(\d+)-(\d*)$')
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    registry: Registry
+
+    def log_message(self, *args) -> None:
+        pass
+
+    def do_GET(self) -> None:
+        self.registry.requests += 1
+        if self.registry.latency:
+            time.sleep(self.registry.latency)
+
+        # /v2/<namespace>/(manifests|blobs)/<ref>
+        parts = self.path.split('/')
+        namespace, kind, ref = '/'.join(parts[2:-2]), parts[-2], parts[-1]
+
+        if kind == 'manifests' and f'{namespace}:{ref}' in self.registry.manifests:
+            body = self.registry.manifests[f'{namespace}:{ref}']
+            digest = 'sha256:' + hashlib.sha256(body).hexdigest()
+            self._send(200, body, {'docker-content-digest': digest,
+                                   'content-type': json.loads(body)['mediaType']})
+        elif kind == 'blobs' and ref in self.registry.blobs:
+            blob = self.registry.blobs[ref]
+            m = _RANGE_RE.match(self.headers.get('range', ''))
+            if not m:
+                self._send(200, blob, {'docker-content-digest': ref})
+                return
+            start = int(m.group(1))
+            end = min(int(m.group(2)) + 1 if m.group(2) else len(blob), len(blob))
+            if start >= len(blob):
+                self._send(416, b'', {'content-range': f'bytes */{len(blob)}'})
+                return
+            self._send(206, blob[start:end], {'docker-content-digest': ref,
+                                              'content-range': f'bytes {start}-{end - 1}/{len(blob)}'})
+        else:
+            self._send(404, b'')
+
+    def _send(self, status: int, body: bytes, headers: Dict[str, str] = {}) -> None:
+        self.send_response(status)
+        self.send_header('content-length', str(len(body)))
+        for k, v in headers.items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.registry.sent += len(body)
+
+        bandwidth = self.registry.bandwidth
+        step = max(1, bandwidth // 100) if bandwidth else len(body) or 1
+        for i in range(0, len(body), step):
+            started = time.monotonic()
+            self.wfile.write(body[i:i + step])
+            if bandwidth:
+                delay = step / bandwidth - (time.monotonic() - started)
+                if delay > 0:
+                    time.sleep(delay)
@@ -0,0 +1,258 @@
+"""
+Reproducible benchmark suite.
+
+Runs the main code paths against generated inputs and a local stand-in
+registry, with a fixed seed so every run measures the same work:
+
+  containerfile.from_reader  parse a generated Containerfile
+  containerfile.as_dict      digest and serialize it
+  image.info                 resolve a manifest, without cache
+  image.info.cached          resolve a manifest from a warm cache
+  image.fetch                fetch every layer of an image
+  cli.startup                run `pkgbox version` in a new interpreter
+
+Results are saved as JSON (`--output`) with the commit and the
+parameters they were measured with. Given a `--baseline` result file,
+such as one saved on another commit, each benchmark median is compared
+with the baseline one and the suite exits with a non zero status if
+any is slower by more than `--threshold`.
+
+Usage: python bench/suite.py [--output FILE] [--baseline FILE] [--threshold RATIO]
+                             [--only NAME] [--rounds N] [--quick]
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import pathlib
+import argparse
+import platform
+import tempfile
+import subprocess
+import statistics
+from datetime import datetime, timezone
+from typing import Any, Callable, Dict, List, Optional
+
+BENCH_DIR = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, BENCH_DIR)
+
+from registry import Registry
+from bench_parse import generate
+
+from pkgbox import cache, containerfile, image, io
+from pkgbox.store import BlobStore
+
+
+FORMAT = 1
+
+# parameters, scaled down by --quick
+PARAMS: Dict[str, Dict[str, Any]] = {
+    'default': {
+        'instructions': 2000,
+        'layers': 8,
+        'layer_size': 4 * 1024 * 1024,
+        'latency': 0.01,
+        'bandwidth': 64 * 1024 * 1024,
+    },
+    'quick': {
+        'instructions': 200,
+        'layers': 4,
+        'layer_size': 256 * 1024,
+        'latency': 0.01,
+        'bandwidth': 64 * 1024 * 1024,
+    },
+}
+
+
+class Context:
+    """
+    What the benchmarks share: their parameters, a scratch directory
+    and the running registry.
+    """
+    def __init__(self, params: Dict[str, Any], work: pathlib.Path, registry: Registry) -> None:
+        self.params = params
+        self.work = work
+        self.registry = registry
+
+    def scratch(self) -> pathlib.Path:
+        """
+        Return a new empty directory under the scratch directory.
+        """
+        return pathlib.Path(tempfile.mkdtemp(dir=self.work))
+
+
+def timed(fn: Callable[[], Any], rounds: int, setup: Optional[Callable[[], Any]] = None) -> List[float]:
+    """
+    Call `fn` once to warm up then `rounds` times, passing it the value
+    `setup` returns if set, and return the duration of each timed call.
+    `setup` is not timed.
+    """
+    times = []
+    for i in range(rounds + 1):
+        args = (setup(),) if setup else ()
+        started = time.perf_counter()
+        fn(*args)
+        if i:
+            times.append(time.perf_counter() - started)
+    return times
+
+
+def bench_from_reader(ctx: Context, rounds: int) -> List[float]:
+    reader = io.FileReader('file', str(ctx.work / 'Containerfile'))
+    return timed(lambda: containerfile.from_reader(reader), rounds)
+
+
+def bench_as_dict(ctx: Context, rounds: int) -> List[float]:
+    cf = containerfile.from_reader(io.FileReader('file', str(ctx.work / 'Containerfile')))
+    return timed(lambda: containerfile.as_dict(cf), rounds)
+
+
+def bench_info(ctx: Context, rounds: int) -> List[float]:
+    img = image.from_str(ctx.params['ref'])
+    return timed(lambda: image.info(img), rounds)
+
+
+def bench_info_cached(ctx: Context, rounds: int) -> List[float]:
+    img = image.from_str(ctx.params['ref'])
+    manifests = cache.ManifestCache(ctx.scratch())
+    return timed(lambda: image.info(img, manifests), rounds)
+
+
+def bench_fetch(ctx: Context, rounds: int) -> List[float]:
+    img = image.from_str(ctx.params['ref'])
+    manifest = image.info(img)
+    return timed(lambda store: image.fetch(img, manifest, store), rounds,
+                 setup=lambda: BlobStore(ctx.scratch()))
+
+
+def bench_startup(ctx: Context, rounds: int) -> List[float]:
+    code = 'import sys; from pkgbox.cli import main; sys.argv = ["pkgbox", "version"]; main()'
+    env = {**os.environ, 'PKGBOX_HOME': str(ctx.scratch())}
+    cmd = [sys.executable, '-c', code]
+    return timed(lambda: subprocess.run(cmd, env=env, check=True, stdout=subprocess.DEVNULL), rounds)
+
+
+BENCHMARKS: Dict[str, Callable[[Context, int], List[float]]] = {
+    'containerfile.from_reader': bench_from_reader,
+    'containerfile.as_dict': bench_as_dict,
+    'image.info': bench_info,
+    'image.info.cached': bench_info_cached,
+    'image.fetch': bench_fetch,
+    'cli.startup': bench_startup,
+}
+
+
+def summarize(times: List[float]) -> Dict[str, Any]:
+    """
+    Return the statistics of a benchmark durations, in seconds.
+    """
+    return {
+        'rounds': len(times),
+        'min': min(times),
+        'median': statistics.median(times),
+        'mean': statistics.fmean(times),
+        'stdev': statistics.stdev(times) if len(times) > 1 else 0.0,
+        'times': times,
+    }
+
+
+def commit() -> Optional[str]:
+    """
+    Return the current git commit of the source tree, if any.
+    """
+    try:
+        res = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=BENCH_DIR, capture_output=True, text=True)
+    except OSError:
+        return None
+    return res.stdout.strip() or None
+
+
+def run(names: List[str], params: Dict[str, Any], rounds: int) -> Dict[str, Any]:
+    """
+    Run the named benchmarks and return the results document.
+    """
+    work = pathlib.Path(tempfile.mkdtemp(prefix='pkgbox-bench-'))
+    try:
+        with Registry(latency=params['latency'], bandwidth=params['bandwidth']) as registry:
+            os.environ['PKGBOX_INSECURE_REGISTRIES'] = registry.address
+            ref = registry.generate_image('bench/suite', 'latest', params['layers'], params['layer_size'])
+            ctx = Context({**params, 'ref': ref}, work, registry)
+            (work / 'Containerfile').write_text(generate(params['instructions']))
+
+            results = {}
+            for name in names:
+                results[name] = summarize(BENCHMARKS[name](ctx, rounds))
+                print(f'{name:28} {results[name]["median"] * 1000:10.2f}ms '
+                      f'(min {results[name]["min"] * 1000:.2f}ms, {rounds} rounds)', file=sys.stderr)
+    finally:
+        shutil.rmtree(work)
+
+    return {
+        'format': FORMAT,
+        'created': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'commit': commit(),
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'cpus': os.cpu_count(),
+        'params': params,
+        'results': results,
+    }
+
+
+def compare(baseline: Dict[str, Any], current: Dict[str, Any], threshold: float) -> List[str]:
+    """
+    Print the change of every benchmark median from `baseline` to
+    `current` and return the names of the ones slower by more than
+    `threshold` (a ratio, 0.1 being 10%).
+    """
+    if baseline.get('params') != current.get('params'):
+        print('warning: baseline was measured with different parameters', file=sys.stderr)
+
+    regressions = []
+    print(f'{"benchmark":28} {"baseline":>10} {"current":>10} {"change":>8}')
+    for name, result in current['results'].items():
+        base = baseline['results'].get(name)
+        if base is None:
+            print(f'{name:28} {"-":>10} {result["median"] * 1000:8.2f}ms')
+            continue
+        change = result['median'] / base['median'] - 1
+        status = ''
+        if change > threshold:
+            status = ' REGRESSION'
+            regressions.append(name)
+        print(f'{name:28} {base["median"] * 1000:8.2f}ms {result["median"] * 1000:8.2f}ms {change:+8.1%}{status}')
+
+    return regressions
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--output', type=pathlib.Path)
+    parser.add_argument('--baseline', type=pathlib.Path)
+    parser.add_argument('--threshold', type=float, default=0.15)
+    parser.add_argument('--only', action='append', choices=list(BENCHMARKS))
+    parser.add_argument('--rounds', type=int, default=5)
+    parser.add_argument('--quick', action='store_true')
+    opts = parser.parse_args()
+
+    # read first, not to find out it is missing after running everything
+    baseline = json.loads(opts.baseline.read_text()) if opts.baseline else None
+
+    params = PARAMS['quick' if opts.quick else 'default']
+    results = run(opts.only or list(BENCHMARKS), params, opts.rounds)
+
+    if opts.output:
+        opts.output.write_text(json.dumps(results, indent=2) + '\n')
+    if baseline is None:
+        return
+
+    regressions = compare(baseline, results, opts.threshold)
+    if regressions:
+        print(f'{len(regressions)} benchmark(s) slower than the baseline by more than {opts.threshold:.0%}: '
+              f'{", ".join(regressions)}', file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,151 @@
+"""
+Batch processing of many Containerfile sources.
+
+Sources are read concurrently in a thread pool, then parsed and
+digested in a process pool. Results are yielded as soon as they are
+ready, so callers can stream them in completion order.
+
+When tracing, workers trace on their own and send their events back
+along with their results.
+
+Worker processes are started by a fork server (or spawned where there
+is none), never forked from this process, whose reader threads may hold
+locks a forked child would inherit locked. A worker dying takes down the
+whole pool: the sources it had, or was given afterwards, get an error
+record each.
+"""
+import os
+import glob
+import multiprocessing
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any, Dict, Iterable, Iterator, List, Mapping, Optional, Tuple
+
+from . import containerfile, errors, io, trace
+
+
+DEFAULT_READ_WORKERS = 16
+
+
+def expand(sources: Iterable[str]) -> List[str]:
+    """
+    Expand glob patterns of local sources, keeping
+    other sources as they are.
+    """
+    expanded = []
+    for source in sources:
+        source = source.strip()
+        if not source:
+            continue
+        scheme, path = io.split_uri(source)
+        if scheme == 'file' and glob.has_magic(path):
+            expanded.extend(sorted(glob.glob(path, recursive=True)))
+        else:
+            expanded.append(source)
+
+    return expanded
+
+
+def _error(source: str, e: Exception) -> Dict[str, Any]:
+    if isinstance(e, errors.PBError):
+        return {'source': source, 'error': e.message, 'errno': e.errno}
+    return {'source': source, 'error': str(e), 'errno': 1}
+
+
+def _read(reader: io.Reader) -> str:
+    with trace.span('batch.read', source=reader.path):
+        return reader.read()
+
+
+def process(source: str, content: str, bases: Optional[Mapping[str, str]] = None) -> Dict[str, Any]:
+    """
+    Parse and digest a Containerfile content, returning a result record.
+    `bases` maps base images to their manifest digest.
+
+    Errors are returned as records too, since `pkgbox.errors` objects
+    can not be sent back from worker processes as they are.
+    """
+    try:
+        with trace.span('batch.process', source=source):
+            return {'source': source, 'result': containerfile.as_dict(containerfile.parse(content), bases)}
+    except Exception as e:
+        return _error(source, e)
+
+
+def _mp_context() -> multiprocessing.context.BaseContext:
+    if 'forkserver' in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context('forkserver')
+    return multiprocessing.get_context('spawn')
+
+
+def _process_traced(source: str, content: str,
+                    bases: Optional[Mapping[str, str]] = None) -> Tuple[Dict[str, Any], List[Dict[str, Any]]]:
+    """
+    Run `process` in a worker process, returning its trace events too.
+    """
+    tracer = trace.enable()
+    try:
+        return process(source, content, bases), tracer.events
+    finally:
+        trace.disable()
+
+
+def run(sources: Iterable[str], jobs: Optional[int] = None,
+        read_workers: int = DEFAULT_READ_WORKERS,
+        bases: Optional[Mapping[str, str]] = None) -> Iterator[Dict[str, Any]]:
+    """
+    Process many Containerfile sources, yielding one record per source
+    in completion order.
+
+    Records have a "source" key and either a "result" key, holding the
+    `containerfile.as_dict` output, or "error" and "errno" keys. An error
+    in a source never stops the batch.
+
+    `jobs` is the number of worker processes (CPU count by default),
+    `1` processes everything in the current process. `bases` maps base
+    images to their manifest digest, see `containerfile.chain_digests`.
+    """
+    jobs = jobs or os.cpu_count() or 1
+    cpu_pool = ProcessPoolExecutor(jobs, mp_context=_mp_context()) if jobs > 1 else None
+
+    with ThreadPoolExecutor(read_workers) as io_pool:
+        pending: Dict[Future, Tuple[str, str]] = {}
+        for source in sources:
+            pending[io_pool.submit(_read, io.from_uri(source))] = ('read', source)
+
+        try:
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    stage, source = pending.pop(future)
+                    if stage in ('process', 'traced'):
+                        try:
+                            result = future.result()
+                        except BrokenProcessPool as e:
+                            yield _error(source, e)
+                            continue
+                        if stage == 'traced':
+                            result, events = result
+                            trace.merge(events)
+                        yield result
+                        continue
+
+                    try:
+                        content = future.result()
+                    except Exception as e:
+                        yield _error(source, e)
+                        continue
+
+                    if cpu_pool:
+                        traced = trace.enabled()
+                        try:
+                            future = cpu_pool.submit(_process_traced if traced else process, source, content, bases)
+                        except BrokenProcessPool as e:
+                            yield _error(source, e)
+                            continue
+                        pending[future] = ('traced' if traced else 'process', source)
+                    else:
+                        yield process(source, content, bases)
+        finally:
+            if cpu_pool:
+                cpu_pool.shutdown(cancel_futures=True)
@@ -0,0 +1,206 @@
+"""
+On disk cache of image manifests.
+
+Manifest bodies are stored by digest in `{root}/blobs/{alg}/{digest}`,
+while tag references ("registry/namespace:tag") point to a digest from
+`{root}/refs/{registry}/{namespace}/{tag}.json` along with the time they
+were last checked against the registry.
+
+Pinned manifests are listed in `{root}/pins/{registry}/{namespace}/{tag}.json`.
+They are never evicted and the layers they reference are kept by the
+layer store garbage collection.
+"""
+import os
+import json
+import time
+import pathlib
+import threading
+from dataclasses import dataclass
+from typing import Dict, Iterator, Optional, Tuple
+
+from .oci.v1 import Descriptor
+
+
+DEFAULT_TTL = 300
+DEFAULT_MAX_SIZE = 64 * 1024 * 1024
+
+
+@dataclass
+class Ref:
+    """
+    A cached tag reference: the manifest digest it pointed to
+    and the time (epoch) it was last validated.
+    """
+    digest: Descriptor
+    checked: float
+
+
+class ManifestCache:
+    """
+    Manifest cache rooted at a given directory.
+
+    Tag references are considered fresh for `ttl` seconds, after which
+    they should be revalidated. Manifest bodies are evicted, least
+    recently used first, when their total size goes over `max_size` bytes.
+    """
+    def __init__(self, root: pathlib.Path, ttl: float = DEFAULT_TTL,
+                 max_size: int = DEFAULT_MAX_SIZE) -> None:
+        """
+        Create a new cache object instance.
+        """
+        self.root = pathlib.Path(root)
+        self.ttl = ttl
+        self.max_size = max_size
+        self._lock = threading.Lock()
+
+    def _blob_path(self, digest: Descriptor) -> pathlib.Path:
+        return self.root / 'blobs' / digest.alg / digest.digest
+
+    def _ref_path(self, name: str) -> pathlib.Path:
+        registry, _, rest = name.partition('/')
+        namespace, _, tag = rest.rpartition(':')
+        return self.root / 'refs' / registry / namespace / f'{tag}.json'
+
+    def get(self, digest: Descriptor) -> Optional[bytes]:
+        """
+        Return a cached manifest body by its digest, if any.
+        """
+        path = self._blob_path(digest)
+        try:
+            data = path.read_bytes()
+        except FileNotFoundError:
+            return None
+
+        # mtime keeps track of the last access for the LRU eviction
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+
+        return data
+
+    def _pin_path(self, name: str) -> pathlib.Path:
+        path = self._ref_path(name)
+        return self.root / 'pins' / path.relative_to(self.root / 'refs')
+
+    def ref(self, name: str) -> Optional[Ref]:
+        """
+        Return the cached reference of a tagged image name, if any.
+        """
+        try:
+            data = json.loads(self._ref_path(name).read_text())
+        except (FileNotFoundError, ValueError):
+            return None
+
+        return Ref(Descriptor.from_str(data['digest']), data['checked'])
+
+    def is_fresh(self, ref: Ref) -> bool:
+        """
+        Check if a reference was validated within the cache ttl.
+        """
+        return time.time() - ref.checked < self.ttl
+
+    def put(self, digest: Descriptor, data: bytes, name: Optional[str] = None) -> None:
+        """
+        Store a manifest body and, if `name` is provided, make
+        the tag reference point to it.
+        """
+        _write(self._blob_path(digest), data)
+        if name:
+            self.touch(name, digest)
+        self.evict()
+
+    def touch(self, name: str, digest: Descriptor) -> None:
+        """
+        Mark a tag reference as validated now.
+        """
+        data = {'digest': str(digest), 'checked': time.time()}
+        _write(self._ref_path(name), json.dumps(data).encode())
+
+    def pin(self, name: str, digest: Descriptor) -> None:
+        """
+        Pin the manifest `digest` under an image name.
+        """
+        data = {'name': name, 'digest': str(digest)}
+        _write(self._pin_path(name), json.dumps(data).encode())
+
+    def unpin(self, name: str) -> bool:
+        """
+        Remove the pin of an image name, returning whether it existed.
+        """
+        try:
+            os.unlink(self._pin_path(name))
+        except FileNotFoundError:
+            return False
+        return True
+
+    def pins(self) -> Dict[str, Descriptor]:
+        """
+        Return the pinned manifest digests by image name.
+        """
+        pins = {}
+        for path in (self.root / 'pins').glob('**/*.json'):
+            try:
+                data = json.loads(path.read_text())
+            except (FileNotFoundError, ValueError):
+                continue
+            pins[data['name']] = Descriptor.from_str(data['digest'])
+        return pins
+
+    def manifests(self, since: float = 0) -> Iterator[Tuple[Descriptor, bytes]]:
+        """
+        Iterate over the cached manifests used since `since` (epoch).
+        """
+        for path in (self.root / 'blobs').glob('*/*'):
+            try:
+                if path.stat().st_mtime < since:
+                    continue
+                data = path.read_bytes()
+            except FileNotFoundError:
+                continue
+            yield Descriptor(path.parent.name, path.name), data
+
+    def evict(self) -> None:
+        """
+        Remove the least recently used manifests until the cache
+        size is under `max_size`. Pinned manifests are kept.
+        """
+        with self._lock:
+            pinned = {self._blob_path(d) for d in self.pins().values()}
+            entries = []
+            total = 0
+            for path in (self.root / 'blobs').glob('*/*'):
+                try:
+                    st = path.stat()
+                except FileNotFoundError:
+                    continue
+                total += st.st_size
+                if path not in pinned:
+                    entries.append((st.st_mtime, st.st_size, path))
+
+            for _, size, path in sorted(entries):
+                if total <= self.max_size:
+                    break
+                try:
+                    os.unlink(path)
+                except FileNotFoundError:
+                    pass
+                total -= size
+
+
+def _write(path: pathlib.Path, data: bytes) -> None:
+    """
+    Atomically write `data` into `path`.
+    """
+    os.makedirs(path.parent, exist_ok=True)
+    tmp = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+
+def from_paths(paths: Dict[str, str], **kwargs) -> ManifestCache:
+    """
+    Return the manifest cache located in the pkgbox data dir.
+    """
+    return ManifestCache(pathlib.Path(f'{paths["data_dir"]}/manifests'), **kwargs)
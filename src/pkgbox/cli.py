@@ -1,16 +1,17 @@
 """
 The cli module is used to run the pkgbox main cli.
+
+Only light modules are imported here: subcommands import the modules
+they need (and their heavy dependencies such as `requests`) when they
+run, so short commands like `pkgbox version` start fast.
 """
 import os
-import re
 import sys
-import shutil
-import pathlib
-from typing import Any
+from typing import Any, Optional, Tuple
 
 import click
 
-from . import containerfile, errors, env, image, io, runtime
+from . import errors, env
 
 
 class SourceType(click.ParamType):
@@ -19,7 +20,7 @@ class SourceType(click.ParamType):
     """
     name: str = 'SourceType'
 
-    def convert(self, value: Any, param: click.Parameter, ctx: click.Context) -> io.Reader:
+    def convert(self, value: Any, param: click.Parameter, ctx: click.Context) -> 'io.Reader':
         """
         Converts a source string, such as file:///tmp/Containerfile into reader
         object.
@@ -31,23 +32,55 @@ class SourceType(click.ParamType):
 
         "file://" is assumed if no scheme is provided.
         """
-        pattern = re.compile('([a-zA-Z]+)//(.*)')
-        m = pattern.match(value)
-        if m:
-            scheme, value = m.groups()
-        else:
-            scheme, value = ('file', value) 
+        from . import io
+
+        return io.from_uri(value)
+
+
+class BaseDigestType(click.ParamType):
+    """
+    Base image digest, given as IMAGE=DIGEST
+    """
+    name: str = 'IMAGE=DIGEST'
 
-        return io.build_reader(scheme, value)
+    def convert(self, value: Any, param: click.Parameter, ctx: click.Context) -> Tuple[str, str]:
+        """
+        Converts an "IMAGE=DIGEST" string, such as
+        "fedora:39=sha256:...", into an (image, digest) tuple.
+        """
+        if isinstance(value, tuple):
+            return value
+        image, sep, digest = value.rpartition('=')
+        if not sep or not image or ':' not in digest:
+            self.fail(f'"{value}" is not an IMAGE=DIGEST pair', param, ctx)
+        return image, digest
 
 
 @click.group
-def cli() -> None:
+@click.option('--trace', 'trace_path', type=click.Path(dir_okay=False), default=None,
+              help='Write a Chrome trace event JSON file of the command.')
+@click.option('--stats', is_flag=True, help='Print a timing summary of the command to stderr.')
+@click.pass_context
+def cli(ctx: click.Context, trace_path: Optional[str], stats: bool) -> None:
     """
     The main cli group which other subcommands are
     attached to.
     """
-    pass
+    if not trace_path and not stats:
+        return
+
+    from . import trace
+
+    tracer = trace.enable()
+
+    def report() -> None:
+        trace.disable()
+        if trace_path:
+            tracer.write(trace_path)
+        if stats:
+            click.echo(trace.format_summary(tracer.summary()), err=True)
+
+    ctx.call_on_close(report)
 
 @cli.command
 def version() -> None:
@@ -88,25 +121,213 @@ def info() -> None:
 
 
 @cli.command
-@click.argument('source', type=SourceType())
-def build(source: SourceType) -> None:
+@click.argument('sources', nargs=-1)
+@click.option('--stdin', 'from_stdin', is_flag=True, help='Read sources from stdin, one per line.')
+@click.option('--jobs', '-j', type=int, default=None, help='Number of worker processes (defaults to the CPU count).')
+@click.option('--ndjson', is_flag=True, help='Output one JSON document per line, even for a single source.')
+@click.option('--base-digest', 'base_digests', type=BaseDigestType(), multiple=True,
+              help='Manifest digest of a base image, chained into the FROM step digests. Repeatable.')
+def build(sources: Tuple[str, ...], from_stdin: bool, jobs: Optional[int], ndjson: bool,
+          base_digests: Tuple[Tuple[str, str], ...]) -> None:
     """
     Handles the `pkgbox build` command.
+
+    SOURCES are Containerfile locations (local paths, globs, file://,
+    http:// or https:// uris). A single source is pretty printed while
+    many sources are processed in parallel and streamed as NDJSON records
+    in completion order.
+
+    Base image digests given with --base-digest key the chained digests
+    of the FROM steps starting from these images.
     """
-    paths = env.get_pkgbox_dirs()
-    data_dir = paths['data_dir']
+    import canonicaljson
+
+    from . import batch, containerfile
+
+    sources = list(sources)
+    if from_stdin:
+        sources.extend(sys.stdin.read().splitlines())
+    sources = batch.expand(sources)
+    bases = dict(base_digests)
+
+    if not sources:
+        raise errors.PBError('No sources provided.')
+
+    if len(sources) == 1 and not ndjson:
+        # load containerfile from source
+        c = containerfile.from_reader(SourceType().convert(sources[0], None, None))
+        click.echo(containerfile.as_json(c, pretty=True, bases=bases))
+        return
+
+    failed = 0
+    for record in batch.run(sources, jobs, bases=bases):
+        failed += 'error' in record
+        click.echo(canonicaljson.encode_canonical_json(record).decode())
+
+    if failed:
+        raise errors.PBError(f'{failed} of {len(sources)} sources failed.')
 
-    # load containerfile from source
-    c = containerfile.from_reader(source)
-    click.echo(containerfile.as_json(c, pretty=True))
-    
     # img = image.from_str(image_name)
     # manifest = image.info(img)
-    # dest = pathlib.Path(f'{data_dir}/oci-layers')
+    # layers = store.from_paths(paths)
 
     # click.echo(f'Fetching data from "{image_name}"...')
-    # image.fetch(img, manifest, dest)
-    # click.echo(f'Data fetched into {dest}')
+    # image.fetch(img, manifest, layers)
+    # click.echo(f'Data fetched into {layers.root}')
+
+
+@cli.command
+@click.argument('images', nargs=-1)
+@click.option('--stdin', 'from_stdin', is_flag=True, help='Read image references from stdin, one per line.')
+@click.option('--workers', '-w', type=int, default=4, help='Number of concurrent layer downloads.')
+@click.option('--unpack', is_flag=True, help='Also extract the layers while they are downloaded.')
+def pull(images: Tuple[str, ...], from_stdin: bool, workers: int, unpack: bool) -> None:
+    """
+    Handles the `pkgbox pull` command.
+
+    IMAGES are image references, such as "registry.fedoraproject.org/fedora:39".
+    Their manifests are resolved concurrently and layers shared by several
+    images are downloaded only once.
+    """
+    from . import cache, extract, pull, store
+
+    images = list(images)
+    if from_stdin:
+        images.extend(sys.stdin.read().splitlines())
+    images = [i.strip() for i in images if i.strip()]
+
+    if not images:
+        raise errors.PBError('No images provided.')
+
+    paths = env.get_pkgbox_dirs()
+    layers = store.from_paths(paths)
+    summary = pull.pull(images, layers, cache.from_paths(paths), workers=workers,
+                        unpack=extract.from_paths(paths) if unpack else None)
+
+    for name in summary.images:
+        click.echo(f'pulled: {name}')
+    for name, message in summary.errors.items():
+        click.echo(f'failed: {name}: {message}', err=True)
+
+    mib = 1024 * 1024
+    click.echo(f'layers: {summary.references} referenced, {summary.unique} unique, '
+               f'{summary.cached} cached, {summary.downloaded} downloaded')
+    click.echo(f'downloaded: {summary.downloaded_bytes / mib:.1f} MiB in {summary.elapsed:.2f}s '
+               f'({summary.throughput / mib:.1f} MiB/s)')
+    click.echo(f'saved by dedup: {summary.saved_bytes / mib:.1f} MiB')
+
+    if (quota := env.getvar('PKGBOX_STORE_QUOTA')):
+        from . import gc
+
+        result = gc.collect(layers, cache.from_paths(paths), gc.parse_size(quota))
+        if result.removed:
+            click.echo(f'evicted: {result.removed} layers ({result.freed / mib:.1f} MiB)')
+
+    if summary.errors:
+        raise errors.PBError(f'{len(summary.errors)} of {len(summary.errors) + len(summary.images)} images failed.')
+
+
+@cli.command
+@click.argument('images', nargs=-1)
+@click.option('--remove', is_flag=True, help='Remove the pins instead of adding them.')
+def pin(images: Tuple[str, ...], remove: bool) -> None:
+    """
+    Handles the `pkgbox pin` command.
+
+    Pinned IMAGES keep their layers in the store when it is
+    garbage collected.
+    """
+    from . import cache, image
+
+    manifests = cache.from_paths(env.get_pkgbox_dirs())
+
+    for name in images:
+        if remove:
+            if not manifests.unpin(name):
+                raise errors.PBError(f'"{name}" is not pinned.')
+            click.echo(f'unpinned: {name}')
+            continue
+
+        manifest = image.info(image.from_str(name), manifests)
+        manifests.pin(name, manifest.digest)
+        click.echo(f'pinned: {name} ({manifest.digest})')
+
+
+@cli.command
+@click.option('--quota', default=None, help='Target store size, such as "10G" (defaults to $PKGBOX_STORE_QUOTA, or 0).')
+@click.option('--recent', type=float, default=7.0, help='Keep layers of manifests used within this many days.')
+@click.option('--dry-run', is_flag=True, help='Only report what would be evicted.')
+def gc(quota: Optional[str], recent: float, dry_run: bool) -> None:
+    """
+    Handles the `pkgbox gc` command.
+
+    Layers not referenced by pinned or recently used manifests are
+    evicted, least recently used first, until the store is under quota.
+    """
+    from . import cache, gc, store
+
+    paths = env.get_pkgbox_dirs()
+    quota = quota or env.getvar('PKGBOX_STORE_QUOTA') or '0'
+    result = gc.collect(store.from_paths(paths), cache.from_paths(paths), gc.parse_size(quota),
+                        recent=recent * 24 * 3600, dry_run=dry_run)
+
+    mib = 1024 * 1024
+    verb = 'would evict' if dry_run else 'evicted'
+    click.echo(f'{verb}: {result.removed} layers ({result.freed / mib:.1f} MiB)')
+    if result.partials:
+        click.echo(f'{verb}: {result.partials} partial layers')
+    click.echo(f'kept: {result.referenced} referenced, {result.busy} in use')
+    click.echo(f'usage: {result.usage / mib:.1f} MiB')
+
+
+@cli.command
+@click.argument('name', metavar='IMAGE')
+@click.argument('path', default='')
+def ls(name: str, path: str) -> None:
+    """
+    Handles the `pkgbox ls` command.
+
+    Lists the files of IMAGE under PATH, read from the indexes of its
+    layers. Layers missing from the store are indexed from the registry
+    without being downloaded when possible (see `pkgbox.lazy`).
+    """
+    from . import cache, gzindex, image, lazy, store
+
+    paths = env.get_pkgbox_dirs()
+    img = image.from_str(name)
+    manifest = image.info(img, cache.from_paths(paths))
+    with lazy.fetch(img, manifest, store.from_paths(paths), prefetch=False) as files:
+        entries = files.list(path)
+
+    for entry, member in entries:
+        size = member.size if member else 0
+        link = f' -> {member.linkname}' if member and member.issym() else ''
+        click.echo(f'{gzindex.filemode(member)} {size:>10} {entry}{link}')
+
+
+@cli.command
+@click.argument('name', metavar='IMAGE')
+@click.argument('path')
+def cat(name: str, path: str) -> None:
+    """
+    Handles the `pkgbox cat` command.
+
+    Writes the content of the file at PATH in IMAGE to stdout, reading
+    only the part of its layer holding it, fetched from the registry
+    with range requests if the layer is not in the store.
+    """
+    from . import cache, image, lazy, store
+
+    paths = env.get_pkgbox_dirs()
+    img = image.from_str(name)
+    manifest = image.info(img, cache.from_paths(paths))
+    profile = lazy.profile_from_paths(paths, manifest)
+
+    out = sys.stdout.buffer
+    with lazy.fetch(img, manifest, store.from_paths(paths), profile) as files:
+        for chunk in files.read(path):
+            out.write(chunk)
+    out.flush()
 
 
 def main() -> None:
@@ -3,84 +3,68 @@ This module handles the parsing and management
 of Containerfiles content.
 """
 import json
+import errno
 import hashlib
 import pathlib
-from typing import Dict, Any
+from typing import Any, Container, Dict, List, Mapping, Optional
 
 import canonicaljson
-from dockerfile_parse import DockerfileParser, util
 
-from . import io
+from . import errors, io, normalize, trace
+from .parser import Containerfile, Instruction, Stage, parse
 
 
-class ContainerfileParser(DockerfileParser):
+def from_filepath(path: pathlib.Path) -> Containerfile:
     """
-    A class that inherits DockerfileParser to handle
-    cached content in a specific way.
-    """
-    def __init__(self, *args, **kwargs) -> None:
-        """
-        Create a new object instance, forcing the
-        parent class parser to used the cached content.
-        """
-        super().__init__(*args, **kwargs)
-        self.cache_content = True
-
-    @property
-    def content(self) -> str:
-        """
-        Overwrites the parent method to return
-        the cached content.
-        """
-        return self.cached_content
-
-    @content.setter
-    def content(self, content: str) -> None:
-        """
-        Overwrites the parent method to not to any file
-        operations.
-        """
-        self.cached_content = util.b2u(content)
-
-
-def from_filepath(path: pathlib.Path) -> ContainerfileParser:
-    """
-    Return a parser object from a given path, where path
+    Return a parsed Containerfile from a given path, where path
     should be the location of a Containerfile.
     """
-    parser = ContainerfileParser()
-
     with open(path.resolve(), 'r') as f:
-        parser.content = f.read()
-
-    return parser
+        return parse(f.read())
 
 
-def from_reader(reader: io.Reader) -> ContainerfileParser:
-    parser = ContainerfileParser()
-    parser.content = reader.read()
-    
-    return parser
+def from_reader(reader: io.Reader) -> Containerfile:
+    """
+    Return a parsed Containerfile from a reader object.
+    """
+    return parse(reader.read())
 
 
-def as_dict(parser: ContainerfileParser) -> Dict[str, str]:
+def as_dict(cf: Containerfile, bases: Optional[Mapping[str, str]] = None) -> Dict[str, Any]:
     """
-    Return the dict representation of a ContainerfileParser(DockerfileParser).
+    Return the dict representation of a parsed Containerfile.
+
+    `bases` maps base image names to their manifest digest,
+    see `chain_digests`.
     """
+    digests = digest_instructions(cf)
+    chain = chain_digests(cf, bases, digests)
     data = {
-        'from': parser.baseimage,
-        'labels': parser.labels,
-        'envs': parser.envs,
-        'cmd': parser.cmd, 
-        'args': parser.args,
-        'build_args': parser.build_args, 
+        'from': cf.baseimage,
+        'labels': dict(cf.labels),
+        'envs': dict(cf.envs),
+        'cmd': cf.cmd, 
+        'args': dict(cf.args),
+        'build_args': dict(cf.build_args), 
         'instructions': {
             'digest': None,
+            'normalization': normalize.VERSION,
             'items': [
-                {'name': i['instruction'], 'value': i['value'], 'digest': 'sha256:' + digest_instruction(i)}
-                for i in parser.structure
+                {'name': i.name, 'value': i.value, 'digest': 'sha256:' + d, 'chain_digest': c}
+                for i, d, c in zip(cf.instructions, digests, chain)
             ]
-        }
+        },
+        'stages': [
+            {
+                'index': s.index,
+                'name': s.name,
+                'from': s.base,
+                'instructions': [s.start, s.end],
+                'depends': list(s.depends),
+                'images': list(s.images),
+            }
+            for s in cf.stages
+        ],
     }
 
     data['instructions']['digest'] = ''.join([i['digest'].split(':')[1] for i in data['instructions']['items']])
@@ -89,22 +73,119 @@ def as_dict(parser: ContainerfileParser) -> Dict[str, str]:
     return data
 
 
-def as_json(parser: ContainerfileParser, pretty: bool = False) -> str:
+def as_json(cf: Containerfile, pretty: bool = False, bases: Optional[Mapping[str, str]] = None) -> str:
     """
     Return a json string representation of a parsed containerfile.
     """
     if pretty:
-        return canonicaljson.encode_pretty_printed_json(as_dict(parser)).decode()    
-    return canonicaljson.encode_canonical_json(as_dict(parser)).decode()
+        return canonicaljson.encode_pretty_printed_json(as_dict(cf, bases)).decode()    
+    return canonicaljson.encode_canonical_json(as_dict(cf, bases)).decode()
+
 
+def _digest(text: str) -> str:
+    content = f'v{normalize.VERSION}\n{text}'
 
-def digest_instruction(data: Dict[str, str]) -> str:
+    return hashlib.sha256(content.encode()).hexdigest()
+
+
+def digest_instruction(instruction: Instruction, args: Optional[Mapping[str, str]] = None) -> str:
     """
     Return the sha256 string represenation of a
     containerfile instruction.
+
+    The instruction is normalized first (see `pkgbox.normalize`), using
+    `args` as the build arguments in scope.
     """
-    instruction = data['instruction']
-    value = data['value']
-    content = f'{instruction} {value}'
+    return _digest(normalize.normalize(instruction, args))
 
-    return hashlib.sha256(content.encode()).hexdigest()
+
+@trace.traced('containerfile.digest')
+def digest_instructions(cf: Containerfile) -> List[str]:
+    """
+    Return the sha256 string represenation of every
+    instruction of a Containerfile.
+    """
+    return [_digest(text) for text in normalize.normalize_all(cf)]
+
+
+@trace.traced('containerfile.chain')
+def chain_digests(cf: Containerfile, bases: Optional[Mapping[str, str]] = None,
+                  digests: Optional[List[str]] = None) -> List[str]:
+    """
+    Return the chained digest of each instruction.
+
+    The digest of a step covers its instruction digest, its resolved ARG/ENV
+    context and the digest of the previous step, so it identifies the whole
+    build prefix up to that step. FROM steps also cover their base image
+    manifest digest if found in `bases`, which maps image names (as in
+    `Containerfile.parent_images`) to digests.
+
+    `digests` are the instruction digests, computed if not provided.
+    """
+    bases = bases or {}
+    digests = digests or digest_instructions(cf)
+    chain = []
+    parent = ''
+
+    for inst, digest in zip(cf.instructions, digests):
+        context = dict(inst.resolved)
+        if inst.name == 'FROM' and context.get('image') in bases:
+            context['digest'] = bases[context['image']]
+
+        content = '\n'.join([parent, digest, canonicaljson.encode_canonical_json(context).decode()])
+        parent = 'sha256:' + hashlib.sha256(content.encode()).hexdigest()
+        chain.append(parent)
+
+    return chain
+
+
+def longest_cached_prefix(cf: Containerfile, cached: Container[str],
+                          bases: Optional[Mapping[str, str]] = None) -> int:
+    """
+    Return the number of leading steps of `cf` that can be reused from a
+    cache, where `cached` holds the chained digests of cached steps.
+
+    Since a chained digest covers its whole prefix, this is the position of
+    the deepest cached step.
+    """
+    chain = chain_digests(cf, bases)
+
+    for n in range(len(chain), 0, -1):
+        if chain[n - 1] in cached:
+            return n
+
+    return 0
+
+
+def target_stage(cf: Containerfile, target: Optional[str] = None) -> Stage:
+    """
+    Return the stage named `target` or at index `target`,
+    the last stage if not set.
+    """
+    if not cf.stages:
+        raise errors.PBError('Containerfile has no stage', errno.EINVAL)
+    if target is None:
+        return cf.stages[-1]
+    stage = cf.stage(target)
+    if stage is None:
+        raise errors.PBError(f'Unknown build stage "{target}"', errno.EINVAL)
+    return stage
+
+
+def needed_stages(cf: Containerfile, target: Optional[str] = None) -> List[Stage]:
+    """
+    Return the stages needed to build the `target` stage (see
+    `target_stage`), along with it, in Containerfile order.
+
+    Since stages only depend on previous ones, every stage comes
+    after its dependencies.
+    """
+    needed = set()
+    todo = [target_stage(cf, target).index]
+    while todo:
+        index = todo.pop()
+        if index not in needed:
+            needed.add(index)
+            todo.extend(cf.stages[index].depends)
+
+    return [s for s in cf.stages if s.index in needed]
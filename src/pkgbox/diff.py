@@ -0,0 +1,357 @@
+"""
+Filesystem diff engine, finding what a build step changed in a rootfs.
+
+Before a step, `record` walks the rootfs and saves a stat snapshot of
+every entry: its mode, inode, size, mtime, ctime and owner, the target
+of symlinks. After the step, `diff` walks the rootfs again and compares
+it with the snapshot, emitting additions, modifications and deletions
+(whiteouts) without reading any file whose stat data settles it.
+
+Content is only compared when the stat data is ambiguous:
+
+- a file with the same size and mtime but another inode or ctime (say,
+  replaced by a copy keeping its mtime, or broken out of a hard link
+  farm by the snapshotter) is compared with its content in `base`, the
+  rootfs as it was before the step, such as its parent snapshot. Without
+  `base` it is considered modified. A file still sharing its inode with
+  `base` (hard links count in the ctime) is considered unchanged, as
+  files of a hard link farm must be broken out before being written;
+- a file modified within `RACY_WINDOW` of the snapshot could be written
+  again without its mtime changing, so its digest is saved in the
+  snapshot and checked if its stat data did not change.
+
+Snapshots are streamed to a compressed file, both trees being walked in
+the same order (directory entries sorted by name, depth first) and
+merged, so memory stays bounded whatever the number of files. Directory
+listings are read ahead by worker threads, up to a bounded window.
+"""
+import os
+import stat
+import gzip
+import time
+import errno
+import struct
+import hashlib
+import pathlib
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import BinaryIO, Iterator, List, NamedTuple, Optional, Tuple
+
+from . import errors, trace
+from .extract import WHITEOUT_PREFIX
+
+
+DEFAULT_WORKERS = 4
+WINDOW = 256
+RACY_WINDOW = 1_000_000_000
+READ_SIZE = 1024 * 1024
+
+ADDED = 'A'
+MODIFIED = 'M'
+DELETED = 'D'
+
+_MAGIC = b'PBSTAT1\n'
+_HEADER = struct.Struct('<q')
+# path length, mode, inode, size, mtime, ctime, uid, gid, extra length
+_RECORD = struct.Struct('<HIQQqqIIH')
+
+
+class Stat(NamedTuple):
+    """
+    The stat data of an entry. `extra` is the target of a symlink or
+    the sha256 digest of a racy regular file.
+    """
+    mode: int
+    ino: int
+    size: int
+    mtime_ns: int
+    ctime_ns: int
+    uid: int
+    gid: int
+    extra: bytes = b''
+
+
+@dataclass(frozen=True)
+class Change:
+    """
+    A change of the rootfs entry `path`.
+    """
+    kind: str
+    path: str
+
+    @property
+    def whiteout(self) -> str:
+        """
+        Return the layer whiteout entry name of a deletion.
+        """
+        parent, _, name = self.path.rpartition('/')
+        return f'{parent}/{WHITEOUT_PREFIX}{name}' if parent else f'{WHITEOUT_PREFIX}{name}'
+
+
+def _key(path: str) -> str:
+    # sorts entries depth first, a directory right before its children
+    return path.replace('/', '\0')
+
+
+def _digest(path: str) -> bytes:
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while (chunk := f.read(READ_SIZE)):
+            h.update(chunk)
+    return h.digest()
+
+
+def _same_content(a: str, b: str) -> bool:
+    with open(a, 'rb') as fa, open(b, 'rb') as fb:
+        while True:
+            ca, cb = fa.read(READ_SIZE), fb.read(READ_SIZE)
+            if ca != cb:
+                return False
+            if not ca:
+                return True
+
+
+class _Walker:
+    """
+    Depth first walk of a tree, directory entries sorted by name, with
+    up to `window` directory listings read ahead by `workers` threads.
+    """
+    def __init__(self, root: str, workers: int, window: int) -> None:
+        self.root = root
+        self.window = window
+        self.pool = ThreadPoolExecutor(max_workers=workers) if workers > 1 else None
+        self.ahead = 0
+
+    def _list(self, rel: str) -> List[Tuple[str, os.stat_result]]:
+        path = os.path.join(self.root, rel) if rel else self.root
+        try:
+            with os.scandir(path) as it:
+                entries = [(e.name, e.stat(follow_symlinks=False)) for e in it]
+        except FileNotFoundError:
+            # removed while walking
+            return []
+        entries.sort(key=lambda e: e[0])
+        return entries
+
+    def _submit(self, rel: str) -> Optional[Future]:
+        if self.pool is None or self.ahead >= self.window:
+            return None
+        self.ahead += 1
+        return self.pool.submit(self._list, rel)
+
+    def _walk(self, rel: str, future: Optional[Future]) -> Iterator[Tuple[str, os.stat_result]]:
+        if future is None:
+            entries = self._list(rel)
+        else:
+            entries = future.result()
+            self.ahead -= 1
+
+        prefix = f'{rel}/' if rel else ''
+        ahead = {name: self._submit(prefix + name) for name, st in entries if stat.S_ISDIR(st.st_mode)}
+        for name, st in entries:
+            path = prefix + name
+            yield path, st
+            if name in ahead:
+                yield from self._walk(path, ahead.pop(name))
+
+    def __iter__(self) -> Iterator[Tuple[str, os.stat_result]]:
+        try:
+            yield from self._walk('', self._submit(''))
+        finally:
+            if self.pool:
+                self.pool.shutdown(wait=True, cancel_futures=True)
+
+
+def walk(root: pathlib.Path, workers: int = DEFAULT_WORKERS,
+         window: int = WINDOW) -> Iterator[Tuple[str, os.stat_result]]:
+    """
+    Iterate over the (relative path, lstat result) of every entry of
+    `root`, depth first with directory entries sorted by name.
+    """
+    return iter(_Walker(str(root), workers, window))
+
+
+def _stat(root: str, path: str, st: os.stat_result, since: int) -> Stat:
+    extra = b''
+    if stat.S_ISLNK(st.st_mode):
+        extra = os.fsencode(os.readlink(os.path.join(root, path)))
+    elif stat.S_ISREG(st.st_mode) and st.st_mtime_ns >= since:
+        extra = _digest(os.path.join(root, path))
+    return Stat(st.st_mode, st.st_ino, st.st_size, st.st_mtime_ns, st.st_ctime_ns, st.st_uid, st.st_gid, extra)
+
+
+class StatSnapshot:
+    """
+    A stat snapshot file, as written by `record`.
+    """
+    def __init__(self, path: pathlib.Path) -> None:
+        """
+        Create a new snapshot object instance.
+        """
+        self.path = pathlib.Path(path)
+        with self._open() as f:
+            self.started = self._header(f)
+
+    def _open(self) -> BinaryIO:
+        try:
+            return gzip.open(self.path, 'rb')
+        except FileNotFoundError:
+            raise errors.PBError(f'Stat snapshot {self.path} not found', errno.ENOENT)
+
+    def _header(self, f: BinaryIO) -> int:
+        head = f.read(len(_MAGIC) + _HEADER.size)
+        if not head.startswith(_MAGIC) or len(head) < len(_MAGIC) + _HEADER.size:
+            raise errors.PBError(f'Invalid stat snapshot {self.path}', errno.EINVAL)
+        return _HEADER.unpack_from(head, len(_MAGIC))[0]
+
+    def __iter__(self) -> Iterator[Tuple[str, Stat]]:
+        with self._open() as f:
+            self._header(f)
+            while (head := f.read(_RECORD.size)):
+                if len(head) < _RECORD.size:
+                    raise errors.PBError(f'Truncated stat snapshot {self.path}', errno.EIO)
+                plen, mode, ino, size, mtime, ctime, uid, gid, elen = _RECORD.unpack(head)
+                data = f.read(plen + elen)
+                yield os.fsdecode(data[:plen]), Stat(mode, ino, size, mtime, ctime, uid, gid, data[plen:])
+
+
+class _Writer:
+    def __init__(self, path: pathlib.Path, started: int) -> None:
+        self.path = pathlib.Path(path)
+        self.tmp = f'{path}.{os.getpid()}.tmp'
+        self.f = gzip.open(self.tmp, 'wb', compresslevel=1)
+        self.f.write(_MAGIC + _HEADER.pack(started))
+
+    def write(self, path: str, st: Stat) -> None:
+        name = os.fsencode(path)
+        self.f.write(_RECORD.pack(len(name), *st[:-1], len(st.extra)) + name + st.extra)
+
+    def commit(self) -> StatSnapshot:
+        self.f.close()
+        os.replace(self.tmp, self.path)
+        return StatSnapshot(self.path)
+
+    def abort(self) -> None:
+        self.f.close()
+        os.unlink(self.tmp)
+
+
+@trace.traced('diff.record')
+def record(root: pathlib.Path, dest: pathlib.Path, workers: int = DEFAULT_WORKERS) -> StatSnapshot:
+    """
+    Save the stat snapshot of the `root` tree into `dest`.
+    """
+    started = time.time_ns()
+    since = started - RACY_WINDOW
+    writer = _Writer(dest, started)
+    try:
+        for path, st in walk(root, workers):
+            writer.write(path, _stat(str(root), path, st, since))
+    except BaseException:
+        writer.abort()
+        raise
+    return writer.commit()
+
+
+def _modified(root: str, base: Optional[str], path: str, old: Stat, new: Stat) -> bool:
+    """
+    Check if an entry present before and after a step changed.
+    """
+    if (old.mode, old.uid, old.gid) != (new.mode, new.uid, new.gid):
+        return True
+    if stat.S_ISDIR(new.mode):
+        return old.mtime_ns != new.mtime_ns
+    if stat.S_ISLNK(new.mode):
+        return old.extra != new.extra or old.mtime_ns != new.mtime_ns
+    if not stat.S_ISREG(new.mode):
+        return (old.ino, old.mtime_ns) != (new.ino, new.mtime_ns)
+
+    if old.size != new.size or old.mtime_ns != new.mtime_ns:
+        return True
+    if (old.ino, old.ctime_ns) == (new.ino, new.ctime_ns):
+        # racily clean: written again within the mtime granularity
+        return bool(old.extra) and _digest(os.path.join(root, path)) != old.extra
+    # same size and mtime but another inode or ctime
+    if base is None:
+        return True
+    try:
+        if os.lstat(os.path.join(base, path)).st_ino == new.ino:
+            # shared with base by a hard link farm
+            return False
+        return not _same_content(os.path.join(base, path), os.path.join(root, path))
+    except FileNotFoundError:
+        return True
+
+
+def _children(key: str, other: str) -> bool:
+    return other.startswith(key + '\0')
+
+
+def _stats(root: str, entries: Iterator[Tuple[str, os.stat_result]], since: int,
+           writer: Optional[_Writer]) -> Iterator[Tuple[str, Stat]]:
+    for path, st in entries:
+        data = _stat(root, path, st, since)
+        if writer:
+            writer.write(path, data)
+        yield path, data
+
+
+@trace.traced('diff.diff')
+def diff(before: StatSnapshot, root: pathlib.Path, base: Optional[pathlib.Path] = None,
+         save: Optional[pathlib.Path] = None, workers: int = DEFAULT_WORKERS) -> Iterator[Change]:
+    """
+    Iterate over the changes of the `root` tree since its `before` stat
+    snapshot, depth first with directory entries sorted by name.
+
+    `base` is the tree as it was when `before` was recorded, used to
+    compare the content of ambiguous files. If `save` is set, the stat
+    snapshot of `root` is saved there as it is walked, once every change
+    is iterated over, to diff the next step from.
+
+    A deleted directory is a single deletion and an entry replacing a
+    directory with a non directory a modification, their children
+    being dropped along with them.
+    """
+    started = time.time_ns()
+    since = started - RACY_WINDOW
+    writer = _Writer(save, started) if save else None
+    root_s, base_s = str(root), str(base) if base else None
+
+    old_it = iter(before)
+    new_it = _stats(root_s, walk(root, workers), since, writer)
+    old = next(old_it, None)
+    new = next(new_it, None)
+    skip: Optional[str] = None
+
+    try:
+        while old is not None or new is not None:
+            old_key = _key(old[0]) if old is not None else None
+            # children of a deleted or replaced directory
+            if skip is not None and old_key is not None and _children(skip, old_key):
+                old = next(old_it, None)
+                continue
+
+            new_key = _key(new[0]) if new is not None else None
+            if new_key is None or (old_key is not None and old_key < new_key):
+                yield Change(DELETED, old[0])
+                if stat.S_ISDIR(old[1].mode):
+                    skip = old_key
+                old = next(old_it, None)
+                continue
+
+            if old_key is None or new_key < old_key:
+                yield Change(ADDED, new[0])
+            else:
+                if _modified(root_s, base_s, new[0], old[1], new[1]):
+                    yield Change(MODIFIED, new[0])
+                    if stat.S_ISDIR(old[1].mode) and not stat.S_ISDIR(new[1].mode):
+                        skip = old_key
+                old = next(old_it, None)
+            new = next(new_it, None)
+    except BaseException:
+        if writer:
+            writer.abort()
+        raise
+
+    if writer:
+        writer.commit()
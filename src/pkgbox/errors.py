@@ -64,3 +64,15 @@ class PBRuntimeError(PBError):
         Create a new instance of this error.
         """
         super().__init__(message, errno.ENOTRECOVERABLE)
+
+
+class PBDigestError(PBError):
+    """
+    Error raised when some content does not match
+    its expected digest.
+    """
+    def __init__(self, expected: str, actual: str) -> None:
+        """
+        Create a new instance of this error.
+        """
+        super().__init__(f'Digest mismatch: expected {expected}, got {actual}', errno.EBADMSG)
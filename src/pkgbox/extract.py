@@ -0,0 +1,441 @@
+"""
+Streaming layer extraction.
+
+An `Extractor` is fed the raw bytes of a layer blob as they are
+downloaded and unpacks them into a layer directory in the same pass:
+decompression and untarring run in a background thread, so they overlap
+with the download instead of reading the blob back from disk later.
+
+Layer directories live in `{root}/{alg}/{digest}` and only show up there
+once the whole layer is extracted and its blob verified.
+
+Entries are always created inside the layer directory: ".." components
+are rejected and symlinks are resolved as if the layer directory was
+the filesystem root. OCI whiteout entries (".wh.<name>" and the
+".wh..wh..opq" opaque marker) are kept as empty marker files, to be
+applied when layers are stacked, and are listed by the extractor.
+
+Layer blobs are plain, gzip or zstd compressed tar streams, told apart
+by their first bytes rather than by their media type.
+"""
+import os
+import gzip
+import stat
+import zlib
+import queue
+import errno
+import shutil
+import tarfile
+import pathlib
+import threading
+from typing import Any, BinaryIO, Dict, List, Optional, Tuple
+
+from . import errors, image, trace, zstd
+from .oci.v1 import Descriptor
+from .store import BlobStore
+
+
+WHITEOUT_PREFIX = '.wh.'
+OPAQUE_WHITEOUT = '.wh..wh..opq'
+MAX_SYMLINKS = 40
+QUEUE_SIZE = 16
+READ_SIZE = 1024 * 1024
+
+_GZIP_MAGIC = b'\x1f\x8b'
+
+
+def _decompressor(head: bytes) -> Optional[Any]:
+    """
+    Return a `zlib` like decompression object for a layer blob starting
+    with `head`, `None` for a plain tar stream.
+    """
+    if head.startswith(_GZIP_MAGIC):
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+    if head.startswith(zstd.MAGIC):
+        return zstd.Decompressor()
+    return None
+
+
+class _StreamReader:
+    """
+    File-like object reading the decompressed content of the chunks
+    put in a queue, `None` marking the end of the stream.
+    """
+    def __init__(self, chunks: 'queue.Queue[Optional[bytes]]') -> None:
+        self.chunks = chunks
+        self.buffer = bytearray()
+        self.eof = False
+        self._decompress = None
+        self._started = False
+
+    def _next(self) -> None:
+        chunk = self.chunks.get()
+        if chunk is None:
+            self.eof = True
+            if self._decompress:
+                self.buffer += self._decompress.flush()
+            return
+
+        if not self._started:
+            self._started = True
+            self._decompress = _decompressor(chunk)
+
+        if self._decompress is None:
+            self.buffer += chunk
+            return
+
+        while chunk:
+            self.buffer += self._decompress.decompress(chunk)
+            chunk = self._decompress.unused_data
+            if chunk and self._decompress.eof:
+                # concatenated gzip members
+                self._decompress = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            else:
+                break
+
+    def read(self, size: int = -1) -> bytes:
+        while not self.eof and (size < 0 or len(self.buffer) < size):
+            self._next()
+
+        if size < 0:
+            size = len(self.buffer)
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return data
+
+    def drain(self) -> None:
+        """
+        Consume the rest of the stream.
+        """
+        while not self.eof:
+            if self.chunks.get() is None:
+                self.eof = True
+
+
+class Extractor:
+    """
+    Extract a layer stream into `dest`, going through a temporary
+    directory next to it until `commit` is called.
+
+    Chunks passed to `write` are unpacked by a background thread. An
+    extraction error is raised by the next `write` or by `commit`.
+    """
+    def __init__(self, dest: pathlib.Path) -> None:
+        """
+        Create a new extractor and start its thread.
+        """
+        self.dest = pathlib.Path(dest)
+        self.tmp = self.dest.with_name(f'{self.dest.name}.{os.getpid()}.{threading.get_ident()}.tmp')
+        self.whiteouts: List[str] = []
+        self.opaque: List[str] = []
+        self.size = 0
+        self._thread: Optional[threading.Thread] = None
+        self._start()
+
+    def _start(self) -> None:
+        if self.tmp.exists():
+            shutil.rmtree(self.tmp)
+        os.makedirs(self.tmp)
+        self.whiteouts, self.opaque = [], []
+        self.size = 0
+        self._error: Optional[BaseException] = None
+        self._chunks: 'queue.Queue[Optional[bytes]]' = queue.Queue(QUEUE_SIZE)
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _stop(self) -> None:
+        if self._thread:
+            self._chunks.put(None)
+            self._thread.join()
+            self._thread = None
+
+    def _run(self) -> None:
+        reader = _StreamReader(self._chunks)
+        try:
+            with trace.span('extract.untar', layer=self.dest.name):
+                _untar(reader, str(self.tmp), self.whiteouts, self.opaque)
+        except BaseException as e:
+            self._error = e
+        finally:
+            # keep the writer from blocking on a full queue
+            reader.drain()
+
+    def _raise(self) -> None:
+        e = self._error
+        if e is None:
+            return
+        if isinstance(e, errors.PBError):
+            raise e
+        raise errors.PBError(f'Unable to extract layer into {self.dest}: {e}')
+
+    def write(self, data: bytes) -> None:
+        """
+        Feed a chunk of the layer blob.
+        """
+        self._raise()
+        if data:
+            self._chunks.put(bytes(data))
+            self.size += len(data)
+
+    def reset(self) -> None:
+        """
+        Drop everything extracted so far and start over.
+        """
+        self._stop()
+        self._start()
+
+    def commit(self) -> pathlib.Path:
+        """
+        Wait for the extraction to end and move the layer directory
+        into place.
+
+        If another extraction of the same layer was committed first,
+        its directory is kept and this one is dropped.
+        """
+        self._stop()
+        try:
+            self._raise()
+        except errors.PBError:
+            self.abort()
+            raise
+
+        os.makedirs(self.dest.parent, exist_ok=True)
+        try:
+            os.rename(self.tmp, self.dest)
+        except OSError as e:
+            if e.errno not in (errno.EEXIST, errno.ENOTEMPTY):
+                raise errors.PBError(str(e), e.errno)
+            shutil.rmtree(self.tmp, ignore_errors=True)
+
+        return self.dest
+
+    def abort(self) -> None:
+        """
+        Stop the extraction and remove its temporary directory.
+        """
+        self._stop()
+        shutil.rmtree(self.tmp, ignore_errors=True)
+
+    def __enter__(self) -> 'Extractor':
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        if self._thread or self.tmp.exists():
+            self.abort()
+
+
+def open_blob(path: pathlib.Path) -> BinaryIO:
+    """
+    Open a layer blob, returning a file-like object reading its
+    uncompressed tar content.
+    """
+    with open(path, 'rb') as f:
+        magic = f.read(len(zstd.MAGIC))
+
+    if magic.startswith(_GZIP_MAGIC):
+        return gzip.open(path, 'rb')
+    if magic == zstd.MAGIC:
+        return zstd.reader(open(path, 'rb'))
+    return open(path, 'rb')
+
+
+class LayerDirs:
+    """
+    Extracted layers rooted at a given directory.
+    """
+    def __init__(self, root: pathlib.Path) -> None:
+        """
+        Create a new object instance.
+        """
+        self.root = pathlib.Path(root)
+
+    def path(self, desc: Descriptor) -> pathlib.Path:
+        """
+        Return the directory of an extracted layer.
+        """
+        return self.root / desc.alg / desc.digest
+
+    def exists(self, desc: Descriptor) -> bool:
+        """
+        Check if a layer was extracted.
+        """
+        return self.path(desc).is_dir()
+
+    def extractor(self, desc: Descriptor) -> Extractor:
+        """
+        Return a new `Extractor` for `desc`.
+        """
+        os.makedirs(self.root / desc.alg, exist_ok=True)
+        return Extractor(self.path(desc))
+
+
+@trace.traced('extract.unpack')
+def unpack(img: image.Image, layer: Descriptor, store: BlobStore, layers: LayerDirs,
+           progress: Optional[image.Progress] = None,
+           retry: Optional[image.RetryPolicy] = None) -> pathlib.Path:
+    """
+    Extract a layer, downloading its blob into the store if needed,
+    and return its directory.
+
+    A missing blob is extracted while it is downloaded. A blob already in
+    the store, or downloaded by another process meanwhile, is extracted
+    from the store.
+    """
+    if layers.exists(layer):
+        return layers.path(layer)
+
+    with layers.extractor(layer) as extractor:
+        if not layers.exists(layer) and not store.exists(layer):
+            image.fetch_layer(img, layer, store, progress, retry, tee=extractor)
+        if layers.exists(layer):
+            return layers.path(layer)
+        if not extractor.size:
+            extractor.reset()
+            with open(store.path(layer), 'rb') as f:
+                while (chunk := f.read(READ_SIZE)):
+                    extractor.write(chunk)
+        return extractor.commit()
+
+
+def _clean(name: str) -> str:
+    """
+    Return an archive member name relative to the layer root,
+    rejecting names going out of it.
+    """
+    parts = [p for p in name.split('/') if p not in ('', '.')]
+    if '..' in parts:
+        raise errors.PBError(f'Unsafe path "{name}" in layer', errno.EPERM)
+    return '/'.join(parts)
+
+
+def _resolve(root: str, name: str, follow: bool = False) -> str:
+    """
+    Return the host path of `name` within `root`, resolving symlinks
+    of its parent directories (and of itself if `follow` is set) as if
+    `root` was the filesystem root.
+    """
+    parts = name.split('/')
+    resolved: List[str] = []
+    links = 0
+
+    while parts:
+        part = parts.pop(0)
+        if part in ('', '.'):
+            continue
+        if part == '..':
+            if resolved:
+                resolved.pop()
+            continue
+
+        path = os.path.join(root, *resolved, part)
+        if (parts or follow) and os.path.islink(path):
+            links += 1
+            if links > MAX_SYMLINKS:
+                raise errors.PBError(f'Too many levels of symbolic links in "{name}"', errno.ELOOP)
+            target = os.readlink(path)
+            if target.startswith('/'):
+                resolved = []
+            parts = target.split('/') + parts
+            continue
+        resolved.append(part)
+
+    return os.path.join(root, *resolved)
+
+
+def _remove(path: str) -> None:
+    """
+    Remove whatever is at `path`, without following symlinks.
+    """
+    try:
+        st = os.lstat(path)
+    except FileNotFoundError:
+        return
+    if stat.S_ISDIR(st.st_mode):
+        shutil.rmtree(path)
+    else:
+        os.unlink(path)
+
+
+def _untar(reader: _StreamReader, root: str, whiteouts: List[str], opaque: List[str]) -> None:
+    """
+    Unpack a tar stream into `root`.
+    """
+    owner = os.geteuid() == 0
+    dirs: List[Tuple[str, tarfile.TarInfo]] = []
+
+    with tarfile.open(fileobj=reader, mode='r|') as tar:
+        for member in tar:
+            name = _clean(member.name)
+            if not name:
+                continue
+
+            base = os.path.basename(name)
+            if base == OPAQUE_WHITEOUT:
+                opaque.append(os.path.dirname(name))
+            elif base.startswith(WHITEOUT_PREFIX):
+                whiteouts.append(os.path.join(os.path.dirname(name), base[len(WHITEOUT_PREFIX):]))
+
+            path = _resolve(root, name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+            if member.isdir():
+                try:
+                    if not stat.S_ISDIR(os.lstat(path).st_mode):
+                        os.unlink(path)
+                except FileNotFoundError:
+                    pass
+                os.makedirs(path, exist_ok=True)
+                dirs.append((path, member))
+                continue
+
+            _remove(path)
+
+            if member.isreg():
+                fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL | os.O_NOFOLLOW, 0o600)
+                with os.fdopen(fd, 'wb') as f:
+                    src = tar.extractfile(member)
+                    while (chunk := src.read(READ_SIZE)):
+                        f.write(chunk)
+            elif member.issym():
+                os.symlink(member.linkname, path)
+            elif member.islnk():
+                target = _resolve(root, _clean(member.linkname))
+                if not os.path.lexists(target):
+                    raise errors.PBError(f'Hardlink target "{member.linkname}" of "{member.name}" not found',
+                                         errno.ENOENT)
+                os.link(target, path, follow_symlinks=False)
+                continue
+            elif member.isfifo():
+                os.mkfifo(path)
+            elif member.ischr() or member.isblk():
+                if not owner:
+                    # device nodes can only be created by root
+                    continue
+                kind = stat.S_IFCHR if member.ischr() else stat.S_IFBLK
+                os.mknod(path, kind | 0o600, os.makedev(member.devmajor, member.devminor))
+            else:
+                continue
+
+            _apply(path, member, owner)
+
+    # directories last, so read-only ones can still be filled
+    for path, member in reversed(dirs):
+        _apply(path, member, owner)
+
+
+def _apply(path: str, member: tarfile.TarInfo, owner: bool) -> None:
+    """
+    Apply the ownership, mode and mtime of a member.
+    """
+    if owner:
+        os.lchown(path, member.uid, member.gid)
+    if not member.issym():
+        os.chmod(path, member.mode & 0o7777)
+    os.utime(path, (member.mtime, member.mtime), follow_symlinks=False)
+
+
+def from_paths(paths: Dict[str, str]) -> LayerDirs:
+    """
+    Return the extracted layers located in the pkgbox data dir.
+    """
+    return LayerDirs(pathlib.Path(f'{paths["data_dir"]}/layers'))
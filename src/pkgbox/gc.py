@@ -0,0 +1,163 @@
+"""
+Garbage collection of the layer store.
+
+Blobs referenced by pinned manifests, or by manifests used within the
+`recent` window, are always kept. Other blobs are evicted least recently
+used first until the store usage is under a quota. Sizes and access
+times come from the store index and access logs, so a collection never
+scans the blobs directory.
+
+Partial files of incomplete blobs (interrupted downloads, layers being
+written) count in the store usage. Those not modified for `partial_age`
+seconds, and whose lock is free, are removed first. Their age is
+measured with the clock of the filesystem holding the store, as the
+lock files do, so clock skew between hosts sharing it does not matter.
+"""
+import os
+import re
+import time
+import heapq
+from dataclasses import dataclass
+from typing import Optional, Set
+
+from . import errors, image
+from .cache import ManifestCache
+from .lock import FileLock
+from .oci.v1 import Descriptor
+from .store import BlobStore
+
+
+DEFAULT_RECENT = 7 * 24 * 3600
+DEFAULT_PARTIAL_AGE = 24 * 3600
+
+_SIZE_RE = re.compile(r'^\s*(\d+(?:\.\d+)?)\s*([kmgt]?)i?b?\s*$', re.I)
+_UNITS = {'': 1, 'k': 1024, 'm': 1024 ** 2, 'g': 1024 ** 3, 't': 1024 ** 4}
+
+
+@dataclass
+class Result:
+    """
+    Result of a collection: blobs removed, bytes freed, referenced
+    blobs kept, blobs skipped because they were in use, partial blobs
+    removed and the store usage after the collection.
+    """
+    removed: int = 0
+    freed: int = 0
+    referenced: int = 0
+    busy: int = 0
+    partials: int = 0
+    usage: int = 0
+
+
+def parse_size(value: str) -> int:
+    """
+    Parse a size such as "512M", "10G" or "1048576" into bytes.
+    """
+    m = _SIZE_RE.match(value)
+    if not m:
+        raise errors.PBError(f'Invalid size "{value}"')
+
+    return int(float(m.group(1)) * _UNITS[m.group(2).lower()])
+
+
+def referenced(cache: ManifestCache, recent: float = DEFAULT_RECENT) -> Set[str]:
+    """
+    Return the blobs referenced by pinned manifests and by manifests
+    used within the last `recent` seconds.
+    """
+    manifests = [(d, cache.get(d)) for d in cache.pins().values()]
+    manifests.extend(cache.manifests(since=time.time() - recent))
+
+    keep = set()
+    for digest, data in manifests:
+        if data is None:
+            continue
+        try:
+            keep.update(str(layer) for layer in image.parse_manifest(data, digest).layers)
+        except (ValueError, KeyError):
+            continue
+
+    return keep
+
+
+def _now(store: BlobStore) -> float:
+    """
+    Return the current time of the filesystem clock of the store.
+    """
+    path = store.partial_dir / '.clock'
+    path.touch()
+    return os.stat(path).st_mtime
+
+
+def _lock(lock: FileLock) -> bool:
+    try:
+        lock.acquire()
+    except errors.PBError:
+        return False
+    return True
+
+
+def collect(store: BlobStore, cache: Optional[ManifestCache] = None, quota: int = 0,
+            recent: float = DEFAULT_RECENT, dry_run: bool = False,
+            partial_age: float = DEFAULT_PARTIAL_AGE) -> Result:
+    """
+    Evict unreferenced blobs, least recently used first, until the
+    store usage is under `quota` bytes (`0` evicts all of them), after
+    removing partial blobs older than `partial_age` seconds.
+
+    Blobs and partial blobs locked by a running download or writer
+    are skipped. With `dry_run`, nothing is removed but the result is
+    computed as if it was.
+    """
+    result = Result()
+    blobs = store.blobs()
+    partials = store.partials()
+    keep = referenced(cache, recent) if cache else set()
+    usage = sum(blobs.values()) + sum(size for size, _ in partials.values())
+
+    now = _now(store)
+    for name, (size, mtime) in partials.items():
+        if now - mtime < partial_age:
+            continue
+        if not dry_run:
+            lock = store.partial_lock(name, timeout=0)
+            if not _lock(lock):
+                result.busy += 1
+                continue
+            try:
+                store.remove_partial(name)
+            finally:
+                lock.release()
+        result.partials += 1
+        result.freed += size
+        usage -= size
+
+    candidates = []
+    for name, size in blobs.items():
+        if name in keep:
+            result.referenced += 1
+            continue
+        desc = Descriptor.from_str(name)
+        candidates.append((store.last_access(desc), name, desc, size))
+    heapq.heapify(candidates)
+
+    while candidates and usage > quota:
+        _, _, desc, size = heapq.heappop(candidates)
+        if not dry_run:
+            lock = store.lock(desc, timeout=0)
+            if not _lock(lock):
+                result.busy += 1
+                continue
+            try:
+                store.remove(desc)
+            finally:
+                lock.release()
+        result.removed += 1
+        result.freed += size
+        usage -= size
+
+    if result.removed and not dry_run:
+        store.compact(force=False)
+    result.usage = usage
+
+    return result
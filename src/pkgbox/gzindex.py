@@ -0,0 +1,652 @@
+"""
+Seekable index of layer blobs.
+
+Reading one file of a gzipped layer normally means decompressing the
+layer up to it. An index is built once per blob, in a single pass, and
+kept next to it in the store as `{digest}.idx`. It holds the tar headers
+of the layer with the offsets of their data, and zran style checkpoints
+taken about every `SPAN` bytes of tar stream at deflate block boundaries:
+the blob offset, down to the bit, and the last 32 KiB of output, which is
+all a raw inflate needs to resume there. Reading a file then decompresses
+at most `SPAN` bytes before reaching it.
+
+Resuming in the middle of a deflate stream takes `Z_BLOCK` and
+`inflatePrime`, which the `zlib` module does not expose, so the system
+zlib library is used through `ctypes`. Without it, indexes hold no
+checkpoints and reads decompress the blob from its start, as they do
+for zstd layers, whose decompressor can not resume mid-stream.
+
+Index layout, little endian:
+
+- header: magic, compression (u8: none, gzip, zstd), blob size (u64),
+  checkpoint count (u32)
+- checkpoints: blob offset (u64), bits (u8), tar offset (u64), window
+  size (u32) and the zlib compressed window
+- members, zlib compressed: data offset (u64), size (u64), mtime (i64),
+  mode, uid, gid (u32), type (u8), name and link sizes (u32), name, link
+"""
+import io
+import os
+import gzip
+import stat
+import zlib
+import errno
+import ctypes
+import struct
+import tarfile
+import pathlib
+import functools
+import threading
+import ctypes.util
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import BinaryIO, Iterator, List, Optional, Tuple
+
+from . import errors, rootfs, trace, zstd
+from .extract import _GZIP_MAGIC, READ_SIZE, _clean
+from .oci.v1 import Descriptor, Manifest
+from .store import BlobStore
+
+
+SPAN = 4 * 1024 * 1024
+WORKERS = 4
+WINDOW_SIZE = 32 * 1024
+OUT_SIZE = 256 * 1024
+
+_MAGIC = b'PBGZIX1\0'
+_HEADER = struct.Struct('<8sBQI')
+_POINT = struct.Struct('<QBQI')
+_MEMBER = struct.Struct('<QQqIIIBII')
+_COMPRESSIONS = ('', 'gzip', 'zstd')
+
+_Z_OK = 0
+_Z_STREAM_END = 1
+_Z_BUF_ERROR = -5
+_Z_NO_FLUSH = 0
+_Z_BLOCK = 5
+_GZIP_WBITS = 16 + zlib.MAX_WBITS
+_RAW_WBITS = -zlib.MAX_WBITS
+
+_MODES = {
+    tarfile.DIRTYPE: stat.S_IFDIR,
+    tarfile.SYMTYPE: stat.S_IFLNK,
+    tarfile.FIFOTYPE: stat.S_IFIFO,
+    tarfile.CHRTYPE: stat.S_IFCHR,
+    tarfile.BLKTYPE: stat.S_IFBLK,
+}
+
+
+class _ZStream(ctypes.Structure):
+    _fields_ = [
+        ('next_in', ctypes.c_void_p),
+        ('avail_in', ctypes.c_uint),
+        ('total_in', ctypes.c_ulong),
+        ('next_out', ctypes.c_void_p),
+        ('avail_out', ctypes.c_uint),
+        ('total_out', ctypes.c_ulong),
+        ('msg', ctypes.c_char_p),
+        ('state', ctypes.c_void_p),
+        ('zalloc', ctypes.c_void_p),
+        ('zfree', ctypes.c_void_p),
+        ('opaque', ctypes.c_void_p),
+        ('data_type', ctypes.c_int),
+        ('adler', ctypes.c_ulong),
+        ('reserved', ctypes.c_ulong),
+    ]
+
+
+@functools.lru_cache(maxsize=None)
+def _libz() -> Optional[ctypes.CDLL]:
+    """
+    Return the system zlib library, `None` if it can not be loaded.
+    """
+    for name in ('libz.so.1', 'libz.dylib', ctypes.util.find_library('z')):
+        if not name:
+            continue
+        try:
+            lib = ctypes.CDLL(name)
+            break
+        except OSError:
+            continue
+    else:
+        return None
+
+    strm = ctypes.POINTER(_ZStream)
+    lib.zlibVersion.restype = ctypes.c_char_p
+    lib.inflateInit2_.argtypes = [strm, ctypes.c_int, ctypes.c_char_p, ctypes.c_int]
+    lib.inflate.argtypes = [strm, ctypes.c_int]
+    lib.inflateEnd.argtypes = [strm]
+    lib.inflatePrime.argtypes = [strm, ctypes.c_int, ctypes.c_int]
+    lib.inflateSetDictionary.argtypes = [strm, ctypes.c_char_p, ctypes.c_uint]
+    lib.inflateReset2.argtypes = [strm, ctypes.c_int]
+    return lib
+
+
+class _Inflate:
+    """
+    Inflate stream of the system zlib library.
+    """
+    def __init__(self, lib: ctypes.CDLL, wbits: int) -> None:
+        self.lib = lib
+        self.strm = _ZStream()
+        self._out = ctypes.create_string_buffer(OUT_SIZE)
+        self._in = None
+        self._full = False
+        self._check(lib.inflateInit2_(ctypes.byref(self.strm), wbits, lib.zlibVersion(), ctypes.sizeof(_ZStream)))
+
+    def _check(self, ret: int) -> int:
+        if ret not in (_Z_OK, _Z_STREAM_END, _Z_BUF_ERROR):
+            msg = self.strm.msg.decode() if self.strm.msg else f'zlib error {ret}'
+            raise errors.PBError(f'Invalid compressed data: {msg}', errno.EIO)
+        return ret
+
+    @property
+    def pending(self) -> int:
+        """
+        Return the amount of fed bytes not consumed yet.
+        """
+        return self.strm.avail_in
+
+    @property
+    def hungry(self) -> bool:
+        """
+        Check if more input is needed to make progress: every fed byte
+        is consumed and no output is left in zlib buffers.
+        """
+        return not self.strm.avail_in and not self._full
+
+    def feed(self, data: bytes) -> None:
+        """
+        Set the next input bytes, once the previous ones are consumed.
+        """
+        self._in = ctypes.create_string_buffer(data, len(data))
+        self.strm.next_in = ctypes.addressof(self._in)
+        self.strm.avail_in = len(data)
+
+    def skip(self, size: int) -> int:
+        """
+        Drop up to `size` pending input bytes, returning how many were.
+        """
+        size = min(size, self.strm.avail_in)
+        self.strm.next_in += size
+        self.strm.avail_in -= size
+        return size
+
+    def inflate(self, flush: int = _Z_NO_FLUSH) -> Tuple[int, bytes]:
+        """
+        Inflate pending input, returning the zlib status and the output.
+        """
+        self.strm.next_out = ctypes.addressof(self._out)
+        self.strm.avail_out = OUT_SIZE
+        ret = self._check(self.lib.inflate(ctypes.byref(self.strm), flush))
+        self._full = not self.strm.avail_out
+        return ret, ctypes.string_at(self._out, OUT_SIZE - self.strm.avail_out)
+
+    def reset(self, wbits: int) -> None:
+        self._check(self.lib.inflateReset2(ctypes.byref(self.strm), wbits))
+
+    def prime(self, bits: int, value: int) -> None:
+        self._check(self.lib.inflatePrime(ctypes.byref(self.strm), bits, value))
+
+    def dictionary(self, window: bytes) -> None:
+        self._check(self.lib.inflateSetDictionary(ctypes.byref(self.strm), window, len(window)))
+
+    def close(self) -> None:
+        self.lib.inflateEnd(ctypes.byref(self.strm))
+
+
+@dataclass
+class Point:
+    """
+    A checkpoint of a gzipped blob: the blob offset, and the amount of
+    bits of the byte before it, where a deflate block starts, the
+    matching tar stream offset and the 32 KiB of output before it.
+
+    A checkpoint without window is the start of a gzip member, reads
+    from it need no dictionary. `_Builder` never takes such checkpoints,
+    the indexes of eStargz layers built from their TOC only have those.
+    """
+    offset: int
+    bits: int
+    position: int
+    window: bytes
+
+
+class _Builder:
+    """
+    File-like object reading the tar stream of a gzipped blob, taking a
+    checkpoint every `span` bytes of it.
+    """
+    def __init__(self, f: BinaryIO, lib: ctypes.CDLL, span: int) -> None:
+        self.f = f
+        self.span = span
+        self.inflate = _Inflate(lib, _GZIP_WBITS)
+        self.fed = 0
+        self.position = 0
+        self.buffer = bytearray()
+        self.window = bytearray()
+        self.points: List[Point] = []
+        self.eof = False
+
+    def _step(self) -> None:
+        if self.inflate.hungry:
+            chunk = self.f.read(READ_SIZE)
+            if not chunk:
+                self.eof = True
+                return
+            self.inflate.feed(chunk)
+            self.fed += len(chunk)
+
+        ret, out = self.inflate.inflate(_Z_BLOCK)
+        self.position += len(out)
+        self.buffer += out
+        self.window += out
+        if len(self.window) > 2 * WINDOW_SIZE:
+            del self.window[:-WINDOW_SIZE]
+
+        if ret == _Z_STREAM_END:
+            # concatenated gzip members
+            self.inflate.reset(_GZIP_WBITS)
+            return
+
+        data_type = self.inflate.strm.data_type
+        last = self.points[-1].position if self.points else 0
+        # at a block boundary which is not the end of the stream
+        if data_type & 128 and not data_type & 64 and self.position - last >= self.span:
+            offset = self.fed - self.inflate.pending
+            self.points.append(Point(offset, data_type & 7, self.position, bytes(self.window[-WINDOW_SIZE:])))
+
+    def read(self, size: int = -1) -> bytes:
+        while not self.eof and (size < 0 or len(self.buffer) < size):
+            self._step()
+
+        if size < 0:
+            size = len(self.buffer)
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return data
+
+    def close(self) -> None:
+        self.inflate.close()
+
+
+class Index:
+    """
+    Index of a layer blob: its tar headers and gzip checkpoints.
+
+    `compression` is "gzip", "zstd" or empty for a plain tar blob.
+    """
+    def __init__(self, compression: str, size: int, points: List[Point],
+                 members: List[tarfile.TarInfo]) -> None:
+        """
+        Create a new index object instance.
+        """
+        self.compression = compression
+        self.size = size
+        self.points = points
+        self.members = members
+
+    def find(self, name: str, before: Optional[tarfile.TarInfo] = None) -> Optional[tarfile.TarInfo]:
+        """
+        Return the last member named `name`, if any, only looking at
+        the members preceding `before` if set, like the target of a
+        hardlink.
+        """
+        name = _clean(name)
+        members = self.members
+        if before is not None:
+            end = next((i for i, m in enumerate(members) if m is before), len(members))
+            members = members[:end]
+        for member in reversed(members):
+            if _clean(member.name) == name:
+                return member
+        return None
+
+    def _point(self, position: int) -> Optional[Point]:
+        """
+        Return the checkpoint reads of `position` start from, `None`
+        for the start of the blob.
+        """
+        usable = _libz() is not None
+        point = None
+        for p in self.points:
+            if p.position > position:
+                break
+            if usable or not p.window:
+                point = p
+        return point
+
+    def extent(self, member: tarfile.TarInfo) -> Tuple[int, int]:
+        """
+        Return the range of blob bytes, `[start, end)`, read to get the
+        content of a regular file member.
+        """
+        start, end = member.offset_data, member.offset_data + member.size
+        if not self.compression:
+            return start, end
+        if self.compression == 'zstd':
+            return 0, self.size
+
+        point = self._point(start)
+        first = point.offset - (1 if point.bits else 0) if point else 0
+        for p in self.points:
+            # everything before a deflate block boundary is decoded
+            # without reading past it
+            if p.position >= end:
+                return first, p.offset
+        return first, self.size
+
+    def _inflate(self, f: BinaryIO, member: tarfile.TarInfo) -> Tuple[int, Iterator[bytes]]:
+        """
+        Return the tar stream offset reads of `member` start from and
+        an iterator over the tar stream from there.
+        """
+        if not self.compression:
+            f.seek(member.offset_data)
+            size = member.size
+            return member.offset_data, iter(lambda: f.read(min(READ_SIZE, size)), b'')
+        if self.compression == 'zstd':
+            return 0, _py_inflate(f, None, self.size, zstd.MAGIC)
+
+        point = self._point(member.offset_data)
+        start = point.position if point else 0
+        limit = self.extent(member)[1]
+        lib = _libz()
+        if lib is None:
+            return start, _py_inflate(f, point, limit)
+        return start, _lib_inflate(lib, f, point, limit)
+
+    def read(self, blob: pathlib.Path, member: tarfile.TarInfo) -> Iterator[bytes]:
+        """
+        Yield the content of a regular file member of the blob.
+        """
+        with open(blob, 'rb') as f:
+            yield from self.read_from(f, member)
+
+    def read_from(self, f: BinaryIO, member: tarfile.TarInfo) -> Iterator[bytes]:
+        """
+        Yield the content of a regular file member, reading the blob
+        from the seekable file object `f`.
+        """
+        start, end = member.offset_data, member.offset_data + member.size
+        position, chunks = self._inflate(f, member)
+        for chunk in chunks:
+            lo, hi = max(start, position), min(end, position + len(chunk))
+            if hi > lo:
+                yield chunk[lo - position:hi - position]
+            position += len(chunk)
+            if position >= end:
+                return
+
+        if position < end:
+            raise errors.PBError(f'Layer blob is truncated, reading "{member.name}"', errno.EIO)
+
+    def save(self, path: pathlib.Path) -> None:
+        """
+        Write the index to `path`, atomically.
+        """
+        out = bytearray(_HEADER.pack(_MAGIC, _COMPRESSIONS.index(self.compression), self.size, len(self.points)))
+        for p in self.points:
+            window = zlib.compress(p.window)
+            out += _POINT.pack(p.offset, p.bits, p.position, len(window))
+            out += window
+
+        members = bytearray()
+        for m in self.members:
+            name = m.name.encode('utf-8', 'surrogateescape')
+            link = m.linkname.encode('utf-8', 'surrogateescape')
+            members += _MEMBER.pack(m.offset_data, m.size, int(m.mtime), m.mode, m.uid, m.gid,
+                                    ord(m.type), len(name), len(link))
+            members += name + link
+        out += zlib.compress(members)
+
+        tmp = path.with_name(f'{path.name}.{os.getpid()}.{threading.get_ident()}.tmp')
+        with open(tmp, 'wb') as f:
+            f.write(out)
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path: pathlib.Path) -> Optional['Index']:
+        """
+        Read an index from `path`, returning `None` if it is missing
+        or invalid.
+        """
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            magic, compression, size, count = _HEADER.unpack_from(data)
+            if magic != _MAGIC:
+                return None
+
+            pos = _HEADER.size
+            points = []
+            for _ in range(count):
+                offset, bits, position, length = _POINT.unpack_from(data, pos)
+                pos += _POINT.size
+                points.append(Point(offset, bits, position, zlib.decompress(data[pos:pos + length])))
+                pos += length
+
+            records = zlib.decompress(data[pos:])
+            compression = _COMPRESSIONS[compression]
+        except (OSError, struct.error, zlib.error, IndexError):
+            return None
+
+        members = []
+        pos = 0
+        while pos < len(records):
+            offset, size_, mtime, mode, uid, gid, kind, nlen, llen = _MEMBER.unpack_from(records, pos)
+            pos += _MEMBER.size
+            m = tarfile.TarInfo(records[pos:pos + nlen].decode('utf-8', 'surrogateescape'))
+            pos += nlen
+            m.linkname = records[pos:pos + llen].decode('utf-8', 'surrogateescape')
+            pos += llen
+            m.offset_data, m.size, m.mtime, m.mode, m.uid, m.gid = offset, size_, mtime, mode, uid, gid
+            m.type = bytes([kind])
+            members.append(m)
+
+        return cls(compression, size, points, members)
+
+
+def _read(f: BinaryIO, limit: int) -> bytes:
+    """
+    Read the next chunk of a blob, stopping at offset `limit`.
+    """
+    return f.read(max(0, min(READ_SIZE, limit - f.tell())))
+
+
+def _py_inflate(f: BinaryIO, point: Optional[Point], limit: int, head: bytes = _GZIP_MAGIC) -> Iterator[bytes]:
+    """
+    Yield the tar stream of a gzipped blob, from the gzip member
+    starting at `point` or from its start, up to offset `limit`.
+    Blobs compressed otherwise are told apart by their `head` bytes.
+    """
+    f.seek(point.offset if point else 0)
+    inflater = rootfs._Inflater(head)
+    while (chunk := _read(f, limit)):
+        yield inflater.feed(chunk)
+
+
+def _lib_inflate(lib: ctypes.CDLL, f: BinaryIO, point: Optional[Point], limit: int) -> Iterator[bytes]:
+    """
+    Yield the tar stream of a gzipped blob, from `point` or from its
+    start, up to offset `limit`.
+    """
+    raw = bool(point and point.window)
+    inflate = _Inflate(lib, _RAW_WBITS if raw else _GZIP_WBITS)
+    try:
+        if raw:
+            f.seek(point.offset - (1 if point.bits else 0))
+            if point.bits:
+                inflate.prime(point.bits, f.read(1)[0] >> (8 - point.bits))
+            inflate.dictionary(point.window)
+        else:
+            f.seek(point.offset if point else 0)
+
+        trailer = 0
+        while True:
+            if inflate.hungry or (trailer and not inflate.pending):
+                chunk = _read(f, limit)
+                if not chunk:
+                    return
+                inflate.feed(chunk)
+            if trailer:
+                # the raw stream ended: skip its gzip trailer and go on
+                # with the next gzip member
+                trailer -= inflate.skip(trailer)
+                if not trailer:
+                    inflate.reset(_GZIP_WBITS)
+                continue
+
+            ret, out = inflate.inflate()
+            if out:
+                yield out
+            if ret == _Z_STREAM_END:
+                if raw:
+                    raw = False
+                    trailer = 8
+                else:
+                    inflate.reset(_GZIP_WBITS)
+    finally:
+        inflate.close()
+
+
+@trace.traced('gzindex.build')
+def build(blob: pathlib.Path, span: int = SPAN) -> Index:
+    """
+    Build the index of a layer blob.
+    """
+    with open(blob, 'rb') as f:
+        return build_from(f, os.fstat(f.fileno()).st_size, span)
+
+
+def build_from(f: io.BufferedReader, size: int, span: int = SPAN) -> Index:
+    """
+    Build the index of a layer blob of `size` bytes, read sequentially
+    from `f`.
+    """
+    head = f.peek(len(zstd.MAGIC))[:len(zstd.MAGIC)]
+    lib = _libz()
+    if head == zstd.MAGIC:
+        with tarfile.open(fileobj=zstd.reader(f, closefd=False), mode='r|') as tar:
+            return Index('zstd', size, [], list(tar))
+    if not head.startswith(_GZIP_MAGIC):
+        with tarfile.open(fileobj=f, mode='r|') as tar:
+            return Index('', size, [], list(tar))
+    if lib is None:
+        with gzip.GzipFile(fileobj=f) as gz, tarfile.open(fileobj=gz, mode='r|') as tar:
+            return Index('gzip', size, [], list(tar))
+
+    reader = _Builder(f, lib, span)
+    try:
+        with tarfile.open(fileobj=reader, mode='r|') as tar:
+            members = list(tar)
+    finally:
+        reader.close()
+    return Index('gzip', size, reader.points, members)
+
+
+def index_path(store: BlobStore, desc: Descriptor) -> pathlib.Path:
+    """
+    Return the path of the index of a blob.
+    """
+    return store.sidecar(desc, 'idx')
+
+
+def toc_index_path(store: BlobStore, desc: Descriptor) -> pathlib.Path:
+    """
+    Return the path of the index of a remote blob read from its
+    eStargz table of contents. Its content is not verified, so it is
+    kept apart from the index of the blob and never used once the blob
+    is in the store.
+    """
+    return store.sidecar(desc, 'toc.idx')
+
+
+def get(store: BlobStore, desc: Descriptor) -> Index:
+    """
+    Return the index of a blob of the store, building it on first use.
+    """
+    if not store.exists(desc):
+        raise errors.PBError(f'Layer {desc} is not in the store', errno.ENOENT)
+
+    path = index_path(store, desc)
+    index = Index.load(path)
+    if index is None or index.size != store.size(desc):
+        index = build(store.path(desc))
+        index.save(path)
+    return index
+
+
+class Files:
+    """
+    Files of an image, read from the indexes of its layers.
+    """
+    def __init__(self, manifest: Manifest, store: BlobStore) -> None:
+        """
+        Load, or build, the indexes of the image layers, up to `WORKERS`
+        at a time, and merge them.
+        """
+        self.store = store
+        self.manifest = manifest
+        self.layers = list(manifest.layers)
+        with ThreadPoolExecutor(max_workers=max(1, min(WORKERS, len(self.layers)))) as pool:
+            self.indexes = list(pool.map(self._index, self.layers))
+        self.tree = rootfs.merge([index.members for index in self.indexes])
+
+    def _index(self, layer: Descriptor) -> Index:
+        return get(self.store, layer)
+
+    def _read(self, n: int, member: tarfile.TarInfo) -> Iterator[bytes]:
+        self.store.touch(self.layers[n])
+        return self.indexes[n].read(self.store.path(self.layers[n]), member)
+
+    def list(self, path: str = '') -> List[Tuple[str, Optional[tarfile.TarInfo]]]:
+        """
+        Return the (path, member) entries under `path`, sorted by path.
+        Directories only implied by their children have no member.
+        """
+        prefix = _clean(path)
+        node = self.tree.lookup(prefix)
+        if node is None:
+            raise errors.PBError(f'"{path}" not found', errno.ENOENT)
+        if not node.is_dir:
+            return [(prefix, node.entry.member)]
+
+        return sorted((name, child.entry.member if child.entry else None)
+                      for name, child in self.tree.walk(node, prefix))
+
+    def find(self, path: str) -> Tuple[int, tarfile.TarInfo]:
+        """
+        Return the layer number and the regular file member of the file
+        at `path`, following symlinks and hardlinks.
+        """
+        node = self.tree.lookup(path)
+        if node is None:
+            raise errors.PBError(f'"{path}" not found', errno.ENOENT)
+        if node.is_dir:
+            raise errors.PBError(f'"{path}" is a directory', errno.EISDIR)
+
+        n, member = node.entry.layer, node.entry.member
+        if member.islnk():
+            member = self.indexes[n].find(member.linkname, member)
+            if member is None:
+                raise errors.PBError(f'Hardlink target of "{path}" not found', errno.ENOENT)
+        if not member.isreg():
+            raise errors.PBError(f'"{path}" is not a regular file', errno.EINVAL)
+        return n, member
+
+    def read(self, path: str) -> Iterator[bytes]:
+        """
+        Yield the content of a file, following symlinks.
+        """
+        return self._read(*self.find(path))
+
+
+def filemode(member: Optional[tarfile.TarInfo]) -> str:
+    """
+    Return the `ls -l` style mode string of a member, implied
+    directories included.
+    """
+    if member is None:
+        return stat.filemode(stat.S_IFDIR | 0o755)
+    return stat.filemode(_MODES.get(member.type, stat.S_IFREG) | member.mode)
@@ -1,11 +1,46 @@
 import os
+import json
+import base64
+import time
+import errno
+import hashlib
 import pathlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
-from typing import Any, Dict
+from typing import Any, Callable, Dict, List, Optional, Protocol, Tuple
 
 import requests
+from requests.adapters import HTTPAdapter
 
-from .oci.v1 import Descriptor, Manifest
+from . import env, errors, trace
+from .cache import ManifestCache
+from .oci.v1 import INDEXES, MANIFESTS, OCI_INDEX, OCI_MANIFEST, Config, Descriptor, ImageIndex, Manifest, Platform
+from .store import BlobStore
+
+
+DEFAULT_WORKERS = 4
+POOL_SIZE = 16
+MIN_CHUNK_SIZE = 64 * 1024
+MAX_CHUNK_SIZE = 4 * 1024 * 1024
+ACCEPT = ', '.join(INDEXES + MANIFESTS)
+
+Progress = Callable[[Descriptor, int, Optional[int]], None]
+
+_ARCHITECTURES = {
+    'x86_64': 'amd64',
+    'amd64': 'amd64',
+    'aarch64': 'arm64',
+    'arm64': 'arm64',
+    'armv7l': 'arm',
+    'armv6l': 'arm',
+    'i386': '386',
+    'i686': '386',
+}
+_VARIANTS = {'aarch64': 'v8', 'armv7l': 'v7', 'armv6l': 'v6'}
+
+_sessions: Dict[str, requests.Session] = {}
+_sessions_lock = threading.Lock()
 
 
 @dataclass
@@ -13,13 +48,24 @@ class Image:
     """
     Image dataclass to store an image reference data
     from an image name, such as "registry.fedoraproject.org/fedora:39".
+
+    Digest references, such as "registry.fedoraproject.org/fedora@sha256:...",
+    store the digest as their tag.
     """
     registry: str
     namespace: str
     tag: str
 
+    @property
+    def is_digest(self) -> bool:
+        """
+        Check if the image is referenced by digest instead of by tag.
+        """
+        return ':' in self.tag
+
     def __str__(self) -> str:
-        return f'{self.registry}/{self.namespace}:{self.tag}'
+        sep = '@' if self.is_digest else ':'
+        return f'{self.registry}/{self.namespace}{sep}{self.tag}'
 
     def __eq__(other: 'Image', self) -> bool:
         if self.registry != other.registry:
@@ -41,53 +87,476 @@ def from_str(name: str) -> Image:
     parts = name.split('/')
 
     reg = parts[0]
-    namespace, tag = '/'.join(parts[1:]).split(':')
+    rest = '/'.join(parts[1:])
+    if '@' in rest:
+        namespace, tag = rest.split('@')
+    else:
+        namespace, tag = rest.split(':')
 
     return Image(reg, namespace, tag)
 
 
-def info(image: Image) -> Manifest:
+class Tee(Protocol):
     """
-    Get the required info, such as  layer urls,
-    to be fetched.
+    Consumer of the bytes of a blob, fed while it is downloaded.
     """
-    baseurl = f'https://{image.registry}/v2/{image.namespace}'
+    def write(self, data: bytes) -> None: pass
+
+    def reset(self) -> None: pass
+
+
+@dataclass
+class RetryPolicy:
+    """
+    Retry policy of blob downloads.
+
+    A download is tried up to `attempts` times, waiting `backoff` seconds
+    after the first failure and multiplying the wait by `factor` after each
+    following one, up to `max_backoff`. `timeout` is the connect/read timeout
+    of each attempt.
+    """
+    attempts: int = 5
+    backoff: float = 0.5
+    factor: float = 2.0
+    max_backoff: float = 30.0
+    timeout: float = 60.0
+
+    def delay(self, attempt: int) -> float:
+        """
+        Return the wait time after the failed `attempt` (0 based).
+        """
+        return min(self.max_backoff, self.backoff * self.factor ** attempt)
+
+    def should_retry(self, error: requests.exceptions.RequestException) -> bool:
+        """
+        Check if a request error is transient: connection and read errors,
+        5xx and 429 responses.
+        """
+        if isinstance(error, requests.exceptions.HTTPError):
+            status = error.response.status_code
+            return status >= 500 or status == 429
+
+        transient = (
+            requests.exceptions.ConnectionError,
+            requests.exceptions.Timeout,
+            requests.exceptions.ChunkedEncodingError,
+        )
+        return isinstance(error, transient)
+
+
+def session(registry: str) -> requests.Session:
+    """
+    Return the shared keep-alive session of a registry.
+
+    Sessions are created once per registry and reused by every
+    request, so concurrent layer downloads share a connection pool.
+    """
+    with _sessions_lock:
+        s = _sessions.get(registry)
+        if s is None:
+            s = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=POOL_SIZE)
+            s.mount('http://', adapter)
+            s.mount('https://', adapter)
+            _sessions[registry] = s
+        return s
+
+
+def baseurl(image: Image) -> str:
+    """
+    Return the registry api base url of an image.
+
+    Registries listed in the comma separated `PKGBOX_INSECURE_REGISTRIES`
+    env var are accessed using plain http.
+    """
+    insecure = (env.getvar('PKGBOX_INSECURE_REGISTRIES') or '').split(',')
+    scheme = 'http' if image.registry in insecure else 'https'
+
+    return f'{scheme}://{image.registry}/v2/{image.namespace}'
+
+
+def _descriptor(data: Dict[str, Any]) -> Descriptor:
+    platform = data.get('platform')
+    if platform is not None:
+        platform = Platform(platform.get('os', ''), platform.get('architecture', ''), platform.get('variant'))
+
+    return Descriptor(*data['digest'].split(':'), data.get('mediaType'), data.get('size'), platform)
 
-    res = requests.get(f'{baseurl}/manifests/{image.tag}')
-    data = res.json()
+
+def is_index(data: bytes) -> bool:
+    """
+    Check if a manifest response body is an image index (or a docker
+    manifest list) rather than an image manifest.
+    """
+    data = json.loads(data)
+    return data.get('mediaType') in INDEXES or ('manifests' in data and 'layers' not in data)
+
+
+def parse_manifest(data: bytes, digest: Descriptor) -> Manifest:
+    """
+    Parse a manifest response body, either a schema1 manifest or a
+    schema2 / OCI one. Layers are listed base layer first, while schema1
+    manifests list them the other way around.
+
+    Schema2 manifests have no name, tag or architecture: those are set
+    by `info`.
+    """
+    data = json.loads(data)
+
+    if data.get('schemaVersion', 1) != 1:
+        return Manifest(
+            name='',
+            tag='',
+            architecture='',
+            layers=[_descriptor(d) for d in data['layers']],
+            history=[],
+            signatures=[],
+            digest=digest,
+            media_type=data.get('mediaType', OCI_MANIFEST),
+            config=_descriptor(data['config'])
+        )
 
     return Manifest(
         name=data['name'],
         tag=data['tag'],
         architecture=data['architecture'],
-        layers=[Descriptor.from_str(s['blobSum']) for s in data['fsLayers']],
+        layers=[Descriptor.from_str(s['blobSum']) for s in reversed(data['fsLayers'])],
         history=data.get('history', []),
         signatures=data.get('signatures', []),
-        digest=Descriptor.from_str(res.headers['docker-content-digest'])
+        digest=digest
+    )
+
+
+def parse_index(data: bytes, digest: Descriptor) -> ImageIndex:
+    """
+    Parse an image index response body.
+    """
+    data = json.loads(data)
+
+    return ImageIndex(
+        media_type=data.get('mediaType', OCI_INDEX),
+        manifests=[_descriptor(d) for d in data['manifests']],
+        digest=digest
+    )
+
+
+def default_platform() -> Platform:
+    """
+    Return the platform images are pulled for: the `PKGBOX_PLATFORM` env
+    var, such as "linux/arm64/v8", or the host platform.
+    """
+    if (value := env.getvar('PKGBOX_PLATFORM')):
+        return Platform.from_str(value)
+
+    machine = os.uname().machine.lower()
+    return Platform('linux', _ARCHITECTURES.get(machine, machine), _VARIANTS.get(machine))
+
+
+def select_platform(index: ImageIndex, platform: Platform) -> Descriptor:
+    """
+    Return the descriptor of the first manifest of an index matching
+    `platform`.
+    """
+    for desc in index.manifests:
+        if desc.platform and platform.matches(desc.platform):
+            return desc
+
+    available = ', '.join(str(d.platform) for d in index.manifests if d.platform)
+    raise errors.PBError(f'No manifest for platform {platform} (available: {available or "none"})', errno.ENOENT)
+
+
+def _b64decode(data: str) -> bytes:
+    return base64.urlsafe_b64decode(data + '=' * (-len(data) % 4))
+
+
+def _signed_payload(body: bytes) -> bytes:
+    """
+    Return the content the digest of a manifest covers: its body, or
+    the signed payload of a schema1 signed manifest, which is the body
+    without its signatures.
+    """
+    if b'"signatures"' not in body:
+        return body
+    try:
+        data = json.loads(body)
+        protected = json.loads(_b64decode(data['signatures'][0]['protected']))
+        return body[:protected['formatLength']] + _b64decode(protected['formatTail'])
+    except (ValueError, KeyError, IndexError, TypeError):
+        return body
+
+
+def _get_manifest(image: Image, cache: Optional[ManifestCache]) -> Tuple[bytes, Descriptor]:
+    """
+    Return a manifest, or index, body and its digest, from the cache if
+    it is fresh there.
+    """
+    headers = {'Accept': ACCEPT}
+    body = None
+
+    if cache and image.is_digest:
+        digest = Descriptor.from_str(image.tag)
+        if (body := cache.get(digest)) is not None:
+            trace.event('image.manifest.cache.hit', ref=str(image))
+            return body, digest
+    elif cache and (ref := cache.ref(str(image))):
+        if (body := cache.get(ref.digest)) is not None:
+            if cache.is_fresh(ref):
+                trace.event('image.manifest.cache.hit', ref=str(image))
+                return body, ref.digest
+            headers['If-None-Match'] = f'"{ref.digest}"'
+
+    with trace.span('image.manifest', ref=str(image)):
+        res = session(image.registry).get(f'{baseurl(image)}/manifests/{image.tag}', headers=headers)
+
+    if res.status_code == 304 and body is not None:
+        trace.event('image.manifest.cache.revalidated', ref=str(image))
+        cache.touch(str(image), ref.digest)
+        return body, ref.digest
+    trace.event('image.manifest.cache.miss', ref=str(image))
+
+    try:
+        res.raise_for_status()
+    except requests.exceptions.HTTPError as e:
+        raise errors.PBError(str(e), e.response.status_code)
+
+    # digest references are trusted over the registry header,
+    # which is checked against the body either way
+    if image.is_digest:
+        digest = Descriptor.from_str(image.tag)
+    elif 'docker-content-digest' in res.headers:
+        digest = Descriptor.from_str(res.headers['docker-content-digest'])
+    else:
+        digest = Descriptor('sha256', hashlib.sha256(_signed_payload(res.content)).hexdigest())
+    if hashlib.new(digest.alg, _signed_payload(res.content)).hexdigest() != digest.digest:
+        raise errors.PBError(f'Digest mismatch for manifest {digest} of {image}', errno.EIO)
+    if cache:
+        cache.put(digest, res.content, None if image.is_digest else str(image))
+
+    return res.content, digest
+
+
+@trace.traced('image.resolve')
+def info(image: Image, cache: Optional[ManifestCache] = None, platform: Optional[Platform] = None) -> Manifest:
+    """
+    Get the required info, such as  layer urls,
+    to be fetched.
+
+    If a `cache` is provided, digest references are served from it without
+    any request, as are tag references validated within the cache ttl. Older
+    tag references are revalidated with a conditional request.
+
+    Multi-platform images are resolved to their manifest for `platform`,
+    `default_platform()` if not set.
+    """
+    body, digest = _get_manifest(image, cache)
+
+    desc = None
+    if is_index(body):
+        desc = select_platform(parse_index(body, digest), platform or default_platform())
+        body, digest = _get_manifest(Image(image.registry, image.namespace, str(desc)), cache)
+
+    manifest = parse_manifest(body, digest)
+    if manifest.schema_version != 1:
+        manifest.name, manifest.tag = image.namespace, image.tag
+        manifest.architecture = desc.platform.architecture if desc else ''
+
+    return manifest
+
+
+def parse_config(data: bytes) -> Config:
+    """
+    Parse an image configuration: a schema2 / OCI config blob or the
+    `v1Compatibility` entry of a schema1 manifest history.
+    """
+    data = json.loads(data)
+    config = data.get('config') or {}
+
+    return Config(
+        os=data.get('os', ''),
+        architecture=data.get('architecture', ''),
+        variant=data.get('variant'),
+        env=config.get('Env') or [],
+        entrypoint=config.get('Entrypoint') or [],
+        cmd=config.get('Cmd') or [],
+        working_dir=config.get('WorkingDir') or '',
+        user=config.get('User') or '',
+        labels=config.get('Labels') or {},
+        diff_ids=[Descriptor.from_str(d) for d in (data.get('rootfs') or {}).get('diff_ids', [])],
+        history=data.get('history') or []
     )
 
 
-def layer_exists(layer: Descriptor, dest: pathlib.Path) -> bool:
+def config(image: Image, manifest: Manifest, cache: Optional[ManifestCache] = None) -> Config:
     """
-    Checks if a layer exists in dest.
+    Return the configuration of an image.
+
+    Schema2 configs are blobs, verified and kept in the manifest
+    `cache` like manifests are. Schema1 manifests embed theirs.
     """
-    return os.path.exists(f'{dest}/{layer.digest}.tar.gz')
+    if manifest.config is None:
+        if not manifest.history:
+            raise errors.PBError(f'Manifest {manifest.digest} has no configuration', errno.ENOENT)
+        return parse_config(manifest.history[0]['v1Compatibility'])
+
+    desc = manifest.config
+    if cache and (body := cache.get(desc)) is not None:
+        return parse_config(body)
+
+    res = session(image.registry).get(f'{baseurl(image)}/blobs/{desc}', allow_redirects=True)
+    try:
+        res.raise_for_status()
+    except requests.exceptions.HTTPError as e:
+        raise errors.PBError(str(e), e.response.status_code)
 
+    if hashlib.new(desc.alg, res.content).hexdigest() != desc.digest:
+        raise errors.PBError(f'Digest mismatch for config {desc}', errno.EIO)
+    if cache:
+        cache.put(desc, res.content)
 
-def fetch(image: Image, manifest: Manifest, dest: pathlib.Path) -> None:
+    return parse_config(res.content)
+
+
+def layer_exists(layer: Descriptor, store: BlobStore) -> bool:
     """
-    Fecthes the image and its layers into the `dest` folder.
+    Checks if a verified layer exists in the store, recording
+    the access for the store garbage collection.
+    """
+    if not store.exists(layer):
+        return False
+    trace.event('image.layer.cached', layer=str(layer))
+    store.touch(layer)
+    return True
+
 
-    `dest` will be created in case it does not exist.
+def chunk_size(total: Optional[int]) -> int:
     """
-    baseurl = f'https://{image.registry}/v2/{image.namespace}'
-    os.makedirs(str(dest), exist_ok=True)
+    Return the download chunk size to use for a blob of `total` bytes.
 
+    Small blobs are read in small chunks while bigger ones use up to
+    `MAX_CHUNK_SIZE` bytes per chunk.
+    """
+    if not total:
+        return MIN_CHUNK_SIZE
+
+    return max(MIN_CHUNK_SIZE, min(MAX_CHUNK_SIZE, total // 64))
+
+
+def _total(stream: requests.Response) -> Optional[int]:
+    """
+    Return the full size of a blob from a (ranged) response, if known.
+    """
+    if stream.status_code == 206:
+        total = stream.headers.get('content-range', '').rpartition('/')[2]
+        return int(total) if total.isdigit() else None
+
+    total = stream.headers.get('content-length')
+    return int(total) if total else None
+
+
+def _feed(tee: Tee, path: pathlib.Path, size: int) -> None:
+    """
+    Feed the first `size` bytes of a file to `tee`.
+    """
+    with open(path, 'rb') as f:
+        while size > 0 and (chunk := f.read(min(size, MAX_CHUNK_SIZE))):
+            tee.write(chunk)
+            size -= len(chunk)
+
+
+def fetch_layer(image: Image, layer: Descriptor, store: BlobStore,
+                progress: Optional[Progress] = None, retry: Optional[RetryPolicy] = None,
+                tee: Optional[Tee] = None) -> None:
+    """
+    Download a single layer blob into the store.
+
+    The blob is hashed while it is downloaded and only committed into
+    the store if it matches the layer digest.
+
+    Interrupted downloads are retried according to `retry` and resumed
+    using a `Range` request, both within this call and across calls since
+    partial blobs are kept in the store. A full download is done if the
+    registry ignores the range.
+
+    Only one process sharing the store downloads a given layer at a time,
+    others wait for it and reuse its result.
+
+    `progress`, if provided, is called with the layer, the amount of bytes
+    downloaded so far and the total size (`None` if unknown) after each chunk.
+
+    `tee`, if provided, is fed the whole blob content from its first byte,
+    including the part of a resumed download read back from the partial
+    blob. It is not fed at all if the layer is already in the store.
+    """
+    url = f'{baseurl(image)}/blobs/{layer}'
+    retry = retry or RetryPolicy()
+
+    with trace.span('image.download', layer=str(layer)) as span, store.lock(layer):
+        if store.exists(layer):
+            # downloaded by another process while waiting for the lock
+            span.set(shared=True)
+            return
+
+        with store.writer(layer) as writer:
+            resumed = writer.size
+            if tee and writer.size:
+                _feed(tee, writer.partial_path, writer.size)
+
+            for attempt in range(retry.attempts):
+                headers = {'Range': f'bytes={writer.size}-'} if writer.size else {}
+                try:
+                    with session(image.registry).get(url, headers=headers, allow_redirects=True,
+                                                     stream=True, timeout=retry.timeout) as stream:
+                        if stream.status_code == 416:
+                            # the partial blob is already complete
+                            break
+                        stream.raise_for_status()
+                        if writer.size and stream.status_code != 206:
+                            writer.reset()
+                            resumed = 0
+                            if tee:
+                                tee.reset()
+
+                        total = _total(stream)
+                        for chunk in stream.iter_content(chunk_size=chunk_size(total)):
+                            writer.write(chunk)
+                            if tee:
+                                tee.write(chunk)
+                            if progress:
+                                progress(layer, writer.size, total)
+                    break
+                except requests.exceptions.RequestException as e:
+                    if not retry.should_retry(e) or attempt + 1 >= retry.attempts:
+                        if isinstance(e, requests.exceptions.HTTPError):
+                            raise errors.PBError(str(e), e.response.status_code)
+                        raise errors.PBError(str(e))
+                    time.sleep(retry.delay(attempt))
+
+            span.set(bytes=writer.size - resumed, resumed=resumed)
+            writer.commit()
+
+
+def fetch(image: Image, manifest: Manifest, store: BlobStore,
+          workers: int = DEFAULT_WORKERS, progress: Optional[Progress] = None,
+          retry: Optional[RetryPolicy] = None) -> None:
+    """
+    Fecthes the image layers into the blob store.
+
+    Up to `workers` layers are downloaded concurrently, all of them
+    sharing the registry session. Layers already in the store are skipped
+    and failed downloads are retried according to `retry`.
+    """
+    layers: List[Descriptor] = []
     for layer in manifest.layers:
-        if layer_exists(layer, dest):
+        if layer in layers or layer_exists(layer, store):
             continue
-        with requests.get(f'{baseurl}/blobs/{layer}', allow_redirects=True, stream=True) as stream:
-            stream.raise_for_status()
-            with open(f'{dest}/{layer.digest}.tar.gz', 'wb') as f:
-                for chunk in stream.iter_content(chunk_size=8192):
-                    f.write(chunk)
+        layers.append(layer)
+
+    if workers <= 1 or len(layers) <= 1:
+        for layer in layers:
+            fetch_layer(image, layer, store, progress, retry)
+        return
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(fetch_layer, image, layer, store, progress, retry) for layer in layers]
+        for future in futures:
+            future.result()
@@ -1,11 +1,27 @@
 """
 IO library.
 """
+import os
+import re
+import json
+import errno
 import typing
+import hashlib
+import pathlib
+import threading
 
-from . import errors
+from . import env, errors, store, trace
+from .oci.v1 import Descriptor
 
-import requests
+
+DEFAULT_TIMEOUT = 30
+POOL_SIZE = 16
+MAX_SIZE = 16 * 1024 * 1024
+
+_session = None
+_session_lock = threading.Lock()
+_cache: typing.Optional['ResponseCache'] = None
+_cache_lock = threading.Lock()
 
 
 class Reader(typing.Protocol):
@@ -25,25 +41,188 @@ class FileReader(Reader):
         Return the file content of a given path.
         """
         try:
-            with open(self.path, 'r') as f:
+            with trace.span('io.read', path=self.path), open(self.path, 'r') as f:
                 return f.read()
         except OSError as e:
             raise errors.PBError(str(e), e.errno)
 
 
+class ResponseCache:
+    """
+    Local cache of http responses.
+
+    Bodies are kept by digest in a `pkgbox.store.BlobStore` while the
+    validators (ETag, Last-Modified) of each url are kept in
+    `{root}/urls/{sha256 of the url}.json`.
+    """
+    def __init__(self, root: pathlib.Path) -> None:
+        """
+        Create a new cache object instance.
+        """
+        self.root = pathlib.Path(root)
+        self.blobs = store.BlobStore(self.root)
+
+    def _meta_path(self, url: str) -> pathlib.Path:
+        return self.root / 'urls' / f'{hashlib.sha256(url.encode()).hexdigest()}.json'
+
+    def get(self, digest: Descriptor) -> typing.Optional[bytes]:
+        """
+        Return a cached body by its digest, if any.
+        """
+        if not self.blobs.exists(digest):
+            return None
+        try:
+            return self.blobs.path(digest).read_bytes()
+        except FileNotFoundError:
+            return None
+
+    def meta(self, url: str) -> typing.Optional[typing.Dict[str, str]]:
+        """
+        Return the cached digest and validators of a url, if any.
+        """
+        try:
+            return json.loads(self._meta_path(url).read_text())
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def put(self, url: str, data: bytes, headers: typing.Mapping[str, str]) -> Descriptor:
+        """
+        Store a response body with the validators found in its
+        headers and return its digest.
+        """
+        digest = Descriptor('sha256', hashlib.sha256(data).hexdigest())
+        if not self.blobs.exists(digest):
+            with self.blobs.lock(digest):
+                # stored by another reader while waiting for the lock
+                if not self.blobs.exists(digest):
+                    with self.blobs.writer(digest) as w:
+                        w.write(data)
+                        w.commit()
+
+        meta = {
+            'digest': str(digest),
+            'etag': headers.get('etag'),
+            'last_modified': headers.get('last-modified')
+        }
+        path = self._meta_path(url)
+        os.makedirs(path.parent, exist_ok=True)
+        tmp = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(meta, f)
+        os.replace(tmp, path)
+
+        return digest
+
+
+def session() -> 'requests.Session':
+    """
+    Return the pooled session shared by all http readers.
+    """
+    global _session
+
+    import requests
+    from requests.adapters import HTTPAdapter
+
+    with _session_lock:
+        if _session is None:
+            _session = requests.Session()
+            adapter = HTTPAdapter(pool_maxsize=POOL_SIZE)
+            _session.mount('http://', adapter)
+            _session.mount('https://', adapter)
+        return _session
+
+
+def response_cache() -> ResponseCache:
+    """
+    Return the http response cache located in the pkgbox data dir,
+    shared by all http readers of the process.
+    """
+    global _cache
+
+    root = pathlib.Path(f'{env.get_pkgbox_dirs()["data_dir"]}/http-cache')
+    with _cache_lock:
+        if _cache is None or _cache.root != root:
+            _cache = ResponseCache(root)
+        return _cache
+
+
 class HttpReader(Reader):
     def read(self) -> str:
         """
         Return the content of a given http(s) url using a
         GET request.
+
+        Responses are cached and revalidated using their ETag or
+        Last-Modified headers. Urls pinned to a digest with a
+        "#sha256=<digest>" fragment are served from the cache without
+        any request when possible, and checked against it otherwise.
+
+        Bodies bigger than `MAX_SIZE` bytes are rejected.
         """
+        import requests
+
+        url, _, fragment = f'{self.scheme}://{self.path}'.partition('#')
+        pin = None
+        if fragment.startswith('sha256='):
+            pin = Descriptor('sha256', fragment[len('sha256='):])
+
+        cache = response_cache()
+        if pin and (data := cache.get(pin)) is not None:
+            trace.event('io.cache.hit', url=url)
+            return data.decode()
+
+        headers = {}
+        cached = None
+        meta = cache.meta(url)
+        if meta and (cached := cache.get(Descriptor.from_str(meta['digest']))) is not None:
+            if meta['etag']:
+                headers['If-None-Match'] = meta['etag']
+            if meta['last_modified']:
+                headers['If-Modified-Since'] = meta['last_modified']
+
         try:
-            res = requests.get(f'{self.scheme}://{self.path}')
-            res.raise_for_status()
+            with trace.span('io.fetch', url=url) as span, \
+                    session().get(url, headers=headers, timeout=DEFAULT_TIMEOUT, stream=True) as res:
+                if res.status_code == 304 and cached is not None:
+                    trace.event('io.cache.revalidated', url=url)
+                    data = cached
+                    digest = Descriptor.from_str(meta['digest'])
+                else:
+                    trace.event('io.cache.miss', url=url)
+                    res.raise_for_status()
+                    data = _read_limited(res, url)
+                    digest = Descriptor('sha256', hashlib.sha256(data).hexdigest())
+                    # never cache what a pinned url must not serve
+                    if pin and digest != pin:
+                        raise errors.PBDigestError(str(pin), str(digest))
+                    cache.put(url, data, res.headers)
+                    span.set(bytes=len(data))
         except requests.exceptions.HTTPError as e:
             raise errors.PBError(str(e), e.response.status_code)
+        except requests.exceptions.RequestException as e:
+            raise errors.PBError(str(e))
+
+        if pin and digest != pin:
+            raise errors.PBDigestError(str(pin), str(digest))
+
+        return data.decode()
+
 
-        return res.text
+def _read_limited(res: 'requests.Response', url: str) -> bytes:
+    """
+    Read a response body, failing if it is bigger than `MAX_SIZE`.
+    """
+    size = res.headers.get('content-length')
+    if size and int(size) > MAX_SIZE:
+        raise errors.PBError(f'Response from {url} is bigger than {MAX_SIZE} bytes', errno.EFBIG)
+
+    data = bytearray()
+    for chunk in res.iter_content(chunk_size=64 * 1024):
+        data += chunk
+        if len(data) > MAX_SIZE:
+            raise errors.PBError(f'Response from {url} is bigger than {MAX_SIZE} bytes', errno.EFBIG)
+
+    return bytes(data)
 
 
 def build_reader(scheme: str, value: str) -> Reader:
@@ -58,3 +237,24 @@ def build_reader(scheme: str, value: str) -> Reader:
     }
 
     return ref.get(scheme, FileReader)(scheme, value)
+
+
+def split_uri(value: str) -> typing.Tuple[str, str]:
+    """
+    Split a source uri, such as file:///tmp/Containerfile, into
+    its scheme and path.
+
+    "file" is assumed if no scheme is provided.
+    """
+    m = re.match('([a-zA-Z]+)://(.*)', value)
+    if m:
+        return m.group(1), m.group(2)
+
+    return 'file', value
+
+
+def from_uri(value: str) -> Reader:
+    """
+    Build a reader object from a source uri.
+    """
+    return build_reader(*split_uri(value))
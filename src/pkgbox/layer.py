@@ -0,0 +1,266 @@
+"""
+Reproducible layer writer.
+
+A layer is written in a single pass, straight into the blob store: the
+tar stream is hashed into the layer diff id as it is produced, cut into
+chunks compressed in parallel, and the compressed output is hashed as
+it is written to the store. Nothing is staged in a temporary copy.
+
+Layers are reproducible: entries are written in the order given (the
+sorted, depth first order of `pkgbox.diff`), their mtime is set to
+`mtime` and their owner to `owner`, user and group names are dropped,
+and compressed output does not depend on the number of workers:
+
+- gzip: each `CHUNK_SIZE` chunk is an independent gzip member, like
+  pigz `--independent` does, which compress on worker threads (zlib
+  releases the GIL) and are written in order. Concatenated members
+  are a valid gzip stream;
+- zstd: the zstd library compresses on its own worker threads, always
+  in its multithreaded mode, whose output is the same whatever the
+  number of threads.
+
+Extended attributes are not kept.
+"""
+import os
+import stat
+import zlib
+import errno
+import hashlib
+import pathlib
+import tarfile
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Deque, Dict, Iterable, List, Optional, Tuple
+
+from . import errors, trace, zstd
+from .diff import ADDED, DELETED, Change, walk
+from .oci.v1 import OCI_LAYER, OCI_LAYER_GZIP, OCI_LAYER_ZSTD, Descriptor
+from .store import BlobStore, NewBlobWriter
+
+
+DEFAULT_WORKERS = 4
+DEFAULT_GZIP_LEVEL = 6
+CHUNK_SIZE = 1024 * 1024
+
+GZIP = 'gzip'
+ZSTD = 'zstd'
+_MEDIA_TYPES = {'': OCI_LAYER, GZIP: OCI_LAYER_GZIP, ZSTD: OCI_LAYER_ZSTD}
+
+
+@dataclass
+class Layer:
+    """
+    A written layer: its blob descriptor (digest, size and media type)
+    and its diff id, the digest of the uncompressed tar, along with
+    the uncompressed size and the number of tar entries.
+    """
+    descriptor: Descriptor
+    diff_id: Descriptor
+    tar_size: int
+    entries: int
+
+
+def _gzip_member(data: bytes, level: int) -> bytes:
+    # a gzip header with no mtime
+    return zlib.compress(data, level=level, wbits=31)
+
+
+class _Sink:
+    """
+    File-like object the tar stream is written to: hashes it, cuts it
+    into chunks and writes them compressed to `out`.
+    """
+    def __init__(self, out: NewBlobWriter, compression: str, level: Optional[int], workers: int) -> None:
+        self.out = out
+        self.compression = compression
+        self.workers = max(1, workers)
+        self.hash = hashlib.sha256()
+        self.size = 0
+        self.buffer = bytearray()
+        self.pending: Deque[Future] = deque()
+        self.pool: Optional[ThreadPoolExecutor] = None
+        self.compressor: Optional[zstd.Compressor] = None
+
+        if compression == GZIP:
+            self.level = DEFAULT_GZIP_LEVEL if level is None else level
+            if self.workers > 1:
+                self.pool = ThreadPoolExecutor(max_workers=self.workers)
+        elif compression == ZSTD:
+            self.compressor = zstd.Compressor(zstd.DEFAULT_LEVEL if level is None else level, self.workers)
+
+    def write(self, data: bytes) -> int:
+        self.hash.update(data)
+        self.size += len(data)
+        if not self.compression:
+            self.out.write(data)
+            return len(data)
+
+        self.buffer += data
+        while len(self.buffer) >= CHUNK_SIZE:
+            chunk = bytes(self.buffer[:CHUNK_SIZE])
+            del self.buffer[:CHUNK_SIZE]
+            self._chunk(chunk)
+        return len(data)
+
+    def _chunk(self, chunk: bytes) -> None:
+        if self.compressor:
+            self.out.write(self.compressor.compress(chunk))
+        elif self.pool is None:
+            self.out.write(_gzip_member(chunk, self.level))
+        else:
+            # bounded, so memory does not grow with the layer size
+            self.pending.append(self.pool.submit(_gzip_member, chunk, self.level))
+            while len(self.pending) > 2 * self.workers:
+                self.out.write(self.pending.popleft().result())
+
+    def close(self) -> None:
+        if self.buffer:
+            self._chunk(bytes(self.buffer))
+            self.buffer.clear()
+        while self.pending:
+            self.out.write(self.pending.popleft().result())
+        if self.compressor:
+            self.out.write(self.compressor.flush())
+        self.shutdown()
+
+    def shutdown(self) -> None:
+        if self.pool:
+            self.pool.shutdown(wait=True, cancel_futures=True)
+            self.pool = None
+
+
+class _Entries:
+    """
+    Tar entries of the changes of a rootfs, with the parent directories
+    of changed entries and hard links within the layer.
+    """
+    def __init__(self, root: pathlib.Path, mtime: int, owner: Optional[Tuple[int, int]]) -> None:
+        self.root = root
+        self.mtime = mtime
+        self.owner = owner
+        self.dirs: List[str] = []
+        self.inodes: Dict[Tuple[int, int], str] = {}
+
+    def _info(self, name: str, st: os.stat_result) -> tarfile.TarInfo:
+        info = tarfile.TarInfo(name)
+        info.mode = stat.S_IMODE(st.st_mode)
+        info.mtime = self.mtime
+        info.uid, info.gid = self.owner if self.owner else (st.st_uid, st.st_gid)
+        info.uname = info.gname = ''
+        return info
+
+    def _entry(self, name: str) -> Tuple[tarfile.TarInfo, Optional[str]]:
+        """
+        Return the tar entry of a rootfs path, and the path to read
+        its content from for regular files.
+        """
+        path = os.path.join(self.root, name)
+        st = os.lstat(path)
+        info = self._info(name, st)
+        if stat.S_ISDIR(st.st_mode):
+            info.type = tarfile.DIRTYPE
+        elif stat.S_ISLNK(st.st_mode):
+            info.type = tarfile.SYMTYPE
+            info.linkname = os.readlink(path)
+        elif stat.S_ISREG(st.st_mode):
+            if st.st_nlink > 1:
+                key = (st.st_dev, st.st_ino)
+                if key in self.inodes:
+                    info.type = tarfile.LNKTYPE
+                    info.linkname = self.inodes[key]
+                    return info, None
+                self.inodes[key] = name
+            info.size = st.st_size
+            return info, path
+        elif stat.S_ISCHR(st.st_mode) or stat.S_ISBLK(st.st_mode):
+            info.type = tarfile.CHRTYPE if stat.S_ISCHR(st.st_mode) else tarfile.BLKTYPE
+            info.devmajor, info.devminor = os.major(st.st_rdev), os.minor(st.st_rdev)
+        elif stat.S_ISFIFO(st.st_mode):
+            info.type = tarfile.FIFOTYPE
+        else:
+            raise errors.PBError(f'Unsupported file type of "{name}"', errno.EINVAL)
+        return info, None
+
+    def parents(self, name: str) -> Iterable[str]:
+        """
+        Return the parent directories of `name` not written yet.
+        """
+        parts = name.split('/')[:-1]
+        wanted = ['/'.join(parts[:i + 1]) for i in range(len(parts))]
+        # entries are depth first: leave the directories we are out of
+        while self.dirs and self.dirs[-1] not in wanted:
+            self.dirs.pop()
+        return [d for d in wanted if d not in self.dirs]
+
+    def add(self, tar: tarfile.TarFile, change: Change) -> int:
+        """
+        Write the tar entries of a change, returning their count.
+        """
+        count = 0
+        for parent in self.parents(change.path):
+            tar.addfile(self._entry(parent)[0])
+            self.dirs.append(parent)
+            count += 1
+
+        if change.kind == DELETED:
+            info = tarfile.TarInfo(change.whiteout)
+            info.mtime = self.mtime
+            info.uid, info.gid = self.owner or (0, 0)
+            tar.addfile(info)
+            return count + 1
+
+        info, path = self._entry(change.path)
+        if info.isdir():
+            self.dirs.append(change.path)
+        if path is None:
+            tar.addfile(info)
+        else:
+            with open(path, 'rb') as f:
+                tar.addfile(info, f)
+        return count + 1
+
+
+def changes(root: pathlib.Path) -> Iterable[Change]:
+    """
+    Return every entry of `root` as an addition, to write
+    a whole tree as a layer.
+    """
+    return (Change(ADDED, path) for path, _ in walk(root))
+
+
+@trace.traced('layer.write')
+def write(store: BlobStore, root: pathlib.Path, changes: Iterable[Change], compression: str = GZIP,
+          level: Optional[int] = None, workers: int = DEFAULT_WORKERS, mtime: int = 0,
+          owner: Optional[Tuple[int, int]] = (0, 0)) -> Layer:
+    """
+    Write the `changes` of the `root` tree as a layer into `store`.
+
+    `compression` is "gzip", "zstd" or "" for an uncompressed tar,
+    using `workers` threads. Entries get `mtime` as their mtime and are
+    owned by `owner` (uid, gid), or keep their owner if it is `None`.
+    """
+    if compression not in _MEDIA_TYPES:
+        raise errors.PBError(f'Unknown layer compression "{compression}"', errno.EINVAL)
+
+    out = store.new_writer()
+    sink = _Sink(out, compression, level, workers)
+    entries = _Entries(pathlib.Path(root), mtime, owner)
+    count = 0
+    try:
+        with tarfile.open(fileobj=sink, mode='w|', format=tarfile.PAX_FORMAT) as tar:
+            for change in changes:
+                count += entries.add(tar, change)
+        sink.close()
+        out.commit()
+    except OSError as e:
+        raise errors.PBError(str(e), e.errno)
+    finally:
+        sink.shutdown()
+        out.close()
+
+    desc = Descriptor(out.desc.alg, out.desc.digest, _MEDIA_TYPES[compression], out.size)
+    diff_id = Descriptor('sha256', sink.hash.hexdigest())
+    trace.event('layer.written', bytes=out.size, tar_bytes=sink.size)
+
+    return Layer(desc, diff_id, sink.size, count)
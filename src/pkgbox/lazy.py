@@ -0,0 +1,559 @@
+"""
+Lazy remote layers.
+
+A lazy image reads the files of the layers missing from the store
+straight from the registry with `Range` requests, so a file can be read
+as soon as the few blocks holding it are fetched, instead of once every
+layer is downloaded.
+
+Layers are read through an index (see `pkgbox.gzindex`):
+
+- eStargz layers end with a table of contents listing every file and
+  the offset of the gzip member holding its content. It is fetched with
+  a couple of range reads and turned into an index.
+- other layers are indexed by streaming their blob once, which is
+  written to the store along the way: once indexed, they are read
+  locally.
+
+Indexes are kept in the store, so later runs start reading right away.
+
+Blobs are fetched in `BLOCK_SIZE` blocks kept in a bounded in-memory
+cache shared by concurrent readers: a block is fetched once and
+consecutive missing blocks are fetched with a single request. Content
+read this way is trusted as served by the registry, like it is by
+stargz snapshotters, since a blob can only be verified once downloaded
+whole.
+
+Files read from an image are recorded, in first access order, in an
+access profile kept in `{data_dir}/profiles`. When the image is opened
+again, the blocks holding those files are prefetched in the background,
+in the same order, so they are usually there before being asked for.
+"""
+import io
+import re
+import gzip
+import json
+import time
+import errno
+import hashlib
+import tarfile
+import pathlib
+import datetime
+import threading
+import collections
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterator, List, Optional
+
+import requests
+
+from . import errors, gzindex, image, trace
+from .extract import READ_SIZE
+from .oci.v1 import Descriptor, Manifest
+from .store import BlobStore, BlobWriter
+
+
+BLOCK_SIZE = 512 * 1024
+CACHE_SIZE = 256 * 1024 * 1024
+PREFETCH_WORKERS = 4
+FOOTER_SIZE = 51
+TOC_NAME = 'stargz.index.json'
+
+_FOOTER_RE = re.compile(rb'([0-9a-f]{16})STARGZ')
+_LANDMARKS = ('.prefetch.landmark', '.no.prefetch.landmark', TOC_NAME)
+_TOC_TYPES = {
+    'reg': tarfile.REGTYPE,
+    'dir': tarfile.DIRTYPE,
+    'symlink': tarfile.SYMTYPE,
+    'hardlink': tarfile.LNKTYPE,
+    'char': tarfile.CHRTYPE,
+    'block': tarfile.BLKTYPE,
+    'fifo': tarfile.FIFOTYPE,
+}
+
+
+class _RemoteFile(io.RawIOBase):
+    """
+    Seekable file object reading a `RemoteBlob`.
+    """
+    def __init__(self, blob: 'RemoteBlob') -> None:
+        self.blob = blob
+        self.pos = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def readinto(self, b) -> int:
+        data = self.blob.read(self.pos, len(b))
+        b[:len(data)] = data
+        self.pos += len(data)
+        return len(data)
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_CUR:
+            offset += self.pos
+        elif whence == io.SEEK_END:
+            offset += self.blob.size
+        self.pos = offset
+        return self.pos
+
+    def tell(self) -> int:
+        return self.pos
+
+
+class _Stream(io.RawIOBase):
+    """
+    File object reading a whole blob response, verifying the blob
+    digest once its end is reached, and writing it to `out` if set.
+    """
+    def __init__(self, blob: 'RemoteBlob', res: requests.Response, out: Optional[BlobWriter] = None) -> None:
+        self.blob = blob
+        self.out = out
+        self.chunks = res.iter_content(chunk_size=READ_SIZE)
+        self.buffer = b''
+        self.hash = hashlib.new(blob.layer.alg)
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, b) -> int:
+        if not self.buffer:
+            self.buffer = next(self.chunks, b'')
+            if not self.buffer:
+                if self.hash.hexdigest() != self.blob.layer.digest:
+                    raise errors.PBError(f'Digest mismatch for {self.blob.layer}', errno.EIO)
+                return 0
+            self.hash.update(self.buffer)
+            self.blob.fetched += len(self.buffer)
+            if self.out is not None:
+                self.out.write(self.buffer)
+
+        n = min(len(b), len(self.buffer))
+        b[:n] = self.buffer[:n]
+        self.buffer = self.buffer[n:]
+        return n
+
+
+class RemoteBlob:
+    """
+    A blob read from the registry with range requests, through a cache
+    of `BLOCK_SIZE` blocks holding up to `cache_size` bytes.
+    """
+    def __init__(self, img: image.Image, layer: Descriptor, retry: Optional[image.RetryPolicy] = None,
+                 cache_size: int = CACHE_SIZE) -> None:
+        """
+        Create a new remote blob object instance.
+        """
+        self.image = img
+        self.layer = layer
+        self.url = f'{image.baseurl(img)}/blobs/{layer}'
+        self.retry = retry or image.RetryPolicy()
+        self.cache_size = cache_size
+        self.requests = 0
+        self.fetched = 0
+        self._size: Optional[int] = None
+        self._blocks: 'collections.OrderedDict[int, bytes]' = collections.OrderedDict()
+        self._cached = 0
+        self._pending: Dict[int, threading.Event] = {}
+        self._lock = threading.Lock()
+
+    def _get(self, headers: Dict[str, str], stream: bool = False) -> requests.Response:
+        """
+        Send a blob request, retrying transient errors.
+        """
+        for attempt in range(self.retry.attempts):
+            try:
+                res = image.session(self.image.registry).get(self.url, headers=headers, allow_redirects=True,
+                                                             stream=stream, timeout=self.retry.timeout)
+                res.raise_for_status()
+                with self._lock:
+                    self.requests += 1
+                return res
+            except requests.exceptions.RequestException as e:
+                if not self.retry.should_retry(e) or attempt + 1 >= self.retry.attempts:
+                    if isinstance(e, requests.exceptions.HTTPError):
+                        raise errors.PBError(str(e), e.response.status_code)
+                    raise errors.PBError(str(e))
+                time.sleep(self.retry.delay(attempt))
+
+    def _range(self, start: int, end: int) -> bytes:
+        """
+        Fetch the blob bytes in `[start, end)`.
+        """
+        with trace.span('lazy.range', layer=str(self.layer), bytes=end - start):
+            res = self._get({'Range': f'bytes={start}-{end - 1}'})
+        if res.status_code != 206:
+            raise errors.PBError(f'Registry {self.image.registry} does not support range requests',
+                                 errno.EOPNOTSUPP)
+        with self._lock:
+            self.fetched += len(res.content)
+            if self._size is None:
+                self._size = image._total(res)
+        return res.content
+
+    @property
+    def size(self) -> int:
+        """
+        Return the blob size, fetching its first byte if unknown.
+        """
+        if self._size is None:
+            self._range(0, 1)
+        if self._size is None:
+            raise errors.PBError(f'Unable to get the size of {self.layer}', errno.EIO)
+        return self._size
+
+    def _put(self, n: int, block: bytes) -> None:
+        with self._lock:
+            self._blocks[n] = block
+            self._cached += len(block)
+            while self._cached > self.cache_size and len(self._blocks) > 1:
+                _, evicted = self._blocks.popitem(last=False)
+                self._cached -= len(evicted)
+
+    def _load(self, first: int, last: int) -> Dict[int, bytes]:
+        """
+        Return the blocks `first` to `last`, fetching the missing ones
+        unless another thread is already fetching them.
+        """
+        blocks: Dict[int, bytes] = {}
+        todo: List[int] = []
+        waits = []
+        with self._lock:
+            for n in range(first, last + 1):
+                if n in self._blocks:
+                    self._blocks.move_to_end(n)
+                    blocks[n] = self._blocks[n]
+                elif n in self._pending:
+                    waits.append((n, self._pending[n]))
+                else:
+                    self._pending[n] = threading.Event()
+                    todo.append(n)
+
+        try:
+            runs: List[List[int]] = []
+            for n in todo:
+                if runs and runs[-1][-1] == n - 1:
+                    runs[-1].append(n)
+                else:
+                    runs.append([n])
+            for run in runs:
+                data = self._range(run[0] * BLOCK_SIZE, (run[-1] + 1) * BLOCK_SIZE)
+                for i, n in enumerate(run):
+                    blocks[n] = data[i * BLOCK_SIZE:(i + 1) * BLOCK_SIZE]
+                    self._put(n, blocks[n])
+        finally:
+            with self._lock:
+                for n in todo:
+                    self._pending.pop(n).set()
+
+        for n, event in waits:
+            event.wait()
+            with self._lock:
+                block = self._blocks.get(n)
+            # fetched and evicted meanwhile, or failed
+            blocks[n] = block if block is not None else self._load(n, n)[n]
+
+        return blocks
+
+    def read(self, offset: int, size: int) -> bytes:
+        """
+        Return up to `size` blob bytes from `offset`.
+        """
+        end = min(offset + size, self.size)
+        if offset >= end:
+            return b''
+
+        first, last = offset // BLOCK_SIZE, (end - 1) // BLOCK_SIZE
+        blocks = self._load(first, last)
+        data = b''.join(blocks[n] for n in range(first, last + 1))
+        start = offset - first * BLOCK_SIZE
+        return data[start:start + end - offset]
+
+    def open(self) -> io.RawIOBase:
+        """
+        Return a seekable file object reading the blob.
+        """
+        return _RemoteFile(self)
+
+    def stream(self, out: Optional[BlobWriter] = None) -> io.BufferedReader:
+        """
+        Return a file object reading the whole blob with one request,
+        verifying its digest once read to the end. The blob is written
+        to `out` as it is read, if set.
+        """
+        res = self._get({}, stream=True)
+        if self._size is None:
+            self._size = image._total(res)
+        return io.BufferedReader(_Stream(self, res, out), READ_SIZE)
+
+
+def _mtime(value: Optional[str]) -> int:
+    if not value:
+        return 0
+    try:
+        return int(datetime.datetime.fromisoformat(value).timestamp())
+    except (ValueError, OverflowError):
+        return 0
+
+
+def parse_toc(toc: dict, size: int) -> gzindex.Index:
+    """
+    Return the index of an eStargz layer of `size` bytes from its table
+    of contents.
+
+    The tar stream offsets of the index are made up: every file content,
+    or chunk of it, starts a gzip member, which makes a checkpoint.
+    """
+    members = []
+    points = []
+    position = 0
+    start = 0
+    for entry in toc.get('entries', []):
+        kind = entry.get('type')
+        if kind == 'chunk':
+            points.append(gzindex.Point(entry['offset'], 0, start + entry.get('chunkOffset', 0), b''))
+            continue
+        if kind not in _TOC_TYPES or entry.get('name', '').strip('/') in _LANDMARKS:
+            continue
+
+        member = tarfile.TarInfo(entry['name'])
+        member.type = _TOC_TYPES[kind]
+        member.mode = entry.get('mode', 0) & 0o7777
+        member.uid = entry.get('uid', 0)
+        member.gid = entry.get('gid', 0)
+        member.mtime = _mtime(entry.get('modtime'))
+        member.linkname = entry.get('linkName', '')
+        member.devmajor = entry.get('devMajor', 0)
+        member.devminor = entry.get('devMinor', 0)
+        if kind == 'reg':
+            member.size = entry.get('size', 0)
+            member.offset_data = start = position
+            if member.size:
+                points.append(gzindex.Point(entry['offset'], 0, position, b''))
+            position += member.size
+        members.append(member)
+
+    return gzindex.Index('gzip', size, points, members)
+
+
+def read_toc(blob: RemoteBlob) -> Optional[gzindex.Index]:
+    """
+    Return the index of an eStargz blob from its table of contents,
+    `None` if the blob is not an eStargz one.
+    """
+    size = blob.size
+    if size < FOOTER_SIZE:
+        return None
+    m = _FOOTER_RE.search(blob.read(size - FOOTER_SIZE, FOOTER_SIZE))
+    if not m:
+        return None
+
+    offset = int(m.group(1), 16)
+    try:
+        data = gzip.decompress(blob.read(offset, size - offset))
+        with tarfile.open(fileobj=io.BytesIO(data), mode='r:') as tar:
+            toc = json.loads(tar.extractfile(TOC_NAME).read())
+    except (OSError, EOFError, KeyError, ValueError, tarfile.TarError) as e:
+        raise errors.PBError(f'Invalid eStargz table of contents in {blob.layer}: {e}', errno.EIO)
+
+    return parse_toc(toc, size)
+
+
+def remote_index(blob: RemoteBlob, store: BlobStore) -> gzindex.Index:
+    """
+    Return the index of a remote blob, from the store if it was built
+    before.
+
+    An index read from the eStargz table of contents is built from
+    unverified bytes, so it is saved apart from the index of the blob
+    (see `gzindex.toc_index_path`). Other blobs are downloaded into the
+    store while they are indexed, since they are streamed whole anyway.
+    """
+    path = gzindex.index_path(store, blob.layer)
+    toc_path = gzindex.toc_index_path(store, blob.layer)
+    index = gzindex.Index.load(path) or gzindex.Index.load(toc_path)
+    if index is not None:
+        blob._size = index.size
+        return index
+
+    index = read_toc(blob)
+    if index is not None:
+        toc_path.parent.mkdir(parents=True, exist_ok=True)
+        index.save(toc_path)
+        return index
+
+    with trace.span('lazy.download', layer=str(blob.layer)), store.lock(blob.layer):
+        if store.exists(blob.layer):
+            # downloaded by another process while waiting for the lock
+            return gzindex.get(store, blob.layer)
+
+        with store.writer(blob.layer) as w:
+            # the index needs the whole stream, a partial file is of no use
+            w.reset()
+            try:
+                with blob.stream(w) as f:
+                    index = gzindex.build_from(f, blob.size, gzindex.SPAN)
+                    # read the rest of the blob so it is verified and stored
+                    while f.read(READ_SIZE):
+                        pass
+                w.commit()
+            except BaseException:
+                w.abort()
+                raise
+
+    path.parent.mkdir(parents=True, exist_ok=True)
+    index.save(path)
+    return index
+
+
+class Profile:
+    """
+    Access profile of an image: the files read from it, in first
+    access order.
+    """
+    def __init__(self, path: pathlib.Path) -> None:
+        """
+        Create a new profile object instance, loading the files
+        recorded in `path`.
+        """
+        self.path = pathlib.Path(path)
+        self.files: List[str] = []
+        self._new: List[str] = []
+        self._lock = threading.Lock()
+        try:
+            with open(self.path) as f:
+                self.files = list(dict.fromkeys(json.loads(line) for line in f if line.strip()))
+        except (OSError, ValueError):
+            pass
+        self._seen = set(self.files)
+
+    def record(self, name: str) -> None:
+        """
+        Record a file read.
+        """
+        with self._lock:
+            if name in self._seen:
+                return
+            self._seen.add(name)
+            self.files.append(name)
+            self._new.append(name)
+
+    def save(self) -> None:
+        """
+        Append the files recorded since the last save.
+        """
+        with self._lock:
+            new, self._new = self._new, []
+        if not new:
+            return
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with open(self.path, 'a') as f:
+            f.write(''.join(json.dumps(name) + '\n' for name in new))
+
+
+class LazyImage(gzindex.Files):
+    """
+    Files of an image whose layers missing from the store are read
+    from the registry on demand.
+    """
+    def __init__(self, img: image.Image, manifest: Manifest, store: BlobStore,
+                 profile: Optional[Profile] = None, retry: Optional[image.RetryPolicy] = None,
+                 cache_size: int = CACHE_SIZE) -> None:
+        """
+        Open an image, fetching the indexes of its remote layers.
+        """
+        self.image = img
+        self.profile = profile
+        self.retry = retry
+        self.cache_size = cache_size
+        self.remote: Dict[str, RemoteBlob] = {}
+        self._prefetch: Optional[ThreadPoolExecutor] = None
+        super().__init__(manifest, store)
+
+    def _index(self, layer: Descriptor) -> gzindex.Index:
+        if self.store.exists(layer):
+            return gzindex.get(self.store, layer)
+        blob = self.remote.setdefault(str(layer), RemoteBlob(self.image, layer, self.retry, self.cache_size))
+        index = remote_index(blob, self.store)
+        if self.store.exists(layer):
+            # downloaded whole while indexing it
+            self.remote.pop(str(layer), None)
+        return index
+
+    def _read(self, n: int, member: tarfile.TarInfo) -> Iterator[bytes]:
+        blob = self.remote.get(str(self.layers[n]))
+        if blob is None:
+            return super()._read(n, member)
+        return self.indexes[n].read_from(blob.open(), member)
+
+    def read(self, path: str) -> Iterator[bytes]:
+        """
+        Yield the content of a file, following symlinks, and record it
+        in the access profile.
+        """
+        chunks = super().read(path)
+        if self.profile:
+            self.profile.record(path)
+        return chunks
+
+    def _warm(self, name: str) -> None:
+        try:
+            n, member = self.find(name)
+        except errors.PBError:
+            return
+        blob = self.remote.get(str(self.layers[n]))
+        if blob is not None:
+            start, end = self.indexes[n].extent(member)
+            blob.read(start, end - start)
+
+    def prefetch(self, workers: int = PREFETCH_WORKERS) -> None:
+        """
+        Start fetching the blocks of the files of the access profile in
+        the background.
+        """
+        if not self.profile or not self.remote or self._prefetch:
+            return
+        self._prefetch = ThreadPoolExecutor(max_workers=workers)
+        for name in self.profile.files:
+            self._prefetch.submit(self._warm, name)
+
+    def close(self) -> None:
+        """
+        Stop prefetching and save the access profile.
+        """
+        if self._prefetch:
+            self._prefetch.shutdown(wait=True, cancel_futures=True)
+            self._prefetch = None
+        if self.profile:
+            self.profile.save()
+
+    def __enter__(self) -> 'LazyImage':
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+
+def profile_from_paths(paths: Dict[str, str], manifest: Manifest) -> Profile:
+    """
+    Return the access profile of an image, kept in the pkgbox data dir.
+    """
+    return Profile(pathlib.Path(f'{paths["data_dir"]}/profiles/{manifest.digest.alg}/{manifest.digest.digest}'))
+
+
+def fetch(img: image.Image, manifest: Manifest, store: BlobStore, profile: Optional[Profile] = None,
+          retry: Optional[image.RetryPolicy] = None, prefetch: bool = True) -> LazyImage:
+    """
+    Lazy counterpart of `pkgbox.image.fetch`: return the files of an
+    image, with the layers missing from the store read from the
+    registry on demand instead of downloaded first.
+
+    If `prefetch` is set, the files of the access profile are fetched
+    in the background.
+    """
+    lazy = LazyImage(img, manifest, store, profile, retry)
+    if prefetch:
+        lazy.prefetch()
+    return lazy
@@ -0,0 +1,197 @@
+"""
+Lock files shared by processes, possibly on different hosts.
+
+A lock is a file created with `O_CREAT | O_EXCL`, which is atomic on
+local filesystems as well as on NFS (v3 and later), unlike `flock`/`fcntl`
+locks. The holder keeps touching the lock file while it holds it, so a
+lock whose mtime does not change for `stale` seconds belongs to a crashed
+holder and may be broken. The mtime is only compared to itself, never to
+the local clock, so clock skew between hosts does not matter. Locks held
+by dead processes of the local host are broken right away.
+"""
+import os
+import json
+import time
+import errno
+import socket
+import pathlib
+import threading
+from typing import Optional, Tuple
+
+from . import errors
+
+
+DEFAULT_STALE = 30.0
+MAX_POLL = 0.5
+
+
+class FileLock:
+    """
+    Exclusive lock backed by the `path` file.
+
+    `stale` is the amount of seconds after which a lock that was not
+    refreshed is considered abandoned and `timeout`, if set, the maximum
+    amount of seconds to wait for it.
+    """
+    def __init__(self, path: pathlib.Path, stale: float = DEFAULT_STALE,
+                 timeout: Optional[float] = None) -> None:
+        """
+        Create a new lock object instance.
+        """
+        self.path = pathlib.Path(path)
+        self.stale = stale
+        self.timeout = timeout
+        self.token = f'{socket.gethostname()}:{os.getpid()}:{threading.get_ident()}:{time.time_ns()}'
+        self._stop: Optional[threading.Event] = None
+        self._heartbeat: Optional[threading.Thread] = None
+        # identity of the break guard last seen and when, see `_break`
+        self._guard_seen: Optional[Tuple[Tuple[int, int], float]] = None
+
+    def _create(self, path: pathlib.Path) -> bool:
+        """
+        Atomically create a lock file owned by this lock.
+        """
+        try:
+            fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+        except FileExistsError:
+            return False
+
+        try:
+            os.write(fd, json.dumps({'host': socket.gethostname(), 'pid': os.getpid(),
+                                     'token': self.token}).encode())
+        finally:
+            os.close(fd)
+        return True
+
+    def _owner(self) -> Optional[Tuple[str, int, str, float]]:
+        """
+        Return the host, pid, token and mtime of the current lock
+        file, or `None` if there is none.
+        """
+        try:
+            st = os.stat(self.path)
+            data = json.loads(self.path.read_text() or '{}')
+        except FileNotFoundError:
+            return None
+        except ValueError:
+            # the holder did not write its identity yet
+            data = {}
+        return data.get('host', ''), data.get('pid', 0), data.get('token', ''), st.st_mtime
+
+    def _break(self, token: str) -> None:
+        """
+        Remove an abandoned lock, if it is still held by `token`.
+
+        Breakers serialize on a second lock file so two of them can not
+        remove a lock taken in between by a live holder. A guard left by
+        a crashed breaker is removed once it was seen unchanged for
+        `stale` seconds, like the lock file itself.
+        """
+        guard = self.path.with_name(f'{self.path.name}.break')
+        if not self._create(guard):
+            try:
+                st = os.stat(guard)
+                seen, now = (st.st_ino, st.st_mtime_ns), time.monotonic()
+                if self._guard_seen is None or self._guard_seen[0] != seen:
+                    self._guard_seen = seen, now
+                elif now - self._guard_seen[1] > self.stale:
+                    os.unlink(guard)
+                    self._guard_seen = None
+            except FileNotFoundError:
+                pass
+            return
+
+        try:
+            owner = self._owner()
+            if owner and owner[2] == token:
+                os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+        finally:
+            os.unlink(guard)
+
+    def acquire(self) -> None:
+        """
+        Wait until the lock is acquired.
+        """
+        os.makedirs(self.path.parent, exist_ok=True)
+        started = time.monotonic()
+        delay = 0.01
+        seen: Optional[Tuple[str, float]] = None
+        seen_at = started
+
+        while not self._create(self.path):
+            now = time.monotonic()
+            owner = self._owner()
+            if owner:
+                host, pid, token, mtime = owner
+                if (token, mtime) != seen:
+                    seen, seen_at = (token, mtime), now
+                if host == socket.gethostname() and pid and not _alive(pid):
+                    self._break(token)
+                    continue
+                if now - seen_at > self.stale:
+                    self._break(token)
+                    continue
+
+            if self.timeout is not None and now - started > self.timeout:
+                raise errors.PBError(f'Timed out waiting for lock {self.path}', errno.ETIMEDOUT)
+            time.sleep(delay)
+            delay = min(MAX_POLL, delay * 2)
+
+        self._stop = threading.Event()
+        self._heartbeat = threading.Thread(target=self._refresh, daemon=True)
+        self._heartbeat.start()
+
+    def _refresh(self) -> None:
+        """
+        Touch the lock file until the lock is released, or until it
+        was broken, so the lock of a new holder is never kept alive.
+        """
+        while not self._stop.wait(self.stale / 3):
+            owner = self._owner()
+            if owner is None or owner[2] != self.token:
+                return
+            try:
+                os.utime(self.path)
+            except FileNotFoundError:
+                return
+
+    def release(self) -> None:
+        """
+        Release the lock.
+
+        The lock file is left alone if it was broken and taken by
+        someone else in the meantime.
+        """
+        if self._stop:
+            self._stop.set()
+            self._heartbeat.join()
+            self._stop = self._heartbeat = None
+
+        owner = self._owner()
+        if owner and owner[2] == self.token:
+            try:
+                os.unlink(self.path)
+            except FileNotFoundError:
+                pass
+
+    def __enter__(self) -> 'FileLock':
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        self.release()
+
+
+def _alive(pid: int) -> bool:
+    """
+    Check if a local process is running.
+    """
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
@@ -0,0 +1,159 @@
+"""
+Canonical form of Containerfile instructions, used before hashing
+so cosmetic edits do not change instruction digests.
+
+The rules are versioned by `VERSION`, which is part of every digest:
+any change to the canonical form must bump it.
+
+Version 1 rules:
+
+- whitespace runs outside quotes, including folded continuation lines,
+  are collapsed into a single space;
+- exec form JSON arrays are encoded as compact JSON;
+- LABEL and ENV pairs are resolved and sorted by key, ARG declarations
+  are sorted;
+- ARG references are replaced by their value in instructions where
+  they are resolved at build time (not in CMD, ENTRYPOINT and
+  HEALTHCHECK, which run with the image environment);
+- FROM uses its resolved image and an upper-case "AS";
+- heredoc bodies are kept verbatim.
+"""
+import json
+from typing import Dict, List, Mapping, Optional
+
+from .parser import Containerfile, Instruction, dequote, image_from, split_words
+
+
+VERSION = 1
+
+_EXEC_FORM = ('RUN', 'CMD', 'ENTRYPOINT', 'SHELL', 'COPY', 'ADD', 'VOLUME')
+_NO_SUBSTITUTION = ('CMD', 'ENTRYPOINT', 'HEALTHCHECK', 'COMMENT')
+
+
+def collapse(value: str) -> str:
+    """
+    Return `value` with whitespace outside of quotes collapsed.
+    """
+    if '"' not in value and "'" not in value and '\\' not in value:
+        return ' '.join(value.split())
+    return ' '.join(split_words(value, dequote=False))
+
+
+def substitute(value: str, args: Mapping[str, str]) -> str:
+    """
+    Replace `$NAME` and `${NAME}` references to `args` in `value`.
+
+    References in single quotes, escaped ones and unknown names are
+    kept as they are.
+    """
+    if not args or '$' not in value:
+        return value
+
+    out = []
+    quotes = None
+    pos = 0
+    size = len(value)
+
+    while pos < size:
+        ch = value[pos]
+        if ch == '\\' and quotes != "'":
+            out.append(value[pos:pos + 2])
+            pos += 2
+            continue
+        if ch in ('"', "'") and quotes in (None, ch):
+            quotes = None if quotes else ch
+        elif ch == '$' and quotes != "'":
+            braced = value.startswith('{', pos + 1)
+            start = pos + 2 if braced else pos + 1
+            end = start
+            while end < size and (value[end].isalnum() or value[end] == '_'):
+                end += 1
+            name = value[start:end]
+            closed = not braced or value.startswith('}', end)
+            if name in args and closed:
+                out.append(args[name])
+                pos = end + 1 if braced else end
+                continue
+        out.append(ch)
+        pos += 1
+
+    return ''.join(out)
+
+
+def _exec_form(value: str) -> Optional[str]:
+    """
+    Return the compact JSON form of an exec form value, if it is one.
+    """
+    if not value.lstrip().startswith('['):
+        return None
+    try:
+        data = json.loads(value)
+    except ValueError:
+        return None
+    if not isinstance(data, list) or not all(isinstance(i, str) for i in data):
+        return None
+
+    return json.dumps(data, separators=(',', ':'), ensure_ascii=False)
+
+
+def _pairs(pairs) -> str:
+    return ' '.join(f'{k}={json.dumps(v, ensure_ascii=False)}' for k, v in sorted(dict(pairs).items()))
+
+
+def normalize(instruction: Instruction, args: Optional[Mapping[str, str]] = None) -> str:
+    """
+    Return the canonical text of an instruction.
+
+    `args` are the build arguments in scope of the instruction.
+    """
+    name = instruction.name
+    args = args or {}
+    value, _, heredocs = instruction.value.partition('\n')
+
+    if name in ('LABEL', 'ENV'):
+        value = _pairs(instruction.resolved)
+    elif name == 'ARG':
+        # "ARG NAME" (no default) differs from "ARG NAME="
+        words = []
+        for word in split_words(value, dequote=False):
+            key, eq, default = word.partition('=')
+            words.append(f'{dequote(key)}={json.dumps(dequote(default), ensure_ascii=False)}' if eq else dequote(key))
+        value = ' '.join(sorted(words))
+    elif name == 'FROM':
+        image, stage = image_from(value)
+        platform = [w for w in split_words(value, dequote=False) if w.startswith('--platform=')]
+        resolved = dict(instruction.resolved).get('image', image)
+        value = ' '.join(platform + [resolved or ''] + (['AS', stage] if stage else []))
+    elif name in _EXEC_FORM and (exec_form := _exec_form(value)) is not None:
+        value = exec_form
+    else:
+        if name not in _NO_SUBSTITUTION:
+            value = substitute(value, args)
+        value = collapse(value)
+
+    if heredocs:
+        value = f'{value}\n{heredocs}'
+
+    return f'{name} {value}'
+
+
+def normalize_all(cf: Containerfile) -> List[str]:
+    """
+    Return the canonical text of every instruction of a Containerfile,
+    tracking the build arguments in scope of each one.
+    """
+    texts = []
+    args: Dict[str, str] = {}
+
+    for inst in cf.instructions:
+        texts.append(normalize(inst, args))
+        if inst.name == 'FROM':
+            args = {}
+        elif inst.name == 'ARG':
+            args.update(inst.resolved)
+        elif inst.name == 'ENV':
+            # env vars take precedence over args with the same name
+            for key, _ in inst.resolved:
+                args.pop(key, None)
+
+    return texts
@@ -1,11 +1,54 @@
 from dataclasses import dataclass, field
-from typing import Any, List
+from typing import Any, Dict, List, Optional
+
+
+DOCKER_MANIFEST_V1 = 'application/vnd.docker.distribution.manifest.v1+json'
+DOCKER_MANIFEST_V1_SIGNED = 'application/vnd.docker.distribution.manifest.v1+prettyjws'
+DOCKER_MANIFEST = 'application/vnd.docker.distribution.manifest.v2+json'
+DOCKER_MANIFEST_LIST = 'application/vnd.docker.distribution.manifest.list.v2+json'
+DOCKER_CONFIG = 'application/vnd.docker.container.image.v1+json'
+DOCKER_LAYER = 'application/vnd.docker.image.rootfs.diff.tar.gzip'
+OCI_MANIFEST = 'application/vnd.oci.image.manifest.v1+json'
+OCI_INDEX = 'application/vnd.oci.image.index.v1+json'
+OCI_CONFIG = 'application/vnd.oci.image.config.v1+json'
+OCI_LAYER = 'application/vnd.oci.image.layer.v1.tar'
+OCI_LAYER_GZIP = 'application/vnd.oci.image.layer.v1.tar+gzip'
+OCI_LAYER_ZSTD = 'application/vnd.oci.image.layer.v1.tar+zstd'
+
+MANIFESTS = (OCI_MANIFEST, DOCKER_MANIFEST, DOCKER_MANIFEST_V1_SIGNED, DOCKER_MANIFEST_V1)
+INDEXES = (OCI_INDEX, DOCKER_MANIFEST_LIST)
+
+
+@dataclass
+class Platform:
+    os: str
+    architecture: str
+    variant: Optional[str] = None
+
+    def __str__(self) -> str:
+        return '/'.join(p for p in (self.os, self.architecture, self.variant) if p)
+
+    @classmethod
+    def from_str(cls, data: str) -> 'Platform':
+        return cls(*data.split('/', 2))
+
+    def matches(self, other: 'Platform') -> bool:
+        """
+        Check if `other` can run on this platform: same os and
+        architecture, and same variant if this platform has one.
+        """
+        if (self.os, self.architecture) != (other.os, other.architecture):
+            return False
+        return not self.variant or self.variant == other.variant
 
 
 @dataclass
 class Descriptor:
     alg: str
     digest: str
+    media_type: Optional[str] = field(default=None, compare=False)
+    size: Optional[int] = field(default=None, compare=False)
+    platform: Optional[Platform] = field(default=None, compare=False)
 
     def __str__(self) -> str:
         return f'{self.alg}:{self.digest}'
@@ -25,6 +68,34 @@ class Manifest:
     history: List[str]
     signatures: Any
     digest: Descriptor
+    media_type: Optional[str] = None
+    config: Optional[Descriptor] = None
 
     def __post_init__(self) -> None:
-        self.schema_version = 1
+        self.schema_version = 1 if self.config is None else 2
+
+
+@dataclass
+class ImageIndex:
+    schema_version: str = field(init=False)
+    media_type: str
+    manifests: List[Descriptor]
+    digest: Descriptor
+
+    def __post_init__(self) -> None:
+        self.schema_version = 2
+
+
+@dataclass
+class Config:
+    os: str
+    architecture: str
+    variant: Optional[str] = None
+    env: List[str] = field(default_factory=list)
+    entrypoint: List[str] = field(default_factory=list)
+    cmd: List[str] = field(default_factory=list)
+    working_dir: str = ''
+    user: str = ''
+    labels: Dict[str, str] = field(default_factory=dict)
+    diff_ids: List[Descriptor] = field(default_factory=list)
+    history: List[Dict[str, Any]] = field(default_factory=list)
@@ -0,0 +1,473 @@
+"""
+Native Containerfile parser.
+
+The content is tokenized once into an immutable `Containerfile` model
+which holds the instruction list along with every value derived from it
+(base image, labels, envs, args, cmd, build stages), so none of them
+needs to parse the content again.
+
+The output follows the conventions of `dockerfile_parse` (comments are
+kept as "COMMENT" instructions, continuation lines are folded into
+a single value), with support for heredocs and parser directives.
+"""
+import re
+from dataclasses import dataclass, replace
+from types import MappingProxyType
+from typing import Dict, Iterable, Iterator, List, Mapping, Optional, Tuple
+
+from . import errors, trace
+
+
+COMMENT_INSTRUCTION = 'COMMENT'
+
+_INSTRUCTION_RE = re.compile(r'^\s*(\S+)\s+(.*)$')
+_COMMENT_RE = re.compile(r'^\s*#')
+_DIRECTIVE_RE = re.compile(r'^\s*#\s*(escape|syntax)\s*=\s*(.*?)\s*$', re.I)
+_HEREDOC_INSTRUCTIONS = ('RUN', 'COPY', 'ADD')
+_HEREDOC_RE = re.compile(r'<<(-?)(["\']?)([A-Za-z_][A-Za-z0-9_]*)\2')
+_FROM_RE = re.compile(r"""(?xi)
+    \s*
+    (?P<platform> --platform=\S+)?
+    \s*
+    (?P<image> \S+ )
+    (?:
+        \s+ AS \s+
+        (?P<name> \S+ )
+    )?
+""")
+
+
+@dataclass(frozen=True)
+class Instruction:
+    """
+    A single parsed instruction.
+
+    `name` is the upper-case instruction, `value` its arguments with
+    continuation lines folded and `content` the raw source text, spanning
+    from `startline` to `endline` (0-based). `heredocs` holds the raw
+    content of each heredoc attached to the instruction.
+
+    `resolved` holds the key/value pairs defined by FROM (its "image"),
+    ARG, ENV and LABEL instructions after ARG/ENV substitution and
+    build args are applied.
+    """
+    name: str
+    value: str
+    startline: int
+    endline: int
+    content: str
+    heredocs: Tuple[str, ...] = ()
+    resolved: Tuple[Tuple[str, str], ...] = ()
+
+    def as_dict(self) -> Dict[str, object]:
+        """
+        Return the `dockerfile_parse` "structure" representation
+        of the instruction.
+        """
+        return {
+            'instruction': self.name,
+            'startline': self.startline,
+            'endline': self.endline,
+            'content': self.content,
+            'value': self.value
+        }
+
+
+@dataclass(frozen=True)
+class Stage:
+    """
+    A build stage, from a FROM instruction up to the next one.
+
+    `name` is the lower-case "AS" name of the stage if any, and `start`
+    and `end` the range of its instructions. `base` is the image the
+    stage starts from, or `None` when it starts from a previous stage.
+    `depends` holds the index of the previous stages it is built from
+    (FROM) or copies files from (COPY --from), and `images` the other
+    images it copies files from.
+    """
+    index: int
+    name: Optional[str]
+    base: Optional[str]
+    start: int
+    end: int
+    depends: Tuple[int, ...] = ()
+    images: Tuple[str, ...] = ()
+
+
+@dataclass(frozen=True)
+class Containerfile:
+    """
+    Immutable parsed Containerfile model.
+
+    Every field is computed once by `parse`.
+    """
+    content: str
+    instructions: Tuple[Instruction, ...]
+    directives: Mapping[str, str]
+    parent_images: Tuple[str, ...]
+    labels: Mapping[str, str]
+    envs: Mapping[str, str]
+    args: Mapping[str, str]
+    build_args: Mapping[str, str]
+    cmd: Optional[str]
+    stages: Tuple[Stage, ...] = ()
+
+    @property
+    def baseimage(self) -> Optional[str]:
+        """
+        Return the base image of the final stage.
+        """
+        return (self.parent_images or (None,))[-1]
+
+    @property
+    def structure(self) -> List[Dict[str, object]]:
+        """
+        Return the instructions as `dockerfile_parse` structure dicts.
+        """
+        return [i.as_dict() for i in self.instructions]
+
+    def stage(self, ref: str) -> Optional[Stage]:
+        """
+        Return the stage named `ref` or at index `ref`, if any.
+        """
+        return _stage(self.stages, ref)
+
+
+def split_words(value: str, maxsplit: Optional[int] = None, dequote: bool = True,
+                args: Optional[Mapping[str, str]] = None,
+                envs: Optional[Mapping[str, str]] = None) -> Iterator[str]:
+    """
+    Split a string into shell-like words.
+
+    Quotes and escapes are consumed if `dequote` is set and `$VAR`/`${VAR}`
+    references are replaced from `envs` or `args` if any of them is provided.
+    """
+    substitute = envs is not None or args is not None
+    quotes = None
+    escaped = False
+    word = None
+    splits = 0
+    pos = 0
+    size = len(value)
+
+    while True:
+        if pos >= size:
+            if word is not None:
+                yield word
+            return
+
+        ch = value[pos]
+        pos += 1
+
+        if substitute and not escaped and ch == '$' and quotes != "'":
+            while True:
+                braced = False
+                name = ''
+                while True:
+                    ch = value[pos] if pos < size else ''
+                    pos += 1
+                    if name == '' and ch == '{':
+                        braced = True
+                        continue
+                    if not ch or (braced and ch == '}'):
+                        break
+                    if not ch.isalnum() and ch != '_':
+                        break
+                    name += ch
+
+                if envs is not None and name in envs:
+                    word = (word or '') + envs[name]
+                elif args is not None and name in args:
+                    word = (word or '') + args[name]
+
+                if ch != '$':
+                    break
+
+            if braced and ch == '}':
+                continue
+            if not ch:
+                pos = size
+
+        # quoting and escaping state after this character
+        was_escaped = escaped
+        escaped = not escaped and ch == '\\' and quotes != "'"
+        if escaped:
+            kept = ''
+        elif was_escaped:
+            kept = ch if quotes != '"' or ch == '"' else f'\\{ch}'
+        elif quotes is None and ch in ('"', "'"):
+            quotes = ch
+            kept = ''
+        elif quotes is not None and quotes == ch:
+            quotes = None
+            kept = ''
+        else:
+            kept = ch
+
+        if dequote:
+            ch = kept
+
+        may_split = maxsplit != 0 and (maxsplit is None or splits < maxsplit)
+        if may_split and quotes is None and not was_escaped and ch.isspace():
+            if word is not None:
+                splits += 1
+                yield word
+            word = None
+        else:
+            word = (word or '') + ch
+
+
+def dequote(value: str, args: Optional[Mapping[str, str]] = None,
+            envs: Optional[Mapping[str, str]] = None) -> str:
+    """
+    Return `value` with its quotes and escapes consumed.
+    """
+    return ''.join(split_words(value, maxsplit=0, args=args, envs=envs))
+
+
+def key_values(value: str, args: Optional[Mapping[str, str]] = None,
+               envs: Optional[Mapping[str, str]] = None) -> List[Tuple[str, str]]:
+    """
+    Return the key/value pairs of a LABEL, ENV or ARG instruction value,
+    either in the "key value" or in the "key=value [key=value...]" form.
+    """
+    words = list(split_words(value, dequote=False))
+    if not words:
+        return []
+
+    if '=' not in words[0]:
+        kv = [dequote(x, args, envs) for x in value.split(None, 1)]
+        return [(kv[0], kv[1] if len(kv) > 1 else '')]
+
+    pairs = []
+    for word in words:
+        if '=' not in word:
+            raise errors.PBError(f'Syntax error - can\'t find = in "{word}". Must be of the form: name=value')
+        k, v = word.split('=', 1)
+        pairs.append((dequote(k, args, envs), dequote(v, args, envs)))
+
+    return pairs
+
+
+def image_from(value: str) -> Tuple[Optional[str], Optional[str]]:
+    """
+    Return the image and stage name of a FROM instruction value.
+    """
+    m = _FROM_RE.match(value)
+    return m.group('image', 'name') if m else (None, None)
+
+
+def copy_from(value: str) -> Optional[str]:
+    """
+    Return the --from flag of a COPY instruction value, if any.
+    """
+    for word in split_words(value):
+        if word.startswith('--from='):
+            return word[len('--from='):]
+        if not word.startswith('--'):
+            break
+    return None
+
+
+def _stage(stages: Iterable[Stage], ref: str) -> Optional[Stage]:
+    if ref.isdigit():
+        return next((s for s in stages if s.index == int(ref)), None)
+    return next((s for s in stages if s.name == ref.lower()), None)
+
+
+def _strip_eol(text: str, escape: str) -> str:
+    text = text.rstrip()
+    if text.endswith(escape):
+        return text[:-1]
+    return text
+
+
+def _tokenize(lines: List[str]) -> Tuple[List[Instruction], Dict[str, str]]:
+    """
+    Split the content lines into instructions.
+    """
+    instructions = []
+    directives = {}
+    directive_possible = True
+    escape = '\\'
+    continuation = re.compile(r'^.*\\\s*$')
+
+    current = None
+    in_continuation = False
+    lineno = 0
+    total = len(lines)
+
+    while lineno < total:
+        line = lines[lineno]
+
+        if directive_possible:
+            m = _DIRECTIVE_RE.match(line)
+            if m and m.group(1).lower() not in directives:
+                directives[m.group(1).lower()] = m.group(2)
+                if m.group(1).lower() == 'escape' and m.group(2) in ('\\', '`'):
+                    escape = m.group(2)
+                    continuation = re.compile(r'^.*' + re.escape(escape) + r'\s*$')
+            else:
+                directive_possible = False
+
+        if _COMMENT_RE.match(line):
+            value = re.sub(r'^\s*#\s*', '', line).replace('\n', '')
+            instructions.append(Instruction(COMMENT_INSTRUCTION, value, lineno, lineno, line))
+            lineno += 1
+            continue
+
+        if not in_continuation:
+            m = _INSTRUCTION_RE.match(line)
+            if not m:
+                lineno += 1
+                continue
+            current = {
+                'name': m.group(1).upper(),
+                'value': _strip_eol(m.group(2), escape),
+                'startline': lineno,
+                'content': line
+            }
+        elif not line.strip():
+            # empty lines do not end a continuation
+            current['content'] += line
+            lineno += 1
+            continue
+        else:
+            current['content'] += line
+            if current['value']:
+                current['value'] += _strip_eol(line, escape)
+            else:
+                current['value'] = _strip_eol(line.lstrip(), escape)
+
+        in_continuation = bool(continuation.match(line))
+        lineno += 1
+        if in_continuation:
+            continue
+
+        # heredoc bodies start on the lines right after the instruction
+        value = current['value']
+        heredocs = []
+        if current['name'] in _HEREDOC_INSTRUCTIONS:
+            for m in _HEREDOC_RE.finditer(current['value']):
+                strip_tabs, delimiter = m.group(1), m.group(3)
+                body = ''
+                while lineno < total:
+                    raw = lines[lineno]
+                    current['content'] += raw
+                    lineno += 1
+                    check = raw.lstrip('\t') if strip_tabs else raw
+                    if check.rstrip('\r\n') == delimiter:
+                        break
+                    body += raw
+                heredocs.append(body)
+                value += f'\n{body}{delimiter}'
+
+        instructions.append(Instruction(
+            current['name'], value, current['startline'], lineno - 1,
+            current['content'], tuple(heredocs)
+        ))
+
+    if in_continuation:
+        # a trailing continuation still ends the instruction
+        instructions.append(Instruction(
+            current['name'], current['value'], current['startline'], total - 1, current['content']
+        ))
+
+    return instructions, directives
+
+
+def _new_stage(stages: List[Stage], image: str, name: Optional[str], start: int) -> Stage:
+    stage = Stage(len(stages), name.lower() if name else None, image, start, start)
+    return _add_dependency(stages, stage, image, base=True)
+
+
+def _add_dependency(stages: List[Stage], stage: Stage, ref: str, base: bool = False) -> Stage:
+    """
+    Add a dependency of `stage` on the previous stage or image `ref`.
+    """
+    parent = _stage(stages, ref)
+    if parent is not None and parent.index < stage.index:
+        if base:
+            stage = replace(stage, base=None)
+        if parent.index not in stage.depends:
+            stage = replace(stage, depends=stage.depends + (parent.index,))
+    elif not base and ref not in stage.images:
+        stage = replace(stage, images=stage.images + (ref,))
+    return stage
+
+
+@trace.traced('containerfile.parse')
+def parse(content: str, build_args: Optional[Dict[str, str]] = None) -> Containerfile:
+    """
+    Parse a Containerfile content into a `Containerfile` model.
+
+    `build_args` are the values of build arguments provided at build time.
+    """
+    build_args = dict(build_args or {})
+    instructions, directives = _tokenize(content.splitlines(True))
+
+    in_stage = False
+    top_args: Dict[str, str] = {}
+    parents: List[str] = []
+    args: Dict[str, str] = {}
+    envs: Dict[str, str] = {}
+    values: Dict[str, Dict[str, str]] = {'LABEL': {}, 'ENV': {}, 'ARG': {}}
+    cmd = None
+    stages: List[Stage] = []
+
+    for n, inst in enumerate(instructions):
+        resolved = []
+        if inst.name == 'FROM':
+            if stages:
+                stages[-1] = replace(stages[-1], end=n)
+            in_stage = True
+            args = {}
+            envs = {}
+            cmd = None
+            for v in values.values():
+                v.clear()
+            image, name = image_from(inst.value)
+            if image is not None:
+                parents.append(dequote(image, args=top_args))
+                resolved.append(('image', parents[-1]))
+                stages.append(_new_stage(stages, parents[-1], name, n))
+        elif inst.name == 'CMD':
+            cmd = inst.value
+        elif inst.name == 'COPY' and stages and (ref := copy_from(inst.value)) is not None:
+            stages[-1] = _add_dependency(stages, stages[-1], ref)
+        elif inst.name in values:
+            if inst.name == 'ARG':
+                pairs = key_values(inst.value)
+            else:
+                pairs = key_values(inst.value, args, envs)
+            for key, value in pairs:
+                if inst.name == 'ARG':
+                    if in_stage:
+                        value = top_args.get(key, build_args.get(key, value))
+                        args[key] = value
+                    else:
+                        value = build_args.get(key, value)
+                        top_args[key] = value
+                elif inst.name == 'ENV':
+                    envs[key] = value
+                values[inst.name][key] = value
+                resolved.append((key, value))
+
+        if resolved:
+            instructions[n] = replace(inst, resolved=tuple(resolved))
+
+    if stages:
+        stages[-1] = replace(stages[-1], end=len(instructions))
+
+    return Containerfile(
+        content=content,
+        instructions=tuple(instructions),
+        directives=MappingProxyType(directives),
+        parent_images=tuple(parents),
+        labels=MappingProxyType(values['LABEL']),
+        envs=MappingProxyType(values['ENV']),
+        args=MappingProxyType(values['ARG']),
+        build_args=MappingProxyType(build_args),
+        cmd=cmd,
+        stages=tuple(stages)
+    )
@@ -0,0 +1,146 @@
+"""
+Pull many images at once.
+
+Manifests of every image are resolved concurrently, then the union of
+their layers is downloaded with each blob fetched exactly once, no
+matter how many images reference it, and optionally extracted.
+"""
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from . import errors, extract, image, trace
+from .cache import ManifestCache
+from .oci.v1 import Descriptor, Manifest
+from .store import BlobStore
+
+
+DEFAULT_RESOLVE_WORKERS = 16
+
+
+@dataclass
+class Summary:
+    """
+    Result of a pull.
+
+    `references` counts layer references across all manifests, `unique`
+    the distinct layers among them, `cached` the ones already in the store
+    and `downloaded` the ones fetched by this pull. Byte counts are
+    known once every layer is in the store: `saved_bytes` is the amount
+    of bytes that downloading each image on its own would have fetched
+    again for shared layers.
+    """
+    images: List[str] = field(default_factory=list)
+    errors: Dict[str, str] = field(default_factory=dict)
+    references: int = 0
+    unique: int = 0
+    cached: int = 0
+    downloaded: int = 0
+    downloaded_bytes: int = 0
+    saved_bytes: int = 0
+    elapsed: float = 0.0
+
+    @property
+    def throughput(self) -> float:
+        """
+        Return the download throughput in bytes per second.
+        """
+        return self.downloaded_bytes / self.elapsed if self.elapsed else 0.0
+
+
+@trace.traced('pull.resolve')
+def resolve(refs: Iterable[str], cache: Optional[ManifestCache] = None,
+            workers: int = DEFAULT_RESOLVE_WORKERS
+            ) -> Tuple[List[Tuple[image.Image, Manifest]], Dict[str, str]]:
+    """
+    Resolve the manifests of many image references concurrently.
+
+    Return the resolved (image, manifest) pairs, in the order of `refs`,
+    and the error messages of references that could not be resolved.
+    """
+    def _resolve(ref: str) -> Tuple[image.Image, Manifest]:
+        img = image.from_str(ref)
+        return img, image.info(img, cache)
+
+    refs = list(dict.fromkeys(refs))
+    resolved = []
+    failed = {}
+
+    with ThreadPoolExecutor(max_workers=max(1, min(workers, len(refs)))) as pool:
+        for ref, future in [(ref, pool.submit(_resolve, ref)) for ref in refs]:
+            try:
+                resolved.append(future.result())
+            except errors.PBError as e:
+                failed[ref] = e.message
+            except Exception as e:
+                failed[ref] = str(e)
+
+    return resolved, failed
+
+
+@trace.traced('pull.pull')
+def pull(refs: Iterable[str], store: BlobStore, cache: Optional[ManifestCache] = None,
+         workers: int = image.DEFAULT_WORKERS, progress: Optional[image.Progress] = None,
+         retry: Optional[image.RetryPolicy] = None,
+         unpack: Optional[extract.LayerDirs] = None) -> Summary:
+    """
+    Pull the layers of many images into the blob store.
+
+    Manifests are resolved concurrently and layers shared by several
+    images are downloaded once, from the first image referencing them.
+    Up to `workers` layers are downloaded concurrently.
+
+    If `unpack` is provided, layers are also extracted into it while
+    they are downloaded (see `pkgbox.extract.unpack`).
+
+    Images whose manifest can not be resolved are reported in the
+    summary `errors` and do not stop the pull, while a failed layer
+    download raises its error.
+    """
+    started = time.perf_counter()
+    summary = Summary()
+    resolved, summary.errors = resolve(refs, cache)
+
+    # layer digest -> (image to fetch it from, layer, references)
+    layers: Dict[str, Tuple[image.Image, Descriptor, int]] = {}
+    for img, manifest in resolved:
+        summary.images.append(str(img))
+        for layer in manifest.layers:
+            summary.references += 1
+            key = str(layer)
+            if key in layers:
+                src, desc, count = layers[key]
+                layers[key] = (src, desc, count + 1)
+            else:
+                layers[key] = (img, layer, 1)
+
+    summary.unique = len(layers)
+    missing = [(img, layer) for img, layer, _ in layers.values() if not image.layer_exists(layer, store)]
+    summary.cached = summary.unique - len(missing)
+
+    todo = missing
+    if unpack:
+        todo = [(img, layer) for img, layer, _ in layers.values() if not unpack.exists(layer)]
+
+    def _get(img: image.Image, layer: Descriptor) -> None:
+        if unpack:
+            extract.unpack(img, layer, store, unpack, progress, retry)
+        else:
+            image.fetch_layer(img, layer, store, progress, retry)
+
+    if workers <= 1 or len(todo) <= 1:
+        for img, layer in todo:
+            _get(img, layer)
+    else:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            futures = [pool.submit(_get, img, layer) for img, layer in todo]
+            for future in futures:
+                future.result()
+
+    summary.downloaded = len(missing)
+    summary.downloaded_bytes = sum(store.size(layer) or 0 for _, layer in missing)
+    summary.saved_bytes = sum((store.size(layer) or 0) * (count - 1) for _, layer, count in layers.values())
+    summary.elapsed = time.perf_counter() - started
+
+    return summary
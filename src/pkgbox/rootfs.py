@@ -0,0 +1,518 @@
+"""
+Root filesystem assembly from image layers.
+
+Applying layers one after the other writes every file that a later
+layer overwrites or deletes. The assembler instead reads the tar headers
+of every layer first and merges them, applying whiteouts and opaque
+directories, into the final file tree. Only the entries left in that
+tree are then extracted, and layers with no surviving entries are not
+read a second time.
+
+The header scan keeps copies of the decompressor state at regular
+offsets of each blob. Extraction restarts from those checkpoints, so
+the ranges of a layer holding no surviving file are not decompressed
+again and the rest is spread across workers, a big base layer
+included. The zstd decompressor state can not be copied, so zstd layers
+only have a checkpoint at their start.
+
+Paths go through the merged tree the way they would go through the
+filesystem: symlinks of parent directories are followed, as if the
+rootfs was the filesystem root, and an entry replacing a directory with
+a non directory drops its whole subtree.
+"""
+import os
+import stat
+import time
+import zlib
+import errno
+import bisect
+import shutil
+import tarfile
+import pathlib
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import BinaryIO, Dict, List, Optional, Tuple
+
+from . import errors, trace, zstd
+from .extract import MAX_SYMLINKS, OPAQUE_WHITEOUT, READ_SIZE, WHITEOUT_PREFIX, _apply, _clean, _decompressor, _remove
+from .oci.v1 import Manifest
+from .store import BlobStore
+
+
+DEFAULT_WORKERS = 4
+CHECKPOINTS = 128
+MIN_SPAN = 1024 * 1024
+
+
+@dataclass
+class Entry:
+    """
+    A tar member of a layer, by layer index.
+    """
+    layer: int
+    member: tarfile.TarInfo
+
+
+class _Node:
+    """
+    A merged tree node: its winning entry (`None` for directories only
+    implied by their children) and its children by name.
+    """
+    __slots__ = ('entry', 'children')
+
+    def __init__(self, entry: Optional[Entry] = None) -> None:
+        self.entry = entry
+        self.children: Dict[str, '_Node'] = {}
+
+    @property
+    def is_dir(self) -> bool:
+        return self.entry is None or self.entry.member.isdir()
+
+
+@dataclass
+class Stats:
+    """
+    Assembly statistics: tar entries read, entries and regular file bytes
+    written into the rootfs, and the entries and bytes skipped since a
+    later layer overwrote or deleted them.
+    """
+    entries: int = 0
+    written: int = 0
+    written_bytes: int = 0
+    skipped: int = 0
+    skipped_bytes: int = 0
+    elapsed: float = 0.0
+
+
+class _Inflater:
+    """
+    Decompressor of a layer blob starting with `head`: gzipped (with
+    possibly several gzip members), zstd compressed or not. Its state
+    can be copied, except for zstd once fed.
+    """
+    def __init__(self, head: bytes = b'') -> None:
+        self._decompress = _decompressor(head)
+
+    @property
+    def copyable(self) -> bool:
+        """
+        Check if the state can be copied after being fed.
+        """
+        return not isinstance(self._decompress, zstd.Decompressor)
+
+    def copy(self) -> '_Inflater':
+        """
+        Return a copy of the decompressor in its current state.
+        """
+        other = _Inflater()
+        other._decompress = self._decompress.copy() if self._decompress else None
+        return other
+
+    def feed(self, chunk: bytes) -> bytes:
+        """
+        Decompress the next chunk of the blob.
+        """
+        if self._decompress is None:
+            return chunk
+
+        out = bytearray()
+        while chunk:
+            out += self._decompress.decompress(chunk)
+            chunk = self._decompress.unused_data
+            if chunk and self._decompress.eof:
+                # concatenated gzip members
+                self._decompress = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            else:
+                break
+        return bytes(out)
+
+
+@dataclass
+class Checkpoint:
+    """
+    A point to resume decompressing a layer blob from: its offset in the
+    blob, the matching position in the tar stream and the decompressor
+    state there.
+    """
+    offset: int
+    position: int
+    state: _Inflater
+
+
+@dataclass
+class Layer:
+    """
+    The tar headers of a layer blob and its decompression checkpoints.
+    """
+    path: pathlib.Path
+    members: List[tarfile.TarInfo]
+    checkpoints: List[Checkpoint]
+
+
+class _ScanReader:
+    """
+    File-like object reading the tar stream of a layer blob, taking a
+    checkpoint every `span` bytes of the blob.
+    """
+    def __init__(self, f: BinaryIO, inflater: _Inflater, span: int) -> None:
+        self.f = f
+        self.inflater = inflater
+        self.span = span
+        self.offset = 0
+        self.position = 0
+        self.buffer = bytearray()
+        self.eof = False
+        self.checkpoints = [Checkpoint(0, 0, inflater.copy())]
+
+    def read(self, size: int = -1) -> bytes:
+        while not self.eof and (size < 0 or len(self.buffer) < size):
+            if self.offset - self.checkpoints[-1].offset >= self.span and self.inflater.copyable:
+                self.checkpoints.append(Checkpoint(self.offset, self.position, self.inflater.copy()))
+            chunk = self.f.read(READ_SIZE)
+            if not chunk:
+                self.eof = True
+                break
+            data = self.inflater.feed(chunk)
+            self.offset += len(chunk)
+            self.position += len(data)
+            self.buffer += data
+
+        if size < 0:
+            size = len(self.buffer)
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return data
+
+
+@trace.traced('rootfs.scan')
+def scan(path: pathlib.Path) -> Layer:
+    """
+    Read the tar headers of a layer blob, recording up to about
+    `CHECKPOINTS` decompression checkpoints on the way.
+    """
+    span = max(MIN_SPAN, os.path.getsize(path) // CHECKPOINTS)
+    with open(path, 'rb') as f:
+        head = f.read(len(zstd.MAGIC))
+        f.seek(0)
+        reader = _ScanReader(f, _Inflater(head), span)
+        with tarfile.open(fileobj=reader, mode='r|') as tar:
+            members = list(tar)
+    return Layer(pathlib.Path(path), members, reader.checkpoints)
+
+
+class Tree:
+    """
+    Merged file tree of a stack of layers.
+    """
+    def __init__(self) -> None:
+        """
+        Create a new empty tree.
+        """
+        self.root = _Node()
+
+    def _get(self, parts: List[str], create: bool = False) -> Optional[_Node]:
+        node = self.root
+        for part in parts:
+            child = node.children.get(part)
+            if child is None or (create and not child.is_dir):
+                if not create:
+                    return None
+                child = node.children[part] = _Node()
+            node = child
+        return node
+
+    def _resolve(self, name: str) -> List[str]:
+        """
+        Return the path components of `name` with the symlinks of its
+        parent directories resolved.
+        """
+        parts = name.split('/')
+        base = parts.pop()
+        resolved: List[str] = []
+        links = 0
+
+        while parts:
+            part = parts.pop(0)
+            if part in ('', '.'):
+                continue
+            if part == '..':
+                if resolved:
+                    resolved.pop()
+                continue
+
+            node = self._get(resolved + [part])
+            if node and node.entry and node.entry.member.issym():
+                links += 1
+                if links > MAX_SYMLINKS:
+                    raise errors.PBError(f'Too many levels of symbolic links in "{name}"', errno.ELOOP)
+                target = node.entry.member.linkname
+                if target.startswith('/'):
+                    resolved = []
+                parts = target.split('/') + parts
+                continue
+            resolved.append(part)
+
+        return resolved + [base]
+
+    def _prune(self, node: _Node, layer: int) -> bool:
+        """
+        Drop the entries of layers below `layer` under `node`, returning
+        whether anything is left.
+        """
+        for name, child in list(node.children.items()):
+            left = self._prune(child, layer)
+            if not left and not (child.entry and child.entry.layer == layer):
+                del node.children[name]
+        return bool(node.children)
+
+    def add(self, layer: int, members: List[tarfile.TarInfo]) -> None:
+        """
+        Apply the entries of a layer on top of the tree.
+        """
+        for member in members:
+            name = _clean(member.name)
+            if not name:
+                continue
+
+            parts = self._resolve(name)
+            base = parts.pop()
+            parent = self._get(parts, create=True)
+
+            if base == OPAQUE_WHITEOUT:
+                self._prune(parent, layer)
+            elif base.startswith(WHITEOUT_PREFIX):
+                parent.children.pop(base[len(WHITEOUT_PREFIX):], None)
+            elif member.isdir() and (existing := parent.children.get(base)) and existing.is_dir:
+                existing.entry = Entry(layer, member)
+            else:
+                parent.children[base] = _Node(Entry(layer, member))
+
+    def lookup(self, name: str) -> Optional[_Node]:
+        """
+        Return the node at `name`, following symlinks, or `None` if
+        there is none.
+        """
+        for _ in range(MAX_SYMLINKS):
+            name = _clean(name)
+            if not name:
+                return self.root
+            parts = self._resolve(name)
+            node = self._get(parts)
+            if node is None or node.entry is None or not node.entry.member.issym():
+                return node
+            target = node.entry.member.linkname
+            name = target if target.startswith('/') else '/'.join(parts[:-1] + [target])
+        raise errors.PBError(f'Too many levels of symbolic links in "{name}"', errno.ELOOP)
+
+    def walk(self, node: Optional[_Node] = None, path: str = '') -> List[Tuple[str, _Node]]:
+        """
+        Return every (path, node) of the tree, or of the subtree of
+        `node` at `path`, parents first.
+        """
+        out = []
+        stack = [(path, node or self.root)]
+        while stack:
+            path, node = stack.pop()
+            for name, child in node.children.items():
+                child_path = f'{path}/{name}' if path else name
+                out.append((child_path, child))
+                stack.append((child_path, child))
+        return out
+
+
+def merge(layers: List[List[tarfile.TarInfo]]) -> Tree:
+    """
+    Merge the tar headers of a stack of layers, lowest first.
+    """
+    tree = Tree()
+    for n, members in enumerate(layers):
+        tree.add(n, members)
+    return tree
+
+
+def _create(member: tarfile.TarInfo, path: str, owner: bool) -> None:
+    """
+    Create the non regular file entry of `member` at `path`.
+    """
+    if member.issym():
+        os.symlink(member.linkname, path)
+    elif member.isfifo():
+        os.mkfifo(path)
+    elif member.ischr() or member.isblk():
+        if not owner:
+            # device nodes can only be created by root
+            return
+        kind = stat.S_IFCHR if member.ischr() else stat.S_IFBLK
+        os.mknod(path, kind | 0o600, os.makedev(member.devmajor, member.devminor))
+    else:
+        return
+    _apply(path, member, owner)
+
+
+def _open(path: str) -> BinaryIO:
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | os.O_NOFOLLOW, 0o600)
+    return os.fdopen(fd, 'wb')
+
+
+def _finish(member: tarfile.TarInfo, paths: List[str], owner: bool) -> int:
+    """
+    Copy the file extracted at the first path of `paths` to the others
+    and apply the member metadata, returning the amount of bytes written.
+    """
+    for path in paths[1:]:
+        with open(paths[0], 'rb') as src, _open(path) as f:
+            shutil.copyfileobj(src, f, READ_SIZE)
+    for path in paths:
+        _apply(path, member, owner)
+    return member.size * len(paths)
+
+
+@trace.traced('rootfs.extract')
+def _extract(layer: Layer, start: Checkpoint,
+             files: List[Tuple[tarfile.TarInfo, List[str]]], owner: bool) -> int:
+    """
+    Extract regular files of a layer, sorted by offset, to their
+    destination paths by decompressing the blob from `start`. Return
+    the amount of bytes written.
+    """
+    written = 0
+    inflater = start.state.copy()
+    position = start.position
+    pending = iter(files)
+    current = next(pending, None)
+    out: Optional[BinaryIO] = None
+
+    try:
+        with open(layer.path, 'rb') as f:
+            f.seek(start.offset)
+            while current:
+                chunk = f.read(READ_SIZE)
+                if not chunk:
+                    break
+                data = memoryview(inflater.feed(chunk))
+                end = position + len(data)
+
+                while current and current[0].offset_data <= end:
+                    member, paths = current
+                    if out is None:
+                        _remove(paths[0])
+                        out = _open(paths[0])
+                    member_end = member.offset_data + member.size
+                    lo, hi = max(member.offset_data, position), min(member_end, end)
+                    if hi > lo:
+                        out.write(data[lo - position:hi - position])
+                    if member_end > end:
+                        break
+                    out.close()
+                    out = None
+                    written += _finish(member, paths, owner)
+                    current = next(pending, None)
+                position = end
+    finally:
+        if out:
+            out.close()
+
+    if current:
+        raise errors.PBError(f'Layer {layer.path.name} is truncated', errno.EIO)
+    return written
+
+
+@trace.traced('rootfs.assemble')
+def assemble(manifest: Manifest, store: BlobStore, dest: pathlib.Path,
+             workers: int = DEFAULT_WORKERS) -> Stats:
+    """
+    Assemble the rootfs of an image into `dest`, which should be empty,
+    from its layers in the blob store.
+
+    Layer headers are scanned and layers extracted by up to `workers`
+    threads.
+    """
+    started = time.perf_counter()
+    stats = Stats()
+    dest = pathlib.Path(dest)
+    owner = os.geteuid() == 0
+
+    blobs = []
+    for layer in manifest.layers:
+        if not store.exists(layer):
+            raise errors.PBError(f'Layer {layer} is not in the store', errno.ENOENT)
+        blobs.append(store.path(layer))
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        scanned = list(pool.map(scan, blobs))
+    headers = [layer.members for layer in scanned]
+    tree = merge(headers)
+
+    # layer -> tar offset -> (regular file, destination paths)
+    files: List[Dict[int, Tuple[tarfile.TarInfo, List[str]]]] = [{} for _ in blobs]
+    others: List[Tuple[tarfile.TarInfo, str]] = []
+    links: List[Tuple[str, str]] = []
+    dirs: List[Tuple[str, Optional[tarfile.TarInfo]]] = []
+    winners: Dict[Tuple[int, str], str] = {}
+
+    nodes = tree.walk()
+    for path, node in nodes:
+        if node.entry and not node.entry.member.islnk():
+            winners[(node.entry.layer, _clean(node.entry.member.name))] = path
+
+    os.makedirs(dest, exist_ok=True)
+    for path, node in nodes:
+        target = os.path.join(dest, path)
+        if node.is_dir:
+            os.makedirs(target, exist_ok=True)
+            dirs.append((target, node.entry.member if node.entry else None))
+            stats.written += node.entry is not None
+            continue
+
+        layer, member = node.entry.layer, node.entry.member
+        stats.written += 1
+        if member.islnk():
+            source = _clean(member.linkname)
+            if (layer, source) in winners:
+                links.append((os.path.join(dest, winners[(layer, source)]), target))
+                continue
+            # the link target was overwritten later on: extract its
+            # content from the layer of the link
+            for m in headers[layer]:
+                if m.offset >= member.offset:
+                    break
+                if _clean(m.name) == source:
+                    member = m
+            if member.islnk():
+                raise errors.PBError(f'Hardlink target "{member.linkname}" of "{path}" not found', errno.ENOENT)
+        if member.isreg():
+            files[layer].setdefault(member.offset, (member, []))[1].append(target)
+        else:
+            others.append((member, target))
+
+    for member, target in others:
+        _create(member, target, owner)
+
+    # files are extracted by checkpoint range, so that a big layer is
+    # decompressed by several workers at once
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        futures = []
+        for layer, wanted in zip(scanned, files):
+            positions = [c.position for c in layer.checkpoints]
+            ranges: Dict[int, List[Tuple[tarfile.TarInfo, List[str]]]] = {}
+            for offset in sorted(wanted):
+                member = wanted[offset][0]
+                ranges.setdefault(bisect.bisect_right(positions, member.offset_data) - 1, []).append(wanted[offset])
+            for n, todo in ranges.items():
+                futures.append(pool.submit(_extract, layer, layer.checkpoints[n], todo, owner))
+        stats.written_bytes = sum(f.result() for f in futures)
+
+    for source, target in links:
+        os.link(source, target, follow_symlinks=False)
+
+    # directories last, so read-only ones can still be filled
+    for path, member in reversed(dirs):
+        if member:
+            _apply(path, member, owner)
+
+    stats.entries = sum(map(len, headers))
+    stats.skipped = stats.entries - stats.written
+    stats.skipped_bytes = sum(m.size for h in headers for m in h if m.isreg()) - stats.written_bytes
+    stats.elapsed = time.perf_counter() - started
+
+    return stats
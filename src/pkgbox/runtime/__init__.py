@@ -5,5 +5,10 @@ from .meta import Runtime
 def build(runtime_name: str) -> Runtime:
     """
     Create a new runtime object.
+
+    Only the in-process "fake" runtime is available for now.
     """
+    if runtime_name == 'fake':
+        from .fake import FakeRuntime
+        return FakeRuntime()
     raise errors.PBNotImplementedError()
@@ -0,0 +1,218 @@
+"""
+Incremental build executor.
+
+The executor runs a list of `Instruction`s through a `Runtime`, taking
+a snapshot of the build after each step. A step is keyed by its
+instruction digest and the snapshot it started from (the parent
+result), the first step starting from a `base`, such as the base image
+manifest digest. The snapshot each step led to is kept in a SQLite
+`BuildIndex` under the data dir.
+
+A build walks the chain of keys through the index for as long as steps
+are found, restores the deepest cached snapshot and only runs the
+remaining instructions. Since keys follow the actual snapshots, a step
+whose output changed (say a RUN downloading the latest version of
+something) invalidates the following ones, while a step leading to an
+already known state joins its cached descendants again.
+"""
+import time
+import errno
+import pathlib
+import sqlite3
+import hashlib
+import threading
+from dataclasses import dataclass
+from typing import Dict, List, Optional
+
+from pkgbox import errors, normalize, trace
+from pkgbox.parser import Containerfile, Stage
+from .meta import Instruction, Runtime
+
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS steps (
+    key TEXT PRIMARY KEY,
+    parent TEXT NOT NULL,
+    instruction TEXT NOT NULL,
+    snapshot TEXT NOT NULL,
+    created REAL NOT NULL,
+    used REAL NOT NULL
+)
+'''
+
+
+def step_key(parent: str, instruction: Instruction) -> str:
+    """
+    Return the cache key of running `instruction` on the
+    `parent` snapshot.
+    """
+    content = f'{parent}\n{instruction.digest}'
+    return 'sha256:' + hashlib.sha256(content.encode()).hexdigest()
+
+
+def from_containerfile(cf: Containerfile, stage: Optional[Stage] = None) -> List[Instruction]:
+    """
+    Return the build instructions of a parsed Containerfile, or of one
+    of its stages, using their normalized form (see `pkgbox.normalize`)
+    so cosmetic edits still hit the cache.
+    """
+    pairs = list(zip(cf.instructions, normalize.normalize_all(cf)))
+    if stage is not None:
+        pairs = pairs[stage.start:stage.end]
+    return [Instruction(inst.name, text[len(inst.name):].lstrip())
+            for inst, text in pairs
+            if inst.name != 'COMMENT']
+
+
+class BuildIndex:
+    """
+    SQLite index of the snapshots of cached build steps.
+    """
+    def __init__(self, path: pathlib.Path) -> None:
+        """
+        Create a new index object instance, creating
+        the database if needed.
+        """
+        self.path = pathlib.Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        try:
+            self._db = sqlite3.connect(self.path, timeout=30, check_same_thread=False, isolation_level=None)
+            self._db.execute('PRAGMA journal_mode=WAL')
+            self._db.execute(_SCHEMA)
+        except sqlite3.Error as e:
+            raise errors.PBError(f'Can not open the build index {self.path}: {e}', errno.EIO)
+
+    def get(self, key: str) -> Optional[str]:
+        """
+        Return the snapshot of a cached step, if any.
+        """
+        with self._lock:
+            row = self._db.execute('SELECT snapshot FROM steps WHERE key = ?', (key,)).fetchone()
+            if row is not None:
+                self._db.execute('UPDATE steps SET used = ? WHERE key = ?', (time.time(), key))
+        return row[0] if row else None
+
+    def put(self, key: str, parent: str, instruction: Instruction, snapshot: str) -> None:
+        """
+        Record the snapshot a step led to.
+        """
+        now = time.time()
+        with self._lock:
+            self._db.execute('INSERT OR REPLACE INTO steps VALUES (?, ?, ?, ?, ?, ?)',
+                             (key, parent, instruction.digest, snapshot, now, now))
+
+    def remove(self, key: str) -> None:
+        """
+        Remove a cached step.
+        """
+        with self._lock:
+            self._db.execute('DELETE FROM steps WHERE key = ?', (key,))
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._db.execute('SELECT COUNT(*) FROM steps').fetchone()[0]
+
+    def close(self) -> None:
+        with self._lock:
+            self._db.close()
+
+
+@dataclass
+class Step:
+    """
+    A build step: its key, the snapshot it led to and
+    whether it came from the cache.
+    """
+    instruction: Instruction
+    key: str
+    snapshot: str
+    cached: bool
+
+
+@dataclass
+class Result:
+    """
+    Result of a build: its steps and the snapshot it led to.
+    """
+    build_id: str
+    base: str
+    steps: List[Step]
+
+    @property
+    def snapshot(self) -> str:
+        return self.steps[-1].snapshot if self.steps else self.base
+
+    @property
+    def cached(self) -> int:
+        """
+        Return the number of steps reused from the cache.
+        """
+        return sum(1 for s in self.steps if s.cached)
+
+
+class Executor:
+    """
+    Runs builds through a runtime, reusing the steps of its index.
+    """
+    def __init__(self, runtime: Runtime, index: BuildIndex) -> None:
+        """
+        Create a new executor object instance.
+        """
+        self.runtime = runtime
+        self.index = index
+
+    def cached_steps(self, instructions: List[Instruction], base: str = '') -> List[Step]:
+        """
+        Return the leading steps of a build found in the index, up to
+        the deepest one. Steps whose snapshot the runtime lost are
+        removed from the index.
+        """
+        steps = []
+        parent = base
+        for inst in instructions:
+            key = step_key(parent, inst)
+            snapshot = self.index.get(key)
+            if snapshot is None:
+                break
+            if not self.runtime.has_snapshot(snapshot):
+                self.index.remove(key)
+                break
+            steps.append(Step(inst, key, snapshot, True))
+            parent = snapshot
+        return steps
+
+    @trace.traced('build.run')
+    def run(self, build_id: str, instructions: List[Instruction], base: str = '') -> Result:
+        """
+        Run a build, resuming from its deepest cached step.
+
+        Each step is recorded as soon as it ran, so a build failing
+        with a `PBRuntimeError` resumes after its last successful step
+        when run again.
+        """
+        self.runtime.prepare_build(build_id)
+
+        steps = self.cached_steps(instructions, base)
+        parent = steps[-1].snapshot if steps else base
+        if steps:
+            trace.event('build.cache.hit', steps=len(steps))
+            self.runtime.restore(build_id, parent)
+
+        for inst in instructions[len(steps):]:
+            key = step_key(parent, inst)
+            with trace.span('build.step', instruction=inst.ctx):
+                self.runtime.run_build_instruction(build_id, inst)
+                snapshot = self.runtime.snapshot(build_id)
+            self.index.put(key, parent, inst, snapshot)
+            steps.append(Step(inst, key, snapshot, False))
+            parent = snapshot
+
+        return Result(build_id, base, steps)
+
+
+def from_paths(paths: Dict[str, str]) -> BuildIndex:
+    """
+    Return the build index located in the pkgbox data dir.
+    """
+    return BuildIndex(pathlib.Path(f'{paths["data_dir"]}/builds/index.db'))
@@ -0,0 +1,88 @@
+"""
+In-process fake runtime, to drive builds without crun.
+
+A build state is the list of the instructions applied to it and a
+snapshot id the digest of that list, so running the same instructions
+in the same order always leads to the same snapshot.
+
+Given a `Snapshotter`, the state is instead written into the build
+rootfs (as `STATE_FILE`) and snapshots are taken by the snapshotter.
+"""
+import json
+import hashlib
+from typing import Dict, List, Optional, Set, Tuple
+
+from pkgbox import errors
+from .meta import Instruction
+from .snapshot import Snapshotter
+
+
+STATE_FILE = 'pkgbox-fake.json'
+
+
+class FakeRuntime:
+    """
+    Runtime recording the instructions it runs.
+
+    `runs` lists the (build id, instruction) pairs run, in order, and
+    RUN instructions whose command is in `failing` raise a
+    `PBRuntimeError`.
+    """
+    def __init__(self, failing: Set[str] = frozenset(), snapshotter: Optional[Snapshotter] = None) -> None:
+        """
+        Create a new fake runtime object instance.
+        """
+        self.failing = set(failing)
+        self.snapshotter = snapshotter
+        self.runs: List[Tuple[str, Instruction]] = []
+        self.builds: Dict[str, List[Tuple[str, str]]] = {}
+        self.snapshots: Dict[str, List[Tuple[str, str]]] = {}
+
+    def _state(self, build_id: str) -> List[Tuple[str, str]]:
+        try:
+            return self.builds[build_id]
+        except KeyError:
+            raise errors.PBRuntimeError(f'Unknown build "{build_id}"')
+
+    def _load(self, build_id: str) -> None:
+        path = self.snapshotter.path(build_id, STATE_FILE)
+        state = json.loads(path.read_text()) if path else []
+        self.builds[build_id] = [tuple(i) for i in state]
+
+    def prepare_build(self, build_id: str) -> None:
+        self.builds[build_id] = []
+        if self.snapshotter:
+            self.snapshotter.prepare(build_id)
+
+    def run_build_instruction(self, build_id: str, instruction: Instruction) -> None:
+        state = self._state(build_id)
+        self.runs.append((build_id, instruction))
+        if instruction.ctx == 'RUN' and instruction.cmd in self.failing:
+            raise errors.PBRuntimeError(f'"{instruction.cmd}" failed')
+        state.append((instruction.ctx, instruction.cmd))
+        if self.snapshotter:
+            path = self.snapshotter.writable(build_id, STATE_FILE)
+            path.write_text(json.dumps(state))
+
+    def snapshot(self, build_id: str) -> str:
+        state = list(self._state(build_id))
+        if self.snapshotter:
+            return self.snapshotter.snapshot(build_id)
+        snapshot = 'sha256:' + hashlib.sha256(json.dumps(state).encode()).hexdigest()
+        self.snapshots[snapshot] = state
+        return snapshot
+
+    def restore(self, build_id: str, snapshot: str) -> None:
+        self._state(build_id)
+        if self.snapshotter:
+            self.snapshotter.restore(build_id, snapshot)
+            self._load(build_id)
+            return
+        if snapshot not in self.snapshots:
+            raise errors.PBRuntimeError(f'Unknown snapshot "{snapshot}"')
+        self.builds[build_id] = list(self.snapshots[snapshot])
+
+    def has_snapshot(self, snapshot: str) -> bool:
+        if self.snapshotter:
+            return self.snapshotter.has_snapshot(snapshot)
+        return snapshot in self.snapshots
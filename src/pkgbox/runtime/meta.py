@@ -20,15 +20,15 @@ class Instruction:
     "ctx" = "RUN" and "cmd" = "make install".
 
     This class has an "digest" proiperty which is automatically filled,
-    with a hash digest (sha256) of both inst_type and inst_cmd.
+    with a hash digest (sha256) of both ctx and cmd.
     """
     ctx: str
     cmd: str
-    inst_digest: str = field(init=False)
+    digest: str = field(init=False)
     
     def __post_init__(self) -> None:
         """
-        Sets the value of `self.inst_digest` after the object initialization.
+        Sets the value of `self.digest` after the object initialization.
         """
         typecmd = f'{self.ctx}{self.cmd}'
         hashed = hashlib.sha256(typecmd.encode()).hexdigest()
@@ -42,7 +42,7 @@ class Instruction:
         """
         return self.digest == other.digest
 
-    def __eq__(self, other: 'Instruction') -> bool:
+    def __ne__(self, other: 'Instruction') -> bool:
         """
         Check two Intruction objects are not the same by comparing its
         digest value.
@@ -73,3 +73,23 @@ class Runtime(Protocol):
         in case of errors.
         """
         pass
+
+    def snapshot(self, build_id: str) -> str:
+        """
+        Record the current state of a build, returning the id
+        of the snapshot to `restore` it from.
+        """
+        pass
+
+    def restore(self, build_id: str, snapshot: str) -> None:
+        """
+        Reset the state of a build to a snapshot, which may have
+        been recorded by another build.
+        """
+        pass
+
+    def has_snapshot(self, snapshot: str) -> bool:
+        """
+        Check if a snapshot can still be restored.
+        """
+        pass
@@ -0,0 +1,207 @@
+"""
+Parallel scheduler of the stages of a multi-stage Containerfile.
+
+Stages and their dependencies (FROM a previous stage, COPY --from) form
+a DAG, see `pkgbox.parser.Stage`. Building a target stage only builds
+the stages it needs, the other ones being skipped. Stages whose
+dependencies are built run concurrently, up to `parallelism` at once,
+each as its own build of the `Executor`, so each one resumes from its
+own cached steps. The target stage builds under the build id itself.
+
+Before any stage runs, every image the stages start from or copy from
+is resolved up front, concurrently, to its manifest digest, which keys
+the first step of the stages starting from it. Stages starting from
+"scratch" start from no image, keyed by `SCRATCH` itself.
+
+Stage references are replaced by the snapshot the stage led to in the
+instructions given to the runtime, "FROM build" becoming "FROM <snapshot>"
+and "COPY --from=build" "COPY --from=<snapshot>", so the runtime can
+restore or copy from it and the cache keys of the steps change along
+with the stages they depend on. Likewise, images copied from are pinned
+to their digest, "COPY --from=nginx:latest" becoming
+"COPY --from=nginx:latest@<digest>".
+"""
+import re
+import errno
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from dataclasses import dataclass, field
+from typing import Callable, Dict, Iterable, List, Optional
+
+from pkgbox import containerfile, errors, trace
+from pkgbox.cache import ManifestCache
+from pkgbox.parser import Containerfile, Stage, copy_from
+from .executor import Executor, Result, from_containerfile
+from .meta import Instruction
+
+
+DEFAULT_PARALLELISM = 4
+DEFAULT_RESOLVE_WORKERS = 16
+SCRATCH = 'scratch'
+
+_COPY_FROM_RE = re.compile(r'--from=\S+')
+
+Resolver = Callable[[str], str]
+
+
+def registry_resolver(cache: Optional[ManifestCache] = None) -> Resolver:
+    """
+    Return a function resolving an image reference
+    to its manifest digest from its registry.
+    """
+    def _resolve(ref: str) -> str:
+        from pkgbox import image
+        try:
+            img = image.from_str(ref)
+        except ValueError:
+            raise errors.PBError(f'Invalid image reference "{ref}"', errno.EINVAL)
+        return str(image.info(img, cache).digest)
+
+    return _resolve
+
+
+@trace.traced('build.resolve')
+def resolve_images(refs: Iterable[str], resolve: Resolver,
+                   workers: int = DEFAULT_RESOLVE_WORKERS) -> Dict[str, str]:
+    """
+    Resolve many image references concurrently, returning
+    their digest by reference.
+    """
+    refs = list(dict.fromkeys(refs))
+    resolved = {}
+    failed = {}
+    if not refs:
+        return resolved
+
+    with ThreadPoolExecutor(max_workers=max(1, min(workers, len(refs)))) as pool:
+        for ref, future in [(ref, pool.submit(resolve, ref)) for ref in refs]:
+            try:
+                resolved[ref] = future.result()
+            except errors.PBError as e:
+                failed[ref] = e.message
+
+    if failed:
+        details = ', '.join(f'{ref} ({message})' for ref, message in failed.items())
+        raise errors.PBError(f'Can not resolve images: {details}', errno.ENOENT)
+
+    return resolved
+
+
+@dataclass
+class Build:
+    """
+    Result of a multi-stage build: the result of each built stage by
+    stage index, the stages skipped and the resolved image digests.
+    """
+    target: Stage
+    stages: Dict[int, Result] = field(default_factory=dict)
+    skipped: List[Stage] = field(default_factory=list)
+    images: Dict[str, str] = field(default_factory=dict)
+
+    @property
+    def snapshot(self) -> str:
+        """
+        Return the snapshot the target stage led to.
+        """
+        return self.stages[self.target.index].snapshot
+
+
+class Scheduler:
+    """
+    Runs the stages of a Containerfile through an executor,
+    independent stages concurrently.
+    """
+    def __init__(self, executor: Executor, resolve: Optional[Resolver] = None,
+                 parallelism: int = DEFAULT_PARALLELISM,
+                 resolve_workers: int = DEFAULT_RESOLVE_WORKERS) -> None:
+        """
+        Create a new scheduler object instance.
+
+        `resolve` maps image references to their digest,
+        `registry_resolver()` if not set.
+        """
+        self.executor = executor
+        self.resolve = resolve or registry_resolver()
+        self.parallelism = max(1, parallelism)
+        self.resolve_workers = resolve_workers
+
+    def stage_build_id(self, build_id: str, stage: Stage, target: Stage) -> str:
+        """
+        Return the build id of a stage.
+        """
+        if stage.index == target.index:
+            return build_id
+        return f'{build_id}.{stage.name or stage.index}'
+
+    def instructions(self, cf: Containerfile, stage: Stage, results: Dict[int, Result],
+                     images: Dict[str, str]) -> List[Instruction]:
+        """
+        Return the build instructions of a stage, with references to
+        the stages it depends on replaced by their snapshot and the
+        images it copies from pinned to their digest in `images`.
+        """
+        instructions = []
+        for inst in from_containerfile(cf, stage):
+            if inst.ctx == 'FROM' and stage.base is None:
+                words = inst.cmd.split(' ')
+                n = 1 if words[0].startswith('--platform=') else 0
+                words[n] = results[stage.depends[0]].snapshot
+                inst = Instruction(inst.ctx, ' '.join(words))
+            elif inst.ctx == 'COPY' and (ref := copy_from(inst.cmd)) is not None:
+                parent = cf.stage(ref)
+                source = None
+                if parent is not None and parent.index in stage.depends:
+                    source = results[parent.index].snapshot
+                elif ref in images and '@' not in ref:
+                    source = f'{ref}@{images[ref]}'
+                if source is not None:
+                    inst = Instruction(inst.ctx, _COPY_FROM_RE.sub(f'--from={source}', inst.cmd, count=1))
+            instructions.append(inst)
+        return instructions
+
+    def _run_stage(self, build_id: str, cf: Containerfile, stage: Stage, target: Stage,
+                   results: Dict[int, Result], images: Dict[str, str]) -> Result:
+        if stage.base is None:
+            base = results[stage.depends[0]].snapshot
+        elif stage.base == SCRATCH:
+            base = SCRATCH
+        else:
+            base = images[stage.base]
+        with trace.span('build.stage', stage=stage.name or str(stage.index)):
+            return self.executor.run(self.stage_build_id(build_id, stage, target),
+                                     self.instructions(cf, stage, results, images), base)
+
+    @trace.traced('build.stages')
+    def run(self, build_id: str, cf: Containerfile, target: Optional[str] = None) -> Build:
+        """
+        Build the `target` stage of a Containerfile (its last stage if
+        not set) along with the stages it needs.
+
+        If a stage fails, the stages already running are left to
+        finish, no other one is started and the error is raised.
+        """
+        stages = containerfile.needed_stages(cf, target)
+        build = Build(stages[-1])
+        build.skipped = [s for s in cf.stages if s not in stages]
+
+        refs = [ref for s in stages for ref in ([s.base] if s.base is not None else []) + list(s.images)
+                if ref != SCRATCH]
+        build.images = resolve_images(refs, self.resolve, self.resolve_workers)
+
+        todo = list(stages)
+        running: Dict[Future, Stage] = {}
+        with ThreadPoolExecutor(max_workers=self.parallelism) as pool:
+            while todo or running:
+                ready = [s for s in todo if all(d in build.stages for d in s.depends)]
+                for stage in ready[:self.parallelism - len(running)]:
+                    todo.remove(stage)
+                    # a snapshot of the results, of the stages it depends on
+                    future = pool.submit(self._run_stage, build_id, cf, stage, build.target,
+                                         dict(build.stages), build.images)
+                    running[future] = stage
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    stage = running.pop(future)
+                    build.stages[stage.index] = future.result()
+
+        return build
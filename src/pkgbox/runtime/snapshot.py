@@ -0,0 +1,401 @@
+"""
+Copy-on-write snapshots of build rootfs states.
+
+A build runs in an active rootfs. Taking a snapshot freezes that rootfs
+under a new snapshot id and gives the build a new active rootfs made
+from it, so that every build step can be kept at a fraction of the cost
+of a full copy. Depending on the `method`:
+
+- "reflink": files are cloned with the FICLONE ioctl, their data
+  blocks being shared until written (btrfs, xfs). Only the directory
+  tree and inodes are created;
+- "hardlink": files are hard links to the snapshot ones. A shared file
+  must be broken out with `Snapshotter.writable` before being modified,
+  content or metadata, or the snapshot would change too. Hard links
+  within the rootfs itself are broken out as well on write;
+- "overlay": the active rootfs is an overlayfs upper dir on top of the
+  chain of snapshot upper dirs, which the runtime mounts with
+  `Snapshotter.mount_options`. A snapshot only moves the upper dir, so
+  it costs the files the step wrote, but the chain grows one layer per
+  step;
+- "copy": a plain copy, as a last resort.
+
+The default is "reflink" where the filesystem supports it, "hardlink"
+otherwise. Files that can not be cloned are copied.
+
+The cost of each snapshot (time, entries created, file bytes copied or
+written) is kept along with it, see `Snapshotter.cost`.
+
+Snapshots live in `{root}/snapshots/{id}` and active builds in
+`{root}/active/{build id}`, under `{data_dir}/builds/rootfs` by default.
+"""
+import os
+import json
+import stat
+import time
+import errno
+import fcntl
+import shutil
+import secrets
+import pathlib
+import tempfile
+from dataclasses import asdict, dataclass
+from typing import Dict, List, Optional, Tuple
+
+from pkgbox import errors, trace
+from pkgbox.extract import _clean
+
+
+REFLINK = 'reflink'
+HARDLINK = 'hardlink'
+OVERLAY = 'overlay'
+COPY = 'copy'
+METHODS = (REFLINK, HARDLINK, OVERLAY, COPY)
+
+# _IOW(0x94, 9, int)
+_FICLONE = 0x40049409
+
+
+@dataclass
+class Cost:
+    """
+    Cost of a snapshot: the method used, the time it took (seconds),
+    the entries it created and the regular file bytes it copied, or
+    for overlay snapshots the entries and bytes of the upper dir.
+    """
+    method: str
+    elapsed: float = 0.0
+    entries: int = 0
+    bytes: int = 0
+
+
+def _reflink(src: str, dst: str) -> bool:
+    """
+    Clone the `src` file into `dst`, returning `False` if the
+    filesystem does not support it.
+    """
+    with open(src, 'rb') as s, open(dst, 'wb') as d:
+        try:
+            fcntl.ioctl(d.fileno(), _FICLONE, s.fileno())
+        except OSError as e:
+            if e.errno in (errno.EOPNOTSUPP, errno.ENOTTY, errno.EXDEV, errno.EINVAL, errno.ENOSYS):
+                return False
+            raise
+    return True
+
+
+def reflink_supported(path: pathlib.Path) -> bool:
+    """
+    Check if files can be cloned with reflinks within the
+    directory `path`.
+    """
+    with tempfile.TemporaryDirectory(dir=path, prefix='.reflink-') as tmp:
+        src = os.path.join(tmp, 'src')
+        with open(src, 'wb') as f:
+            f.write(b'pkgbox')
+        return _reflink(src, os.path.join(tmp, 'dst'))
+
+
+def _metadata(path: str, st: os.stat_result, owner: bool) -> None:
+    if owner:
+        os.lchown(path, st.st_uid, st.st_gid)
+    if not stat.S_ISLNK(st.st_mode):
+        os.chmod(path, stat.S_IMODE(st.st_mode))
+    os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns), follow_symlinks=False)
+
+
+def _clone(src: str, dst: str, method: str, owner: bool, cost: Cost,
+           links: Dict[Tuple[int, int], str]) -> None:
+    """
+    Recreate the `src` directory tree into `dst` with `method`.
+    Directories get their metadata last, so read-only ones can
+    still be filled.
+
+    Hard links within the tree are kept: `links` maps the inodes of
+    linked files already cloned to their clone.
+    """
+    os.mkdir(dst, 0o700)
+    with os.scandir(src) as entries:
+        for entry in entries:
+            s, d = entry.path, os.path.join(dst, entry.name)
+            st = entry.stat(follow_symlinks=False)
+            cost.entries += 1
+            if stat.S_ISDIR(st.st_mode):
+                _clone(s, d, method, owner, cost, links)
+                continue
+            if stat.S_ISLNK(st.st_mode):
+                os.symlink(os.readlink(s), d)
+            elif method == HARDLINK or not stat.S_ISREG(st.st_mode):
+                # devices and fifos have no data to copy
+                os.link(s, d, follow_symlinks=False)
+                continue
+            elif st.st_nlink > 1 and (st.st_dev, st.st_ino) in links:
+                os.link(links[(st.st_dev, st.st_ino)], d)
+                continue
+            else:
+                if method != REFLINK or not _reflink(s, d):
+                    shutil.copyfile(s, d, follow_symlinks=False)
+                    cost.bytes += st.st_size
+                if st.st_nlink > 1:
+                    links[(st.st_dev, st.st_ino)] = d
+            _metadata(d, st, owner)
+    _metadata(dst, os.lstat(src), owner)
+
+
+def clone_tree(src: pathlib.Path, dst: pathlib.Path, method: str) -> Cost:
+    """
+    Recreate the `src` directory tree into `dst`, which should not
+    exist, with reflinks, hard links or copies, and return its cost.
+    """
+    if method not in (REFLINK, HARDLINK, COPY):
+        raise errors.PBError(f'Can not clone a tree with "{method}"', errno.EINVAL)
+    cost = Cost(method)
+    started = time.perf_counter()
+    _clone(str(src), str(dst), method, os.geteuid() == 0, cost, {})
+    cost.elapsed = time.perf_counter() - started
+    return cost
+
+
+def _usage(path: pathlib.Path) -> Cost:
+    """
+    Return the entries and regular file bytes of a tree.
+    """
+    cost = Cost(OVERLAY)
+    for root, dirs, files in os.walk(path):
+        for name in dirs + files:
+            st = os.lstat(os.path.join(root, name))
+            cost.entries += 1
+            if stat.S_ISREG(st.st_mode):
+                cost.bytes += st.st_size
+    return cost
+
+
+def _remove(path: pathlib.Path) -> None:
+    def onerror(func, path, exc_info) -> None:
+        # read-only directories of the rootfs
+        os.chmod(os.path.dirname(path), 0o700)
+        func(path)
+
+    if os.path.lexists(path):
+        shutil.rmtree(path, onerror=onerror)
+
+
+class Snapshotter:
+    """
+    Copy-on-write snapshot store rooted at a given directory.
+
+    It provides the snapshot part of the `Runtime` protocol, so runtimes
+    can hand `snapshot`, `restore` and `has_snapshot` over to it.
+    """
+    def __init__(self, root: pathlib.Path, method: Optional[str] = None) -> None:
+        """
+        Create a new snapshotter object instance, picking the method
+        if not set.
+        """
+        self.root = pathlib.Path(root)
+        for name in ('snapshots', 'active', 'empty'):
+            os.makedirs(self.root / name, exist_ok=True)
+        if method is None:
+            method = REFLINK if reflink_supported(self.root) else HARDLINK
+        if method not in METHODS:
+            raise errors.PBError(f'Unknown snapshot method "{method}"', errno.EINVAL)
+        self.method = method
+        self.owner = os.geteuid() == 0
+        self._parents: Dict[str, Optional[str]] = {}
+
+    def _snapshot_dir(self, snapshot: str) -> pathlib.Path:
+        return self.root / 'snapshots' / snapshot
+
+    def _active_dir(self, build_id: str) -> pathlib.Path:
+        return self.root / 'active' / build_id
+
+    def _meta(self, snapshot: str) -> Dict:
+        try:
+            return json.loads((self._snapshot_dir(snapshot) / 'meta.json').read_text())
+        except FileNotFoundError:
+            raise errors.PBError(f'Unknown snapshot "{snapshot}"', errno.ENOENT)
+
+    def _upper(self, build_id: str) -> pathlib.Path:
+        return self._active_dir(build_id) / 'upper'
+
+    def rootfs(self, build_id: str) -> pathlib.Path:
+        """
+        Return the rootfs directory of an active build. For overlay
+        snapshots, it is the mount point of the overlay.
+        """
+        name = 'merged' if self.method == OVERLAY else 'fs'
+        return self._active_dir(build_id) / name
+
+    def prepare(self, build_id: str, snapshot: Optional[str] = None) -> None:
+        """
+        Create the active rootfs of a build, empty or from `snapshot`,
+        dropping any previous one.
+        """
+        if snapshot is not None:
+            meta = self._meta(snapshot)
+            if meta['method'] != self.method and OVERLAY in (meta['method'], self.method):
+                raise errors.PBError(f'Snapshot "{snapshot}" was made with "{meta["method"]}"', errno.EINVAL)
+
+        active = self._active_dir(build_id)
+        _remove(active)
+        os.makedirs(active)
+        self._parents[build_id] = snapshot
+        (active / 'parent').write_text(snapshot or '')
+
+        if self.method == OVERLAY:
+            for name in ('upper', 'work', 'merged'):
+                os.mkdir(active / name)
+        elif snapshot is None:
+            os.mkdir(active / 'fs')
+        else:
+            with trace.span('snapshot.restore', method=self.method):
+                clone_tree(self._snapshot_dir(snapshot) / 'fs', active / 'fs', self.method)
+
+    def _parent(self, build_id: str) -> Optional[str]:
+        if build_id not in self._parents:
+            try:
+                self._parents[build_id] = (self._active_dir(build_id) / 'parent').read_text() or None
+            except FileNotFoundError:
+                raise errors.PBError(f'Unknown build "{build_id}"', errno.ENOENT)
+        return self._parents[build_id]
+
+    def lowers(self, build_id: str) -> List[pathlib.Path]:
+        """
+        Return the overlay lower dirs of a build, top first.
+        """
+        lowers = []
+        snapshot = self._parent(build_id)
+        while snapshot:
+            lowers.append(self._snapshot_dir(snapshot) / 'fs')
+            snapshot = self._meta(snapshot)['parent']
+        return lowers
+
+    def mount_options(self, build_id: str) -> str:
+        """
+        Return the overlayfs mount options of the rootfs of a build.
+        """
+        if self.method != OVERLAY:
+            raise errors.PBError(f'"{self.method}" snapshots are not mounted', errno.EINVAL)
+        lowers = self.lowers(build_id) or [self.root / 'empty']
+        active = self._active_dir(build_id)
+        return f'lowerdir={":".join(map(str, lowers))},upperdir={active / "upper"},workdir={active / "work"}'
+
+    def snapshot(self, build_id: str) -> str:
+        """
+        Freeze the active rootfs of a build into a new snapshot, and
+        continue the build on top of it.
+        """
+        snapshot = secrets.token_hex(16)
+        parent = self._parent(build_id)
+        active = self._active_dir(build_id)
+        dest = self._snapshot_dir(snapshot)
+        os.mkdir(dest)
+
+        with trace.span('snapshot.create', method=self.method) as span:
+            started = time.perf_counter()
+            if self.method == OVERLAY:
+                os.rename(active / 'upper', dest / 'fs')
+                cost = _usage(dest / 'fs')
+                os.mkdir(active / 'upper')
+                _remove(active / 'work')
+                os.mkdir(active / 'work')
+            else:
+                os.rename(active / 'fs', dest / 'fs')
+                cost = clone_tree(dest / 'fs', active / 'fs', self.method)
+            cost.elapsed = time.perf_counter() - started
+            span.set(bytes=cost.bytes, entries=cost.entries)
+
+        meta = {'method': self.method, 'parent': parent, 'created': time.time(), 'cost': asdict(cost)}
+        (dest / 'meta.json').write_text(json.dumps(meta))
+        self._parents[build_id] = snapshot
+        (active / 'parent').write_text(snapshot)
+
+        return snapshot
+
+    def restore(self, build_id: str, snapshot: str) -> None:
+        """
+        Reset the active rootfs of a build to a snapshot.
+        """
+        self.prepare(build_id, snapshot)
+
+    def has_snapshot(self, snapshot: str) -> bool:
+        """
+        Check if a snapshot exists.
+        """
+        return (self._snapshot_dir(snapshot) / 'meta.json').exists()
+
+    def cost(self, snapshot: str) -> Cost:
+        """
+        Return what taking a snapshot cost.
+        """
+        return Cost(**self._meta(snapshot)['cost'])
+
+    def path(self, build_id: str, name: str) -> Optional[pathlib.Path]:
+        """
+        Return the path holding the current content of the rootfs
+        file `name` of a build, `None` if there is none. Symlinks of
+        parent directories are not followed.
+        """
+        name = _clean(name)
+        if self.method != OVERLAY:
+            path = self.rootfs(build_id) / name
+            return path if os.path.lexists(path) else None
+
+        for layer in [self._upper(build_id)] + self.lowers(build_id):
+            path = layer / name
+            try:
+                st = os.lstat(path)
+            except (FileNotFoundError, NotADirectoryError):
+                continue
+            # a whiteout hides the file of lower layers
+            if stat.S_ISCHR(st.st_mode) and st.st_rdev == 0:
+                return None
+            return path
+        return None
+
+    def writable(self, build_id: str, name: str) -> pathlib.Path:
+        """
+        Return the path to write the rootfs file `name` of a build to,
+        breaking it out of the snapshots it is shared with: hard links
+        are replaced by a copy and overlay files are copied up. Missing
+        parent directories are created.
+        """
+        name = _clean(name)
+        if self.method != OVERLAY:
+            path = self.rootfs(build_id) / name
+            os.makedirs(path.parent, exist_ok=True)
+            if self.method == HARDLINK:
+                try:
+                    st = os.lstat(path)
+                except FileNotFoundError:
+                    return path
+                if stat.S_ISREG(st.st_mode) and st.st_nlink > 1:
+                    tmp = f'{path}.pkgbox-cow'
+                    shutil.copy2(path, tmp, follow_symlinks=False)
+                    if self.owner:
+                        os.lchown(tmp, st.st_uid, st.st_gid)
+                    os.replace(tmp, path)
+            return path
+
+        upper = self._upper(build_id) / name
+        if os.path.lexists(upper):
+            return upper
+        current = self.path(build_id, name)
+        os.makedirs(upper.parent, exist_ok=True)
+        if current is not None:
+            shutil.copy2(current, upper, follow_symlinks=False)
+        return upper
+
+    def remove(self, build_id: str) -> None:
+        """
+        Drop the active rootfs of a build, keeping its snapshots.
+        """
+        self._parents.pop(build_id, None)
+        _remove(self._active_dir(build_id))
+
+
+def from_paths(paths: Dict[str, str], method: Optional[str] = None) -> Snapshotter:
+    """
+    Return the snapshotter located in the pkgbox data dir.
+    """
+    return Snapshotter(pathlib.Path(f'{paths["data_dir"]}/builds/rootfs'), method)
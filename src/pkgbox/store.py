@@ -0,0 +1,567 @@
+"""
+Content addressable blob store used to keep OCI layers.
+
+Blobs are stored as `{root}/blobs/{alg}/{digest}` and are only
+visible there once their content has been verified. Incomplete
+downloads live in `{root}/partial` until they are resumed. Every committed
+blob is recorded in an append-only `{root}/index` file so existence
+checks are dict lookups instead of filesystem scans or re-hashing.
+
+Processes sharing a store, on one or many hosts, coordinate through
+per blob lock files in `{root}/locks` so a blob is only written by one
+of them at a time.
+"""
+import os
+import time
+import hashlib
+import pathlib
+import threading
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from . import errors
+from .lock import FileLock
+from .oci.v1 import Descriptor
+
+
+CHUNK_SIZE = 1024 * 1024
+CHECKPOINT_SIZE = 8 * 1024 * 1024
+ACCESS_RESOLUTION = 60
+SIDECARS = ('idx', 'toc.idx')
+NEW_PREFIX = 'new-'
+# algorithm of a partial blob, by digest length
+_ALGS = {64: 'sha256', 128: 'sha512'}
+
+class BlobWriter:
+    """
+    Write a blob into a partial file, hashing its content as
+    it is written.
+
+    The blob is only moved into the store by `commit` and only if
+    its digest matches the expected descriptor.
+
+    Partial files are kept when a writer is closed without being
+    committed, along with an offset checkpoint of the bytes known to
+    be on disk, so a later writer of the same blob can resume from it.
+    """
+    def __init__(self, store: 'BlobStore', desc: Descriptor) -> None:
+        """
+        Create a new writer for `desc` in `store`, resuming from
+        a previous partial file if any.
+        """
+        self.store = store
+        self.desc = desc
+        self.size = 0
+        self.partial_path = store.partial_dir / desc.digest
+        self.offset_path = store.partial_dir / f'{desc.digest}.offset'
+        self._hash = hashlib.new(desc.alg)
+        self._checkpoint = 0
+
+        self._file = open(self.partial_path, 'a+b')
+        self._resume()
+
+    def _resume(self) -> None:
+        """
+        Restore the writer state from the last checkpoint.
+
+        Bytes past the checkpoint may not have reached the disk and are
+        dropped. The hash state can not be persisted, so the kept prefix
+        is hashed again from the local file.
+        """
+        try:
+            offset = int(self.offset_path.read_text())
+        except (FileNotFoundError, ValueError):
+            offset = 0
+
+        self._file.truncate(offset)
+        self._file.seek(0)
+        while (chunk := self._file.read(CHUNK_SIZE)):
+            self._hash.update(chunk)
+            self.size += len(chunk)
+
+        self._checkpoint = self.size
+
+    def write(self, data: bytes) -> None:
+        """
+        Write and hash a chunk of data.
+        """
+        self._hash.update(data)
+        self._file.write(data)
+        self.size += len(data)
+
+        if self.size - self._checkpoint >= CHECKPOINT_SIZE:
+            self.checkpoint()
+
+    def checkpoint(self) -> None:
+        """
+        Flush the written content to disk and record its offset.
+        """
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+        tmp = f'{self.offset_path}.tmp'
+        with open(tmp, 'w') as f:
+            f.write(str(self.size))
+        os.replace(tmp, self.offset_path)
+
+        self._checkpoint = self.size
+
+    def reset(self) -> None:
+        """
+        Drop all written content and start the blob from scratch.
+        """
+        self._file.truncate(0)
+        self._hash = hashlib.new(self.desc.alg)
+        self.size = 0
+        self.checkpoint()
+
+    def commit(self) -> pathlib.Path:
+        """
+        Verify the written content and atomically move it into the store.
+
+        Raises `pkgbox.errors.PBDigestError` if the content does not match
+        the expected digest, in which case the partial file is removed.
+        """
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._file.close()
+
+        digest = Descriptor(self.desc.alg, self._hash.hexdigest())
+        if digest != self.desc:
+            self.abort()
+            raise errors.PBDigestError(str(self.desc), str(digest))
+
+        path = self.store.path(self.desc)
+        os.makedirs(path.parent, exist_ok=True)
+        os.replace(self.partial_path, path)
+        self._remove(self.offset_path)
+        self.store._record(self.desc, self.size)
+
+        return path
+
+    def close(self) -> None:
+        """
+        Close the writer, keeping the partial content for a later resume.
+        """
+        if not self._file.closed:
+            self.checkpoint()
+            self._file.close()
+
+    def abort(self) -> None:
+        """
+        Discard the written content.
+        """
+        self._file.close()
+        self._remove(self.partial_path)
+        self._remove(self.offset_path)
+
+    def _remove(self, path: pathlib.Path) -> None:
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+
+    def __enter__(self) -> 'BlobWriter':
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        self.close()
+
+
+class NewBlobWriter(BlobWriter):
+    """
+    Write a blob whose digest is only known once it is written, such
+    as a layer being built, hashing its content as it is written.
+
+    It can not be resumed: closing it without committing it discards
+    the partial file. The partial file is guarded by its own lock while
+    it is written, see `BlobStore.partial_lock`.
+    """
+    def __init__(self, store: 'BlobStore', alg: str = 'sha256') -> None:
+        """
+        Create a new writer of a `alg` digested blob in `store`.
+        """
+        self.store = store
+        self.desc = None
+        self.alg = alg
+        self.size = 0
+        name = f'{NEW_PREFIX}{os.getpid()}-{os.urandom(8).hex()}'
+        self.partial_path = store.partial_dir / name
+        self._hash = hashlib.new(alg)
+        self._partial_lock: Optional[FileLock] = store.partial_lock(name)
+        self._partial_lock.acquire()
+        self._file = open(self.partial_path, 'wb')
+
+    def write(self, data: bytes) -> None:
+        """
+        Write and hash a chunk of data.
+        """
+        self._hash.update(data)
+        self._file.write(data)
+        self.size += len(data)
+
+    def commit(self) -> pathlib.Path:
+        """
+        Atomically move the written content into the store, under its
+        digest, unless a blob with the same digest is already there.
+        The digest is then available as `desc`.
+        """
+        try:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._file.close()
+
+            self.desc = Descriptor(self.alg, self._hash.hexdigest())
+            path = self.store.path(self.desc)
+            with self.store.lock(self.desc):
+                if self.store.exists(self.desc):
+                    self._remove(self.partial_path)
+                    self.store.touch(self.desc)
+                    return path
+                os.makedirs(path.parent, exist_ok=True)
+                os.replace(self.partial_path, path)
+                self.store._record(self.desc, self.size)
+        finally:
+            self._release()
+
+        return path
+
+    def close(self) -> None:
+        """
+        Close the writer, discarding its content unless committed.
+        """
+        if not self._file.closed:
+            self.abort()
+
+    def abort(self) -> None:
+        """
+        Discard the written content.
+        """
+        self._file.close()
+        self._remove(self.partial_path)
+        self._release()
+
+    def _release(self) -> None:
+        if self._partial_lock:
+            self._partial_lock.release()
+            self._partial_lock = None
+
+
+class _Log:
+    """
+    Append-only file of whitespace separated records, read incrementally.
+
+    A log can be compacted by atomically replacing its file. Compacted
+    files start with a unique "#" header line, which readers compare to
+    the one they know to detect the replacement and read the new file
+    from the start (inode numbers can not be used since they are reused
+    right away).
+    """
+    def __init__(self, path: pathlib.Path) -> None:
+        self.path = path
+        self.offset = 0
+        self.header: Optional[bytes] = None
+        self._stat: Optional[Tuple[int, int, int]] = None
+
+    def read(self) -> Tuple[bool, List[List[str]]]:
+        """
+        Return the records appended since the last read, along with
+        whether the file was replaced, in which case every record
+        is returned.
+        """
+        try:
+            st = os.stat(self.path)
+            if (st.st_ino, st.st_size, st.st_mtime_ns) == self._stat:
+                return False, []
+            f = open(self.path, 'rb')
+        except FileNotFoundError:
+            return False, []
+
+        with f:
+            first = f.readline()
+            header = first if first.startswith(b'#') else b''
+            replaced = header != self.header
+            if replaced:
+                self.header = header
+                self.offset = 0
+            f.seek(self.offset)
+            records = []
+            for line in f:
+                if not line.endswith(b'\n'):
+                    break
+                self.offset += len(line)
+                if not line.startswith(b'#'):
+                    records.append(line.decode().split())
+            st = os.fstat(f.fileno())
+            self._stat = (st.st_ino, st.st_size, st.st_mtime_ns)
+
+        return replaced, records
+
+    def append(self, record: str) -> None:
+        """
+        Append a single record line.
+        """
+        fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, f'{record}\n'.encode())
+        finally:
+            os.close(fd)
+
+    def rewrite(self, records: Iterable[str]) -> None:
+        """
+        Atomically replace the log content.
+        """
+        tmp = f'{self.path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(tmp, 'w') as f:
+            f.write(f'# {os.urandom(16).hex()}\n')
+            f.writelines(f'{r}\n' for r in records)
+        os.replace(tmp, self.path)
+
+
+class BlobStore:
+    """
+    Blob store rooted at a given directory.
+
+    Besides the index, the last access time of each blob is kept in an
+    append-only `{root}/access` log, so the least recently used blobs
+    can be found without scanning the blobs directory.
+    """
+    def __init__(self, root: pathlib.Path) -> None:
+        """
+        Create a new store object instance, creating its
+        directories and loading its index.
+        """
+        self.root = pathlib.Path(root)
+        self.partial_dir = self.root / 'partial'
+        self.lock_dir = self.root / 'locks'
+        self.index_path = self.root / 'index'
+        self.access_path = self.root / 'access'
+        self._index: Dict[str, int] = {}
+        self._index_log = _Log(self.index_path)
+        self._access: Dict[str, float] = {}
+        self._access_log = _Log(self.access_path)
+        self._garbage = 0
+        self._lock = threading.Lock()
+
+        os.makedirs(self.partial_dir, exist_ok=True)
+        self._load()
+
+    def path(self, desc: Descriptor) -> pathlib.Path:
+        """
+        Return the path of a blob in the store.
+        """
+        return self.root / 'blobs' / desc.alg / desc.digest
+
+    def sidecar(self, desc: Descriptor, ext: str) -> pathlib.Path:
+        """
+        Return the path of a file derived from a blob, such as its
+        index, kept next to it and removed along with it.
+        """
+        return self.root / 'blobs' / desc.alg / f'{desc.digest}.{ext}'
+
+    def exists(self, desc: Descriptor) -> bool:
+        """
+        Check if a verified blob is in the store.
+
+        Records appended to the index since the last check are read
+        first, so blobs committed or removed by other processes sharing
+        the store are seen. An unchanged index costs a single `stat`.
+        """
+        with self._lock:
+            self._load()
+            return str(desc) in self._index
+
+    def size(self, desc: Descriptor) -> Optional[int]:
+        """
+        Return the size of a stored blob or `None` if not found.
+        """
+        if not self.exists(desc):
+            return None
+        return self._index[str(desc)]
+
+    def usage(self) -> int:
+        """
+        Return the total size of the stored blobs.
+        """
+        with self._lock:
+            self._load()
+            return sum(self._index.values())
+
+    def blobs(self) -> Dict[str, int]:
+        """
+        Return the size of every stored blob by its "<alg>:<digest>" name.
+        """
+        with self._lock:
+            self._load()
+            return dict(self._index)
+
+    def writer(self, desc: Descriptor) -> BlobWriter:
+        """
+        Return a new `BlobWriter` to add `desc` into the store.
+        """
+        return BlobWriter(self, desc)
+
+    def new_writer(self, alg: str = 'sha256') -> NewBlobWriter:
+        """
+        Return a new `NewBlobWriter` to add a blob of yet unknown
+        digest into the store.
+        """
+        return NewBlobWriter(self, alg)
+
+    def lock(self, desc: Descriptor, **kwargs) -> FileLock:
+        """
+        Return the `pkgbox.lock.FileLock` guarding writes of `desc`,
+        shared by every process using the store.
+        """
+        return FileLock(self.lock_dir / f'{desc.alg}-{desc.digest}.lock', **kwargs)
+
+    def partial_lock(self, name: str, **kwargs) -> FileLock:
+        """
+        Return the lock guarding the partial files of an incomplete
+        blob, as named by `partials`: the blob lock of a download, or
+        the lock of a `NewBlobWriter`.
+        """
+        if name.startswith(NEW_PREFIX):
+            return FileLock(self.lock_dir / f'{name}.lock', **kwargs)
+        return self.lock(Descriptor(_ALGS.get(len(name), 'sha256'), name), **kwargs)
+
+    def partials(self) -> Dict[str, Tuple[int, float]]:
+        """
+        Return the total size and last modification time (epoch)
+        of the partial files of every incomplete blob, by name.
+        """
+        partials: Dict[str, Tuple[int, float]] = {}
+        with os.scandir(self.partial_dir) as entries:
+            for entry in entries:
+                if entry.name.startswith('.'):
+                    continue
+                try:
+                    st = entry.stat(follow_symlinks=False)
+                except FileNotFoundError:
+                    continue
+                name = entry.name.partition('.')[0]
+                size, mtime = partials.get(name, (0, 0.0))
+                partials[name] = (size + st.st_size, max(mtime, st.st_mtime))
+        return partials
+
+    def remove_partial(self, name: str) -> None:
+        """
+        Remove the partial files of an incomplete blob.
+
+        Callers should hold its `partial_lock`.
+        """
+        for path in (name, f'{name}.offset', f'{name}.offset.tmp'):
+            try:
+                os.unlink(self.partial_dir / path)
+            except FileNotFoundError:
+                pass
+
+    def touch(self, desc: Descriptor) -> None:
+        """
+        Record an access to a blob.
+
+        Accesses are recorded with a resolution of `ACCESS_RESOLUTION`
+        seconds, so frequent uses of a blob do not grow the log.
+        """
+        now = time.time()
+        with self._lock:
+            self._load_access()
+            if now - self._access.get(str(desc), 0) < ACCESS_RESOLUTION:
+                return
+            self._access_log.append(f'{desc} {now:.0f}')
+            self._access[str(desc)] = now
+
+    def last_access(self, desc: Descriptor) -> float:
+        """
+        Return the last recorded access time (epoch) of a blob,
+        `0` if unknown.
+        """
+        with self._lock:
+            self._load_access()
+            return self._access.get(str(desc), 0)
+
+    def remove(self, desc: Descriptor) -> None:
+        """
+        Remove a blob from the store.
+
+        Callers should hold the blob lock so it is not removed while
+        being written.
+        """
+        for path in [self.path(desc)] + [self.sidecar(desc, ext) for ext in SIDECARS]:
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+
+        with self._lock:
+            with self._index_lock():
+                self._index_log.append(f'{desc} -')
+            self._index.pop(str(desc), None)
+            self._access.pop(str(desc), None)
+
+    def compact(self, force: bool = True) -> None:
+        """
+        Rewrite the index and access logs without the records of
+        removed blobs or superseded accesses.
+
+        Unless `force` is set, logs are only rewritten once they hold
+        more such records than live ones.
+        """
+        with self._lock, self._index_lock():
+            self._load()
+            self._load_access()
+            if not force and self._garbage <= len(self._index):
+                return
+            self._index_log.rewrite(f'{k} {v}' for k, v in self._index.items())
+            self._access_log.rewrite(f'{k} {self._access[k]:.0f}' for k in self._index if k in self._access)
+
+    def _index_lock(self) -> FileLock:
+        return FileLock(self.lock_dir / 'index.lock')
+
+    def _load(self) -> None:
+        """
+        Read index records appended since the last load.
+
+        Each record is a "<alg>:<digest> <size>" line, or a
+        "<alg>:<digest> -" line once the blob is removed.
+        """
+        replaced, records = self._index_log.read()
+        if replaced:
+            self._index.clear()
+            self._garbage = 0
+        for digest, size in records:
+            if size == '-':
+                self._index.pop(digest, None)
+                self._garbage += 2
+            else:
+                self._index[digest] = int(size)
+
+    def _load_access(self) -> None:
+        """
+        Read access records appended since the last load.
+
+        Each record is a "<alg>:<digest> <epoch>" line.
+        """
+        replaced, records = self._access_log.read()
+        if replaced:
+            self._access.clear()
+        for digest, epoch in records:
+            if digest in self._access:
+                self._garbage += 1
+            self._access[digest] = max(float(epoch), self._access.get(digest, 0))
+
+    def _record(self, desc: Descriptor, size: int) -> None:
+        """
+        Append a committed blob to the index.
+        """
+        with self._lock:
+            with self._index_lock():
+                self._index_log.append(f'{desc} {size}')
+            self._index[str(desc)] = size
+        self.touch(desc)
+
+
+def from_paths(paths: Dict[str, str]) -> BlobStore:
+    """
+    Return the layer store located in the pkgbox data dir.
+    """
+    return BlobStore(pathlib.Path(f'{paths["data_dir"]}/oci-layers'))
@@ -0,0 +1,269 @@
+"""
+Tracing and timing instrumentation.
+
+Code is instrumented with `span`, or the `traced` decorator, timing a
+block, and `event`, marking an instant such as a cache hit. Until
+tracing is turned on with `enable`, they only look up a global and
+return a shared no-op span, so instrumentation stays in place at no
+measurable cost. Span arguments should be cheap to compute, or set with
+`Span.set` only when `enabled()`.
+
+Names are dotted, the part before the first dot being the category,
+such as "image.download". A span `bytes` argument is summed up to report
+throughputs.
+
+Events from every thread are collected by the `Tracer`, which writes
+them as Chrome trace event JSON (to open with chrome://tracing or
+Perfetto) or summarizes them per name. Worker processes trace on their
+own and send their events back to be `merge`d.
+"""
+import os
+import json
+import time
+import pathlib
+import functools
+import threading
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, List, Optional, TypeVar
+
+
+F = TypeVar('F', bound=Callable[..., Any])
+
+
+class _NoopSpan:
+    def set(self, **args: Any) -> None:
+        pass
+
+    def __enter__(self) -> '_NoopSpan':
+        return self
+
+    def __exit__(self, *args) -> None:
+        pass
+
+
+_NOOP = _NoopSpan()
+
+
+class Span:
+    """
+    A timed block, recorded by its tracer once it exits.
+    """
+    def __init__(self, tracer: 'Tracer', name: str, args: Dict[str, Any]) -> None:
+        self.tracer = tracer
+        self.name = name
+        self.args = args
+        self.start = 0
+
+    def set(self, **args: Any) -> None:
+        """
+        Add arguments to the span, such as the amount of bytes it
+        transferred once known.
+        """
+        self.args.update(args)
+
+    def __enter__(self) -> 'Span':
+        self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        end = time.perf_counter_ns()
+        if exc_type is not None:
+            self.args['error'] = exc_type.__name__
+        self.tracer.add(self.name, 'X', self.start, end - self.start, self.args)
+
+
+@dataclass
+class Stat:
+    """
+    Summary of the events of a given name: their count and, for spans,
+    their total, mean and max duration (in seconds) and the total of
+    their `bytes` argument.
+    """
+    name: str
+    count: int = 0
+    total: float = 0.0
+    max: float = 0.0
+    bytes: int = 0
+    spans: bool = False
+
+    @property
+    def mean(self) -> float:
+        return self.total / self.count if self.count else 0.0
+
+    @property
+    def throughput(self) -> float:
+        """
+        Return the bytes per second of the spans, while they run.
+        """
+        return self.bytes / self.total if self.total else 0.0
+
+
+class Tracer:
+    """
+    Collector of the trace events of a process.
+    """
+    def __init__(self) -> None:
+        """
+        Create a new tracer object instance.
+        """
+        self.events: List[Dict[str, Any]] = []
+        self.threads: Dict[tuple, str] = {}
+        self._lock = threading.Lock()
+
+    def add(self, name: str, phase: str, start: int, duration: int, args: Dict[str, Any]) -> None:
+        """
+        Record an event, timed in nanoseconds of `time.perf_counter_ns`.
+        """
+        thread = threading.current_thread()
+        event = {
+            'name': name,
+            'cat': name.partition('.')[0],
+            'ph': phase,
+            'ts': start / 1000,
+            'pid': os.getpid(),
+            'tid': thread.ident,
+            'args': args,
+        }
+        if phase == 'X':
+            event['dur'] = duration / 1000
+        else:
+            event['s'] = 't'
+        with self._lock:
+            self.events.append(event)
+            self.threads.setdefault((event['pid'], event['tid']), thread.name)
+
+    def merge(self, events: List[Dict[str, Any]]) -> None:
+        """
+        Add the events recorded by another tracer, such as the one of a
+        worker process.
+        """
+        with self._lock:
+            self.events.extend(events)
+
+    def chrome(self) -> Dict[str, Any]:
+        """
+        Return the events in the Chrome trace event format.
+        """
+        with self._lock:
+            events = list(self.events)
+            threads = dict(self.threads)
+        meta = [{'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': tid, 'args': {'name': name}}
+                for (pid, tid), name in threads.items()]
+        return {'traceEvents': meta + sorted(events, key=lambda e: e['ts']), 'displayTimeUnit': 'ms'}
+
+    def write(self, path: pathlib.Path) -> None:
+        """
+        Write the events to `path` as Chrome trace event JSON.
+        """
+        with open(path, 'w') as f:
+            json.dump(self.chrome(), f)
+
+    def summary(self) -> List[Stat]:
+        """
+        Return the statistics of every event name, by decreasing total
+        duration.
+        """
+        stats: Dict[str, Stat] = {}
+        with self._lock:
+            events = list(self.events)
+        for e in events:
+            stat = stats.setdefault(e['name'], Stat(e['name']))
+            stat.count += 1
+            if e['ph'] != 'X':
+                continue
+            duration = e['dur'] / 1e6
+            stat.spans = True
+            stat.total += duration
+            stat.max = max(stat.max, duration)
+            stat.bytes += e['args'].get('bytes', 0)
+        return sorted(stats.values(), key=lambda s: (-s.total, s.name))
+
+
+_tracer: Optional[Tracer] = None
+
+
+def enable() -> Tracer:
+    """
+    Start tracing into a new tracer, returned.
+    """
+    global _tracer
+    _tracer = Tracer()
+    return _tracer
+
+
+def disable() -> Optional[Tracer]:
+    """
+    Stop tracing, returning the tracer in use, if any.
+    """
+    global _tracer
+    tracer, _tracer = _tracer, None
+    return tracer
+
+
+def enabled() -> bool:
+    """
+    Check if tracing is on.
+    """
+    return _tracer is not None
+
+
+def merge(events: List[Dict[str, Any]]) -> None:
+    """
+    Add the events recorded by another process to the tracer in use,
+    if any.
+    """
+    tracer = _tracer
+    if tracer is not None:
+        tracer.merge(events)
+
+
+def span(name: str, **args: Any) -> Any:
+    """
+    Return a context manager timing a block as a `Span`, or doing
+    nothing if tracing is off.
+    """
+    tracer = _tracer
+    if tracer is None:
+        return _NOOP
+    return Span(tracer, name, args)
+
+
+def event(name: str, **args: Any) -> None:
+    """
+    Record an instant event, such as a cache hit.
+    """
+    tracer = _tracer
+    if tracer is not None:
+        tracer.add(name, 'i', time.perf_counter_ns(), 0, args)
+
+
+def traced(name: str) -> Callable[[F], F]:
+    """
+    Decorate a function to run it in a span.
+    """
+    def decorator(func: F) -> F:
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if _tracer is None:
+                return func(*args, **kwargs)
+            with Span(_tracer, name, {}):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def format_summary(stats: List[Stat]) -> str:
+    """
+    Return the statistics as a text table.
+    """
+    mib = 1024 * 1024
+    lines = [f'{"name":<28} {"count":>7} {"total ms":>10} {"mean ms":>9} {"max ms":>9} {"MiB":>8} {"MiB/s":>8}']
+    for s in stats:
+        if not s.spans:
+            lines.append(f'{s.name:<28} {s.count:>7}')
+            continue
+        line = f'{s.name:<28} {s.count:>7} {s.total * 1000:>10.1f} {s.mean * 1000:>9.2f} {s.max * 1000:>9.2f}'
+        if s.bytes:
+            line += f' {s.bytes / mib:>8.1f} {s.throughput / mib:>8.1f}'
+        lines.append(line)
+    return '\n'.join(lines)
@@ -0,0 +1,251 @@
+"""
+Zstandard compression.
+
+Layers of OCI images can be `tar+zstd` compressed, which decompresses
+several times faster than gzip. Python has no zstd support before 3.14
+so the system zstd library is used through `ctypes`, like the zlib one
+is in `pkgbox.gzindex`. Without it, zstd layers can not be read.
+
+`Decompressor` and `Compressor` follow the `zlib` compression object
+interface, so they can be used where zlib ones are.
+"""
+import io
+import errno
+import ctypes
+import functools
+import ctypes.util
+from typing import BinaryIO, Optional
+
+from . import errors
+
+
+MAGIC = b'\x28\xb5\x2f\xfd'
+DEFAULT_LEVEL = 3
+READ_SIZE = 1024 * 1024
+
+_E_CONTINUE = 0
+_E_END = 2
+_C_COMPRESSION_LEVEL = 100
+_C_NB_WORKERS = 400
+
+
+class _Buffer(ctypes.Structure):
+    # ZSTD_inBuffer and ZSTD_outBuffer
+    _fields_ = [
+        ('data', ctypes.c_void_p),
+        ('size', ctypes.c_size_t),
+        ('pos', ctypes.c_size_t),
+    ]
+
+
+@functools.lru_cache(maxsize=None)
+def _libzstd() -> Optional[ctypes.CDLL]:
+    """
+    Return the system zstd library, `None` if it can not be loaded.
+    """
+    for name in ('libzstd.so.1', 'libzstd.1.dylib', ctypes.util.find_library('zstd')):
+        if not name:
+            continue
+        try:
+            lib = ctypes.CDLL(name)
+            break
+        except OSError:
+            continue
+    else:
+        return None
+
+    buf = ctypes.POINTER(_Buffer)
+    lib.ZSTD_isError.argtypes = [ctypes.c_size_t]
+    lib.ZSTD_getErrorName.argtypes = [ctypes.c_size_t]
+    lib.ZSTD_getErrorName.restype = ctypes.c_char_p
+    lib.ZSTD_DStreamOutSize.restype = ctypes.c_size_t
+    lib.ZSTD_CStreamOutSize.restype = ctypes.c_size_t
+    lib.ZSTD_createDStream.restype = ctypes.c_void_p
+    lib.ZSTD_freeDStream.argtypes = [ctypes.c_void_p]
+    lib.ZSTD_initDStream.argtypes = [ctypes.c_void_p]
+    lib.ZSTD_initDStream.restype = ctypes.c_size_t
+    lib.ZSTD_decompressStream.argtypes = [ctypes.c_void_p, buf, buf]
+    lib.ZSTD_decompressStream.restype = ctypes.c_size_t
+    lib.ZSTD_createCCtx.restype = ctypes.c_void_p
+    lib.ZSTD_freeCCtx.argtypes = [ctypes.c_void_p]
+    lib.ZSTD_CCtx_setParameter.argtypes = [ctypes.c_void_p, ctypes.c_int, ctypes.c_int]
+    lib.ZSTD_CCtx_setParameter.restype = ctypes.c_size_t
+    lib.ZSTD_compressStream2.argtypes = [ctypes.c_void_p, buf, buf, ctypes.c_int]
+    lib.ZSTD_compressStream2.restype = ctypes.c_size_t
+    return lib
+
+
+def available() -> bool:
+    """
+    Check if the system zstd library can be used.
+    """
+    return _libzstd() is not None
+
+
+def _lib() -> ctypes.CDLL:
+    lib = _libzstd()
+    if lib is None:
+        raise errors.PBError('zstd compressed layers require the zstd library (libzstd)', errno.ENOTSUP)
+    return lib
+
+
+def _check(lib: ctypes.CDLL, ret: int) -> int:
+    if lib.ZSTD_isError(ret):
+        raise errors.PBError(f'Invalid zstd data: {lib.ZSTD_getErrorName(ret).decode()}', errno.EIO)
+    return ret
+
+
+class Decompressor:
+    """
+    Streaming zstd decompressor. Concatenated frames are decompressed
+    as a single stream, so `unused_data` is always empty.
+    """
+    def __init__(self) -> None:
+        self.lib = _lib()
+        self.eof = False
+        self.unused_data = b''
+        self._size = self.lib.ZSTD_DStreamOutSize()
+        self._out = ctypes.create_string_buffer(self._size)
+        self._stream = self.lib.ZSTD_createDStream()
+        self._fed = False
+        _check(self.lib, self.lib.ZSTD_initDStream(self._stream))
+
+    def copy(self) -> 'Decompressor':
+        """
+        Return a copy of the decompressor, which the zstd library only
+        allows before it is fed.
+        """
+        if self._fed:
+            raise errors.PBError('zstd decompression state can not be copied', errno.ENOTSUP)
+        return Decompressor()
+
+    def decompress(self, data: bytes) -> bytes:
+        """
+        Decompress `data`, returning the output it makes available.
+        """
+        self._fed = True
+        src = ctypes.create_string_buffer(data, len(data))
+        inp = _Buffer(ctypes.addressof(src), len(data), 0)
+        out = bytearray()
+        while True:
+            buf = _Buffer(ctypes.addressof(self._out), self._size, 0)
+            ret = _check(self.lib, self.lib.ZSTD_decompressStream(self._stream, ctypes.byref(buf), ctypes.byref(inp)))
+            out += ctypes.string_at(self._out, buf.pos)
+            # 0 means a frame is complete and fully flushed
+            self.eof = ret == 0
+            if inp.pos == inp.size and buf.pos < buf.size:
+                return bytes(out)
+
+    def flush(self) -> bytes:
+        return b''
+
+    def __del__(self) -> None:
+        if getattr(self, '_stream', None):
+            self.lib.ZSTD_freeDStream(self._stream)
+            self._stream = None
+
+
+class Compressor:
+    """
+    Streaming zstd compressor, using up to `workers` threads of the
+    zstd library (0 compresses in the calling thread).
+    """
+    def __init__(self, level: int = DEFAULT_LEVEL, workers: int = 0) -> None:
+        self.lib = _lib()
+        self._size = self.lib.ZSTD_CStreamOutSize()
+        self._out = ctypes.create_string_buffer(self._size)
+        self._ctx = self.lib.ZSTD_createCCtx()
+        _check(self.lib, self.lib.ZSTD_CCtx_setParameter(self._ctx, _C_COMPRESSION_LEVEL, level))
+        if workers:
+            # fails with libraries built without multithreading support
+            self.lib.ZSTD_CCtx_setParameter(self._ctx, _C_NB_WORKERS, workers)
+
+    def _compress(self, data: bytes, mode: int) -> bytes:
+        src = ctypes.create_string_buffer(data, len(data))
+        inp = _Buffer(ctypes.addressof(src), len(data), 0)
+        out = bytearray()
+        while True:
+            buf = _Buffer(ctypes.addressof(self._out), self._size, 0)
+            ret = _check(self.lib, self.lib.ZSTD_compressStream2(self._ctx, ctypes.byref(buf), ctypes.byref(inp), mode))
+            out += ctypes.string_at(self._out, buf.pos)
+            if mode == _E_END and ret == 0:
+                return bytes(out)
+            if mode != _E_END and inp.pos == inp.size:
+                return bytes(out)
+
+    def compress(self, data: bytes) -> bytes:
+        """
+        Compress `data`, returning the output made available so far.
+        """
+        return self._compress(data, _E_CONTINUE)
+
+    def flush(self) -> bytes:
+        """
+        End the frame, returning the rest of the output.
+        """
+        return self._compress(b'', _E_END)
+
+    def __del__(self) -> None:
+        if getattr(self, '_ctx', None):
+            self.lib.ZSTD_freeCCtx(self._ctx)
+            self._ctx = None
+
+
+class _Reader(io.RawIOBase):
+    """
+    File-like object reading the decompressed content of a zstd file.
+    """
+    def __init__(self, f: BinaryIO, closefd: bool) -> None:
+        self.f = f
+        self.closefd = closefd
+        self.decompressor = Decompressor()
+        self.buffer = b''
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, b) -> int:
+        while not self.buffer:
+            chunk = self.f.read(READ_SIZE)
+            if not chunk:
+                if not self.decompressor.eof:
+                    raise errors.PBError('Truncated zstd data', errno.EIO)
+                return 0
+            self.buffer = self.decompressor.decompress(chunk)
+        size = min(len(b), len(self.buffer))
+        b[:size] = self.buffer[:size]
+        self.buffer = self.buffer[size:]
+        return size
+
+    def close(self) -> None:
+        if not self.closed and self.closefd:
+            self.f.close()
+        super().close()
+
+
+def reader(f: BinaryIO, closefd: bool = True) -> io.BufferedReader:
+    """
+    Return a file-like object reading the decompressed content of the
+    zstd file object `f`, closing it when closed unless `closefd` is
+    false.
+    """
+    return io.BufferedReader(_Reader(f, closefd), READ_SIZE)
+
+
+def compress(data: bytes, level: int = DEFAULT_LEVEL) -> bytes:
+    """
+    Compress `data` into a single zstd frame.
+    """
+    c = Compressor(level)
+    return c.compress(data) + c.flush()
+
+
+def decompress(data: bytes) -> bytes:
+    """
+    Decompress zstd `data`, which may hold several frames.
+    """
+    d = Decompressor()
+    out = d.decompress(data)
+    if not d.eof:
+        raise errors.PBError('Truncated zstd data', errno.EIO)
+    return out
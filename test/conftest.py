@@ -1,4 +1,5 @@
 import os
+from unittest import mock
 
 import pytest
 from click.testing import CliRunner
@@ -27,3 +28,12 @@ def fixdir():
 def manifest_json(fixdir):
     with open(f'{fixdir}/manifest.json', 'r') as f:
         return f.read()
+
+
+@pytest.fixture
+def pkgbox_home(tmp_path):
+    d = tmp_path / 'pkgbox-home'
+    d.mkdir()
+
+    with mock.patch.dict(os.environ, {'PKGBOX_HOME': str(d)}):
+        yield d
@@ -0,0 +1,90 @@
+from concurrent.futures import Future
+from concurrent.futures.process import BrokenProcessPool
+
+import requests_mock
+
+from pkgbox import batch, containerfile, parser
+
+
+def test_expand(tmp_path):
+    (tmp_path / 'a.Containerfile').write_text('FROM a\n')
+    (tmp_path / 'b.Containerfile').write_text('FROM b\n')
+
+    assert batch.expand([f'{tmp_path}/*.Containerfile', ' ', 'https://www.pkgbox.org/*', 'missing']) == [
+        f'{tmp_path}/a.Containerfile',
+        f'{tmp_path}/b.Containerfile',
+        'https://www.pkgbox.org/*',
+        'missing',
+    ]
+
+
+def test_run_local_and_http(tmp_path, pkgbox_home):
+    path = tmp_path / 'Containerfile'
+    path.write_text('FROM a\n')
+
+    with requests_mock.Mocker() as m:
+        m.get('https://www.pkgbox.org/Containerfile', text='FROM b\n')
+        m.get('https://www.pkgbox.org/missing', status_code=404)
+        records = list(batch.run([str(path), 'https://www.pkgbox.org/Containerfile',
+                                  'https://www.pkgbox.org/missing'], jobs=1))
+
+    records = {r['source']: r for r in records}
+    assert records[str(path)]['result'] == containerfile.as_dict(parser.parse('FROM a\n'))
+    assert records['https://www.pkgbox.org/Containerfile']['result']['from'] == 'b'
+    assert records['https://www.pkgbox.org/missing']['errno'] == 404
+
+
+def test_run_process_pool(tmp_path):
+    sources = []
+    for i in range(8):
+        path = tmp_path / f'{i}.Containerfile'
+        path.write_text(f'FROM image{i}\n')
+        sources.append(str(path))
+
+    records = list(batch.run(sources, jobs=2))
+
+    assert sorted(r['source'] for r in records) == sorted(sources)
+    assert all(r['result']['from'].startswith('image') for r in records)
+
+
+def test_mp_context():
+    assert batch._mp_context().get_start_method() in ('forkserver', 'spawn')
+
+
+def test_run_broken_pool(tmp_path, monkeypatch):
+    class Pool:
+        def __init__(self, jobs, mp_context):
+            self.broken = False
+
+        def submit(self, fn, *args):
+            if self.broken:
+                raise BrokenProcessPool('A child process terminated abruptly')
+            self.broken = True
+            future = Future()
+            future.set_exception(BrokenProcessPool('A process in the pool was terminated abruptly'))
+            return future
+
+        def shutdown(self, cancel_futures):
+            pass
+
+    monkeypatch.setattr(batch, 'ProcessPoolExecutor', Pool)
+    sources = []
+    for i in range(3):
+        path = tmp_path / f'{i}.Containerfile'
+        path.write_text(f'FROM image{i}\n')
+        sources.append(str(path))
+
+    records = list(batch.run(sources, jobs=2, read_workers=1))
+
+    assert sorted(r['source'] for r in records) == sources
+    assert all('terminated abruptly' in r['error'] for r in records)
+
+
+def test_run_identical_http(pkgbox_home):
+    sources = [f'https://www.pkgbox.org/Containerfile?{i}' for i in range(32)]
+    with requests_mock.Mocker() as m:
+        m.get(requests_mock.ANY, text='FROM fedora\nRUN make\n')
+        records = list(batch.run(sources, jobs=1, read_workers=16))
+
+    assert sorted(r['source'] for r in records) == sorted(sources)
+    assert all(r['result']['from'] == 'fedora' for r in records)
@@ -0,0 +1,70 @@
+import os
+import time
+
+from pkgbox import cache
+from pkgbox.oci.v1 import Descriptor
+
+
+def test_put_get_ok(tmp_path):
+    c = cache.ManifestCache(tmp_path)
+    digest = Descriptor('sha256', '0' * 64)
+
+    assert c.get(digest) is None
+    assert c.ref('registry.fedoraproject.org/fedora:39') is None
+
+    c.put(digest, b'{}', 'registry.fedoraproject.org/fedora:39')
+
+    ref = c.ref('registry.fedoraproject.org/fedora:39')
+    assert c.get(digest) == b'{}'
+    assert ref.digest == digest
+    assert c.is_fresh(ref)
+    assert (tmp_path / 'refs' / 'registry.fedoraproject.org' / 'fedora' / '39.json').exists()
+
+
+def test_ttl(tmp_path):
+    c = cache.ManifestCache(tmp_path, ttl=60)
+    digest = Descriptor('sha256', '0' * 64)
+
+    assert not c.is_fresh(cache.Ref(digest, time.time() - 120))
+    assert c.is_fresh(cache.Ref(digest, time.time() - 30))
+
+
+def test_evict_lru(tmp_path):
+    c = cache.ManifestCache(tmp_path, max_size=10)
+    digests = [Descriptor('sha256', f'{i:064x}') for i in range(3)]
+
+    for i, digest in enumerate(digests[:2]):
+        c.put(digest, b'12345')
+        os.utime(tmp_path / 'blobs' / 'sha256' / digest.digest, (i, i))
+
+    # access the oldest entry so the second one becomes the lru
+    assert c.get(digests[0]) == b'12345'
+    c.put(digests[2], b'12345')
+
+    assert c.get(digests[0]) == b'12345'
+    assert c.get(digests[1]) is None
+    assert c.get(digests[2]) == b'12345'
+
+
+def test_pins(tmp_path):
+    c = cache.ManifestCache(tmp_path, max_size=5)
+    pinned, other = Descriptor('sha256', '0' * 64), Descriptor('sha256', '1' * 64)
+
+    c.pin('registry.fedoraproject.org/fedora:39', pinned)
+    c.put(pinned, b'12345')
+    c.put(other, b'12345')
+
+    assert c.pins() == {'registry.fedoraproject.org/fedora:39': pinned}
+    assert c.get(pinned) == b'12345'
+    assert c.get(other) is None
+    assert [d for d, _ in c.manifests()] == [pinned]
+    assert c.unpin('registry.fedoraproject.org/fedora:39')
+    assert not c.unpin('registry.fedoraproject.org/fedora:39')
+    assert c.pins() == {}
+
+
+def test_from_paths(tmp_path):
+    c = cache.from_paths({'config_dir': f'{tmp_path}/config', 'data_dir': f'{tmp_path}/data'}, ttl=10)
+
+    assert c.root == tmp_path / 'data' / 'manifests'
+    assert c.ttl == 10
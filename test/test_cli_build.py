@@ -1,3 +1,5 @@
+import json
+import errno
 import pathlib
 
 from pkgbox import errors, containerfile
@@ -10,3 +12,65 @@ def test_ok(clirunner, fixdir):
     res = clirunner.invoke(cli, ['build', path])
 
     assert res.stdout == containerfile.as_json(parser, pretty=True) + '\n'
+
+
+def test_many_ok(clirunner, fixdir, tmp_path):
+    path = f'{fixdir}/containerfiles/simple/Containerfile'
+    other = tmp_path / 'Containerfile'
+    other.write_text('FROM fedora\nRUN make\n')
+    res = clirunner.invoke(cli, ['build', '-j', '2', path, str(other)])
+    records = {r['source']: r for r in map(json.loads, res.stdout.splitlines())}
+
+    assert res.exit_code == 0
+    assert records[path]['result'] == containerfile.as_dict(containerfile.from_filepath(pathlib.Path(path)))
+    assert records[str(other)]['result']['from'] == 'fedora'
+
+
+def test_many_glob_stdin(clirunner, tmp_path):
+    for name in ('a', 'b', 'c'):
+        (tmp_path / name).mkdir()
+        (tmp_path / name / 'Containerfile').write_text(f'FROM {name}\n')
+    stdin = f'{tmp_path}/c/Containerfile\n\n'
+    res = clirunner.invoke(cli, ['build', '-j', '1', '--stdin', f'{tmp_path}/[ab]/Containerfile'], input=stdin)
+    records = [json.loads(line) for line in res.stdout.splitlines()]
+
+    assert res.exit_code == 0
+    assert sorted(r['result']['from'] for r in records) == ['a', 'b', 'c']
+
+
+def test_many_errors(clirunner, tmp_path):
+    ok = tmp_path / 'Containerfile'
+    ok.write_text('FROM fedora\n')
+    bad = tmp_path / 'Containerfile.bad'
+    bad.write_text('FROM fedora\nLABEL a=b c\n')
+    res = clirunner.invoke(cli, ['build', '--ndjson', '-j', '1', str(ok), str(bad), str(tmp_path / 'missing')])
+    records = {r['source']: r for r in map(json.loads, res.stdout.splitlines())}
+
+    assert isinstance(res.exception, errors.PBError)
+    assert res.exception.message == '2 of 3 sources failed.'
+    assert records[str(ok)]['result']['from'] == 'fedora'
+    assert 'Syntax error' in records[str(bad)]['error']
+    assert records[str(tmp_path / 'missing')]['errno'] == errno.ENOENT
+
+
+def test_base_digest(clirunner, tmp_path):
+    path = tmp_path / 'Containerfile'
+    path.write_text('FROM fedora:39\nRUN make\n')
+    other = tmp_path / 'Containerfile.other'
+    other.write_text('FROM fedora:39\nRUN make\n')
+    digest = 'sha256:' + 'a' * 64
+    cf = containerfile.from_filepath(path)
+
+    res = clirunner.invoke(cli, ['build', '--base-digest', f'fedora:39={digest}', str(path)])
+    assert res.exit_code == 0
+    assert res.stdout == containerfile.as_json(cf, pretty=True, bases={'fedora:39': digest}) + '\n'
+    assert res.stdout != containerfile.as_json(cf, pretty=True) + '\n'
+
+    res = clirunner.invoke(cli, ['build', '-j', '1', '--base-digest', f'fedora:39={digest}', str(path), str(other)])
+    records = [json.loads(line) for line in res.stdout.splitlines()]
+    assert res.exit_code == 0
+    assert [r['result'] for r in records] == [containerfile.as_dict(cf, {'fedora:39': digest})] * 2
+
+    res = clirunner.invoke(cli, ['build', '--base-digest', 'fedora:39', str(path)])
+    assert res.exit_code == 2
+    assert 'is not an IMAGE=DIGEST pair' in res.output
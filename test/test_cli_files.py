@@ -0,0 +1,83 @@
+import io
+import json
+import gzip
+import hashlib
+import tarfile
+
+import requests_mock
+
+from pkgbox.cli import cli
+from pkgbox.oci.v1 import Descriptor
+from pkgbox.store import BlobStore
+
+
+def _layer(files):
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode='w') as tar:
+        for name, data in files.items():
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            info.mode = 0o644
+            tar.addfile(info, io.BytesIO(data))
+    return gzip.compress(buf.getvalue())
+
+
+def _image(pkgbox_home, m, files, stored=True):
+    blob = _layer(files)
+    digest = hashlib.sha256(blob).hexdigest()
+    if stored:
+        store = BlobStore(pkgbox_home / 'data' / 'oci-layers')
+        with store.writer(Descriptor('sha256', digest)) as w:
+            w.write(blob)
+            w.commit()
+    else:
+        def serve(request, context):
+            if 'Range' not in request.headers:
+                return blob
+            start, end = map(int, request.headers['Range'][len('bytes='):].split('-'))
+            end = min(end + 1, len(blob))
+            context.status_code = 206
+            context.headers['content-range'] = f'bytes {start}-{end - 1}/{len(blob)}'
+            return blob[start:end]
+        m.get(f'https://registry.fedoraproject.org/v2/fedora/blobs/sha256:{digest}', content=serve)
+
+    manifest = json.dumps({'name': 'fedora', 'tag': '39', 'architecture': 'amd64',
+                           'fsLayers': [{'blobSum': f'sha256:{digest}'}]})
+    m.get('https://registry.fedoraproject.org/v2/fedora/manifests/39', text=manifest,
+          headers={'docker-content-digest': 'sha256:' + hashlib.sha256(manifest.encode()).hexdigest()})
+    return Descriptor('sha256', digest)
+
+
+def test_ls(clirunner, pkgbox_home):
+    with requests_mock.Mocker() as m:
+        _image(pkgbox_home, m, {'etc/os-release': b'fedora 39', 'etc/hosts': b'localhost'})
+        res = clirunner.invoke(cli, ['ls', 'registry.fedoraproject.org/fedora:39'])
+
+    assert res.exit_code == 0
+    assert res.stdout.splitlines() == [
+        'drwxr-xr-x          0 etc',
+        '-rw-r--r--          9 etc/hosts',
+        '-rw-r--r--          9 etc/os-release',
+    ]
+
+
+def test_cat(clirunner, pkgbox_home):
+    with requests_mock.Mocker() as m:
+        _image(pkgbox_home, m, {'etc/os-release': b'fedora 39'})
+        res = clirunner.invoke(cli, ['cat', 'registry.fedoraproject.org/fedora:39', '/etc/os-release'])
+        missing = clirunner.invoke(cli, ['cat', 'registry.fedoraproject.org/fedora:39', '/etc/passwd'])
+
+    assert res.exit_code == 0
+    assert res.stdout_bytes == b'fedora 39'
+    assert missing.exception.message == '"/etc/passwd" not found'
+
+
+def test_cat_remote(clirunner, pkgbox_home):
+    with requests_mock.Mocker() as m:
+        layer = _image(pkgbox_home, m, {'etc/os-release': b'fedora 39'}, stored=False)
+        res = clirunner.invoke(cli, ['cat', 'registry.fedoraproject.org/fedora:39', '/etc/os-release'])
+
+    assert res.exit_code == 0
+    assert res.stdout_bytes == b'fedora 39'
+    # a plain gzip layer is downloaded whole while it is indexed
+    assert BlobStore(pkgbox_home / 'data' / 'oci-layers').exists(layer)
@@ -0,0 +1,71 @@
+import json
+import hashlib
+
+import requests_mock
+
+from pkgbox import errors
+from pkgbox.cli import cli
+
+
+def test_ok(clirunner, pkgbox_home):
+    blob = b'layer' * 1024
+    digest = 'sha256:' + hashlib.sha256(blob).hexdigest()
+    manifest = json.dumps({
+        'name': 'fedora', 'tag': '39', 'architecture': 'amd64',
+        'fsLayers': [{'blobSum': digest}]
+    })
+
+    with requests_mock.Mocker() as m:
+        for tag in ('39', '40'):
+            m.get(f'https://registry.fedoraproject.org/v2/fedora/manifests/{tag}', text=manifest,
+                  headers={'docker-content-digest': 'sha256:' + hashlib.sha256(manifest.encode()).hexdigest()})
+        m.get(f'https://registry.fedoraproject.org/v2/fedora/blobs/{digest}', content=blob)
+        res = clirunner.invoke(cli, ['pull', 'registry.fedoraproject.org/fedora:39', '--stdin'],
+                               input='registry.fedoraproject.org/fedora:40\n')
+
+    assert res.exit_code == 0
+    assert 'pulled: registry.fedoraproject.org/fedora:39' in res.stdout
+    assert 'pulled: registry.fedoraproject.org/fedora:40' in res.stdout
+    assert 'layers: 2 referenced, 1 unique, 0 cached, 1 downloaded' in res.stdout
+    assert (pkgbox_home / 'data' / 'oci-layers' / 'blobs' / 'sha256' / digest[7:]).read_bytes() == blob
+
+
+def test_failed(clirunner, pkgbox_home):
+    with requests_mock.Mocker() as m:
+        m.get('https://registry.fedoraproject.org/v2/fedora/manifests/39', status_code=404)
+        res = clirunner.invoke(cli, ['pull', 'registry.fedoraproject.org/fedora:39'])
+
+    assert res.exit_code == 1
+    assert res.exception == errors.PBError('1 of 1 images failed.')
+
+
+def test_no_images(clirunner):
+    res = clirunner.invoke(cli, ['pull'])
+
+    assert res.exception == errors.PBError('No images provided.')
+
+
+def test_gc_quota(clirunner, pkgbox_home):
+    blob = b'layer' * 1024
+    digest = 'sha256:' + hashlib.sha256(blob).hexdigest()
+    manifest = json.dumps({'name': 'fedora', 'tag': '39', 'architecture': 'amd64', 'fsLayers': [{'blobSum': digest}]})
+
+    with requests_mock.Mocker() as m:
+        m.get('https://registry.fedoraproject.org/v2/fedora/manifests/39', text=manifest,
+              headers={'docker-content-digest': 'sha256:' + hashlib.sha256(manifest.encode()).hexdigest()})
+        m.get(f'https://registry.fedoraproject.org/v2/fedora/blobs/{digest}', content=blob)
+        clirunner.invoke(cli, ['pull', 'registry.fedoraproject.org/fedora:39'])
+        res = clirunner.invoke(cli, ['pin', 'registry.fedoraproject.org/fedora:39'])
+
+    assert res.exit_code == 0
+    assert clirunner.invoke(cli, ['gc', '--recent', '0']).stdout.splitlines()[0] == 'evicted: 0 layers (0.0 MiB)'
+
+    res = clirunner.invoke(cli, ['pin', '--remove', 'registry.fedoraproject.org/fedora:39'])
+    assert res.stdout == 'unpinned: registry.fedoraproject.org/fedora:39\n'
+
+    res = clirunner.invoke(cli, ['gc', '--recent', '0', '--dry-run'])
+    assert res.stdout.splitlines()[0] == 'would evict: 1 layers (0.0 MiB)'
+
+    res = clirunner.invoke(cli, ['gc', '--recent', '0'])
+    assert res.stdout.splitlines() == ['evicted: 1 layers (0.0 MiB)', 'kept: 0 referenced, 0 in use', 'usage: 0.0 MiB']
+    assert not (pkgbox_home / 'data' / 'oci-layers' / 'blobs' / 'sha256' / digest[7:]).exists()
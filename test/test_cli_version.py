@@ -1,3 +1,6 @@
+import sys
+import subprocess
+
 from pkgbox.cli import cli
 
 
@@ -6,3 +9,13 @@ def test_version(clirunner):
 
     assert res.exit_code == 0
     assert res.output == 'v0.1.0\n'
+
+
+def test_version_lazy_imports():
+    code = 'import sys; from pkgbox.cli import cli; cli(["version"], standalone_mode=False); print(",".join(sys.modules))'
+    res = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True)
+    modules = res.stdout.splitlines()[-1].split(',')
+
+    assert 'requests' not in modules
+    assert 'canonicaljson' not in modules
+    assert 'pkgbox.containerfile' not in modules
@@ -1,7 +1,9 @@
 import json
 import pathlib
 
-from pkgbox import containerfile
+import pytest
+
+from pkgbox import containerfile, errors, parser
 
 
 def test_parse_simple_ok(fixdir):
@@ -18,3 +20,63 @@ def test_parse_simple_ok(fixdir):
     }
     with open(f'{basedir}/Containerfile.json', 'r') as f:
         assert json.load(f) == containerfile.as_dict(parser)
+
+
+def test_chain_digests_prefix():
+    base = parser.parse('FROM fedora\nRUN make\nRUN make install\n')
+    edited = parser.parse('FROM fedora\nRUN make\nRUN make check\n')
+    chain = containerfile.chain_digests(base)
+
+    assert len(chain) == 3
+    assert len(set(chain)) == 3
+    assert containerfile.chain_digests(edited)[:2] == chain[:2]
+    assert containerfile.chain_digests(edited)[2] != chain[2]
+
+
+def test_chain_digests_context():
+    content = 'FROM fedora\nARG VERSION=1\nRUN make VERSION=$VERSION\n'
+    chain = containerfile.chain_digests(parser.parse(content))
+    other = containerfile.chain_digests(parser.parse(content, build_args={'VERSION': '2'}))
+
+    assert chain[0] == other[0]
+    assert chain[1] != other[1]
+    assert chain[2] != other[2]
+
+
+def test_chain_digests_bases():
+    cf = parser.parse('FROM fedora\nRUN make\n')
+    chain = containerfile.chain_digests(cf)
+
+    assert containerfile.chain_digests(cf, {'fedora': 'sha256:' + '0' * 64}) != chain
+    assert containerfile.chain_digests(cf, {'ubuntu': 'sha256:' + '0' * 64}) == chain
+
+
+def test_longest_cached_prefix():
+    cf = parser.parse('FROM fedora\nRUN make\nRUN make install\n')
+    chain = containerfile.chain_digests(cf)
+
+    assert containerfile.longest_cached_prefix(cf, set()) == 0
+    assert containerfile.longest_cached_prefix(cf, {chain[0]}) == 1
+    assert containerfile.longest_cached_prefix(cf, {chain[0], chain[1]}) == 2
+    assert containerfile.longest_cached_prefix(cf, set(chain)) == 3
+
+
+def test_needed_stages():
+    cf = parser.parse('\n'.join([
+        'FROM fedora AS deps',
+        'FROM deps AS build',
+        'FROM alpine AS docs',
+        'FROM fedora AS test',
+        'COPY --from=build /out /',
+        'FROM scratch',
+        'COPY --from=build /out /',
+    ]))
+
+    assert [s.index for s in containerfile.needed_stages(cf)] == [0, 1, 4]
+    assert [s.index for s in containerfile.needed_stages(cf, 'test')] == [0, 1, 3]
+    assert [s.index for s in containerfile.needed_stages(cf, '2')] == [2]
+    with pytest.raises(errors.PBError) as e:
+        containerfile.needed_stages(cf, 'missing')
+    assert e.value.message == 'Unknown build stage "missing"'
+    with pytest.raises(errors.PBError):
+        containerfile.target_stage(parser.parse('# empty\n'))
@@ -0,0 +1,183 @@
+import os
+import shutil
+
+import pytest
+
+from pkgbox import diff, errors
+from pkgbox.diff import ADDED, DELETED, MODIFIED, Change
+
+
+def _tree(root):
+    os.makedirs(root / 'etc')
+    os.makedirs(root / 'usr' / 'lib' / 'pkg')
+    (root / 'etc' / 'hosts').write_text('127.0.0.1 localhost\n')
+    (root / 'etc' / 'motd').write_text('hello\n')
+    (root / 'usr' / 'lib' / 'pkg' / 'a.so').write_bytes(b'a' * 100)
+    (root / 'usr' / 'lib' / 'pkg' / 'b.so').write_bytes(b'b' * 100)
+    (root / 'usr' / 'lib' / 'libc.so').write_bytes(b'c' * 100)
+    os.symlink('lib', root / 'usr' / 'lib64')
+    # not racy: content is only compared when the stat data is ambiguous
+    old = 1_000_000_000_000_000_000
+    for dirpath, dirs, files in os.walk(root):
+        for name in dirs + files:
+            os.utime(os.path.join(dirpath, name), ns=(old, old), follow_symlinks=False)
+
+
+def _changes(before, root, **kwargs):
+    return [(c.kind, c.path) for c in diff.diff(before, root, **kwargs)]
+
+
+def _restore_mtime(path, st):
+    os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns))
+
+
+@pytest.mark.parametrize('workers', [1, 4])
+def test_walk_order(tmp_path, workers):
+    _tree(tmp_path / 'root')
+    (tmp_path / 'root' / 'etc.d').mkdir()
+    (tmp_path / 'root' / 'etc-old').write_text('')
+
+    paths = [p for p, _ in diff.walk(tmp_path / 'root', workers=workers, window=2)]
+    assert paths == [
+        'etc', 'etc/hosts', 'etc/motd', 'etc-old', 'etc.d',
+        'usr', 'usr/lib', 'usr/lib/libc.so', 'usr/lib/pkg', 'usr/lib/pkg/a.so', 'usr/lib/pkg/b.so', 'usr/lib64',
+    ]
+
+
+def test_unchanged(tmp_path):
+    _tree(tmp_path / 'root')
+    before = diff.record(tmp_path / 'root', tmp_path / 'before')
+
+    assert before.started > 0
+    assert len(list(before)) == 10
+    assert _changes(before, tmp_path / 'root') == []
+
+
+def test_changes(tmp_path):
+    root = tmp_path / 'root'
+    _tree(root)
+    before = diff.record(root, tmp_path / 'before')
+
+    (root / 'etc' / 'hosts').write_text('::1 localhost\n')
+    (root / 'etc' / 'resolv.conf').write_text('nameserver 127.0.0.1\n')
+    os.chmod(root / 'etc' / 'motd', 0o600)
+    shutil.rmtree(root / 'usr' / 'lib' / 'pkg')
+    os.unlink(root / 'usr' / 'lib64')
+    os.symlink('lib/pkg', root / 'usr' / 'lib64')
+    os.makedirs(root / 'opt' / 'app')
+    (root / 'opt' / 'app' / 'run').write_text('')
+
+    assert _changes(before, root) == [
+        (MODIFIED, 'etc'),
+        (MODIFIED, 'etc/hosts'),
+        (MODIFIED, 'etc/motd'),
+        (ADDED, 'etc/resolv.conf'),
+        (ADDED, 'opt'),
+        (ADDED, 'opt/app'),
+        (ADDED, 'opt/app/run'),
+        (MODIFIED, 'usr'),
+        (MODIFIED, 'usr/lib'),
+        # a single whiteout for the directory
+        (DELETED, 'usr/lib/pkg'),
+        (MODIFIED, 'usr/lib64'),
+    ]
+
+
+def test_directory_replaced(tmp_path):
+    root = tmp_path / 'root'
+    _tree(root)
+    before = diff.record(root, tmp_path / 'before')
+
+    shutil.rmtree(root / 'usr' / 'lib' / 'pkg')
+    (root / 'usr' / 'lib' / 'pkg').write_text('file')
+    os.unlink(root / 'etc' / 'motd')
+
+    assert _changes(before, root) == [
+        (MODIFIED, 'etc'),
+        (DELETED, 'etc/motd'),
+        (MODIFIED, 'usr/lib'),
+        (MODIFIED, 'usr/lib/pkg'),
+    ]
+
+
+def test_ambiguous(tmp_path):
+    root = tmp_path / 'root'
+    _tree(root)
+    base = tmp_path / 'base'
+    shutil.copytree(root, base, symlinks=True)
+    before = diff.record(root, tmp_path / 'before')
+
+    # same size and mtime, other inode: same content as before or not
+    libc = root / 'usr' / 'lib' / 'libc.so'
+    st = os.stat(libc)
+    os.unlink(libc)
+    libc.write_bytes(b'c' * 100)
+    _restore_mtime(libc, st)
+    a = root / 'usr' / 'lib' / 'pkg' / 'a.so'
+    st = os.stat(a)
+    a.write_bytes(b'x' * 100)
+    _restore_mtime(a, st)
+    for d in (root / 'usr' / 'lib', root / 'usr' / 'lib' / 'pkg'):
+        _restore_mtime(d, os.stat(base / d.relative_to(root)))
+
+    assert _changes(before, root, base=base) == [(MODIFIED, 'usr/lib/pkg/a.so')]
+    # content can not be compared without base
+    assert _changes(before, root) == [(MODIFIED, 'usr/lib/libc.so'), (MODIFIED, 'usr/lib/pkg/a.so')]
+
+
+def test_hardlink_farm(tmp_path):
+    root = tmp_path / 'root'
+    _tree(root)
+    before = diff.record(root, tmp_path / 'before')
+
+    # linking changes the ctime of files, not their content
+    base = tmp_path / 'base'
+    os.makedirs(base / 'etc')
+    os.link(root / 'etc' / 'hosts', base / 'etc' / 'hosts')
+
+    assert _changes(before, root, base=base) == []
+    assert _changes(before, root) == [(MODIFIED, 'etc/hosts')]
+
+
+def test_racy(tmp_path):
+    root = tmp_path / 'root'
+    os.makedirs(root)
+    (root / 'new').write_text('racy')
+
+    before = diff.record(root, tmp_path / 'before')
+    records = dict(before)
+    assert records['new'].extra == diff._digest(str(root / 'new'))
+
+    # written again within the same mtime tick: stat data is the same
+    assert not diff._modified(str(root), None, 'new', records['new'], records['new'])
+    stale = records['new']._replace(extra=b'\0' * 32)
+    assert diff._modified(str(root), None, 'new', stale, records['new'])
+
+
+def test_save(tmp_path):
+    root = tmp_path / 'root'
+    _tree(root)
+    before = diff.record(root, tmp_path / 'before')
+
+    (root / 'etc' / 'motd').write_text('bye\n')
+    assert _changes(before, root, save=tmp_path / 'after') == [(MODIFIED, 'etc/motd')]
+
+    after = diff.StatSnapshot(tmp_path / 'after')
+    assert _changes(after, root) == []
+    (root / 'etc' / 'issue').write_text('')
+    assert _changes(after, root) == [(MODIFIED, 'etc'), (ADDED, 'etc/issue')]
+
+
+def test_invalid_snapshot(tmp_path):
+    with pytest.raises(errors.PBError):
+        diff.StatSnapshot(tmp_path / 'missing')
+
+    (tmp_path / 'bad').write_bytes(b'')
+    with pytest.raises(errors.PBError) as e:
+        diff.StatSnapshot(tmp_path / 'bad')
+    assert e.value.message.startswith('Invalid stat snapshot')
+
+
+def test_whiteout():
+    assert Change(DELETED, 'usr/lib/pkg').whiteout == 'usr/lib/.wh.pkg'
+    assert Change(DELETED, 'etc').whiteout == '.wh.etc'
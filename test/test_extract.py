@@ -0,0 +1,168 @@
+import io
+import os
+import gzip
+import errno
+import hashlib
+import tarfile
+
+import pytest
+import requests_mock
+
+from pkgbox import errors, extract, image, zstd
+from pkgbox.oci.v1 import Descriptor
+from pkgbox.store import BlobStore
+
+
+def _layer(entries, compress=True):
+    """
+    Build a layer blob from (name, type, data or linkname, mode) entries.
+    """
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode='w') as tar:
+        for name, kind, data, mode in entries:
+            info = tarfile.TarInfo(name)
+            info.type = kind
+            info.mode = mode
+            info.mtime = 1000
+            if kind == tarfile.REGTYPE:
+                info.size = len(data)
+                tar.addfile(info, io.BytesIO(data))
+                continue
+            if kind in (tarfile.SYMTYPE, tarfile.LNKTYPE):
+                info.linkname = data
+            tar.addfile(info)
+    blob = buf.getvalue()
+    if compress == 'zstd':
+        return zstd.compress(blob)
+    return gzip.compress(blob) if compress else blob
+
+
+def _extract(tmp_path, blob, chunk=7):
+    x = extract.Extractor(tmp_path / 'layer')
+    for i in range(0, len(blob), chunk):
+        x.write(blob[i:i + chunk])
+    x.commit()
+    return x
+
+
+@pytest.mark.parametrize('compress', [True, False, 'zstd'])
+def test_extract(tmp_path, compress):
+    blob = _layer([
+        ('etc', tarfile.DIRTYPE, None, 0o555),
+        ('etc/os-release', tarfile.REGTYPE, b'fedora\n', 0o644),
+        ('etc/hardlink', tarfile.LNKTYPE, 'etc/os-release', 0o644),
+        ('./usr/bin/sh', tarfile.SYMTYPE, '/bin/bash', 0o777),
+        ('var/.wh.cache', tarfile.REGTYPE, b'', 0o600),
+        ('opt/.wh..wh..opq', tarfile.REGTYPE, b'', 0o600),
+    ], compress)
+    x = _extract(tmp_path, blob)
+    root = tmp_path / 'layer'
+
+    assert (root / 'etc' / 'os-release').read_bytes() == b'fedora\n'
+    assert os.stat(root / 'etc' / 'hardlink').st_ino == os.stat(root / 'etc' / 'os-release').st_ino
+    assert os.readlink(root / 'usr' / 'bin' / 'sh') == '/bin/bash'
+    assert os.stat(root / 'etc').st_mode & 0o777 == 0o555
+    assert os.stat(root / 'etc' / 'os-release').st_mtime == 1000
+    assert (root / 'var' / '.wh.cache').exists()
+    assert x.whiteouts == ['var/cache']
+    assert x.opaque == ['opt']
+    assert not x.tmp.exists()
+
+
+def test_extract_traversal(tmp_path):
+    x = extract.Extractor(tmp_path / 'layer')
+    x.write(_layer([('../evil', tarfile.REGTYPE, b'x', 0o644)]))
+
+    with pytest.raises(errors.PBError) as e:
+        x.commit()
+
+    assert e.value.errno == errno.EPERM
+    assert not (tmp_path / 'evil').exists()
+    assert not (tmp_path / 'layer').exists()
+    assert not x.tmp.exists()
+
+
+def test_extract_symlink_escape(tmp_path):
+    outside = tmp_path / 'outside'
+    outside.mkdir()
+    _extract(tmp_path, _layer([
+        ('abs', tarfile.SYMTYPE, str(outside), 0o777),
+        ('rel', tarfile.SYMTYPE, '../../../outside', 0o777),
+        ('abs/file', tarfile.REGTYPE, b'a', 0o644),
+        ('rel/file', tarfile.REGTYPE, b'r', 0o644),
+        ('abs', tarfile.DIRTYPE, None, 0o700),
+    ]))
+    root = tmp_path / 'layer'
+
+    assert os.listdir(outside) == []
+    assert (root / str(outside).lstrip('/') / 'file').read_bytes() == b'a'
+    assert (root / 'outside' / 'file').read_bytes() == b'r'
+    assert (root / 'abs').is_dir() and not (root / 'abs').is_symlink()
+
+
+def test_extract_reset(tmp_path):
+    x = extract.Extractor(tmp_path / 'layer')
+    x.write(_layer([('old', tarfile.REGTYPE, b'old', 0o644)])[:20])
+    x.reset()
+    x.write(_layer([('new', tarfile.REGTYPE, b'new', 0o644)]))
+    x.commit()
+
+    assert os.listdir(tmp_path / 'layer') == ['new']
+
+
+def test_unpack_tee(tmp_path):
+    store = BlobStore(tmp_path / 'store')
+    layers = extract.LayerDirs(tmp_path / 'layers')
+    img = image.from_str('registry.fedoraproject.org/fedora:39')
+    blob = _layer([('hello', tarfile.REGTYPE, b'world', 0o644)])
+    layer = Descriptor('sha256', hashlib.sha256(blob).hexdigest())
+    url = f'https://registry.fedoraproject.org/v2/fedora/blobs/{layer}'
+
+    # a previous download got cut off
+    with store.writer(layer) as w:
+        w.write(blob[:10])
+
+    with requests_mock.Mocker() as m:
+        m.get(url, status_code=206, content=blob[10:],
+              headers={'content-range': f'bytes 10-{len(blob) - 1}/{len(blob)}'})
+        path = extract.unpack(img, layer, store, layers)
+
+        assert m.call_count == 1
+        assert m.last_request.headers['Range'] == 'bytes=10-'
+
+    assert path == layers.path(layer)
+    assert (path / 'hello').read_bytes() == b'world'
+    assert store.path(layer).read_bytes() == blob
+
+
+def test_unpack_from_store(tmp_path):
+    store = BlobStore(tmp_path / 'store')
+    layers = extract.from_paths({'data_dir': str(tmp_path)})
+    blob = _layer([('hello', tarfile.REGTYPE, b'world', 0o644)])
+    layer = Descriptor('sha256', hashlib.sha256(blob).hexdigest())
+
+    with store.writer(layer) as w:
+        w.write(blob)
+        w.commit()
+
+    with requests_mock.Mocker() as m:
+        path = extract.unpack(image.from_str('registry.fedoraproject.org/fedora:39'), layer, store, layers)
+
+        assert m.call_count == 0
+
+    assert path == tmp_path / 'layers' / 'sha256' / layer.digest
+    assert (path / 'hello').read_bytes() == b'world'
+
+
+def test_unpack_digest_err(tmp_path):
+    store = BlobStore(tmp_path / 'store')
+    layers = extract.LayerDirs(tmp_path / 'layers')
+    blob = _layer([('hello', tarfile.REGTYPE, b'world', 0o644)])
+    layer = Descriptor('sha256', '0' * 64)
+
+    with requests_mock.Mocker() as m, pytest.raises(errors.PBDigestError):
+        m.get(f'https://registry.fedoraproject.org/v2/fedora/blobs/{layer}', content=blob)
+        extract.unpack(image.from_str('registry.fedoraproject.org/fedora:39'), layer, store, layers)
+
+    assert not layers.exists(layer)
+    assert os.listdir(tmp_path / 'layers' / 'sha256') == []
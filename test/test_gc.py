@@ -0,0 +1,119 @@
+import json
+import time
+import hashlib
+from unittest import mock
+
+import pytest
+
+from pkgbox import errors, gc
+from pkgbox.cache import ManifestCache
+from pkgbox.oci.v1 import Descriptor
+from pkgbox.store import BlobStore
+
+
+def _add(s, data, accessed):
+    desc = Descriptor('sha256', hashlib.sha256(data).hexdigest())
+    with mock.patch('time.time', return_value=accessed), s.writer(desc) as w:
+        w.write(data)
+        w.commit()
+    return desc
+
+
+def _manifest(c, name, layers):
+    data = json.dumps({'name': name, 'tag': '1', 'architecture': 'amd64',
+                       'fsLayers': [{'blobSum': str(l)} for l in layers]}).encode()
+    digest = Descriptor('sha256', hashlib.sha256(data).hexdigest())
+    c.put(digest, data)
+    return digest
+
+
+@pytest.mark.parametrize('value,expected', [
+    ('1024', 1024),
+    ('512M', 512 * 1024 ** 2),
+    ('1.5gib', int(1.5 * 1024 ** 3)),
+    ('10 KB', 10 * 1024),
+])
+def test_parse_size(value, expected):
+    assert gc.parse_size(value) == expected
+
+
+def test_parse_size_err():
+    with pytest.raises(errors.PBError):
+        gc.parse_size('lots')
+
+
+def test_collect_lru(tmp_path):
+    s = BlobStore(tmp_path / 'store')
+    now = int(time.time())
+    old, mid, new = (_add(s, d * 10, now - 100 + i) for i, d in enumerate((b'a', b'b', b'c')))
+
+    result = gc.collect(s, quota=20, dry_run=True)
+
+    assert (result.removed, result.freed, result.usage) == (1, 10, 20)
+    assert s.exists(old)
+
+    result = gc.collect(BlobStore(tmp_path / 'store'), quota=20)
+
+    assert (result.removed, result.freed, result.usage) == (1, 10, 20)
+    assert not s.exists(old) and not s.path(old).exists()
+    assert s.exists(mid) and s.exists(new)
+
+
+def test_collect_referenced(tmp_path):
+    s = BlobStore(tmp_path / 'store')
+    c = ManifestCache(tmp_path / 'manifests')
+    pinned, recent, unused = (_add(s, d * 10, 0) for d in (b'a', b'b', b'c'))
+    c.pin('registry.fedoraproject.org/pinned:1', _manifest(c, 'pinned', [pinned]))
+    _manifest(c, 'recent', [recent])
+
+    # the pinned manifest is not recent, its layers are kept anyway
+    result = gc.collect(s, c, recent=0)
+
+    assert (result.removed, result.referenced) == (2, 1)
+    assert s.exists(pinned)
+
+    _add(s, b'b' * 10, 0)
+    result = gc.collect(s, c)
+
+    assert (result.removed, result.referenced) == (0, 2)
+
+
+def test_collect_busy(tmp_path):
+    s = BlobStore(tmp_path / 'store')
+    desc = _add(s, b'a', 0)
+
+    with s.lock(desc):
+        result = gc.collect(s)
+
+    assert (result.removed, result.busy) == (0, 1)
+    assert s.exists(desc)
+
+
+def test_collect_partials(tmp_path):
+    s = BlobStore(tmp_path / 'store')
+    stale = Descriptor('sha256', hashlib.sha256(b'stale').hexdigest())
+    busy = Descriptor('sha256', hashlib.sha256(b'busy').hexdigest())
+    with s.writer(stale) as w:
+        w.write(b'x' * 10)
+        w.checkpoint()
+    with s.writer(busy) as w:
+        w.write(b'y' * 20)
+    writer = s.new_writer()
+    writer.write(b'z' * 30)
+    writer._file.flush()
+    # a layer writer killed before committing
+    (s.partial_dir / 'new-1-dead').write_bytes(b'w' * 40)
+
+    result = gc.collect(s, quota=1000)
+    # with the offset checkpoints of downloads
+    assert (result.partials, result.usage) == (0, 104)
+
+    with s.lock(busy):
+        result = gc.collect(s, quota=1000, partial_age=0)
+    # the running layer writer and the locked download are kept
+    assert (result.partials, result.busy, result.freed) == (2, 2, 52)
+    assert result.usage == 52
+    assert sorted(s.partials()) == [busy.digest, writer.partial_path.name]
+
+    writer.commit()
+    assert list(s.partials()) == [busy.digest]
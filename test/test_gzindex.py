@@ -0,0 +1,172 @@
+import io
+import os
+import gzip
+import random
+import hashlib
+import tarfile
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from pkgbox import errors, gzindex, zstd
+from pkgbox.oci.v1 import Descriptor, Manifest
+from pkgbox.store import BlobStore
+
+
+def _tar(entries):
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode='w') as tar:
+        for name, kind, data in entries:
+            info = tarfile.TarInfo(name)
+            info.type = kind
+            info.mode = 0o755 if kind == tarfile.DIRTYPE else 0o644
+            if kind == tarfile.REGTYPE:
+                info.size = len(data)
+                tar.addfile(info, io.BytesIO(data))
+                continue
+            if kind in (tarfile.SYMTYPE, tarfile.LNKTYPE):
+                info.linkname = data
+            tar.addfile(info)
+    return buf.getvalue()
+
+
+def _files(count=200):
+    rnd = random.Random(0)
+    return {f'usr/share/{i}': os.urandom(rnd.randint(0, 8000)) + b'pkgbox' * rnd.randint(0, 4000)
+            for i in range(count)}
+
+
+def _put(store, blob):
+    desc = Descriptor('sha256', hashlib.sha256(blob).hexdigest())
+    with store.writer(desc) as w:
+        w.write(blob)
+        w.commit()
+    return desc
+
+
+REG, DIR, SYM, LNK = tarfile.REGTYPE, tarfile.DIRTYPE, tarfile.SYMTYPE, tarfile.LNKTYPE
+
+
+@pytest.mark.parametrize('kind', ['gzip', 'members', 'plain', 'zstd'])
+def test_build_read(tmp_path, kind):
+    files = _files()
+    data = _tar([(name, REG, content) for name, content in files.items()])
+    half = len(data) // 2
+    blob = {
+        'gzip': gzip.compress(data),
+        'members': gzip.compress(data[:half]) + gzip.compress(data[half:]),
+        'plain': data,
+        'zstd': zstd.compress(data),
+    }[kind]
+    path = tmp_path / 'blob'
+    path.write_bytes(blob)
+
+    index = gzindex.build(path, span=64 * 1024)
+    index.save(tmp_path / 'blob.idx')
+    loaded = gzindex.Index.load(tmp_path / 'blob.idx')
+
+    assert len(loaded.points) == len(index.points)
+    assert loaded.compression == {'members': 'gzip', 'plain': ''}.get(kind, kind)
+    assert (len(index.points) > 10) == (kind in ('gzip', 'members'))
+    assert [m.name for m in loaded.members] == list(files)
+    for member in loaded.members:
+        assert b''.join(loaded.read(path, member)) == files[member.name]
+
+
+def test_read_without_libz(tmp_path, monkeypatch):
+    files = _files(20)
+    path = tmp_path / 'blob'
+    path.write_bytes(gzip.compress(_tar([(name, REG, content) for name, content in files.items()])))
+    monkeypatch.setattr(gzindex, '_libz', lambda: None)
+
+    index = gzindex.build(path)
+
+    assert index.points == []
+    assert b''.join(index.read(path, index.find('usr/share/7'))) == files['usr/share/7']
+
+
+def test_save_concurrent(tmp_path):
+    path = tmp_path / 'blob'
+    path.write_bytes(gzip.compress(_tar([(name, REG, content) for name, content in _files(20).items()])))
+    index = gzindex.build(path)
+
+    with ThreadPoolExecutor(8) as pool:
+        list(pool.map(lambda _: index.save(tmp_path / 'blob.idx'), range(64)))
+
+    assert [m.name for m in gzindex.Index.load(tmp_path / 'blob.idx').members] == [m.name for m in index.members]
+    assert sorted(os.listdir(tmp_path)) == ['blob', 'blob.idx']
+
+
+def test_load_invalid(tmp_path):
+    (tmp_path / 'idx').write_bytes(b'not an index')
+
+    assert gzindex.Index.load(tmp_path / 'idx') is None
+    assert gzindex.Index.load(tmp_path / 'missing') is None
+
+
+def test_get_cached(tmp_path, monkeypatch):
+    store = BlobStore(tmp_path)
+    desc = _put(store, gzip.compress(_tar([('a', REG, b'a')])))
+
+    gzindex.get(store, desc)
+    assert gzindex.index_path(store, desc).exists()
+
+    monkeypatch.setattr(gzindex, 'build', None)
+    assert [m.name for m in gzindex.get(store, desc).members] == ['a']
+
+    store.remove(desc)
+    assert not gzindex.index_path(store, desc).exists()
+
+
+def test_files(tmp_path):
+    store = BlobStore(tmp_path)
+    layers = [
+        _put(store, gzip.compress(_tar([
+            ('etc', DIR, None),
+            ('etc/os-release', REG, b'fedora 38'),
+            ('etc/hosts', REG, b'localhost'),
+            ('usr/lib/libc', REG, b'libc'),
+            ('lib', SYM, 'usr/lib'),
+        ]))),
+        _put(store, gzip.compress(_tar([
+            ('etc/os-release', REG, b'fedora 39'),
+            ('etc/.wh.hosts', REG, b''),
+            ('etc/issue', LNK, 'etc/os-release'),
+            ('etc/release', SYM, '/etc/os-release'),
+        ]))),
+    ]
+    files = gzindex.Files(Manifest('t', 'l', 'amd64', layers, [], [], layers[-1]), store)
+
+    assert [name for name, _ in files.list()] == [
+        'etc', 'etc/issue', 'etc/os-release', 'etc/release', 'lib', 'usr', 'usr/lib', 'usr/lib/libc',
+    ]
+    assert [name for name, _ in files.list('lib')] == ['lib/libc']
+    assert b''.join(files.read('/etc/os-release')) == b'fedora 39'
+    assert b''.join(files.read('etc/release')) == b'fedora 39'
+    assert b''.join(files.read('etc/issue')) == b'fedora 39'
+    assert b''.join(files.read('lib/libc')) == b'libc'
+
+    with pytest.raises(errors.PBError) as e:
+        files.read('etc/hosts')
+    assert e.value.message == '"etc/hosts" not found'
+
+    with pytest.raises(errors.PBError) as e:
+        files.read('etc')
+    assert e.value.message == '"etc" is a directory'
+
+
+def test_files_hardlink_before(tmp_path):
+    store = BlobStore(tmp_path)
+    layers = [_put(store, gzip.compress(_tar([
+        ('etc/os-release', REG, b'fedora 38'),
+        ('etc/issue', LNK, 'etc/os-release'),
+        ('etc/os-release', REG, b'fedora 39'),
+    ])))]
+    files = gzindex.Files(Manifest('t', 'l', 'amd64', layers, [], [], layers[-1]), store)
+
+    assert b''.join(files.read('etc/os-release')) == b'fedora 39'
+    assert b''.join(files.read('etc/issue')) == b'fedora 38'
+
+    link = files.indexes[0].members[1]
+    assert files.indexes[0].find('etc/os-release', link) is files.indexes[0].members[0]
+    assert files.indexes[0].find('etc/issue', files.indexes[0].members[0]) is None
@@ -1,9 +1,21 @@
 import os
+import json
+import errno
+import time
+import hashlib
 import pathlib
+import threading
+from unittest import mock
 
+import pytest
+import requests
 import requests_mock
 
-from pkgbox import image
+from pkgbox import errors, image
+from pkgbox.cache import ManifestCache
+from pkgbox.oci import v1
+from pkgbox.oci.v1 import Descriptor, Manifest
+from pkgbox.store import BlobStore
 
 
 def test_from_str():
@@ -17,13 +29,24 @@ def test_from_str():
     assert img == image.Image('registry.fedoraproject.org', 'fedora', '39')
 
 
+def test_from_str_digest():
+    name = 'registry.fedoraproject.org/fedora@sha256:' + '0' * 64
+    img = image.from_str(name)
+
+    assert img.namespace == 'fedora'
+    assert img.tag == 'sha256:' + '0' * 64
+    assert img.is_digest
+    assert str(img) == name
+    assert not image.from_str('registry.fedoraproject.org/fedora:39').is_digest
+
+
 def test_info(manifest_json):
     name = 'registry.fedoraproject.org/fedora:39'
     img = image.from_str(name)
 
     with requests_mock.Mocker() as m:
         m.get('https://registry.fedoraproject.org/v2/fedora/manifests/39', 
-              headers={'docker-content-digest': 'sha256:718a00fe32127ad01ddab9fc4b7c968ab2679c92c6385ac6865ae6e2523275e4'},
+              headers={'docker-content-digest': 'sha256:12dbd6cccc3db9afda7916ca4c3cb6339e9cf3e040f4e4eaa51ff66c43798c45'},
               text=manifest_json)
         info = image.info(img)
 
@@ -37,20 +60,358 @@ def test_info(manifest_json):
 
 
 def test_fetch(manifest_json, tmp_path):
-    dest = tmp_path / 'pkgbox-test'
-    dest.mkdir()
+    store = BlobStore(tmp_path / 'pkgbox-test')
     name = 'registry.fedoraproject.org/fedora:39'
     img = image.from_str(name) 
+    blob = b'layer'
+    digest = 'sha256:' + hashlib.sha256(blob).hexdigest()
 
     with requests_mock.Mocker() as m:
+        # the edited manifest is not the signed one anymore
         m.get('https://registry.fedoraproject.org/v2/fedora/manifests/39', 
-              headers={'docker-content-digest': 'sha256:718a00fe32127ad01ddab9fc4b7c968ab2679c92c6385ac6865ae6e2523275e4'},
-              text=manifest_json)
-        m.get('https://registry.fedoraproject.org/v2/fedora/blobs/sha256:718a00fe32127ad01ddab9fc4b7c968ab2679c92c6385ac6865ae6e2523275e4', 
-              text='')
+              text=manifest_json.replace('sha256:718a00fe32127ad01ddab9fc4b7c968ab2679c92c6385ac6865ae6e2523275e4', digest))
+        m.get(f'https://registry.fedoraproject.org/v2/fedora/blobs/{digest}', 
+              content=blob)
         # calls
         info = image.info(img)
-        image.fetch(img, info, dest)
+        image.fetch(img, info, store)
 
     for layer in info.layers:
-        assert os.path.exists(f'{dest}/{layer.digest}.tar.gz')
+        assert image.layer_exists(layer, store)
+        assert store.path(layer).read_bytes() == blob
+
+
+def test_fetch_concurrent(tmp_path):
+    store = BlobStore(tmp_path / 'pkgbox-test')
+    img = image.from_str('registry.fedoraproject.org/fedora:39')
+    blobs = [f'layer-{i}'.encode() for i in range(4)]
+    layers = [Descriptor('sha256', hashlib.sha256(b).hexdigest()) for b in blobs]
+    manifest = Manifest('fedora', '39', 'amd64', layers + layers[:1], [], [], layers[0])
+    baseurl = 'https://registry.fedoraproject.org/v2/fedora/blobs'
+    seen = {}
+
+    with store.writer(layers[0]) as w:
+        w.write(blobs[0])
+        w.commit()
+
+    with requests_mock.Mocker() as m:
+        for layer, blob in zip(layers[1:], blobs[1:]):
+            m.get(f'{baseurl}/{layer}', content=blob)
+        image.fetch(img, manifest, store, workers=3,
+                    progress=lambda layer, done, total: seen.update({layer.digest: done}))
+
+        assert m.call_count == 3
+
+    for layer, blob in zip(layers, blobs):
+        assert store.path(layer).read_bytes() == blob
+    for layer, blob in zip(layers[1:], blobs[1:]):
+        assert seen[layer.digest] == len(blob)
+
+
+def test_fetch_digest_err(tmp_path):
+    store = BlobStore(tmp_path / 'pkgbox-test')
+    img = image.from_str('registry.fedoraproject.org/fedora:39')
+    layer = Descriptor('sha256', hashlib.sha256(b'layer').hexdigest())
+    manifest = Manifest('fedora', '39', 'amd64', [layer], [], [], layer)
+
+    with requests_mock.Mocker() as m, pytest.raises(errors.PBDigestError):
+        m.get(f'https://registry.fedoraproject.org/v2/fedora/blobs/{layer}', content=b'truncated')
+        image.fetch(img, manifest, store)
+
+    assert not image.layer_exists(layer, store)
+    assert not store.path(layer).exists()
+
+
+def test_fetch_http_err(tmp_path):
+    img = image.from_str('registry.fedoraproject.org/fedora:39')
+    layer = Descriptor('sha256', '0' * 64)
+    manifest = Manifest('fedora', '39', 'amd64', [layer], [], [], layer)
+
+    with requests_mock.Mocker() as m, pytest.raises(errors.PBError) as e:
+        m.get(f'https://registry.fedoraproject.org/v2/fedora/blobs/{layer}', status_code=404)
+        image.fetch(img, manifest, BlobStore(tmp_path))
+
+    assert e.value.errno == 404
+
+
+@pytest.mark.parametrize('total,expected', [
+    (None, image.MIN_CHUNK_SIZE),
+    (1024, image.MIN_CHUNK_SIZE),
+    (64 * 1024 * 1024, 1024 * 1024),
+    (1024 * 1024 * 1024, image.MAX_CHUNK_SIZE),
+])
+def test_chunk_size(total, expected):
+    assert image.chunk_size(total) == expected
+
+
+def test_baseurl_insecure():
+    img = image.from_str('127.0.0.1:5000/fedora:39')
+
+    with mock.patch.dict(os.environ, {'PKGBOX_INSECURE_REGISTRIES': '127.0.0.1:5000'}):
+        assert image.baseurl(img) == 'http://127.0.0.1:5000/v2/fedora'
+
+    assert image.baseurl(img) == 'https://127.0.0.1:5000/v2/fedora'
+
+
+def test_fetch_retry_resume(tmp_path):
+    store = BlobStore(tmp_path / 'pkgbox-test')
+    img = image.from_str('registry.fedoraproject.org/fedora:39')
+    blob = b'0123456789'
+    layer = Descriptor('sha256', hashlib.sha256(blob).hexdigest())
+    manifest = Manifest('fedora', '39', 'amd64', [layer], [], [], layer)
+    url = f'https://registry.fedoraproject.org/v2/fedora/blobs/{layer}'
+
+    # a previous download got cut off after 4 bytes
+    with store.writer(layer) as w:
+        w.write(blob[:4])
+
+    with requests_mock.Mocker() as m:
+        m.get(url, [
+            {'exc': requests.exceptions.ConnectionError},
+            {'status_code': 503},
+            {'status_code': 206, 'content': blob[4:],
+             'headers': {'content-range': f'bytes 4-9/{len(blob)}'}},
+        ])
+        image.fetch(img, manifest, store, retry=image.RetryPolicy(backoff=0))
+
+        assert m.call_count == 3
+        assert m.last_request.headers['Range'] == 'bytes=4-'
+
+    assert store.path(layer).read_bytes() == blob
+
+
+def test_fetch_range_ignored(tmp_path):
+    store = BlobStore(tmp_path / 'pkgbox-test')
+    img = image.from_str('registry.fedoraproject.org/fedora:39')
+    blob = b'0123456789'
+    layer = Descriptor('sha256', hashlib.sha256(blob).hexdigest())
+    manifest = Manifest('fedora', '39', 'amd64', [layer], [], [], layer)
+
+    with store.writer(layer) as w:
+        w.write(blob[:4])
+
+    with requests_mock.Mocker() as m:
+        m.get(f'https://registry.fedoraproject.org/v2/fedora/blobs/{layer}', content=blob)
+        image.fetch(img, manifest, store)
+
+    assert store.path(layer).read_bytes() == blob
+
+
+def test_fetch_retry_exhausted(tmp_path):
+    store = BlobStore(tmp_path / 'pkgbox-test')
+    img = image.from_str('registry.fedoraproject.org/fedora:39')
+    layer = Descriptor('sha256', '0' * 64)
+    manifest = Manifest('fedora', '39', 'amd64', [layer], [], [], layer)
+
+    with requests_mock.Mocker() as m, pytest.raises(errors.PBError) as e:
+        m.get(f'https://registry.fedoraproject.org/v2/fedora/blobs/{layer}', status_code=502)
+        image.fetch(img, manifest, store, retry=image.RetryPolicy(attempts=2, backoff=0))
+
+    assert e.value.errno == 502
+    assert m.call_count == 2
+
+
+def test_retry_policy_delay():
+    policy = image.RetryPolicy(backoff=1, factor=2, max_backoff=5)
+
+    assert [policy.delay(i) for i in range(4)] == [1, 2, 4, 5]
+
+
+def test_info_cache(manifest_json, tmp_path):
+    c = ManifestCache(tmp_path, ttl=0)
+    img = image.from_str('registry.fedoraproject.org/fedora:39')
+    url = 'https://registry.fedoraproject.org/v2/fedora/manifests/39'
+    digest = 'sha256:12dbd6cccc3db9afda7916ca4c3cb6339e9cf3e040f4e4eaa51ff66c43798c45'
+
+    with requests_mock.Mocker() as m:
+        m.get(url, headers={'docker-content-digest': digest}, text=manifest_json)
+        first = image.info(img, c)
+
+        assert 'If-None-Match' not in m.last_request.headers
+
+        m.get(url, status_code=304)
+        second = image.info(img, c)
+
+        assert m.call_count == 2
+        assert m.last_request.headers['If-None-Match'] == f'"{digest}"'
+
+    assert first == second
+    assert str(second.digest) == digest
+
+
+def test_info_cache_fresh(manifest_json, tmp_path):
+    c = ManifestCache(tmp_path, ttl=60)
+    img = image.from_str('registry.fedoraproject.org/fedora:39')
+    digest = 'sha256:12dbd6cccc3db9afda7916ca4c3cb6339e9cf3e040f4e4eaa51ff66c43798c45'
+
+    with requests_mock.Mocker() as m:
+        m.get('https://registry.fedoraproject.org/v2/fedora/manifests/39',
+              headers={'docker-content-digest': digest}, text=manifest_json)
+        image.info(img, c)
+        info = image.info(img, c)
+
+        assert m.call_count == 1
+
+    assert info.tag == '39'
+
+
+def test_info_cache_digest_immutable(manifest_json, tmp_path):
+    c = ManifestCache(tmp_path, ttl=0)
+    digest = 'sha256:12dbd6cccc3db9afda7916ca4c3cb6339e9cf3e040f4e4eaa51ff66c43798c45'
+    img = image.from_str(f'registry.fedoraproject.org/fedora@{digest}')
+
+    with requests_mock.Mocker() as m:
+        m.get(f'https://registry.fedoraproject.org/v2/fedora/manifests/{digest}',
+              headers={'docker-content-digest': digest}, text=manifest_json)
+        image.info(img, c)
+        info = image.info(img, c)
+
+        assert m.call_count == 1
+
+    assert str(info.digest) == digest
+
+
+def test_info_digest_mismatch(manifest_json, tmp_path):
+    c = ManifestCache(tmp_path, ttl=0)
+    url = 'https://registry.fedoraproject.org/v2/fedora/manifests'
+    digest = 'sha256:12dbd6cccc3db9afda7916ca4c3cb6339e9cf3e040f4e4eaa51ff66c43798c45'
+    truncated = manifest_json[:-10]
+
+    with requests_mock.Mocker() as m:
+        m.get(f'{url}/39', headers={'docker-content-digest': digest}, text=truncated)
+        with pytest.raises(errors.PBError) as e:
+            image.info(image.from_str('registry.fedoraproject.org/fedora:39'), c)
+        assert e.value.errno == errno.EIO
+
+        # the registry header does not matter for digest references
+        other = 'sha256:' + '0' * 64
+        m.get(f'{url}/{other}', headers={'docker-content-digest': other}, text=manifest_json)
+        with pytest.raises(errors.PBError):
+            image.info(image.from_str(f'registry.fedoraproject.org/fedora@{other}'), c)
+        m.get(f'{url}/{digest}', headers={'docker-content-digest': other}, text=manifest_json)
+        assert str(image.info(image.from_str(f'registry.fedoraproject.org/fedora@{digest}'), c).digest) == digest
+
+    assert c.ref('registry.fedoraproject.org/fedora:39') is None
+    assert c.get(Descriptor.from_str(other)) is None
+
+
+def test_fetch_single_flight(tmp_path):
+    img = image.from_str('registry.fedoraproject.org/fedora:39')
+    blob = b'layer' * 1024
+    layer = Descriptor('sha256', hashlib.sha256(blob).hexdigest())
+    manifest = Manifest('fedora', '39', 'amd64', [layer], [], [], layer)
+
+    def slow(request, context):
+        time.sleep(0.1)
+        return blob
+
+    with requests_mock.Mocker() as m:
+        m.get(f'https://registry.fedoraproject.org/v2/fedora/blobs/{layer}', content=slow)
+        # separate store instances, as separate processes would use
+        threads = [threading.Thread(target=image.fetch, args=(img, manifest, BlobStore(tmp_path)))
+                   for _ in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        assert m.call_count == 1
+
+    assert BlobStore(tmp_path).path(layer).read_bytes() == blob
+
+
+def _oci(m, layers, config=b'{"architecture": "arm64", "os": "linux", "config": {"Cmd": ["/bin/sh"]}}'):
+    """
+    Register an OCI manifest and its config blob, returning the
+    manifest body and digest.
+    """
+    config_digest = 'sha256:' + hashlib.sha256(config).hexdigest()
+    m.get(f'https://registry.fedoraproject.org/v2/fedora/blobs/{config_digest}', content=config)
+    body = json.dumps({
+        'schemaVersion': 2,
+        'mediaType': v1.OCI_MANIFEST,
+        'config': {'mediaType': v1.OCI_CONFIG, 'size': len(config), 'digest': config_digest},
+        'layers': [{'mediaType': v1.OCI_LAYER_ZSTD, 'size': 10, 'digest': l} for l in layers],
+    }).encode()
+    return body, 'sha256:' + hashlib.sha256(body).hexdigest()
+
+
+def test_info_schema2(tmp_path):
+    img = image.from_str('registry.fedoraproject.org/fedora:39')
+    layers = ['sha256:' + '1' * 64, 'sha256:' + '2' * 64]
+
+    with requests_mock.Mocker() as m:
+        body, digest = _oci(m, layers)
+        # no digest header: the body digest is used
+        m.get('https://registry.fedoraproject.org/v2/fedora/manifests/39', content=body)
+        info = image.info(img)
+        config = image.config(img, info, ManifestCache(tmp_path))
+        cached = image.config(img, info, ManifestCache(tmp_path))
+
+        assert v1.OCI_MANIFEST in m.request_history[0].headers['Accept']
+        assert v1.OCI_INDEX in m.request_history[0].headers['Accept']
+        assert m.call_count == 2
+
+    assert info.schema_version == 2
+    assert (info.name, info.tag) == ('fedora', '39')
+    assert [str(l) for l in info.layers] == layers
+    assert info.layers[0].media_type == v1.OCI_LAYER_ZSTD
+    assert str(info.digest) == digest
+    assert config == cached
+    assert (config.os, config.architecture, config.cmd) == ('linux', 'arm64', ['/bin/sh'])
+
+
+def test_info_index(tmp_path):
+    img = image.from_str('registry.fedoraproject.org/fedora:39')
+
+    with requests_mock.Mocker() as m:
+        manifests = []
+        for arch, variant in [('amd64', None), ('arm64', 'v8'), ('arm', 'v7')]:
+            body, digest = _oci(m, ['sha256:' + hashlib.sha256(arch.encode()).hexdigest()])
+            m.get(f'https://registry.fedoraproject.org/v2/fedora/manifests/{digest}', content=body)
+            platform = {'os': 'linux', 'architecture': arch}
+            if variant:
+                platform['variant'] = variant
+            manifests.append({'mediaType': v1.OCI_MANIFEST, 'size': len(body), 'digest': digest,
+                              'platform': platform})
+        index = json.dumps({'schemaVersion': 2, 'mediaType': v1.OCI_INDEX, 'manifests': manifests})
+        m.get('https://registry.fedoraproject.org/v2/fedora/manifests/39', text=index,
+              headers={'docker-content-digest': 'sha256:' + hashlib.sha256(index.encode()).hexdigest()})
+
+        c = ManifestCache(tmp_path, ttl=60)
+        arm = image.info(img, c, v1.Platform.from_str('linux/arm/v7'))
+        with mock.patch.dict(os.environ, {'PKGBOX_PLATFORM': 'linux/arm64'}):
+            arm64 = image.info(img, c)
+        calls = m.call_count
+
+        with pytest.raises(errors.PBError) as e:
+            image.info(img, c, v1.Platform('linux', 's390x'))
+
+    assert calls == 3
+    assert arm.architecture == 'arm'
+    assert str(arm.digest) == manifests[2]['digest']
+    assert arm64.architecture == 'arm64'
+    assert str(arm64.digest) == manifests[1]['digest']
+    assert e.value.message == ('No manifest for platform linux/s390x '
+                               '(available: linux/amd64, linux/arm64/v8, linux/arm/v7)')
+
+
+def test_schema1_config_and_order(manifest_json):
+    data = json.loads(manifest_json)
+    data['fsLayers'] = [{'blobSum': 'sha256:' + 'f' * 64}] + data['fsLayers']
+    info = image.parse_manifest(json.dumps(data).encode(), Descriptor('sha256', '0' * 64))
+    config = image.config(image.from_str('registry.fedoraproject.org/fedora:39'), info)
+
+    # schema1 manifests list the top layer first
+    assert str(info.layers[-1]) == 'sha256:' + 'f' * 64
+    assert config.cmd == ['/bin/bash']
+    assert config.labels['name'] == 'fedora'
+
+
+def test_default_platform():
+    with mock.patch.dict(os.environ, {'PKGBOX_PLATFORM': ''}), \
+            mock.patch('os.uname', return_value=mock.Mock(machine='aarch64')):
+        assert image.default_platform() == v1.Platform('linux', 'arm64', 'v8')
+
+    with mock.patch.dict(os.environ, {'PKGBOX_PLATFORM': 'linux/riscv64'}):
+        assert str(image.default_platform()) == 'linux/riscv64'
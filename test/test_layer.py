@@ -0,0 +1,101 @@
+import io
+import os
+import hashlib
+import tarfile
+
+import pytest
+
+from pkgbox import errors, extract, layer
+from pkgbox.diff import ADDED, DELETED, MODIFIED, Change
+from pkgbox.oci.v1 import OCI_LAYER, OCI_LAYER_GZIP, OCI_LAYER_ZSTD
+from pkgbox.store import BlobStore
+
+
+def _tree(root):
+    os.makedirs(root / 'etc')
+    os.makedirs(root / 'usr' / 'lib')
+    (root / 'etc' / 'hosts').write_text('127.0.0.1 localhost\n')
+    # several chunks, compressed by several workers
+    (root / 'usr' / 'lib' / 'big.so').write_bytes(os.urandom(1024 * 1024) * 3 + b'end')
+    os.link(root / 'usr' / 'lib' / 'big.so', root / 'usr' / 'lib' / 'big.so.1')
+    os.symlink('lib', root / 'usr' / 'lib64')
+    os.chmod(root / 'etc' / 'hosts', 0o600)
+
+
+def _tar(s, lay):
+    with extract.open_blob(s.path(lay.descriptor)) as f:
+        data = f.read()
+    assert hashlib.sha256(data).hexdigest() == lay.diff_id.digest
+    assert len(data) == lay.tar_size
+    return tarfile.open(fileobj=io.BytesIO(data))
+
+
+@pytest.mark.parametrize('compression, media_type', [
+    ('gzip', OCI_LAYER_GZIP), ('zstd', OCI_LAYER_ZSTD), ('', OCI_LAYER),
+])
+def test_write(tmp_path, compression, media_type):
+    _tree(tmp_path / 'root')
+    s = BlobStore(tmp_path / 'store')
+
+    lay = layer.write(s, tmp_path / 'root', layer.changes(tmp_path / 'root'), compression)
+    assert lay.descriptor.media_type == media_type
+    assert s.size(lay.descriptor) == lay.descriptor.size
+    assert lay.entries == 7
+
+    tar = _tar(s, lay)
+    members = {m.name: m for m in tar}
+    assert list(members) == ['etc', 'etc/hosts', 'usr', 'usr/lib', 'usr/lib/big.so', 'usr/lib/big.so.1', 'usr/lib64']
+    assert all(m.mtime == 0 and m.uid == 0 and m.uname == '' for m in members.values())
+    assert members['etc/hosts'].mode == 0o600
+    assert members['usr/lib/big.so.1'].islnk() and members['usr/lib/big.so.1'].linkname == 'usr/lib/big.so'
+    assert members['usr/lib64'].linkname == 'lib'
+    assert tar.extractfile('usr/lib/big.so').read()[-3:] == b'end'
+
+
+@pytest.mark.parametrize('compression', ['gzip', 'zstd'])
+def test_reproducible(tmp_path, compression):
+    _tree(tmp_path / 'root')
+    s = BlobStore(tmp_path / 'store')
+
+    layers = [layer.write(s, tmp_path / 'root', layer.changes(tmp_path / 'root'), compression, workers=workers)
+              for workers in (1, 2, 4)]
+    # touching files does not change the layer
+    os.utime(tmp_path / 'root' / 'etc' / 'hosts', (1, 1))
+    layers.append(layer.write(s, tmp_path / 'root', layer.changes(tmp_path / 'root'), compression))
+
+    assert len({lay.descriptor.digest for lay in layers}) == 1
+    assert len({lay.diff_id.digest for lay in layers}) == 1
+
+
+def test_changes(tmp_path):
+    root = tmp_path / 'root'
+    _tree(root)
+    s = BlobStore(tmp_path / 'store')
+    changes = [
+        Change(ADDED, 'etc/resolv.conf'),
+        Change(DELETED, 'etc/shadow'),
+        Change(MODIFIED, 'usr/lib/big.so.1'),
+        Change(DELETED, 'var'),
+    ]
+    (root / 'etc' / 'resolv.conf').write_text('nameserver 127.0.0.1\n')
+
+    lay = layer.write(s, root, changes, owner=None)
+    members = list(_tar(s, lay))
+    # with the parent directories of the changes
+    assert [m.name for m in members] == [
+        'etc', 'etc/resolv.conf', 'etc/.wh.shadow', 'usr', 'usr/lib', 'usr/lib/big.so.1', '.wh.var',
+    ]
+    assert members[0].uid == os.getuid()
+    # the first link of an inode in the layer holds its content
+    assert members[5].isfile() and members[5].size == 3 * 1024 * 1024 + 3
+
+
+def test_errors(tmp_path):
+    s = BlobStore(tmp_path / 'store')
+    with pytest.raises(errors.PBError) as e:
+        layer.write(s, tmp_path, [], 'bzip2')
+    assert 'Unknown layer compression' in e.value.message
+
+    with pytest.raises(errors.PBError):
+        layer.write(s, tmp_path, [Change(ADDED, 'missing')])
+    assert os.listdir(s.partial_dir) == []
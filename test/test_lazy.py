@@ -0,0 +1,220 @@
+import io
+import os
+import re
+import gzip
+import json
+import struct
+import hashlib
+import tarfile
+
+import pytest
+import requests_mock
+
+from pkgbox import errors, gzindex, image, lazy
+from pkgbox.oci.v1 import Descriptor, Manifest
+from pkgbox.store import BlobStore
+
+
+IMAGE = image.Image('registry.fedoraproject.org', 'fedora', '39')
+FILES = {f'usr/share/{i}': bytes([i]) * (i * 3000) for i in range(1, 40)}
+FILES['etc/os-release'] = b'fedora 39'
+
+
+def _tar(files):
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode='w') as tar:
+        for name, data in files.items():
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+    return buf.getvalue()
+
+
+def _estargz(files):
+    """
+    Build an eStargz blob: every file content starts a gzip member and
+    the table of contents and footer come last.
+    """
+    out = bytearray()
+    pending = bytearray()
+    entries = []
+    for name, data in files.items():
+        info = tarfile.TarInfo(name)
+        info.size = len(data)
+        pending += info.tobuf(tarfile.GNU_FORMAT)
+        entry = {'name': name, 'type': 'reg', 'size': len(data), 'mode': 0o644}
+        if data:
+            out += gzip.compress(bytes(pending))
+            pending = bytearray()
+            entry['offset'] = len(out)
+        pending += data + bytes(-len(data) % tarfile.BLOCKSIZE)
+        entries.append(entry)
+    out += gzip.compress(bytes(pending))
+
+    toc_offset = len(out)
+    out += gzip.compress(_tar({lazy.TOC_NAME: json.dumps({'version': 1, 'entries': entries}).encode()}))
+    extra = b'SG' + struct.pack('<H', 22) + b'%016xSTARGZ' % toc_offset
+    out += b'\x1f\x8b\x08\x04\0\0\0\0\0\xff' + struct.pack('<H', len(extra)) + extra
+    out += b'\x01\x00\x00\xff\xff' + bytes(8)
+    return bytes(out)
+
+
+class _Registry:
+    """
+    Blob endpoint honoring range requests, recording them.
+    """
+    def __init__(self, m, blob, ranges=True):
+        self.blob = blob
+        self.ranges = []
+        self.full = 0
+        self.digest = Descriptor('sha256', hashlib.sha256(blob).hexdigest())
+        m.get(f'https://registry.fedoraproject.org/v2/fedora/blobs/{self.digest}',
+              content=self._serve if ranges else blob)
+
+    def _serve(self, request, context):
+        m = re.match(r'bytes=(\d+)-(\d+)', request.headers.get('Range', ''))
+        if not m:
+            self.full += 1
+            return self.blob
+        start, end = int(m.group(1)), min(int(m.group(2)) + 1, len(self.blob))
+        self.ranges.append((start, end))
+        context.status_code = 206
+        context.headers['content-range'] = f'bytes {start}-{end - 1}/{len(self.blob)}'
+        return self.blob[start:end]
+
+
+def _manifest(*layers):
+    return Manifest('fedora', '39', 'amd64', list(layers), [], [], Descriptor('sha256', '0' * 64))
+
+
+def test_estargz(tmp_path, monkeypatch):
+    monkeypatch.setattr(lazy, 'BLOCK_SIZE', 4096)
+    store = BlobStore(tmp_path)
+
+    with requests_mock.Mocker() as m:
+        registry = _Registry(m, _estargz(FILES))
+        files = lazy.fetch(IMAGE, _manifest(registry.digest), store)
+        toc_requests = len(registry.ranges)
+
+        assert b''.join(files.read('etc/os-release')) == b'fedora 39'
+        assert b''.join(files.read('usr/share/30')) == FILES['usr/share/30']
+
+    assert registry.full == 0
+    assert toc_requests <= 3
+    assert sum(end - start for start, end in registry.ranges) < len(registry.blob) / 2
+    assert [name for name, _ in files.list('etc')] == ['etc/os-release']
+    # unverified, so never used as the index of the stored blob
+    assert gzindex.toc_index_path(store, registry.digest).exists()
+    assert not gzindex.index_path(store, registry.digest).exists()
+    assert not store.exists(registry.digest)
+
+    with store.writer(registry.digest) as w:
+        w.write(registry.blob)
+        w.commit()
+    index = gzindex.get(store, registry.digest)
+    assert gzindex.index_path(store, registry.digest).exists()
+    assert 'etc/os-release' in [m.name for m in index.members]
+
+
+def test_gzip_streamed_index(tmp_path, monkeypatch):
+    monkeypatch.setattr(lazy, 'BLOCK_SIZE', 4096)
+    monkeypatch.setattr(gzindex, 'SPAN', 65536)
+    store = BlobStore(tmp_path)
+
+    with requests_mock.Mocker() as m:
+        files = {f'usr/share/{i}': os.urandom(20000) for i in range(20)}
+        registry = _Registry(m, gzip.compress(_tar(files)))
+        lazy_files = lazy.fetch(IMAGE, _manifest(registry.digest), store)
+        assert registry.full == 1
+        probed = len(registry.ranges)
+
+        # the blob was stored while indexed, so it is read locally
+        assert store.exists(registry.digest)
+        assert lazy_files.remote == {}
+        assert b''.join(lazy_files.read('usr/share/19')) == files['usr/share/19']
+
+        lazy_files = lazy.fetch(IMAGE, _manifest(registry.digest), store)
+        assert b''.join(lazy_files.read('usr/share/3')) == files['usr/share/3']
+
+    assert registry.full == 1
+    assert len(registry.ranges) == probed
+    assert gzindex.Index.load(gzindex.index_path(store, registry.digest)).size == len(registry.blob)
+
+
+def test_stored_layers_read_locally(tmp_path):
+    store = BlobStore(tmp_path)
+    blob = gzip.compress(_tar(FILES))
+    desc = Descriptor('sha256', hashlib.sha256(blob).hexdigest())
+    with store.writer(desc) as w:
+        w.write(blob)
+        w.commit()
+
+    with requests_mock.Mocker():
+        files = lazy.fetch(IMAGE, _manifest(desc), store)
+        assert b''.join(files.read('etc/os-release')) == b'fedora 39'
+
+    assert files.remote == {}
+
+
+def test_digest_mismatch(tmp_path):
+    store = BlobStore(tmp_path)
+    with requests_mock.Mocker() as m:
+        registry = _Registry(m, gzip.compress(_tar(FILES)))
+        registry.blob = gzip.compress(_tar({'evil': b'evil'}))
+
+        with pytest.raises(errors.PBError) as e:
+            lazy.fetch(IMAGE, _manifest(registry.digest), store)
+
+    assert 'Digest mismatch' in e.value.message
+    assert not store.exists(registry.digest)
+    assert store.partials() == {}
+
+
+def test_range_not_supported(tmp_path):
+    with requests_mock.Mocker() as m:
+        registry = _Registry(m, _estargz(FILES), ranges=False)
+
+        with pytest.raises(errors.PBError) as e:
+            lazy.fetch(IMAGE, _manifest(registry.digest), BlobStore(tmp_path))
+
+    assert 'does not support range requests' in e.value.message
+
+
+def test_profile_prefetch(tmp_path, monkeypatch):
+    monkeypatch.setattr(lazy, 'BLOCK_SIZE', 4096)
+    store = BlobStore(tmp_path / 'store')
+    profile = lazy.Profile(tmp_path / 'profile')
+
+    with requests_mock.Mocker() as m:
+        registry = _Registry(m, _estargz(FILES))
+        with lazy.fetch(IMAGE, _manifest(registry.digest), store, profile) as files:
+            b''.join(files.read('usr/share/20'))
+            b''.join(files.read('etc/os-release'))
+            b''.join(files.read('usr/share/20'))
+
+        assert lazy.Profile(tmp_path / 'profile').files == ['usr/share/20', 'etc/os-release']
+
+        with lazy.fetch(IMAGE, _manifest(registry.digest), store, lazy.Profile(tmp_path / 'profile')) as files:
+            files._prefetch.shutdown(wait=True)
+            fetched = len(registry.ranges)
+            assert b''.join(files.read('usr/share/20')) == FILES['usr/share/20']
+            assert b''.join(files.read('etc/os-release')) == b'fedora 39'
+
+    # everything read was prefetched
+    assert len(registry.ranges) == fetched
+
+
+def test_block_cache(monkeypatch):
+    monkeypatch.setattr(lazy, 'BLOCK_SIZE', 1024)
+
+    with requests_mock.Mocker() as m:
+        registry = _Registry(m, os.urandom(10000))
+        blob = lazy.RemoteBlob(IMAGE, registry.digest, cache_size=4096)
+
+        assert blob.read(1000, 2500) == registry.blob[1000:3500]
+        assert blob.read(2000, 100) == registry.blob[2000:2100]
+        assert blob.read(9000, 5000) == registry.blob[9000:]
+
+    # missing blocks are fetched by a single range request
+    assert registry.ranges == [(0, 1), (0, 4096), (8192, 10000)]
+    assert blob._cached <= 4096
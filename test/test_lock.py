@@ -0,0 +1,123 @@
+import os
+import sys
+import json
+import time
+import errno
+import socket
+import threading
+import subprocess
+
+import pytest
+
+from pkgbox import errors
+from pkgbox.lock import FileLock
+
+
+def test_acquire_release(tmp_path):
+    path = tmp_path / 'locks' / 'a.lock'
+
+    with FileLock(path) as lock:
+        assert json.loads(path.read_text())['token'] == lock.token
+
+    assert not path.exists()
+
+
+def test_exclusive(tmp_path):
+    path = tmp_path / 'a.lock'
+    held = []
+    overlaps = []
+
+    def work():
+        with FileLock(path):
+            held.append(1)
+            overlaps.append(len(held))
+            time.sleep(0.01)
+            held.pop()
+
+    threads = [threading.Thread(target=work) for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert overlaps == [1] * 8
+
+
+def test_timeout(tmp_path):
+    path = tmp_path / 'a.lock'
+
+    with FileLock(path), pytest.raises(errors.PBError) as e:
+        FileLock(path, timeout=0.05).acquire()
+
+    assert e.value.errno == errno.ETIMEDOUT
+
+
+def test_stale_dead_process(tmp_path):
+    path = tmp_path / 'a.lock'
+    proc = subprocess.run([sys.executable, '-c', 'import os; print(os.getpid())'],
+                          capture_output=True, text=True)
+    path.write_text(json.dumps({'host': socket.gethostname(), 'pid': int(proc.stdout), 'token': 'dead'}))
+
+    with FileLock(path, timeout=1) as lock:
+        assert json.loads(path.read_text())['token'] == lock.token
+
+
+def test_stale_remote_holder(tmp_path):
+    path = tmp_path / 'a.lock'
+    path.write_text(json.dumps({'host': 'other-host', 'pid': 1, 'token': 'remote'}))
+
+    started = time.monotonic()
+    with FileLock(path, stale=0.1, timeout=2) as lock:
+        assert json.loads(path.read_text())['token'] == lock.token
+
+    assert time.monotonic() - started >= 0.1
+
+
+def test_live_holder_refreshes(tmp_path):
+    path = tmp_path / 'a.lock'
+
+    with FileLock(path, stale=0.1):
+        with pytest.raises(errors.PBError):
+            # the holder heartbeat keeps the lock from going stale
+            FileLock(path, stale=0.1, timeout=0.5).acquire()
+
+
+def test_release_broken(tmp_path):
+    path = tmp_path / 'a.lock'
+    lock = FileLock(path)
+    lock.acquire()
+    os.unlink(path)
+    other = FileLock(path)
+    other.acquire()
+    lock.release()
+
+    assert json.loads(path.read_text())['token'] == other.token
+    other.release()
+
+
+def test_stale_break_guard(tmp_path):
+    path = tmp_path / 'a.lock'
+    path.write_text(json.dumps({'host': 'other-host', 'pid': 1, 'token': 'remote'}))
+    guard = tmp_path / 'a.lock.break'
+    guard.write_text('{}')
+    # a guard from the future, as written by a host whose clock is ahead
+    os.utime(guard, (time.time() + 3600, time.time() + 3600))
+
+    with FileLock(path, stale=0.1, timeout=2) as lock:
+        assert json.loads(path.read_text())['token'] == lock.token
+    assert not guard.exists()
+
+
+def test_heartbeat_stops_when_broken(tmp_path):
+    path = tmp_path / 'a.lock'
+    lock = FileLock(path, stale=0.06)
+    lock.acquire()
+    path.write_text(json.dumps({'host': 'other-host', 'pid': 1, 'token': 'other'}))
+    os.utime(path, (1000, 1000))
+
+    time.sleep(0.1)
+    # the new holder lock is left alone
+    assert os.stat(path).st_mtime == 1000
+    assert not lock._heartbeat.is_alive()
+    lock.release()
+    assert json.loads(path.read_text())['token'] == 'other'
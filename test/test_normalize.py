@@ -0,0 +1,50 @@
+import pytest
+
+from pkgbox import containerfile, normalize, parser
+
+
+def _digests(content: str):
+    return containerfile.digest_instructions(parser.parse(content))
+
+
+@pytest.mark.parametrize('a,b', [
+    ('FROM fedora\nRUN dnf install -y gcc make\n', 'FROM fedora\nRUN dnf install -y \\\n    gcc \\\n    make\n'),
+    ('FROM fedora\nRUN a && b\n', 'FROM fedora\nRUN   a   &&  b   \n'),
+    ('FROM fedora\nCMD ["sh", "-c", "echo"]\n', 'FROM fedora\nCMD [ "sh","-c",  "echo" ]\n'),
+    ('FROM fedora\nLABEL a=1 b="2"\n', 'FROM fedora\nLABEL b=2 \\\n  a="1"\n'),
+    ('FROM fedora\nENV A=1 B=2\n', "FROM fedora\nENV B='2' A=1\n"),
+    ('FROM fedora\nENV A 1\n', 'FROM fedora\nENV A=1\n'),
+    ('FROM fedora\nARG V=1\nRUN make V=$V\n', 'FROM fedora\nARG V=1\nRUN make V=1\n'),
+    ('FROM fedora\nARG V=1\nCOPY a /opt/${V}\n', 'FROM fedora\nARG V=1\nCOPY a /opt/1\n'),
+    ('ARG TAG=39\nFROM fedora:$TAG as build\n', 'FROM fedora:39 AS build\n'),
+])
+def test_cosmetic_edits_same_digest(a, b):
+    assert _digests(a)[-1] == _digests(b)[-1]
+
+
+@pytest.mark.parametrize('a,b', [
+    ('FROM fedora\nRUN echo "a  b"\n', 'FROM fedora\nRUN echo "a b"\n'),
+    ('FROM fedora\nARG V=1\nRUN echo \'$V\'\n', 'FROM fedora\nARG V=1\nRUN echo \'1\'\n'),
+    ('FROM fedora\nARG V\n', 'FROM fedora\nARG V=\n'),
+    ('FROM fedora\nARG V=1\nCMD echo $V\n', 'FROM fedora\nARG V=1\nCMD echo 1\n'),
+    ('FROM fedora\nARG V=1\nENV V=2\nRUN echo $V\n', 'FROM fedora\nARG V=1\nENV V=2\nRUN echo 1\n'),
+    ('FROM fedora\nRUN <<EOF\na  b\nEOF\n', 'FROM fedora\nRUN <<EOF\na b\nEOF\n'),
+])
+def test_semantic_edits_new_digest(a, b):
+    assert _digests(a)[-1] != _digests(b)[-1]
+
+
+def test_substitute():
+    args = {'A': 'a', 'B': 'b'}
+
+    assert normalize.substitute('$A ${B} $C ${A', args) == 'a b $C ${A'
+    assert normalize.substitute('"$A" \'$A\' \\$A $AB', args) == '"a" \'$A\' \\$A $AB'
+
+
+def test_normalize_versioned():
+    inst = parser.parse('RUN make install\n').instructions[0]
+
+    assert normalize.VERSION == 1
+    assert normalize.normalize(inst) == 'RUN make install'
+    assert containerfile.digest_instruction(inst) == \
+        '0c1827d67d08606f1fa7d7fe3899032fe3ea596fc16d23be55db5ba4c72611b2'
@@ -0,0 +1,148 @@
+import dataclasses
+
+import pytest
+
+from pkgbox import errors, parser
+
+
+def test_parse_continuation_ok():
+    cf = parser.parse('FROM fedora\nRUN dnf install -y \\\n  gcc \\\n\n  make\nRUN true\n')
+
+    assert [(i.name, i.value) for i in cf.instructions] == [
+        ('FROM', 'fedora'),
+        ('RUN', 'dnf install -y   gcc   make'),
+        ('RUN', 'true'),
+    ]
+    assert (cf.instructions[1].startline, cf.instructions[1].endline) == (1, 4)
+
+
+def test_parse_comments_ok():
+    cf = parser.parse('FROM fedora\nRUN a \\\n# inner\n  b\n# @org.pkgbox.artifact=true\n')
+
+    assert [(i.name, i.value) for i in cf.instructions] == [
+        ('FROM', 'fedora'),
+        ('COMMENT', 'inner'),
+        ('RUN', 'a   b'),
+        ('COMMENT', '@org.pkgbox.artifact=true'),
+    ]
+
+
+def test_parse_directives_ok():
+    cf = parser.parse('# syntax=docker/dockerfile:1\n# escape=`\nFROM fedora\nRUN a `\n  b\n# escape=\\\n')
+
+    assert dict(cf.directives) == {'syntax': 'docker/dockerfile:1', 'escape': '`'}
+    assert cf.instructions[3].value == 'a   b'
+    assert cf.instructions[-1].name == 'COMMENT'
+
+
+def test_parse_heredoc_ok():
+    content = '\n'.join([
+        'FROM fedora',
+        'RUN <<EOF',
+        '# not a comment',
+        'echo hello',
+        'EOF',
+        'COPY <<-"A" /a <<B /b',
+        '\ta',
+        '\tA',
+        'b',
+        'B',
+        'CMD ["sh"]',
+        ''
+    ])
+    cf = parser.parse(content)
+
+    assert [i.name for i in cf.instructions] == ['FROM', 'RUN', 'COPY', 'CMD']
+    assert cf.instructions[1].heredocs == ('# not a comment\necho hello\n',)
+    assert cf.instructions[1].value == '<<EOF\n# not a comment\necho hello\nEOF'
+    assert cf.instructions[2].heredocs == ('\ta\n', 'b\n')
+    assert (cf.instructions[2].startline, cf.instructions[2].endline) == (5, 9)
+    assert cf.cmd == '["sh"]'
+
+
+def test_parse_stages_ok():
+    content = '\n'.join([
+        'ARG BASE=fedora',
+        'FROM ${BASE}:39 AS build',
+        'LABEL stage=build',
+        'CMD make',
+        'FROM $BASE:40',
+        'ARG BASE',
+        'ARG VERSION=1',
+        'ENV NAME=$BASE-$VERSION PATH="/opt/${BASE}"',
+        'LABEL name="$NAME"',
+        'LABEL single value $NAME',
+        ''
+    ])
+    cf = parser.parse(content, build_args={'VERSION': '2'})
+
+    assert cf.parent_images == ('fedora:39', 'fedora:40')
+    assert cf.baseimage == 'fedora:40'
+    assert cf.args == {'BASE': 'fedora', 'VERSION': '2'}
+    assert cf.envs == {'NAME': 'fedora-2', 'PATH': '/opt/fedora'}
+    assert cf.labels == {'name': 'fedora-2', 'single': 'value fedora-2'}
+    assert cf.build_args == {'VERSION': '2'}
+    assert cf.cmd is None
+
+
+def test_parse_immutable():
+    cf = parser.parse('FROM fedora\nLABEL a=b\n')
+
+    with pytest.raises(dataclasses.FrozenInstanceError):
+        cf.cmd = 'true'
+    with pytest.raises(TypeError):
+        cf.labels['a'] = 'c'
+
+
+def test_parse_key_values_err():
+    with pytest.raises(errors.PBError):
+        parser.parse('FROM fedora\nLABEL a=b c\n')
+
+
+@pytest.mark.parametrize('value,expected', [
+    ('a b  c', ['a', 'b', 'c']),
+    ('"a b" c', ['a b', 'c']),
+    ("'a \\b' c\\ d", ['a \\b', 'c d']),
+    ('"a\\"b"', ['a"b']),
+])
+def test_split_words(value, expected):
+    assert list(parser.split_words(value)) == expected
+
+
+def test_split_words_substitution():
+    words = parser.split_words('$A ${B}x \'$A\' "$A" \\$A', args={'B': 'b'}, envs={'A': 'a'})
+
+    assert list(words) == ['a', 'bx', '$A', 'a', '$A']
+
+
+def test_parse_stage_graph():
+    content = '\n'.join([
+        'ARG BASE=fedora',
+        'FROM $BASE:39 AS Build',
+        'RUN make',
+        'FROM alpine AS tools',
+        '# no dependency',
+        'FROM build AS test',
+        'COPY --from=tools /bin/lint /bin/',
+        'COPY --from=busybox:latest /bin/sh /bin/',
+        'FROM scratch',
+        'COPY --chown=0:0 --from=0 /out /',
+        'COPY --from=later /x /',
+        ''
+    ])
+    cf = parser.parse(content)
+
+    assert [(s.index, s.name, s.base, s.start, s.end) for s in cf.stages] == [
+        (0, 'build', 'fedora:39', 1, 3),
+        (1, 'tools', 'alpine', 3, 5),
+        (2, 'test', None, 5, 8),
+        (3, None, 'scratch', 8, 11),
+    ]
+    assert [(s.depends, s.images) for s in cf.stages] == [
+        ((), ()), ((), ()), ((0, 1), ('busybox:latest',)), ((0,), ('later',)),
+    ]
+    assert cf.stage('BUILD') is cf.stages[0]
+    assert cf.stage('3') is cf.stages[3]
+    assert cf.stage('missing') is None
+    assert parser.copy_from('--chown=1 --from="tools" a b') == 'tools'
+    assert parser.copy_from('a --from=b c') is None
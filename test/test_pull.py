@@ -0,0 +1,94 @@
+import io
+import json
+import hashlib
+import tarfile
+
+import requests_mock
+
+from pkgbox import extract, pull
+from pkgbox.oci.v1 import Descriptor
+from pkgbox.store import BlobStore
+
+
+def _manifest(name, tag, blobs):
+    return json.dumps({
+        'schemaVersion': 1,
+        'name': name,
+        'tag': tag,
+        'architecture': 'amd64',
+        'fsLayers': [{'blobSum': 'sha256:' + hashlib.sha256(b).hexdigest()} for b in blobs],
+        'history': [],
+        'signatures': []
+    })
+
+
+def _mock_image(m, name, tag, blobs):
+    base = f'https://registry.fedoraproject.org/v2/{name}'
+    manifest = _manifest(name, tag, blobs)
+    m.get(f'{base}/manifests/{tag}', text=manifest,
+          headers={'docker-content-digest': 'sha256:' + hashlib.sha256(manifest.encode()).hexdigest()})
+    for blob in blobs:
+        m.get(f'{base}/blobs/sha256:{hashlib.sha256(blob).hexdigest()}', content=blob)
+
+
+def test_pull_dedup(tmp_path):
+    store = BlobStore(tmp_path / 'store')
+    base, app, tools = b'base' * 256, b'app' * 100, b'tools' * 50
+
+    with requests_mock.Mocker() as m:
+        _mock_image(m, 'fedora', '39', [base])
+        _mock_image(m, 'app', 'latest', [base, app])
+        _mock_image(m, 'tools', 'latest', [base, app, tools])
+        summary = pull.pull([
+            'registry.fedoraproject.org/fedora:39',
+            'registry.fedoraproject.org/app:latest',
+            'registry.fedoraproject.org/tools:latest',
+        ], store, workers=3)
+
+        blob_requests = [r for r in m.request_history if '/blobs/' in r.path]
+
+    assert len(blob_requests) == 3
+    assert summary.errors == {}
+    assert len(summary.images) == 3
+    assert (summary.references, summary.unique, summary.cached, summary.downloaded) == (6, 3, 0, 3)
+    assert summary.downloaded_bytes == len(base) + len(app) + len(tools)
+    assert summary.saved_bytes == 2 * len(base) + len(app)
+    for blob in (base, app, tools):
+        assert store.path(Descriptor('sha256', hashlib.sha256(blob).hexdigest())).read_bytes() == blob
+
+
+def test_pull_cached_and_errors(tmp_path):
+    store = BlobStore(tmp_path / 'store')
+    blob = b'layer'
+
+    with requests_mock.Mocker() as m:
+        _mock_image(m, 'fedora', '39', [blob])
+        m.get('https://registry.fedoraproject.org/v2/missing/manifests/1', status_code=404)
+        pull.pull(['registry.fedoraproject.org/fedora:39'], store)
+        summary = pull.pull([
+            'registry.fedoraproject.org/fedora:39',
+            'registry.fedoraproject.org/missing:1',
+            'not-a-reference',
+        ], store)
+
+    assert summary.images == ['registry.fedoraproject.org/fedora:39']
+    assert set(summary.errors) == {'registry.fedoraproject.org/missing:1', 'not-a-reference'}
+    assert (summary.unique, summary.cached, summary.downloaded, summary.downloaded_bytes) == (1, 1, 0, 0)
+
+
+def test_pull_unpack(tmp_path):
+    store = BlobStore(tmp_path / 'store')
+    layers = extract.LayerDirs(tmp_path / 'layers')
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode='w:gz') as tar:
+        info = tarfile.TarInfo('hello')
+        info.size = 5
+        tar.addfile(info, io.BytesIO(b'world'))
+    base = buf.getvalue()
+
+    with requests_mock.Mocker() as m:
+        _mock_image(m, 'fedora', '39', [base])
+        summary = pull.pull(['registry.fedoraproject.org/fedora:39'], store, unpack=layers)
+
+    assert summary.downloaded == 1
+    assert (layers.path(Descriptor('sha256', hashlib.sha256(base).hexdigest())) / 'hello').read_bytes() == b'world'
@@ -1,3 +1,6 @@
+import errno
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
 from unittest import mock
 
 import pytest
@@ -20,7 +23,7 @@ def test_io_reader_file_err():
         r.read()
 
 
-def test_io_reader_http_ok():
+def test_io_reader_http_ok(pkgbox_home):
     r = io.HttpReader('http', 'www.pkgbox.org/Ccntainerfile')
     with requests_mock.Mocker() as m:
         m.get('http://www.pkgbox.org/Ccntainerfile', text='foobar')
@@ -28,7 +31,7 @@ def test_io_reader_http_ok():
         assert r.read() == 'foobar'
 
 
-def test_io_reader_http_err():
+def test_io_reader_http_err(pkgbox_home):
     r = io.HttpReader('http', 'www.pkgbox.org/Ccntainerfile')
     with requests_mock.Mocker() as m, pytest.raises(errors.PBError) as e:
         m.get('http://www.pkgbox.org/Ccntainerfile', status_code=404)
@@ -48,3 +51,83 @@ def test_builder_ok(scheme, path, expected):
     r = io.build_reader(scheme, path)
 
     assert type(r) == expected
+
+
+@pytest.mark.parametrize('value,expected', [
+    ('/tmp/Containerfile', ('file', '/tmp/Containerfile')),
+    ('file:///tmp/Containerfile', ('file', '/tmp/Containerfile')),
+    ('https://www.pkgbox.org/Containerfile', ('https', 'www.pkgbox.org/Containerfile')),
+])
+def test_split_uri(value, expected):
+    assert io.split_uri(value) == expected
+    assert type(io.from_uri(value)) == (io.HttpReader if expected[0] == 'https' else io.FileReader)
+
+
+def test_io_reader_http_revalidate(pkgbox_home):
+    r = io.HttpReader('https', 'www.pkgbox.org/Containerfile')
+    with requests_mock.Mocker() as m:
+        m.get('https://www.pkgbox.org/Containerfile', text='foobar', headers={'etag': '"v1"'})
+        assert r.read() == 'foobar'
+
+        m.get('https://www.pkgbox.org/Containerfile', status_code=304)
+        assert r.read() == 'foobar'
+        assert m.last_request.headers['If-None-Match'] == '"v1"'
+
+        m.get('https://www.pkgbox.org/Containerfile', text='barfoo', headers={'last-modified': 'Mon, 01 Jan 2024 00:00:00 GMT'})
+        assert r.read() == 'barfoo'
+
+        m.get('https://www.pkgbox.org/Containerfile', status_code=304)
+        assert r.read() == 'barfoo'
+        assert m.last_request.headers['If-Modified-Since'] == 'Mon, 01 Jan 2024 00:00:00 GMT'
+        assert 'If-None-Match' not in m.last_request.headers
+
+
+def test_io_reader_http_pinned(pkgbox_home):
+    digest = hashlib.sha256(b'foobar').hexdigest()
+    r = io.HttpReader('https', f'www.pkgbox.org/Containerfile#sha256={digest}')
+    with requests_mock.Mocker() as m:
+        m.get('https://www.pkgbox.org/Containerfile', text='foobar')
+        assert r.read() == 'foobar'
+        assert r.read() == 'foobar'
+        assert m.call_count == 1
+
+
+def test_io_reader_http_pinned_err(pkgbox_home):
+    r = io.HttpReader('https', f'www.pkgbox.org/Containerfile#sha256={"0" * 64}')
+    with requests_mock.Mocker() as m, pytest.raises(errors.PBDigestError):
+        m.get('https://www.pkgbox.org/Containerfile', text='foobar')
+        r.read()
+
+
+def test_io_reader_http_too_big(pkgbox_home):
+    r = io.HttpReader('https', 'www.pkgbox.org/Containerfile')
+    with requests_mock.Mocker() as m, mock.patch.object(io, 'MAX_SIZE', 4), pytest.raises(errors.PBError) as e:
+        m.get('https://www.pkgbox.org/Containerfile', text='foobar')
+        r.read()
+
+    assert e.value.errno == errno.EFBIG
+
+
+def test_io_reader_http_pinned_err_not_cached(pkgbox_home):
+    r = io.HttpReader('https', f'www.pkgbox.org/Containerfile#sha256={"0" * 64}')
+    with requests_mock.Mocker() as m, pytest.raises(errors.PBDigestError):
+        m.get('https://www.pkgbox.org/Containerfile', text='foobar')
+        r.read()
+
+    cache = io.response_cache()
+    assert cache.meta('https://www.pkgbox.org/Containerfile') is None
+    assert cache.blobs.usage() == 0
+
+
+def test_response_cache_shared(pkgbox_home):
+    assert io.response_cache() is io.response_cache()
+
+
+def test_response_cache_put_concurrent(pkgbox_home):
+    cache = io.response_cache()
+    data = b'FROM fedora\n' * 1000
+    with ThreadPoolExecutor(16) as pool:
+        digests = list(pool.map(lambda i: cache.put(f'https://www.pkgbox.org/{i}', data, {}), range(64)))
+
+    assert set(map(str, digests)) == {f'sha256:{hashlib.sha256(data).hexdigest()}'}
+    assert cache.get(digests[0]) == data
@@ -0,0 +1,184 @@
+import io
+import os
+import gzip
+import hashlib
+import tarfile
+
+import pytest
+
+from pkgbox import errors, rootfs, zstd
+from pkgbox.oci.v1 import Descriptor, Manifest
+from pkgbox.store import BlobStore
+
+
+def _layer(entries, compress=gzip.compress):
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode='w') as tar:
+        for name, kind, data in entries:
+            info = tarfile.TarInfo(name)
+            info.type = kind
+            info.mode = 0o755 if kind == tarfile.DIRTYPE else 0o644
+            info.mtime = 1000
+            if kind == tarfile.REGTYPE:
+                info.size = len(data)
+                tar.addfile(info, io.BytesIO(data))
+                continue
+            if kind in (tarfile.SYMTYPE, tarfile.LNKTYPE):
+                info.linkname = data
+            tar.addfile(info)
+    return compress(buf.getvalue())
+
+
+def _manifest(store, layers, compress=gzip.compress):
+    descs = []
+    for entries in layers:
+        blob = _layer(entries, compress)
+        desc = Descriptor('sha256', hashlib.sha256(blob).hexdigest())
+        with store.writer(desc) as w:
+            w.write(blob)
+            w.commit()
+        descs.append(desc)
+    return Manifest('test', 'latest', 'amd64', descs, [], [], descs[-1])
+
+
+def _files(root):
+    out = {}
+    for dirpath, dirnames, filenames in os.walk(root):
+        for name in dirnames + filenames:
+            path = os.path.join(dirpath, name)
+            rel = os.path.relpath(path, root)
+            if os.path.islink(path):
+                out[rel] = '-> ' + os.readlink(path)
+            elif os.path.isdir(path):
+                out[rel] = '/'
+            else:
+                with open(path, 'rb') as f:
+                    out[rel] = f.read()
+    return out
+
+
+REG, DIR, SYM, LNK = tarfile.REGTYPE, tarfile.DIRTYPE, tarfile.SYMTYPE, tarfile.LNKTYPE
+
+
+def test_assemble(tmp_path):
+    store = BlobStore(tmp_path / 'store')
+    manifest = _manifest(store, [
+        [
+            ('etc', DIR, None),
+            ('etc/os-release', REG, b'fedora 38'),
+            ('etc/passwd', REG, b'root'),
+            ('var/cache/big', REG, b'x' * 1000),
+            ('opt/app/old', REG, b'old'),
+            ('usr/lib/libc', REG, b'libc'),
+            ('lib', SYM, 'usr/lib'),
+            ('bin/tool', REG, b'tool'),
+        ],
+        [
+            ('etc/os-release', REG, b'fedora 39'),
+            ('var/.wh.cache', REG, b''),
+            ('opt/app/.wh..wh..opq', REG, b''),
+            ('opt/app/new', REG, b'new'),
+            ('lib/libm', REG, b'libm'),
+            ('bin', REG, b'not a dir anymore'),
+        ],
+        [
+            ('etc/passwd', REG, b'root\nuser'),
+            ('etc/passwd-link', LNK, 'etc/passwd'),
+        ],
+    ])
+    stats = rootfs.assemble(manifest, store, tmp_path / 'rootfs')
+
+    assert _files(tmp_path / 'rootfs') == {
+        'etc': '/',
+        'etc/os-release': b'fedora 39',
+        'etc/passwd': b'root\nuser',
+        'etc/passwd-link': b'root\nuser',
+        'var': '/',
+        'opt': '/',
+        'opt/app': '/',
+        'opt/app/new': b'new',
+        'usr': '/',
+        'usr/lib': '/',
+        'usr/lib/libc': b'libc',
+        'usr/lib/libm': b'libm',
+        'lib': '-> usr/lib',
+        'bin': b'not a dir anymore',
+    }
+    root = tmp_path / 'rootfs'
+    assert os.stat(root / 'etc' / 'passwd').st_ino == os.stat(root / 'etc' / 'passwd-link').st_ino
+    assert stats.entries == 16
+    assert stats.skipped_bytes == len(b'fedora 38root' + b'x' * 1000 + b'oldtool')
+    assert stats.written_bytes == len(b'fedora 39' + b'root\nuser' + b'new' + b'libc' + b'libm' + b'not a dir anymore')
+
+
+def test_assemble_hardlink_overwritten(tmp_path):
+    store = BlobStore(tmp_path / 'store')
+    manifest = _manifest(store, [
+        [('a', REG, b'first'), ('b', LNK, 'a')],
+        [('a', REG, b'second')],
+    ])
+    rootfs.assemble(manifest, store, tmp_path / 'rootfs', workers=1)
+
+    assert (tmp_path / 'rootfs' / 'a').read_bytes() == b'second'
+    assert (tmp_path / 'rootfs' / 'b').read_bytes() == b'first'
+
+
+def test_assemble_from_checkpoints(tmp_path, monkeypatch):
+    monkeypatch.setattr(rootfs, 'MIN_SPAN', 1)
+    monkeypatch.setattr(rootfs, 'READ_SIZE', 4096)
+    store = BlobStore(tmp_path / 'store')
+    data = {f'f{i}': os.urandom(i * 1000) for i in range(20)}
+    manifest = _manifest(store, [
+        [(name, REG, content) for name, content in data.items()],
+        [('f3', REG, b'new'), ('.wh.f5', REG, b'')],
+    ])
+
+    layer = rootfs.scan(store.path(manifest.layers[0]))
+    assert len(layer.checkpoints) > 10
+    assert [m.name for m in layer.members] == list(data)
+
+    stats = rootfs.assemble(manifest, store, tmp_path / 'rootfs')
+    data['f3'] = b'new'
+    del data['f5']
+
+    assert _files(tmp_path / 'rootfs') == data
+    assert stats.written_bytes == sum(map(len, data.values()))
+
+
+def test_assemble_zstd(tmp_path, monkeypatch):
+    monkeypatch.setattr(rootfs, 'MIN_SPAN', 1)
+    store = BlobStore(tmp_path / 'store')
+    data = {f'f{i}': os.urandom(i * 1000) for i in range(20)}
+    manifest = _manifest(store, [
+        [(name, REG, content) for name, content in data.items()],
+        [('f3', REG, b'new')],
+    ], compress=zstd.compress)
+
+    # zstd layers are only resumed from their start
+    assert len(rootfs.scan(store.path(manifest.layers[0])).checkpoints) == 1
+
+    rootfs.assemble(manifest, store, tmp_path / 'rootfs')
+    data['f3'] = b'new'
+
+    assert _files(tmp_path / 'rootfs') == data
+
+
+def test_assemble_missing_layer(tmp_path):
+    layer = Descriptor('sha256', '0' * 64)
+
+    with pytest.raises(errors.PBError) as e:
+        rootfs.assemble(Manifest('t', 'l', 'amd64', [layer], [], [], layer), BlobStore(tmp_path), tmp_path / 'r')
+
+    assert 'not in the store' in e.value.message
+
+
+def test_merge_opaque_same_layer():
+    def members(entries):
+        return [tarfile.TarInfo(n) for n in entries]
+
+    tree = rootfs.merge([
+        members(['d/lower', 'd/sub/lower']),
+        members(['d/sub/upper', 'd/.wh..wh..opq']),
+    ])
+
+    assert sorted(p for p, _ in tree.walk()) == ['d', 'd/sub', 'd/sub/upper']
@@ -0,0 +1,108 @@
+import pytest
+
+from pkgbox import errors, parser, runtime
+from pkgbox.runtime import executor
+from pkgbox.runtime.executor import BuildIndex, Executor
+from pkgbox.runtime.fake import FakeRuntime
+from pkgbox.runtime.meta import Instruction
+
+
+def _instructions(*cmds):
+    return [Instruction('FROM', 'fedora:39')] + [Instruction('RUN', c) for c in cmds]
+
+
+def _ran(rt):
+    return [i.cmd for _, i in rt.runs]
+
+
+def test_build_fake():
+    assert isinstance(runtime.build('fake'), FakeRuntime)
+
+    with pytest.raises(errors.PBNotImplementedError):
+        runtime.build('crun')
+
+
+def test_run_and_resume(tmp_path):
+    rt = FakeRuntime()
+    ex = Executor(rt, BuildIndex(tmp_path / 'index.db'))
+
+    res = ex.run('b1', _instructions('a', 'b', 'c'), base='sha256:base')
+    assert _ran(rt) == ['fedora:39', 'a', 'b', 'c']
+    assert res.cached == 0
+    assert rt.snapshots[res.snapshot] == [('FROM', 'fedora:39'), ('RUN', 'a'), ('RUN', 'b'), ('RUN', 'c')]
+    assert len(ex.index) == 4
+
+    rt.runs.clear()
+    again = ex.run('b2', _instructions('a', 'b', 'c'), base='sha256:base')
+    assert _ran(rt) == []
+    assert again.cached == 4
+    assert again.snapshot == res.snapshot
+    assert rt.builds['b2'] == rt.snapshots[res.snapshot]
+
+    # only the steps after the change run again
+    rt.runs.clear()
+    changed = ex.run('b3', _instructions('a', 'x', 'c'), base='sha256:base')
+    assert _ran(rt) == ['x', 'c']
+    assert changed.cached == 2
+    assert rt.builds['b3'] == [('FROM', 'fedora:39'), ('RUN', 'a'), ('RUN', 'x'), ('RUN', 'c')]
+
+    # a new base image invalidates every step
+    rt.runs.clear()
+    ex.run('b4', _instructions('a'), base='sha256:other')
+    assert _ran(rt) == ['fedora:39', 'a']
+
+
+def test_index_persists(tmp_path):
+    rt = FakeRuntime()
+    index = BuildIndex(tmp_path / 'index.db')
+    Executor(rt, index).run('b1', _instructions('a', 'b'))
+    index.close()
+
+    rt.runs.clear()
+    res = Executor(rt, BuildIndex(tmp_path / 'index.db')).run('b2', _instructions('a', 'b', 'c'))
+    assert _ran(rt) == ['c']
+    assert [s.cached for s in res.steps] == [True, True, True, False]
+
+
+def test_failure_resumes(tmp_path):
+    rt = FakeRuntime(failing={'b'})
+    ex = Executor(rt, BuildIndex(tmp_path / 'index.db'))
+
+    with pytest.raises(errors.PBRuntimeError):
+        ex.run('b1', _instructions('a', 'b', 'c'))
+    assert len(ex.index) == 2
+
+    rt.failing.clear()
+    rt.runs.clear()
+    ex.run('b2', _instructions('a', 'b', 'c'))
+    assert _ran(rt) == ['b', 'c']
+
+
+def test_lost_snapshot(tmp_path):
+    rt = FakeRuntime()
+    ex = Executor(rt, BuildIndex(tmp_path / 'index.db'))
+    res = ex.run('b1', _instructions('a', 'b'))
+
+    del rt.snapshots[res.steps[1].snapshot]
+    assert [s.instruction.cmd for s in ex.cached_steps(_instructions('a', 'b'))] == ['fedora:39']
+    assert ex.index.get(res.steps[1].key) is None
+
+    rt.runs.clear()
+    ex.run('b2', _instructions('a', 'b'))
+    assert _ran(rt) == ['a', 'b']
+
+
+def test_from_containerfile():
+    a = parser.parse('FROM fedora:39\n# comment\nARG V=1\nRUN   make   install V=$V\n')
+    b = parser.parse('FROM fedora:39\nARG V=1\nRUN make install V=$V\n')
+
+    instructions = executor.from_containerfile(a)
+    assert [(i.ctx, i.cmd) for i in instructions] == \
+        [('FROM', 'fedora:39'), ('ARG', 'V="1"'), ('RUN', 'make install V=1')]
+    assert [i.digest for i in instructions] == [i.digest for i in executor.from_containerfile(b)]
+
+
+def test_from_paths(tmp_path):
+    index = executor.from_paths({'data_dir': str(tmp_path)})
+    assert index.path == tmp_path / 'builds' / 'index.db'
+    assert index.path.exists()
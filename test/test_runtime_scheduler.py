@@ -0,0 +1,178 @@
+import time
+import threading
+
+import pytest
+
+from pkgbox import errors, parser
+from pkgbox.runtime import scheduler
+from pkgbox.runtime.executor import BuildIndex, Executor
+from pkgbox.runtime.fake import FakeRuntime
+from pkgbox.runtime.scheduler import Scheduler
+
+
+CONTAINERFILE = '\n'.join([
+    'FROM fedora:39 AS deps',
+    'RUN dnf install gcc',
+    'FROM deps AS build',
+    'RUN make',
+    'FROM alpine AS docs',
+    'RUN make docs',
+    'FROM fedora:39 AS lint',
+    'RUN make lint',
+    'FROM alpine AS unused',
+    'RUN sleep 1',
+    'FROM scratch',
+    'COPY --from=build /out /',
+    'COPY --from=docs /doc /doc',
+    'COPY --from=lint /report /',
+    '',
+])
+
+
+class SlowRuntime(FakeRuntime):
+    """
+    Fake runtime taking some time per instruction,
+    recording how many builds ran at once.
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.lock = threading.Lock()
+        self.active = set()
+        self.max_active = 0
+
+    def run_build_instruction(self, build_id, instruction):
+        with self.lock:
+            self.active.add(build_id)
+            self.max_active = max(self.max_active, len(self.active))
+        time.sleep(0.05)
+        try:
+            super().run_build_instruction(build_id, instruction)
+        finally:
+            with self.lock:
+                self.active.discard(build_id)
+
+
+def _resolve(ref):
+    return 'sha256:' + ref.replace(':', '-')
+
+
+def _scheduler(tmp_path, rt, **kwargs):
+    return Scheduler(Executor(rt, BuildIndex(tmp_path / 'index.db')), _resolve, **kwargs)
+
+
+def test_run(tmp_path):
+    rt = FakeRuntime()
+    build = _scheduler(tmp_path, rt).run('b1', parser.parse(CONTAINERFILE))
+
+    assert sorted(build.stages) == [0, 1, 2, 3, 5]
+    assert [s.name for s in build.skipped] == ['unused']
+    assert build.images == {'fedora:39': 'sha256:fedora-39', 'alpine': 'sha256:alpine'}
+    assert build.stages[5].base == scheduler.SCRATCH
+    assert build.snapshot == build.stages[5].snapshot
+    assert sorted(rt.builds) == ['b1', 'b1.build', 'b1.deps', 'b1.docs', 'b1.lint']
+
+    # stage references are replaced by their snapshot
+    assert rt.builds['b1.build'][0] == ('FROM', f'{build.stages[0].snapshot} AS build')
+    assert rt.builds['b1'][1] == ('COPY', f'--from={build.stages[1].snapshot} /out /')
+    assert build.stages[0].base == 'sha256:fedora-39'
+    assert build.stages[1].base == build.stages[0].snapshot
+
+
+def test_target(tmp_path):
+    rt = FakeRuntime()
+    build = _scheduler(tmp_path, rt).run('b1', parser.parse(CONTAINERFILE), target='build')
+
+    assert sorted(build.stages) == [0, 1]
+    assert sorted(rt.builds) == ['b1', 'b1.deps']
+    assert build.images == {'fedora:39': 'sha256:fedora-39'}
+
+
+@pytest.mark.parametrize('parallelism, expected', [(1, 1), (4, 3)])
+def test_parallelism(tmp_path, parallelism, expected):
+    rt = SlowRuntime()
+    _scheduler(tmp_path, rt, parallelism=parallelism).run('b1', parser.parse(CONTAINERFILE))
+
+    # deps (then build), docs and lint are independent
+    assert rt.max_active == expected
+
+
+def test_cache(tmp_path):
+    rt = FakeRuntime()
+    sched = _scheduler(tmp_path, rt)
+    first = sched.run('b1', parser.parse(CONTAINERFILE))
+
+    rt.runs.clear()
+    sched.run('b2', parser.parse(CONTAINERFILE))
+    assert rt.runs == []
+
+    # the stages depending on a changed stage run again
+    edited = CONTAINERFILE.replace('RUN make\n', 'RUN make -j4\n')
+    second = sched.run('b3', parser.parse(edited))
+    assert [(b, i.cmd) for b, i in rt.runs] == [
+        ('b3.build', 'make -j4'),
+        ('b3', f'--from={second.stages[1].snapshot} /out /'),
+        ('b3', f'--from={second.stages[2].snapshot} /doc /doc'),
+        ('b3', f'--from={second.stages[3].snapshot} /report /'),
+    ]
+    assert second.stages[2].snapshot == first.stages[2].snapshot
+    assert second.snapshot != first.snapshot
+
+
+def test_scratch(tmp_path):
+    def resolve(ref):
+        if ref == 'scratch':
+            raise errors.PBError('scratch is not an image', 22)
+        return _resolve(ref)
+
+    rt = FakeRuntime()
+    sched = Scheduler(Executor(rt, BuildIndex(tmp_path / 'index.db')), resolve)
+    build = sched.run('b1', parser.parse('FROM scratch\nCOPY --from=scratch /a /\n'))
+    assert build.images == {}
+    assert rt.builds['b1'] == [('FROM', 'scratch'), ('COPY', '--from=scratch /a /')]
+
+    # the default resolver reports invalid references as errors
+    with pytest.raises(errors.PBError) as e:
+        scheduler.registry_resolver()('scratch')
+    assert e.value.message == 'Invalid image reference "scratch"'
+
+
+def test_copy_from_image(tmp_path):
+    digests = {'nginx:latest': 'sha256:old'}
+    rt = FakeRuntime()
+    sched = _scheduler(tmp_path, rt)
+    sched.resolve = digests.__getitem__
+    cf = parser.parse('FROM scratch\nCOPY --from=nginx:latest /usr/share/nginx /\n')
+
+    first = sched.run('b1', cf)
+    assert rt.builds['b1'][1] == ('COPY', '--from=nginx:latest@sha256:old /usr/share/nginx /')
+    assert sched.run('b2', cf).stages[0].cached == 2
+
+    # a new image behind the tag runs the step again
+    digests['nginx:latest'] = 'sha256:new'
+    second = sched.run('b3', cf)
+    assert [s.cached for s in second.stages[0].steps] == [True, False]
+    assert second.snapshot != first.snapshot
+
+
+def test_resolve_first(tmp_path):
+    def resolve(ref):
+        if ref == 'alpine':
+            raise errors.PBError('manifest unknown', 2)
+        return _resolve(ref)
+
+    rt = FakeRuntime()
+    sched = Scheduler(Executor(rt, BuildIndex(tmp_path / 'index.db')), resolve)
+    with pytest.raises(errors.PBError) as e:
+        sched.run('b1', parser.parse(CONTAINERFILE))
+    assert e.value.message == 'Can not resolve images: alpine (manifest unknown)'
+    assert rt.runs == []
+
+
+def test_failure(tmp_path):
+    rt = FakeRuntime(failing={'make docs'})
+    with pytest.raises(errors.PBRuntimeError):
+        _scheduler(tmp_path, rt, parallelism=1).run('b1', parser.parse(CONTAINERFILE))
+
+    # stages are started in order: lint and the final stage never ran
+    assert 'b1.lint' not in rt.builds and 'b1' not in rt.builds
+    assert scheduler.resolve_images([], _resolve) == {}
@@ -0,0 +1,164 @@
+import os
+
+import pytest
+
+from pkgbox import errors
+from pkgbox.runtime import snapshot
+from pkgbox.runtime.executor import BuildIndex, Executor
+from pkgbox.runtime.fake import STATE_FILE, FakeRuntime
+from pkgbox.runtime.meta import Instruction
+from pkgbox.runtime.snapshot import Snapshotter
+
+
+def _rootfs(path):
+    os.makedirs(path / 'usr' / 'bin')
+    (path / 'usr' / 'bin' / 'tool').write_bytes(b'x' * 1000)
+    os.chmod(path / 'usr' / 'bin' / 'tool', 0o755)
+    (path / 'etc').mkdir()
+    (path / 'etc' / 'os-release').write_text('fedora')
+    os.symlink('usr/bin', path / 'bin')
+    os.chmod(path / 'etc', 0o555)
+
+
+def _write(snap, build_id, name, data):
+    snap.writable(build_id, name).write_text(data)
+
+
+@pytest.mark.parametrize('method', [snapshot.HARDLINK, snapshot.COPY])
+def test_clone_tree(tmp_path, method):
+    _rootfs(tmp_path / 'src')
+
+    cost = snapshot.clone_tree(tmp_path / 'src', tmp_path / 'dst', method)
+    assert cost.entries == 6
+    assert cost.bytes == (0 if method == snapshot.HARDLINK else 1006)
+
+    dst = tmp_path / 'dst'
+    assert (dst / 'usr' / 'bin' / 'tool').read_bytes() == b'x' * 1000
+    assert os.stat(dst / 'usr' / 'bin' / 'tool').st_mode & 0o777 == 0o755
+    assert os.stat(dst / 'etc').st_mode & 0o777 == 0o555
+    assert os.readlink(dst / 'bin') == 'usr/bin'
+    linked = os.stat(dst / 'etc' / 'os-release').st_ino == os.stat(tmp_path / 'src' / 'etc' / 'os-release').st_ino
+    assert linked == (method == snapshot.HARDLINK)
+
+
+@pytest.mark.parametrize('method', [snapshot.REFLINK, snapshot.COPY])
+def test_clone_tree_hardlinks(tmp_path, method):
+    _rootfs(tmp_path / 'src')
+    os.link(tmp_path / 'src' / 'usr' / 'bin' / 'tool', tmp_path / 'src' / 'bin-tool')
+
+    cost = snapshot.clone_tree(tmp_path / 'src', tmp_path / 'dst', method)
+    if not snapshot.reflink_supported(tmp_path):
+        # the linked file is copied once
+        assert cost.bytes == 1006
+    tool, link = os.stat(tmp_path / 'dst' / 'usr' / 'bin' / 'tool'), os.stat(tmp_path / 'dst' / 'bin-tool')
+    assert tool.st_ino == link.st_ino and tool.st_nlink == 2
+    assert tool.st_ino != os.stat(tmp_path / 'src' / 'bin-tool').st_ino
+
+
+def test_reflink_fallback(tmp_path):
+    # copied where the filesystem has no reflink support
+    _rootfs(tmp_path / 'src')
+    cost = snapshot.clone_tree(tmp_path / 'src', tmp_path / 'dst', snapshot.REFLINK)
+    expected = 0 if snapshot.reflink_supported(tmp_path) else 1006
+    assert cost.bytes == expected
+    assert (tmp_path / 'dst' / 'etc' / 'os-release').read_text() == 'fedora'
+
+
+@pytest.mark.parametrize('method', [snapshot.HARDLINK, snapshot.COPY, snapshot.OVERLAY])
+def test_snapshots(tmp_path, method):
+    snap = Snapshotter(tmp_path, method)
+    snap.prepare('b1')
+    _write(snap, 'b1', 'etc/os-release', 'fedora')
+    first = snap.snapshot('b1')
+
+    _write(snap, 'b1', 'etc/os-release', 'rhel')
+    _write(snap, 'b1', 'etc/hostname', 'box')
+    second = snap.snapshot('b1')
+
+    assert snap.has_snapshot(first) and snap.has_snapshot(second)
+    assert not snap.has_snapshot('nope')
+    assert snap.path('b1', 'etc/os-release').read_text() == 'rhel'
+
+    # writing after a snapshot does not change it
+    snap.restore('b2', first)
+    assert snap.path('b2', 'etc/os-release').read_text() == 'fedora'
+    assert snap.path('b2', 'etc/hostname') is None
+    _write(snap, 'b2', 'etc/os-release', 'debian')
+
+    snap.restore('b3', first)
+    assert snap.path('b3', 'etc/os-release').read_text() == 'fedora'
+    snap.restore('b3', second)
+    assert snap.path('b3', 'etc/hostname').read_text() == 'box'
+
+    cost = snap.cost(second)
+    assert cost.method == method
+    assert cost.elapsed > 0
+    if method == snapshot.OVERLAY:
+        assert cost.bytes == len('rhel') + len('box')
+    elif method == snapshot.HARDLINK:
+        assert cost.bytes == 0
+
+
+def test_overlay_mount_options(tmp_path):
+    snap = Snapshotter(tmp_path, snapshot.OVERLAY)
+    snap.prepare('b1')
+    assert snap.mount_options('b1').startswith(f'lowerdir={tmp_path / "empty"},upperdir=')
+
+    first = snap.snapshot('b1')
+    second = snap.snapshot('b1')
+    lowers = [tmp_path / 'snapshots' / s / 'fs' for s in (second, first)]
+    assert snap.lowers('b1') == lowers
+    assert snap.mount_options('b1') == \
+        f'lowerdir={lowers[0]}:{lowers[1]},upperdir={tmp_path}/active/b1/upper,workdir={tmp_path}/active/b1/work'
+    assert snap.rootfs('b1') == tmp_path / 'active' / 'b1' / 'merged'
+
+    # whiteouts hide lower files, when they can be created
+    _write(snap, 'b1', 'etc/gone', 'x')
+    snap.snapshot('b1')
+    os.mkdir(tmp_path / 'active' / 'b1' / 'upper' / 'etc')
+    try:
+        os.mknod(tmp_path / 'active' / 'b1' / 'upper' / 'etc' / 'gone', 0o600 | 0o020000, 0)
+    except PermissionError:
+        return
+    assert snap.path('b1', 'etc/gone') is None
+
+
+def test_errors(tmp_path):
+    with pytest.raises(errors.PBError) as e:
+        Snapshotter(tmp_path, 'zfs')
+    assert 'Unknown snapshot method' in e.value.message
+
+    snap = Snapshotter(tmp_path, snapshot.COPY)
+    with pytest.raises(errors.PBError):
+        snap.restore('b1', 'nope')
+    with pytest.raises(errors.PBError):
+        snap.mount_options('b1')
+
+    snap.prepare('b1')
+    copied = snap.snapshot('b1')
+    with pytest.raises(errors.PBError):
+        Snapshotter(tmp_path, snapshot.OVERLAY).restore('b2', copied)
+
+
+def test_default_method(tmp_path):
+    expected = snapshot.REFLINK if snapshot.reflink_supported(tmp_path) else snapshot.HARDLINK
+    assert Snapshotter(tmp_path).method == expected
+    assert snapshot.from_paths({'data_dir': str(tmp_path)}).root == tmp_path / 'builds' / 'rootfs'
+
+
+@pytest.mark.parametrize('method', [snapshot.HARDLINK, snapshot.OVERLAY])
+def test_executor(tmp_path, method):
+    rt = FakeRuntime(snapshotter=Snapshotter(tmp_path / 'rootfs', method))
+    ex = Executor(rt, BuildIndex(tmp_path / 'index.db'))
+    steps = [Instruction('FROM', 'fedora:39'), Instruction('RUN', 'a'), Instruction('RUN', 'b')]
+
+    first = ex.run('b1', steps)
+    rt.runs.clear()
+    res = ex.run('b2', steps[:2] + [Instruction('RUN', 'c')])
+    assert [i.cmd for _, i in rt.runs] == ['c']
+    assert rt.builds['b2'] == [('FROM', 'fedora:39'), ('RUN', 'a'), ('RUN', 'c')]
+
+    # the snapshots of the first build were left untouched
+    rt.snapshotter.restore('b3', first.snapshot)
+    assert '"b"' in rt.snapshotter.path('b3', STATE_FILE).read_text()
+    assert res.steps[1].snapshot == first.steps[1].snapshot
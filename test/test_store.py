@@ -0,0 +1,194 @@
+import os
+import errno
+import hashlib
+from unittest import mock
+
+import pytest
+
+from pkgbox import errors, store
+from pkgbox.oci.v1 import Descriptor
+
+
+def _desc(data: bytes) -> Descriptor:
+    return Descriptor('sha256', hashlib.sha256(data).hexdigest())
+
+
+def test_commit_ok(tmp_path):
+    s = store.BlobStore(tmp_path)
+    desc = _desc(b'foobar')
+
+    assert not s.exists(desc)
+
+    with s.writer(desc) as w:
+        w.write(b'foo')
+        w.write(b'bar')
+        path = w.commit()
+
+    assert path == tmp_path / 'blobs' / 'sha256' / desc.digest
+    assert path.read_bytes() == b'foobar'
+    assert s.exists(desc)
+    assert s.size(desc) == 6
+    assert os.listdir(s.partial_dir) == []
+
+
+def test_commit_digest_err(tmp_path):
+    s = store.BlobStore(tmp_path)
+    desc = _desc(b'foobar')
+
+    with pytest.raises(errors.PBDigestError) as e, s.writer(desc) as w:
+        w.write(b'foo')
+        w.commit()
+
+    assert e.value.errno == errno.EBADMSG
+    assert not s.exists(desc)
+    assert not s.path(desc).exists()
+    assert os.listdir(s.partial_dir) == []
+
+
+def test_resume_on_error(tmp_path):
+    s = store.BlobStore(tmp_path)
+    desc = _desc(b'foobar')
+
+    with pytest.raises(RuntimeError), s.writer(desc) as w:
+        w.write(b'foo')
+        raise RuntimeError()
+
+    assert not s.exists(desc)
+
+    with s.writer(desc) as w:
+        assert w.size == 3
+        w.write(b'bar')
+        w.commit()
+
+    assert s.path(desc).read_bytes() == b'foobar'
+    assert os.listdir(s.partial_dir) == []
+
+
+def test_resume_from_checkpoint(tmp_path):
+    s = store.BlobStore(tmp_path)
+    desc = _desc(b'foobar')
+
+    with s.writer(desc) as w:
+        w.write(b'foo')
+
+    # bytes written after the last checkpoint are not trusted
+    with open(s.partial_dir / desc.digest, 'ab') as f:
+        f.write(b'garbage')
+
+    with s.writer(desc) as w:
+        assert w.size == 3
+        w.write(b'bar')
+        w.commit()
+
+    assert s.path(desc).read_bytes() == b'foobar'
+
+
+def test_reset(tmp_path):
+    s = store.BlobStore(tmp_path)
+    desc = _desc(b'foobar')
+
+    with s.writer(desc) as w:
+        w.write(b'xxx')
+
+    with s.writer(desc) as w:
+        w.reset()
+        w.write(b'foobar')
+        w.commit()
+
+    assert s.path(desc).read_bytes() == b'foobar'
+
+
+def test_unindexed_blob_not_trusted(tmp_path):
+    s = store.BlobStore(tmp_path)
+    desc = _desc(b'foobar')
+    path = s.path(desc)
+    path.parent.mkdir(parents=True)
+    path.write_bytes(b'foo')
+
+    assert not s.exists(desc)
+
+
+def test_index_shared(tmp_path):
+    s1 = store.BlobStore(tmp_path)
+    s2 = store.BlobStore(tmp_path)
+    desc = _desc(b'foobar')
+
+    with s1.writer(desc) as w:
+        w.write(b'foobar')
+        w.commit()
+
+    assert s2.exists(desc)
+    assert store.BlobStore(tmp_path).size(desc) == 6
+
+
+def _add(s, data):
+    desc = _desc(data)
+    with s.writer(desc) as w:
+        w.write(data)
+        w.commit()
+    return desc
+
+
+def test_remove_compact(tmp_path):
+    s = store.BlobStore(tmp_path)
+    other = store.BlobStore(tmp_path)
+    keep, drop = _add(s, b'keep'), _add(s, b'drop')
+
+    assert other.usage() == 8
+
+    s.remove(drop)
+
+    assert not s.path(drop).exists()
+    assert not other.exists(drop)
+    assert other.usage() == 4
+
+    s.compact()
+
+    assert s.index_path.read_text().splitlines()[1:] == [f'{keep} 4']
+    assert other.blobs() == {str(keep): 4}
+    assert store.BlobStore(tmp_path).blobs() == {str(keep): 4}
+
+
+def test_touch(tmp_path):
+    s = store.BlobStore(tmp_path)
+    desc = _add(s, b'foobar')
+    committed = s.last_access(desc)
+
+    assert committed > 0
+
+    s.touch(desc)
+    with open(s.access_path) as f:
+        assert len(f.readlines()) == 1
+
+    with mock.patch('time.time', return_value=committed + store.ACCESS_RESOLUTION + 1):
+        s.touch(desc)
+
+    assert store.BlobStore(tmp_path).last_access(desc) == round(committed + store.ACCESS_RESOLUTION + 1)
+
+
+def test_from_paths(tmp_path):
+    s = store.from_paths({'config_dir': f'{tmp_path}/config', 'data_dir': f'{tmp_path}/data'})
+
+    assert s.root == tmp_path / 'data' / 'oci-layers'
+
+
+def test_new_writer(tmp_path):
+    s = store.BlobStore(tmp_path)
+    desc = _desc(b'foobar')
+
+    with s.new_writer() as w:
+        w.write(b'foo')
+        w.write(b'bar')
+        path = w.commit()
+    assert w.desc == desc
+    assert path.read_bytes() == b'foobar'
+    assert s.size(desc) == 6
+
+    # already in the store
+    with s.new_writer() as w:
+        w.write(b'foobar')
+        assert w.commit() == path
+
+    with s.new_writer() as w:
+        w.write(b'discarded')
+    assert os.listdir(s.partial_dir) == []
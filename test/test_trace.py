@@ -0,0 +1,125 @@
+import json
+import hashlib
+
+import pytest
+import requests_mock
+
+from pkgbox import batch, image, trace
+from pkgbox.cli import cli
+from pkgbox.oci.v1 import Descriptor, Manifest
+from pkgbox.store import BlobStore
+
+
+@pytest.fixture
+def tracer():
+    tracer = trace.enable()
+    yield tracer
+    trace.disable()
+
+
+def test_disabled():
+    assert not trace.enabled()
+    with trace.span('test.span', bytes=1) as span:
+        span.set(bytes=2)
+    trace.event('test.event')
+
+    assert trace.disable() is None
+
+
+def test_spans(tracer):
+    @trace.traced('test.func')
+    def func(n):
+        return n * 2
+
+    with trace.span('test.download', layer='a') as span:
+        assert func(21) == 42
+        span.set(bytes=1024 * 1024)
+    with trace.span('test.download', layer='b', bytes=1024 * 1024):
+        pass
+    with pytest.raises(ValueError):
+        with trace.span('test.error'):
+            raise ValueError()
+    trace.event('test.cache.hit')
+
+    events = {e['name']: e for e in tracer.events}
+    assert set(events) == {'test.func', 'test.download', 'test.error', 'test.cache.hit'}
+    assert events['test.func']['ph'] == 'X'
+    assert events['test.func']['cat'] == 'test'
+    assert events['test.error']['args'] == {'error': 'ValueError'}
+    assert events['test.cache.hit']['ph'] == 'i'
+
+    stats = {s.name: s for s in tracer.summary()}
+    assert stats['test.download'].count == 2
+    assert stats['test.download'].bytes == 2 * 1024 * 1024
+    assert stats['test.download'].throughput > 0
+    assert stats['test.cache.hit'].count == 1
+    assert not stats['test.cache.hit'].spans
+
+    table = trace.format_summary(tracer.summary()).splitlines()
+    assert table[0].split() == ['name', 'count', 'total', 'ms', 'mean', 'ms', 'max', 'ms', 'MiB', 'MiB/s']
+    assert len(table) == 5
+
+
+def test_chrome(tracer, tmp_path):
+    with trace.span('test.outer'):
+        with trace.span('test.inner'):
+            pass
+
+    tracer.write(tmp_path / 'trace.json')
+    data = json.loads((tmp_path / 'trace.json').read_text())
+    events = data['traceEvents']
+
+    assert events[0]['ph'] == 'M'
+    assert events[0]['args'] == {'name': 'MainThread'}
+    outer, inner = events[1:]
+    assert (outer['name'], inner['name']) == ('test.outer', 'test.inner')
+    assert outer['ts'] <= inner['ts']
+    assert inner['ts'] + inner['dur'] <= outer['ts'] + outer['dur']
+
+
+def test_fetch_instrumented(tracer, tmp_path):
+    store = BlobStore(tmp_path)
+    img = image.from_str('registry.fedoraproject.org/fedora:39')
+    blobs = [b'layer' * 1000, b'other']
+    layers = [Descriptor('sha256', hashlib.sha256(b).hexdigest()) for b in blobs]
+
+    with requests_mock.Mocker() as m:
+        m.get(f'https://registry.fedoraproject.org/v2/fedora/blobs/{layers[0]}', content=blobs[0])
+        m.get(f'https://registry.fedoraproject.org/v2/fedora/blobs/{layers[1]}', content=blobs[1])
+        image.fetch(img, Manifest('fedora', '39', 'amd64', layers, [], [], layers[0]), store, workers=1)
+        image.fetch(img, Manifest('fedora', '39', 'amd64', layers[:1], [], [], layers[0]), store)
+
+    downloads = [e for e in tracer.events if e['name'] == 'image.download']
+    assert {e['args']['layer']: e['args']['bytes'] for e in downloads} == {
+        str(layers[0]): len(blobs[0]),
+        str(layers[1]): len(blobs[1]),
+    }
+    assert [e['args']['layer'] for e in tracer.events if e['name'] == 'image.layer.cached'] == [str(layers[0])]
+
+
+def test_batch_workers(tracer, tmp_path):
+    sources = []
+    for i in range(4):
+        path = tmp_path / f'{i}.Containerfile'
+        path.write_text(f'FROM image{i}\nRUN true\n')
+        sources.append(str(path))
+
+    assert len(list(batch.run(sources, jobs=2))) == 4
+
+    parsed = [e for e in tracer.events if e['name'] == 'containerfile.parse']
+    assert len(parsed) == 4
+    assert all(e['pid'] != tracer.events[0]['pid'] for e in parsed)
+
+
+def test_cli(clirunner, tmp_path):
+    path = tmp_path / 'Containerfile'
+    path.write_text('FROM fedora:39\nRUN true\n')
+
+    res = clirunner.invoke(cli, ['--trace', str(tmp_path / 'trace.json'), '--stats', 'build', str(path)])
+
+    assert res.exit_code == 0
+    assert not trace.enabled()
+    names = {e['name'] for e in json.loads((tmp_path / 'trace.json').read_text())['traceEvents']}
+    assert {'io.read', 'containerfile.parse', 'containerfile.digest'} <= names
+    assert 'containerfile.parse ' in res.stderr
+    assert json.loads(res.stdout)['from'] == 'fedora:39'
@@ -0,0 +1,67 @@
+import io
+import os
+
+import pytest
+
+from pkgbox import errors, zstd
+
+
+DATA = os.urandom(300000) + bytes(3000000)
+
+
+def test_roundtrip():
+    blob = zstd.compress(DATA)
+
+    assert blob.startswith(zstd.MAGIC)
+    assert len(blob) < len(DATA) / 5
+    assert zstd.decompress(blob) == DATA
+    # concatenated frames are a single stream
+    assert zstd.decompress(blob + zstd.compress(b'end')) == DATA + b'end'
+
+
+def test_streaming():
+    c = zstd.Compressor(level=1, workers=2)
+    blob = b''.join(c.compress(DATA[i:i + 100000]) for i in range(0, len(DATA), 100000)) + c.flush()
+
+    d = zstd.Decompressor()
+    out = b''.join(d.decompress(blob[i:i + 777]) for i in range(0, len(blob), 777))
+
+    assert out == DATA
+    assert d.eof
+    assert d.unused_data == b''
+
+
+def test_reader():
+    f = io.BytesIO(zstd.compress(DATA))
+    with zstd.reader(f, closefd=False) as r:
+        assert r.read(10) == DATA[:10]
+        assert r.read() == DATA[10:]
+
+    assert not f.closed
+
+
+def test_truncated():
+    blob = zstd.compress(DATA)
+
+    with pytest.raises(errors.PBError) as e:
+        zstd.decompress(blob[:-10])
+    assert e.value.message == 'Truncated zstd data'
+
+    with pytest.raises(errors.PBError):
+        zstd.reader(io.BytesIO(blob[:len(blob) // 2])).read()
+
+
+def test_invalid():
+    with pytest.raises(errors.PBError) as e:
+        zstd.decompress(zstd.MAGIC + b'garbage' * 10)
+
+    assert e.value.message.startswith('Invalid zstd data')
+
+
+def test_copy():
+    d = zstd.Decompressor()
+    assert d.copy().decompress(zstd.compress(b'data')) == b'data'
+
+    d.decompress(zstd.compress(b'data'))
+    with pytest.raises(errors.PBError):
+        d.copy()